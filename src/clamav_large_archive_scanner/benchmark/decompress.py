@@ -0,0 +1,240 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Times reading a compressed tar in each of compressed_stream's modes, for TGZs written by gzip and written as BGZF,
+# and for TZSTs, TXZs and TBZ2s. TXZs are written by xz in 16MiB blocks, and TZSTs by pzstd, where those are on the
+# PATH, so that they can be decompressed on several threads
+# Every member is read through archive_members, the same way that the unpack handlers read them
+#
+# python -m clamav_large_archive_scanner.benchmark.decompress --size 4G --compression xz
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import time
+import zlib
+
+import click
+import humanize
+
+import clamav_large_archive_scanner.lib.archive_members as archive_members
+import clamav_large_archive_scanner.lib.compressed_stream as compressed_stream
+from clamav_large_archive_scanner.lib.file_data import FileType
+from clamav_large_archive_scanner.lib.filesize import convert_human_to_machine_bytes
+
+DEFAULT_SIZE = '1G'
+MEMBER_SIZE = 16 * 1024 * 1024
+# How much data goes into each BGZF block, same as bgzip
+BGZF_BLOCK_SIZE = 0xff00
+# The empty block that BGZF streams end with
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# What each kind of archive is compressed with, BGZF is a kind of gzip
+KINDS = {
+    'gzip': compressed_stream.GZIP,
+    'bgzf': compressed_stream.GZIP,
+    'zstd': compressed_stream.ZSTD,
+    'xz': compressed_stream.XZ,
+    'bzip2': compressed_stream.BZIP2,
+}
+FILE_TYPES = {
+    compressed_stream.GZIP: FileType.TARGZ,
+    compressed_stream.ZSTD: FileType.TARZST,
+    compressed_stream.XZ: FileType.TARXZ,
+    compressed_stream.BZIP2: FileType.TARBZ2,
+}
+DEFAULT_KINDS = ['gzip', 'bgzf']
+
+
+def _make_member_data() -> bytes:
+    # Text made of a few words, so that it compresses about as well as text does, rather than down to nothing
+    words = [b'some', b'member', b'data', b'archive', b'scanner', b'nested', b'file', b'clamd']
+    generator = random.Random(MEMBER_SIZE)
+    return b' '.join(generator.choice(words) for _ in range(MEMBER_SIZE // 5))[:MEMBER_SIZE]
+
+
+class _BgzfWriter(io.RawIOBase):
+    # Same as bgzip, a gzip member for every BGZF_BLOCK_SIZE of data, each one saying how big it is in its extra field
+
+    def __init__(self, f):
+        super().__init__()
+        self._f = f
+        self._pending = b''
+
+    def writable(self) -> bool:
+        return True
+
+    def _write_block(self, block: bytes) -> None:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(block) + compressor.flush()
+        header = struct.pack('<2sBBLBBH2sHH', b'\x1f\x8b', 8, 4, 0, 0, 255, 6, b'BC', 2, 18 + len(deflated) + 8 - 1)
+        self._f.write(header + deflated + struct.pack('<2L', zlib.crc32(block), len(block)))
+
+    def write(self, data) -> int:
+        self._pending += bytes(data)
+        while len(self._pending) >= BGZF_BLOCK_SIZE:
+            self._write_block(self._pending[:BGZF_BLOCK_SIZE])
+            self._pending = self._pending[BGZF_BLOCK_SIZE:]
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            if len(self._pending) > 0:
+                self._write_block(self._pending)
+            self._f.write(BGZF_EOF)
+        super().close()
+
+
+def _write_tar(f, size: int) -> None:
+    # size bytes of members, MEMBER_SIZE each
+    data = _make_member_data()
+    with tarfile.open(fileobj=f, mode='w|') as tar:
+        for index in range((size + MEMBER_SIZE - 1) // MEMBER_SIZE):
+            tar_info = tarfile.TarInfo(f'dir_{index // 100}/file_{index}')
+            tar_info.size = len(data)
+            tar.addfile(tar_info, io.BytesIO(data))
+
+
+def _compress_command(kind: str) -> list[str]:
+    # None of Python's compressors write anything that can be decompressed on several threads
+    if kind == 'xz' and shutil.which('xz') is not None:
+        return ['xz', '-6', '-T0', '--block-size=16MiB', '-c']
+    elif kind == 'zstd':
+        return [next((x for x in ['pzstd', 'zstd'] if shutil.which(x) is not None), 'zstd'), '-q', '-c']
+    return []
+
+
+def _make_archive(path: str, size: int, kind: str) -> None:
+    """
+    Writes a compressed tar with size bytes of members in it, compressed the way kind says to
+    """
+
+    with open(path, 'wb') as f:
+        command = _compress_command(kind)
+        if len(command) > 0:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=f)
+            with process.stdin:
+                _write_tar(process.stdin, size)
+            if process.wait() != 0:
+                raise click.ClickException(f'{command[0]} exited with {process.returncode}')
+            return
+
+        if kind == 'bgzf':
+            compressed = _BgzfWriter(f)
+        elif kind == 'xz':
+            compressed = lzma.LZMAFile(f, 'wb', preset=6)
+        elif kind == 'bzip2':
+            compressed = bz2.BZ2File(f, 'wb', compresslevel=9)
+        else:
+            compressed = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+
+        with compressed:
+            _write_tar(compressed, size)
+
+
+def _read_archive(path: str, filetype: FileType, dest_dir: str) -> None:
+    """
+    :param dest_dir: If set, the members are written out here, the way they are unpacked, otherwise they are just read
+    """
+
+    for member in archive_members.iter_members(path, filetype):
+        if dest_dir is not None:
+            archive_members.extract_member(member, os.path.join(dest_dir, member.safe_relative_path()))
+        else:
+            for _ in member.iter_chunks():
+                pass
+
+
+@click.command()
+@click.option('--size', default=DEFAULT_SIZE, type=str,
+              help=f'How much data to put in the generated archives, before it is compressed '
+                   f'(default: {DEFAULT_SIZE}).')
+@click.option('--tmp-dir', default='/tmp', type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help='Where to generate the archives (default: /tmp).')
+@click.option('--compression', 'kinds', multiple=True, type=click.Choice(list(KINDS.keys())),
+              help=f'Only time archives compressed like this, can be given more than once '
+                   f'(default: {", ".join(DEFAULT_KINDS)}).')
+@click.option('--mode', 'mode_names', multiple=True, type=click.Choice(compressed_stream.DECOMPRESS_MODES),
+              help='Only time these modes, can be given more than once (default: all of them, external only if there '
+                   'is a tool on the PATH for the compression).')
+@click.option('--extract', is_flag=True, default=False,
+              help='Write the members out to the tmp dir, instead of only reading them.')
+def decompress_benchmark(size, tmp_dir, kinds, mode_names, extract):
+    size = int(convert_human_to_machine_bytes(size))
+    if 'zstd' in kinds and shutil.which('pzstd') is None and shutil.which('zstd') is None:
+        raise click.ClickException('Neither pzstd nor zstd are on the PATH, to write the TZST with')
+
+    root = tempfile.mkdtemp(prefix='clam_unpacker_decompress_benchmark_', dir=tmp_dir)
+    try:
+        for kind in kinds or DEFAULT_KINDS:
+            compression = KINDS[kind]
+            tool = compressed_stream.find_external_tool(compression)
+            if len(mode_names) > 0 and compressed_stream.DECOMPRESS_MODE_EXTERNAL in mode_names and tool is None:
+                raise click.ClickException(f'None of {", ".join(compressed_stream.EXTERNAL_TOOLS[compression])} '
+                                           f'are on the PATH')
+            modes = mode_names or [x for x in compressed_stream.DECOMPRESS_MODES
+                                   if x != compressed_stream.DECOMPRESS_MODE_EXTERNAL or tool is not None]
+
+            path = os.path.join(root, f'benchmark_{kind}.tar')
+            click.echo(f'Generating a {kind} archive with {humanize.naturalsize(size, binary=True)} in it in {root}')
+            _make_archive(path, size, kind)
+            compressed_size = os.path.getsize(path)
+
+            baseline = None
+            for mode in modes:
+                compressed_stream.use_mode(mode)
+                dest_dir = os.path.join(root, 'extracted') if extract else None
+                start = time.perf_counter()
+                _read_archive(path, FILE_TYPES[compression], dest_dir)
+                elapsed = time.perf_counter() - start
+                if dest_dir is not None:
+                    shutil.rmtree(dest_dir, ignore_errors=True)
+
+                baseline = baseline or elapsed
+                name = f'{kind} {mode}' + (f' ({tool})' if mode == compressed_stream.DECOMPRESS_MODE_EXTERNAL else '')
+                click.echo(f'{name:24} {elapsed:8.2f}s '
+                           f'{humanize.naturalsize(size / elapsed, binary=True):>12}/s out '
+                           f'{humanize.naturalsize(compressed_size / elapsed, binary=True):>12}/s in '
+                           f'{baseline / elapsed:6.2f}x')
+
+            os.remove(path)
+    finally:
+        compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_PYTHON)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    decompress_benchmark()
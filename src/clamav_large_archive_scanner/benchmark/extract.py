@@ -0,0 +1,203 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Tracks the peak RSS of extracting a TAR, TGZ or ZIP against how many members it has
+# Compares shutil.unpack_archive, which goes through tarfile.extractall or zipfile.extractall, with extracting one member
+# at a time, and for ZIPs, with splitting the members up between processes
+#
+# python -m clamav_large_archive_scanner.benchmark.extract --members 100000 --members 1000000
+# python -m clamav_large_archive_scanner.benchmark.extract --filetype zip --members 20000 --member-size 65536
+
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import Callable
+
+import click
+import humanize
+
+import clamav_large_archive_scanner.lib.archive_members as archive_members
+from clamav_large_archive_scanner.lib.file_data import FileType
+
+FILES_PER_DIR = 1000
+DEFAULT_MEMBER_COUNTS = (10000, 100000, 1000000)
+DEFAULT_MEMBER_SIZE = 16
+
+# shutil.unpack_archive formats for each of the file types it benchmarks
+SHUTIL_FORMATS = {
+    FileType.TAR: 'tar',
+    FileType.TARGZ: 'gztar',
+    FileType.ZIP: 'zip',
+}
+
+
+def _make_member_data(member_size: int) -> bytes:
+    # Text made of a few words, so that it compresses about as well as text does, rather than down to nothing
+    words = [b'some', b'member', b'data', b'archive', b'scanner', b'nested', b'file', b'clamd']
+    generator = random.Random(member_size)
+    data = b''
+    while len(data) < member_size:
+        data += generator.choice(words) + b' '
+    return data[:member_size]
+
+
+def _make_tar(path: str, filetype: FileType, member_count: int, data: bytes) -> None:
+    """
+    Writes a tar with member_count files of data in it, FILES_PER_DIR to a directory
+    """
+
+    with tarfile.open(path, 'w:gz' if filetype == FileType.TARGZ else 'w') as tar:
+        for index in range(member_count):
+            tar_info = tarfile.TarInfo(f'dir_{index // FILES_PER_DIR}/file_{index}')
+            tar_info.size = len(data)
+            tar.addfile(tar_info, io.BytesIO(data))
+            # Writing holds on to every TarInfo as well, which would only skew what the extractions start out with
+            tar.members.clear()
+
+
+def _make_zip(path: str, member_count: int, data: bytes) -> None:
+    """
+    Writes a zip with member_count deflated files of data in it, FILES_PER_DIR to a directory
+    """
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for index in range(member_count):
+            zip_file.writestr(f'dir_{index // FILES_PER_DIR}/file_{index}', data)
+
+
+def _make_archive(path: str, filetype: FileType, member_count: int, member_size: int) -> None:
+    # Runs in a process of its own as well, zipfile has to hold on to every ZipInfo until it writes the central
+    # directory, and whatever it doesn't give back would otherwise be counted against every extraction forked after it
+    data = _make_member_data(member_size)
+    if filetype == FileType.ZIP:
+        _make_zip(path, member_count, data)
+    else:
+        _make_tar(path, filetype, member_count, data)
+
+
+def _shutil_unpack_archive(path: str, filetype: FileType, dest_dir: str) -> None:
+    # How TARs, TGZs and ZIPs were extracted originally
+    shutil.unpack_archive(path, dest_dir, format=SHUTIL_FORMATS[filetype])
+
+
+def _extract_members(path: str, filetype: FileType, dest_dir: str) -> None:
+    # What TarFileUnpackHandler and ZipFileUnpackHandler do, without the nested archive checks
+    for member in archive_members.iter_members(path, filetype):
+        archive_members.extract_member(member, os.path.join(dest_dir, member.safe_relative_path()))
+
+
+def _extract_zip(path: str, filetype: FileType, dest_dir: str) -> None:
+    # What ZipFileUnpackHandler does with --zip-jobs, with a job for every CPU. Only ZIPs with at least
+    # archive_members.ZIP_SHARD_MIN_SIZE for each job are split up. The peak RSS is that of the process the jobs are
+    # started from, each job's is about that of the archive_members extraction
+    archive_members.extract_zip(path, dest_dir, os.cpu_count())
+
+
+EXTRACTIONS = {
+    'shutil.unpack_archive': _shutil_unpack_archive,
+    'archive_members': _extract_members,
+    'archive_members.extract_zip': _extract_zip,
+}  # type: dict[str, Callable[[str, FileType, str], None]]
+
+# Extractions that only work on some of the file types
+EXTRACTION_FILE_TYPES = {
+    'archive_members.extract_zip': [FileType.ZIP],
+}
+
+
+def _run_extraction(name: str, path: str, filetype: FileType, dest_dir: str) -> tuple[float, int, int]:
+    """
+    Runs in a process of its own, so that the peak RSS is this extraction's alone
+    :return: How long it took, the RSS it started out with and its peak RSS, both in bytes
+    """
+
+    # ru_maxrss is in KiB on Linux
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    EXTRACTIONS[name](path, filetype, dest_dir)
+    elapsed = time.perf_counter() - start
+    return elapsed, start_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _in_fresh_process(fn: Callable, *args):
+    # A fresh process for every run, forked so that it doesn't have to import everything again
+    context = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+
+@click.command()
+@click.option('--members', 'member_counts', multiple=True, type=click.IntRange(min=1),
+              help=f'How many members to put in the generated archive, can be given more than once '
+                   f'(default: {", ".join(str(x) for x in DEFAULT_MEMBER_COUNTS)}).')
+@click.option('--member-size', default=DEFAULT_MEMBER_SIZE, type=click.IntRange(min=1),
+              help=f'How big each member of the generated archive is, in bytes (default: {DEFAULT_MEMBER_SIZE}).')
+@click.option('--filetype', 'filetype_name', default=FileType.TAR.get_filetype_short(),
+              type=click.Choice([x.get_filetype_short() for x in SHUTIL_FORMATS.keys()]),
+              help=f'Whether to generate a TAR, a TGZ or a ZIP (default: {FileType.TAR.get_filetype_short()}).')
+@click.option('--tmp-dir', default='/tmp', type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help='Where to generate the archive, and extract it to (default: /tmp).')
+@click.option('--extraction', 'extraction_names', multiple=True, type=click.Choice(list(EXTRACTIONS.keys())),
+              help='Only measure these extractions, can be given more than once (default: all of them).')
+def extract_benchmark(member_counts, member_size, filetype_name, tmp_dir, extraction_names):
+    filetype = next(x for x in SHUTIL_FORMATS.keys() if x.get_filetype_short() == filetype_name)
+
+    root = tempfile.mkdtemp(prefix='clam_unpacker_extract_benchmark_', dir=tmp_dir)
+    try:
+        for member_count in member_counts or DEFAULT_MEMBER_COUNTS:
+            path = os.path.join(root, f'benchmark.{filetype_name}')
+            click.echo(f'Generating a {filetype_name} with {humanize.intcomma(member_count)} members in {root}')
+            _in_fresh_process(_make_archive, path, filetype, member_count, member_size)
+
+            for name in extraction_names or EXTRACTIONS.keys():
+                if filetype not in EXTRACTION_FILE_TYPES.get(name, SHUTIL_FORMATS.keys()):
+                    continue
+
+                dest_dir = os.path.join(root, 'extracted')
+                elapsed, start_rss, peak_rss = _in_fresh_process(_run_extraction, name, path, filetype, dest_dir)
+                shutil.rmtree(dest_dir, ignore_errors=True)
+
+                click.echo(f'{name:28} {humanize.intcomma(member_count):>12} members {elapsed:8.2f}s '
+                           f'peak RSS {humanize.naturalsize(peak_rss, binary=True):>10} '
+                           f'(+{humanize.naturalsize(peak_rss - start_rss, binary=True)})')
+
+            os.remove(path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    extract_benchmark()
@@ -0,0 +1,150 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Times the walk that recursive unpacking does over an unpacked tree, to look for nested archives
+# Compares the scandir walker with the os.walk based ways that came before it, on a generated tree
+#
+# python -m clamav_large_archive_scanner.benchmark.walk --files 1000000
+
+import functools
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable
+
+import click
+import humanize
+
+import clamav_large_archive_scanner.lib.file_data as file_data
+import clamav_large_archive_scanner.lib.walker as walker
+from clamav_large_archive_scanner.main import DEFAULT_MIN_SIZE_THRESHOLD_BYTES
+
+FILES_PER_DIR = 1000
+DIRS_PER_DIR = 10
+
+
+def _make_tree(root: str, file_count: int) -> None:
+    """
+    Fills root with file_count empty files, FILES_PER_DIR to a directory, in a tree DIRS_PER_DIR wide
+    """
+
+    dir_count = (file_count + FILES_PER_DIR - 1) // FILES_PER_DIR
+    dir_paths = [root]
+    # Breadth first, so the tree stays as shallow as it can
+    for index in range(1, dir_count):
+        dir_path = os.path.join(dir_paths[(index - 1) // DIRS_PER_DIR], f'dir_{index}')
+        os.mkdir(dir_path)
+        dir_paths.append(dir_path)
+
+    for index in range(file_count):
+        file_path = os.path.join(dir_paths[index // FILES_PER_DIR], f'file_{index}')
+        os.close(os.open(file_path, os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def _os_walk_file_meta_from_path(root: str, min_file_size: int) -> int:
+    # How find_nested_archives looked at files originally, min_file_size is only checked after the fact
+    count = 0
+    for a_dir, _, files in os.walk(root):
+        for file in files:
+            file_meta = file_data.file_meta_from_path(os.path.join(a_dir, file))
+            count += file_meta.size_raw >= min_file_size
+    return count
+
+
+def _os_walk_classify_file(root: str, min_file_size: int) -> int:
+    count = 0
+    for a_dir, _, files in os.walk(root):
+        for file in files:
+            file_meta = file_data.classify_file(os.path.join(a_dir, file), min_file_size)
+            count += file_meta.size_raw >= min_file_size
+    return count
+
+
+def _walker_classify_entry(root: str, min_file_size: int, threads: int = 1) -> int:
+    count = 0
+    for _, entries in walker.walk(root, threads=threads):
+        for entry in entries:
+            file_meta = file_data.classify_entry(entry, min_file_size)
+            count += file_meta.size_raw >= min_file_size
+    return count
+
+
+WALKS = {
+    'os.walk+file_meta_from_path': _os_walk_file_meta_from_path,
+    'os.walk+classify_file': _os_walk_classify_file,
+    'walker+classify_entry': _walker_classify_entry,
+}  # type: dict[str, Callable[[str, int], int]]
+
+# Same as walker+classify_entry, with --walk-threads
+THREADED_WALK = 'threaded walker+classify_entry'
+DEFAULT_WALK_THREADS = 8
+
+
+def _time_walk(walk: Callable[[str, int], int], root: str, min_file_size: int, rounds: int) -> float:
+    # Best of the rounds, the first one tends to pay for whatever the page cache didn't have yet
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        walk(root, min_file_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@click.command()
+@click.option('--files', 'file_count', default=1000000, type=click.IntRange(min=1),
+              help='How many files to put in the generated tree (default: 1000000).')
+@click.option('--tmp-dir', default='/tmp', type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help='Where to generate the tree (default: /tmp).')
+@click.option('--rounds', default=3, type=click.IntRange(min=1), help='How many times to time each walk (default: 3).')
+@click.option('--walk', 'walk_names', multiple=True, type=click.Choice(list(WALKS.keys()) + [THREADED_WALK]),
+              help='Only time these walks, can be given more than once (default: all of them).')
+@click.option('--walk-threads', default=DEFAULT_WALK_THREADS, type=click.IntRange(min=2),
+              help=f'How many threads the threaded walker gets (default: {DEFAULT_WALK_THREADS}).')
+def walk_benchmark(file_count, tmp_dir, rounds, walk_names, walk_threads):
+    walks = dict(WALKS)
+    walks[THREADED_WALK] = functools.partial(_walker_classify_entry, threads=walk_threads)
+
+    root = tempfile.mkdtemp(prefix='clam_unpacker_walk_benchmark_', dir=tmp_dir)
+    try:
+        click.echo(f'Generating {humanize.intcomma(file_count)} files in {root}')
+        start = time.perf_counter()
+        _make_tree(root, file_count)
+        click.echo(f'Generated in {time.perf_counter() - start:.1f}s')
+
+        baseline = None
+        for name in walk_names or walks.keys():
+            elapsed = _time_walk(walks[name], root, DEFAULT_MIN_SIZE_THRESHOLD_BYTES, rounds)
+            baseline = baseline or elapsed
+            click.echo(f'{name:32} {elapsed:8.2f}s {file_count / elapsed:12,.0f} files/s {baseline / elapsed:6.2f}x')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    walk_benchmark()
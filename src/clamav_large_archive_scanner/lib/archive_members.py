@@ -0,0 +1,275 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Reads the members of an archive one at a time, without extracting the archive anywhere
+
+import concurrent.futures
+import multiprocessing
+import os
+import tarfile
+from typing import BinaryIO, Iterator, Optional
+
+from clamav_large_archive_scanner.lib import compressed_stream, iso9660, zip_directory
+from clamav_large_archive_scanner.lib.file_data import FileType, FileView
+
+# What the tar in each kind of compressed tar is compressed with
+TAR_COMPRESSIONS = {
+    FileType.TARGZ: compressed_stream.GZIP,
+    FileType.TARZST: compressed_stream.ZSTD,
+    FileType.TARXZ: compressed_stream.XZ,
+    FileType.TARBZ2: compressed_stream.BZIP2,
+}
+
+STREAMABLE_FILE_TYPES = [FileType.TAR, FileType.ZIP] + list(TAR_COMPRESSIONS.keys())
+
+# Member data is read in pieces this big
+READ_CHUNK_SIZE = 1024 * 1024
+
+# ZIPs are only split up between processes if each of them gets at least this much of the archive to extract, starting
+# a process costs more than it saves for anything smaller
+ZIP_SHARD_MIN_SIZE = 64 * 1024 * 1024
+
+
+class ArchiveMember:
+    def __init__(self, name: str, size: int, fileobj: BinaryIO, data_offset: Optional[int] = None):
+        # Path of the member inside the archive, as the archive has it
+        self.name = name
+        self.size = size
+        # Only good until the next member is read
+        self.fileobj = fileobj
+        # Where the member is in the archive, for members that are stored there as they are, in one piece
+        self.data_offset = data_offset
+
+    def safe_relative_path(self) -> str:
+        # Where the member ends up relative to the unpack dir, names that try to climb out of it are kept inside
+        return os.path.normpath('/' + self.name).lstrip('/')
+
+    def iter_chunks(self, already_read: bytes = b'') -> Iterator[bytes]:
+        """
+        :param already_read: Whatever was read from fileobj before this was called, it is handed back first
+        :return: The rest of the member's data, READ_CHUNK_SIZE at a time
+        """
+
+        if len(already_read) > 0:
+            yield already_read
+
+        while True:
+            chunk = self.fileobj.read(READ_CHUNK_SIZE)
+            if chunk == b'':
+                return
+            yield chunk
+
+
+def _iter_tar_infos(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """
+    Same as iterating over tar, without holding on to what was read.
+    A TarFile keeps every TarInfo it reads in tar.members, which for millions of members adds up to GiBs, so the
+    headers are read one at a time with next(), and each TarInfo is let go of once the next one has been read
+    """
+
+    while True:
+        tar_info = tar.next()
+        if tar_info is None:
+            return
+
+        # Nothing looks for hard link targets here, which is all that tar.members gets used for once it's been read
+        tar.members.clear()
+        yield tar_info
+
+
+def _iter_regular_members(tar: tarfile.TarFile, name_prefix: str = '',
+                          seekable: bool = False) -> Iterator[ArchiveMember]:
+    for tar_info in _iter_tar_infos(tar):
+        if not tar_info.isreg():
+            continue
+
+        # Sparse members are stored in pieces, anything else is in one piece, right after its header
+        data_offset = tar_info.offset_data if seekable and tar_info.sparse is None else None
+        yield ArchiveMember(name_prefix + tar_info.name, tar_info.size, tar.extractfile(tar_info), data_offset)
+
+
+def _open_archive(path: str, view: Optional[FileView]) -> BinaryIO:
+    return view.open() if view is not None else open(path, 'rb')
+
+
+def _iter_tar_members(path: str, view: Optional[FileView], compression: str) -> Iterator[ArchiveMember]:
+    # Stream mode reads the archive front to back exactly once, compressed_stream decides where it gets decompressed
+    with _open_archive(path, view) as f, compressed_stream.open_stream(f, compression) as stream, \
+            tarfile.open(fileobj=stream, mode='r|') as tar:
+        yield from _iter_regular_members(tar)
+
+
+def _iter_plain_tar_members(path: str, view: Optional[FileView]) -> Iterator[ArchiveMember]:
+    # Nothing to decompress, so the data of the members that aren't read is seeked past, and where it is is known
+    with _open_archive(path, view) as f, tarfile.open(fileobj=f, mode='r:') as tar:
+        yield from _iter_regular_members(tar, seekable=True)
+
+
+def iter_tar_stream(stream: BinaryIO, name_prefix: str = '') -> Iterator[ArchiveMember]:
+    """
+    Same as iter_members, for an uncompressed tar that is being read from a pipe, rather than from a file
+    :param stream: The tar, only ever read forwards
+    :param name_prefix: Put in front of the name of every member
+    :return: The regular files in the tar, in the order they are stored in. Links and directories are skipped
+    """
+
+    with tarfile.open(fileobj=stream, mode='r|') as tar:
+        yield from _iter_regular_members(tar, name_prefix)
+
+
+def _iter_zip_members(path: str, view: Optional[FileView]) -> Iterator[ArchiveMember]:
+    # The central directory is read as the entries are, zipfile.ZipFile would read all of it up front
+    with _open_zip(path, view) as archive:
+        for entry in archive.iter_entries():
+            if entry.is_dir():
+                continue
+
+            data_offset = archive.data_offset(entry)
+            with archive.open_entry(entry, data_offset) as member_file:
+                yield ArchiveMember(entry.name, entry.file_size, member_file,
+                                    data_offset if entry.is_stored() else None)
+
+
+def _iter_iso_members(path: str, view: Optional[FileView]) -> Iterator[ArchiveMember]:
+    image = iso9660.IsoImage(view.source_path, view.offset) if view is not None else iso9660.IsoImage(path)
+    with image:
+        for iso_file in image.iter_files():
+            data_offset = iso_file.extents[0][0] if len(iso_file.extents) == 1 else None
+            yield ArchiveMember(iso_file.name, iso_file.size, image.open_file(iso_file), data_offset)
+
+
+def extract_member(member: ArchiveMember, dest_path: str, already_read: bytes = b'') -> str:
+    """
+    Writes a single member out, the same way that shutil.unpack_archive would have, except that nothing is written over.
+    If dest_path is taken, by a member with the same name, the member goes to dest_path.1, dest_path.2 and so on
+    instead, so every member with the same name ends up whole, in a file of its own, and gets scanned
+    :param member: The member to write
+    :param dest_path: Where to write it to, any missing parent directories are created
+    :param already_read: Whatever was read from the member before this was called
+    :return: Where the member ended up
+    """
+
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    candidate, index = dest_path, 0
+    while True:
+        try:
+            # Creating it exclusively means nothing else is writing to it, even another process extracting the same name
+            f = open(candidate, 'xb')
+            break
+        except FileExistsError:
+            index += 1
+            candidate = f'{dest_path}.{index}'
+
+    with f:
+        for chunk in member.iter_chunks(already_read):
+            f.write(chunk)
+
+    # Same as the chmod -R a+r after a regular unpack, otherwise clamd can't read it
+    os.chmod(candidate, 0o644)
+    return candidate
+
+
+def _open_zip(path: str, view: Optional[FileView]) -> zip_directory.ZipArchive:
+    if view is not None:
+        return zip_directory.ZipArchive(view.source_path, view.offset, view.length)
+    return zip_directory.ZipArchive(path)
+
+
+def _extract_zip_shard(path: str, view: Optional[FileView], shard: zip_directory.ZipShard, dest_dir: str) -> int:
+    """
+    Runs in a process of its own, with the archive opened again, so that nothing is shared with the other shards
+    :return: How many members were extracted
+    """
+
+    extracted = 0
+    with _open_zip(path, view) as archive:
+        for entry in archive.iter_entries(shard):
+            if entry.is_dir():
+                continue
+
+            with archive.open_entry(entry) as member_file:
+                member = ArchiveMember(entry.name, entry.file_size, member_file)
+                # makedirs copes with the other processes creating the same directories at the same time
+                extract_member(member, os.path.join(dest_dir, member.safe_relative_path()))
+            extracted += 1
+
+    return extracted
+
+
+def extract_zip(path: str, dest_dir: str, jobs: int, view: Optional[FileView] = None) -> int:
+    """
+    Extracts every regular file in a ZIP, with its central directory split between up to jobs processes.
+    ZIP members are compressed on their own, so each process inflates the members in its part of the central directory
+    without needing anything from the others. Members that have the same name are each written to a file of their own,
+    with .1, .2 and so on after the name, rather than over each other, so that every one of them gets scanned
+    :param path: Path to the archive
+    :param dest_dir: Where to extract it to
+    :param jobs: How many processes to extract it with at most, each one gets at least ZIP_SHARD_MIN_SIZE of the archive
+    :param view: If set, the archive is read from here instead of from path
+    :return: How many members were extracted
+    """
+
+    with _open_zip(path, view) as archive:
+        size = view.length if view is not None else archive.length
+        shards = archive.shard_entries(max(1, min(jobs, size // ZIP_SHARD_MIN_SIZE)))
+
+    if len(shards) <= 1:
+        return sum(_extract_zip_shard(path, view, shard, dest_dir) for shard in shards)
+
+    # The shards are started from a fork server, rather than forked from here, where there are other threads running
+    context = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as executor:
+        futures = [executor.submit(_extract_zip_shard, path, view, shard, dest_dir) for shard in shards]
+        try:
+            return sum(future.result() for future in futures)
+        except BaseException:
+            # Leaving the with waits for the shards that already started, so nothing is still writing to dest_dir
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def iter_members(path: str, filetype: FileType, view: Optional[FileView] = None) -> Iterator[ArchiveMember]:
+    """
+    :param path: Path to the archive
+    :param filetype: One of STREAMABLE_FILE_TYPES, or FileType.ISO
+    :param view: If set, the archive is read from here instead of from path
+    :return: The regular files in the archive, in the order they are stored in. Links and directories are skipped.
+        data_offset is set for the members of TARs, ZIPs and ISOs that are stored in one piece, as they are
+    """
+
+    if filetype == FileType.ZIP:
+        return _iter_zip_members(path, view)
+    elif filetype == FileType.TAR:
+        return _iter_plain_tar_members(path, view)
+    elif filetype in TAR_COMPRESSIONS:
+        return _iter_tar_members(path, view, TAR_COMPRESSIONS[filetype])
+    elif filetype == FileType.ISO:
+        return _iter_iso_members(path, view)
+
+    raise ValueError(f'Unable to stream the members of {filetype}')
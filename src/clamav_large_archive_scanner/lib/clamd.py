@@ -0,0 +1,605 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# A client for clamd's own socket protocol, so scanning doesn't have to fork a clamdscan for every path
+# The protocol is described in the COMMANDS section of man 8 clamd, everything here uses the NUL delimited z commands
+
+import os
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib import filesize
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+
+# Where the common distributions put clamd.conf, checked in order when one isn't given
+DEFAULT_CLAMD_CONF_PATHS = [
+    '/etc/clamav/clamd.conf',  # Debian and Ubuntu
+    '/etc/clamd.d/scan.conf',  # Fedora and RHEL
+    '/etc/clamd.conf',
+    '/usr/local/etc/clamd.conf',  # Built from source
+]
+
+# clamd listens on every interface when TCPAddr isn't set, this is the one we can count on reaching
+DEFAULT_TCP_ADDR = '127.0.0.1'
+
+# How many connections can be open to clamd at once
+DEFAULT_POOL_SIZE = 4
+
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+
+# How many commands are sent down a session ahead of their replies, clamd stops reading from a connection
+# while it has more than this many waiting to be worked on, and this keeps us from filling up the socket buffers
+PIPELINE_DEPTH = 32
+
+# What clamd uses when StreamMaxLength isn't set, it hangs up on INSTREAM data beyond this
+DEFAULT_STREAM_MAX_LENGTH = 100 * 1024 * 1024
+
+# What clamd uses when MaxScanSize and MaxFiles aren't set, it stops looking inside of an archive past either one
+# For both of these, 0 means no limit
+DEFAULT_MAX_SCAN_SIZE = 400 * 1024 * 1024
+DEFAULT_MAX_FILES = 10000
+
+# INSTREAM chunks are prefixed with their length, as an unsigned 32 bit int in network byte order
+_CHUNK_LENGTH = struct.Struct('!L')
+_END_OF_STREAM = _CHUNK_LENGTH.pack(0)
+
+_RECV_SIZE = 4096
+_DELIMITER = b'\0'
+
+
+class ClamdAddress:
+    def __init__(self, family: int, address):
+        self.family = family
+        self.address = address
+
+    def connect(self, timeout: Optional[float]) -> socket.socket:
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(DEFAULT_CONNECT_TIMEOUT_SECONDS)
+            sock.connect(self.address)
+            sock.settimeout(timeout)
+        except OSError as e:
+            sock.close()
+            raise ClamdException(f'Unable to connect to clamd at {self}: {e}')
+
+        return sock
+
+    def __str__(self):
+        if self.family == socket.AF_UNIX:
+            return self.address
+
+        return f'{self.address[0]}:{self.address[1]}'
+
+
+def find_clamd_conf(conf_path: Optional[str] = None) -> str:
+    """
+    :param conf_path: An explicit clamd.conf to use, if not given, DEFAULT_CLAMD_CONF_PATHS are checked
+    :return: Path to the clamd.conf that should be used
+    """
+
+    if conf_path is not None:
+        return conf_path
+
+    for a_path in DEFAULT_CLAMD_CONF_PATHS:
+        if os.path.isfile(a_path):
+            return a_path
+
+    raise ClamdException(f'Unable to find clamd.conf, looked in: {", ".join(DEFAULT_CLAMD_CONF_PATHS)}')
+
+
+def _read_clamd_conf(conf_path: str) -> dict:
+    """
+    :param conf_path: Path to clamd.conf
+    :return: The options that are set in it. Like clamd, if an option is repeated the last one wins, except for
+             TCPAddr, which clamd listens on every one of, and where the first one is kept
+    """
+
+    options = {}  # type: dict[str, str]
+
+    try:
+        with open(conf_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+
+                # Options and their values can be separated by tabs as well as spaces
+                parts = line.split(None, 1)
+                key = parts[0]
+                value = parts[1] if len(parts) > 1 else ''
+                if key == 'TCPAddr':
+                    # Only the first one matters to us
+                    options.setdefault(key, value)
+                else:
+                    options[key] = value
+    except OSError as e:
+        raise ClamdException(f'Unable to read {conf_path}: {e}')
+
+    if 'Example' in options:
+        raise ClamdException(f'{conf_path} still has the Example line in it, clamd has not been configured')
+
+    return options
+
+
+def parse_clamd_conf(conf_path: str) -> ClamdAddress:
+    """
+    Finds where clamd is listening, the same way that clamdscan does. LocalSocket is preferred over TCPSocket
+    :param conf_path: Path to clamd.conf
+    :return: The address of clamd
+    """
+
+    options = _read_clamd_conf(conf_path)
+
+    if 'LocalSocket' in options:
+        return ClamdAddress(socket.AF_UNIX, options['LocalSocket'])
+
+    if 'TCPSocket' in options:
+        try:
+            port = int(options['TCPSocket'])
+        except ValueError:
+            raise ClamdException(f'Invalid TCPSocket in {conf_path}: {options["TCPSocket"]}')
+
+        return ClamdAddress(socket.AF_INET, (options.get('TCPAddr', DEFAULT_TCP_ADDR), port))
+
+    raise ClamdException(f'Neither LocalSocket nor TCPSocket is set in {conf_path}')
+
+
+def _parse_size_option(options: dict, name: str, default: int, conf_path: str) -> int:
+    if name not in options:
+        return default
+
+    # clamd takes the same K and M suffixes that --min-size does
+    try:
+        return int(filesize.convert_human_to_machine_bytes(options[name]))
+    except ValueError:
+        raise ClamdException(f'Invalid {name} in {conf_path}: {options[name]}')
+
+
+def parse_stream_max_length(conf_path: str) -> int:
+    """
+    :param conf_path: Path to clamd.conf
+    :return: The most data, in bytes, that clamd will take over a single INSTREAM
+    """
+
+    return _parse_size_option(_read_clamd_conf(conf_path), 'StreamMaxLength', DEFAULT_STREAM_MAX_LENGTH, conf_path)
+
+
+def parse_archive_limits(conf_path: str) -> Tuple[int, int]:
+    """
+    :param conf_path: Path to clamd.conf
+    :return: clamd's MaxScanSize and MaxFiles, how much of an archive it is willing to look at. 0 means no limit
+    """
+
+    options = _read_clamd_conf(conf_path)
+    max_scan_size = _parse_size_option(options, 'MaxScanSize', DEFAULT_MAX_SCAN_SIZE, conf_path)
+
+    try:
+        max_files = int(options.get('MaxFiles', DEFAULT_MAX_FILES))
+    except ValueError:
+        raise ClamdException(f'Invalid MaxFiles in {conf_path}: {options["MaxFiles"]}')
+
+    return max_scan_size, max_files
+
+
+class ClamdReply:
+    """
+    A reply to one of the scan commands, one line for each file that clamd had something to say about.
+    """
+
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        self.found = []  # type: list[tuple[str, str]]
+        self.errors = []  # type: list[str]
+
+        for line in lines:
+            if line.endswith(' FOUND'):
+                path, _, signature = line[:-len(' FOUND')].rpartition(': ')
+                self.found.append((path, signature))
+            elif not line.endswith(' OK'):
+                # ERROR lines, and anything that isn't a scan result at all, like UNKNOWN COMMAND
+                self.errors.append(line)
+
+    def get_return_code(self) -> int:
+        # Same as clamdscan: 1 if anything was found, 2 if anything went wrong, 0 otherwise
+        if len(self.found) > 0:
+            return 1
+        elif len(self.errors) > 0 or len(self.lines) == 0:
+            return 2
+        else:
+            return 0
+
+    def __str__(self):
+        return '\n'.join(self.lines)
+
+
+def _encode_command(command: str) -> bytes:
+    return b'z' + os.fsencode(command) + _DELIMITER
+
+
+class _ReplyReader:
+    # clamd terminates every reply with a NUL, and can send several of them in a row
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buffer = b''
+
+    def read_one(self) -> Optional[str]:
+        while _DELIMITER not in self._buffer:
+            data = self.sock.recv(_RECV_SIZE)
+            if data == b'':
+                # Closed by clamd
+                return None
+            self._buffer += data
+
+        reply, _, self._buffer = self._buffer.partition(_DELIMITER)
+        return reply.decode('utf-8', errors='replace')
+
+    def read_all(self) -> List[str]:
+        replies = []
+        while True:
+            reply = self.read_one()
+            if reply is None:
+                return replies
+            replies.append(reply)
+
+
+def _send_stream(sock: socket.socket, chunks: Iterable[bytes]) -> None:
+    try:
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            sock.sendall(_CHUNK_LENGTH.pack(len(chunk)) + chunk)
+        sock.sendall(_END_OF_STREAM)
+    except (BrokenPipeError, ConnectionResetError):
+        # clamd hangs up on streams that go over StreamMaxLength, after telling us why
+        fast_log.debug('clamd closed the connection while streaming to it')
+
+
+class _Session:
+    """
+    A connection in IDSESSION mode, where clamd keeps the connection open for more commands.
+    Replies come back prefixed with the number of the command that they belong to, starting at 1.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.reader = _ReplyReader(sock)
+        self._next_id = 1
+
+        self.sock.sendall(_encode_command('IDSESSION'))
+
+    def is_alive(self) -> bool:
+        # clamd closes sessions that have been idle for longer than its IdleTimeout
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def command(self, command: str, chunks: Iterable[bytes] = None) -> str:
+        request_id = self._next_id
+        self._next_id += 1
+
+        self.sock.sendall(_encode_command(command))
+        if chunks is not None:
+            _send_stream(self.sock, chunks)
+
+        reply = self.reader.read_one()
+        if reply is None:
+            raise ClamdException(f'clamd closed the connection before replying to {command}')
+
+        reply_id, _, reply = reply.partition(': ')
+        if reply_id != str(request_id):
+            raise ClamdException(f'Got a reply to command {reply_id} while waiting on command {request_id}')
+
+        return reply
+
+    def pipeline(self, commands: List[str]) -> List[str]:
+        """
+        Sends the commands one after the other, PIPELINE_DEPTH of them at most ahead of their replies, which clamd
+        works on with all of its threads, and sends back in whatever order they finish in
+        :return: The replies, in the same order as the commands
+        """
+
+        first_id = self._next_id
+        self._next_id += len(commands)
+        replies = [None] * len(commands)  # type: list[Optional[str]]
+
+        sent = 0
+        received = 0
+        while received < len(commands):
+            while sent < len(commands) and sent - received < PIPELINE_DEPTH:
+                self.sock.sendall(_encode_command(commands[sent]))
+                sent += 1
+
+            reply = self.reader.read_one()
+            if reply is None:
+                raise ClamdException(f'clamd closed the connection with {len(commands) - received} replies to go')
+
+            reply_id, _, reply = reply.partition(': ')
+            index = int(reply_id) - first_id if reply_id.isdigit() else -1
+            if not 0 <= index < sent or replies[index] is not None:
+                raise ClamdException(f'Got a reply to command {reply_id}, which is not waiting on one: {reply}')
+
+            replies[index] = reply
+            received += 1
+
+        return replies
+
+    def close(self) -> None:
+        try:
+            self.sock.sendall(_encode_command('END'))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Abort:
+    """
+    Lets another thread give up on a scan that is still running, without waiting for clamd to finish it.
+    Whatever the scan is waiting on is interrupted: the connection to clamd is shut down, or the clamdscan process is
+    killed. Scans that start after the abort are interrupted right away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aborted = False
+        self._on_abort = None  # type: Optional[Callable[[], None]]
+
+    def is_aborted(self) -> bool:
+        return self._aborted
+
+    def abort(self) -> None:
+        with self._lock:
+            self._aborted = True
+            if self._on_abort is not None:
+                self._on_abort()
+
+    @contextmanager
+    def watching(self, on_abort: Callable[[], None]) -> Iterator[None]:
+        """
+        :param on_abort: Interrupts whatever is being waited on in the with, called from the thread that aborts
+        """
+
+        with self._lock:
+            if self._aborted:
+                on_abort()
+            self._on_abort = on_abort
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._on_abort = None
+
+
+def _shut_down(sock: socket.socket) -> None:
+    # Unlike close, this wakes up whatever is blocked on the socket in another thread
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+@contextmanager
+def _abortable(abort: Optional[Abort], sock: socket.socket) -> Iterator[None]:
+    if abort is None:
+        yield
+        return
+
+    with abort.watching(lambda: _shut_down(sock)):
+        yield
+
+    # clamd's reply may have been cut short, without anything going wrong otherwise
+    if abort.is_aborted():
+        raise ClamdException('Scan aborted')
+
+
+class ClamdClient:
+    """
+    Talks to clamd over its socket, keeping a pool of connections around so they can be reused.
+
+    clamd only takes VERSION, INSTREAM and a few others inside of an IDSESSION, so those are the ones that go over
+    the pooled connections. The directory scans, and PING, get a connection to themselves, which clamd closes once
+    it has replied. Either way, no more than pool_size connections are open at once, idle ones included.
+    """
+
+    def __init__(self, address: ClamdAddress, pool_size: int = DEFAULT_POOL_SIZE, timeout: Optional[float] = None,
+                 stream_max_length: int = DEFAULT_STREAM_MAX_LENGTH, max_scan_size: int = DEFAULT_MAX_SCAN_SIZE,
+                 max_files: int = DEFAULT_MAX_FILES):
+        """
+        :param address: Where clamd is listening
+        :param pool_size: How many connections can be open to clamd at once
+        :param timeout: How long to wait on clamd once connected, None waits forever, since scans can take a while
+        :param stream_max_length: clamd's StreamMaxLength, anything bigger can't be sent over INSTREAM
+        :param max_scan_size: clamd's MaxScanSize, the most it will extract out of a single archive, 0 for no limit
+        :param max_files: clamd's MaxFiles, the most files it will look at in a single archive, 0 for no limit
+        """
+
+        self.address = address
+        self.timeout = timeout
+        self.stream_max_length = stream_max_length
+        self.max_scan_size = max_scan_size
+        self.max_files = max_files
+
+        self.pool_size = pool_size
+
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._idle_sessions = []  # type: list[_Session]
+
+    def _acquire_slot(self, want_session: bool) -> Optional[_Session]:
+        """
+        Waits until fewer than pool_size connections are in use.
+        Idle sessions are connections as well, so some of them may be closed to make room for a new connection.
+        :param want_session: If true, an idle session is handed back, if there is one
+        :return: The idle session, or None if a new connection needs to be opened
+        """
+
+        self._slots.acquire()
+
+        with self._lock:
+            self._in_use += 1
+
+            while len(self._idle_sessions) > 0:
+                if want_session:
+                    session = self._idle_sessions.pop()
+                    if session.is_alive():
+                        return session
+                    session.sock.close()
+                elif self._in_use + len(self._idle_sessions) > self.pool_size:
+                    self._idle_sessions.pop(0).close()
+                else:
+                    break
+
+        return None
+
+    def _release_slot(self, idle_session: Optional[_Session] = None) -> None:
+        with self._lock:
+            self._in_use -= 1
+            if idle_session is not None:
+                self._idle_sessions.append(idle_session)
+
+        self._slots.release()
+
+    @contextmanager
+    def _session(self) -> Iterator[_Session]:
+        session = self._acquire_slot(want_session=True)
+        try:
+            if session is None:
+                fast_log.trace(f'Opening a new session to clamd at {self.address}')
+                session = _Session(self.address.connect(self.timeout))
+
+            yield session
+        except BaseException:
+            # Can't tell what state the connection has been left in
+            if session is not None:
+                session.close()
+            self._release_slot()
+            raise
+
+        self._release_slot(session)
+
+    def _session_command(self, command: str, chunks: Iterable[bytes] = None) -> str:
+        try:
+            with self._session() as session:
+                return session.command(command, chunks)
+        except OSError as e:
+            raise ClamdException(f'Lost the connection to clamd at {self.address}: {e}')
+
+    def _one_shot_command(self, command: str, abort: Optional[Abort] = None) -> List[str]:
+        self._acquire_slot(want_session=False)
+        try:
+            sock = self.address.connect(self.timeout)
+            try:
+                with _abortable(abort, sock):
+                    sock.sendall(_encode_command(command))
+                    return _ReplyReader(sock).read_all()
+            finally:
+                sock.close()
+        except OSError as e:
+            raise ClamdException(f'Lost the connection to clamd at {self.address}: {e}')
+        finally:
+            self._release_slot()
+
+    def ping(self) -> bool:
+        """
+        :return: True if clamd is up and answering, False otherwise
+        """
+
+        try:
+            return self._one_shot_command('PING') == ['PONG']
+        except ClamdException as e:
+            fast_log.debug(f'Unable to ping clamd: {e}')
+            return False
+
+    def version(self) -> str:
+        return self._session_command('VERSION')
+
+    def multiscan(self, path: str, abort: Optional[Abort] = None) -> ClamdReply:
+        # Scans the directory using all of clamd's threads
+        return ClamdReply(self._one_shot_command(f'MULTISCAN {path}', abort))
+
+    def scan_files(self, paths: List[str], abort: Optional[Abort] = None) -> ClamdReply:
+        """
+        Same as clamdscan -m --file-list, a SCAN for every path, pipelined down a single session
+        :param paths: Regular files, SCAN on a directory doesn't use more than one of clamd's threads
+        :param abort: If given, aborting it closes the session and raises a ClamdException, even part way
+        :return: One line for every path, in the same order
+        """
+
+        try:
+            with self._session() as session, _abortable(abort, session.sock):
+                return ClamdReply(session.pipeline([f'SCAN {path}' for path in paths]))
+        except OSError as e:
+            raise ClamdException(f'Lost the connection to clamd at {self.address}: {e}')
+
+    def contscan(self, path: str) -> ClamdReply:
+        # Scans the directory on a single thread, not stopping at the first file found
+        return ClamdReply(self._one_shot_command(f'CONTSCAN {path}'))
+
+    def allmatchscan(self, path: str, abort: Optional[Abort] = None) -> ClamdReply:
+        # Like CONTSCAN, but also reports every signature that matches each file, not just the first
+        return ClamdReply(self._one_shot_command(f'ALLMATCHSCAN {path}', abort))
+
+    def instream(self, chunks: Iterable[bytes]) -> ClamdReply:
+        """
+        Sends data to clamd to be scanned, without it having to be written anywhere that clamd can read
+        :param chunks: The data to scan, in whatever pieces are convenient
+        :return: The reply, the path in it is always 'stream'
+        """
+
+        return ClamdReply([self._session_command('INSTREAM', chunks)])
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._idle_sessions:
+                session.close()
+            self._idle_sessions = []
+
+
+def client_from_conf(conf_path: Optional[str] = None, pool_size: int = DEFAULT_POOL_SIZE) -> ClamdClient:
+    """
+    :param conf_path: clamd.conf to read the socket from, if not given, DEFAULT_CLAMD_CONF_PATHS are checked
+    :param pool_size: How many connections can be open to clamd at once
+    :return: A client for the clamd described by the conf
+    """
+
+    conf_path = find_clamd_conf(conf_path)
+    address = parse_clamd_conf(conf_path)
+    stream_max_length = parse_stream_max_length(conf_path)
+    max_scan_size, max_files = parse_archive_limits(conf_path)
+    fast_log.debug(f'Using clamd at {address}, from {conf_path}')
+
+    return ClamdClient(address, pool_size, stream_max_length=stream_max_length, max_scan_size=max_scan_size,
+                       max_files=max_files)
@@ -27,19 +27,35 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import click
 
+import clamav_large_archive_scanner.lib.contexts as contexts
+import clamav_large_archive_scanner.lib.mount_slots as mount_slots
+import clamav_large_archive_scanner.lib.mount_table as mount_table
 import clamav_large_archive_scanner.lib.mount_tools as mount_tools
 import clamav_large_archive_scanner.lib.tmp_files as tmp_files
 from clamav_large_archive_scanner.lib import fast_log
 from clamav_large_archive_scanner.lib.exceptions import MountException
 from clamav_large_archive_scanner.lib.file_data import FileType
 
+# How many partitions of a disk image get un-mounted at the same time, each guestunmount waits on its appliance to exit
+UMOUNT_JOBS = 8
+
 
 class BaseCleanupHandler:
-    def __init__(self, path: str):
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
         self.path = path
+        # What is mounted where, shared by all the handlers in a cleanup pass, read on first use otherwise
+        self._mounts = mounts
+
+    def get_mounts(self) -> mount_table.MountTable:
+        if self._mounts is None:
+            self._mounts = mount_tools.read_mount_table()
+        return self._mounts
 
     def cleanup(self) -> None:
         fast_log.debug(f'Cleaning up {self.path} by deleting it.')
@@ -47,23 +63,23 @@ class BaseCleanupHandler:
 
 
 class TarCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
 
 
 class ZipCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
 
 
 class IsoCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
 
     def cleanup(self) -> None:
         fast_log.debug(f'Cleaning up {self.path} by un-mounting it.')
         try:
-            mount_tools.umount_iso(self.path)
+            mount_tools.umount_iso(self.path, self.get_mounts())
         except MountException as e:
             raise click.FileError(filename=self.path, hint=f'Unable to un-mount from {self.path}')
 
@@ -72,25 +88,38 @@ class IsoCleanupHandler(BaseCleanupHandler):
 
 # Handles VMDK and QCOW2
 class GuestFSCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
+
+    def _umount_partition(self, a_dir: str) -> bool:
+        try:
+            fast_log.debug(f'Un-mounting {a_dir}')
+            mount_tools.umount_guestfs_partition(a_dir, self.get_mounts())
+        except MountException as e:
+            fast_log.warn(f'Unable to unmount {a_dir}, continuing anyway')
+            fast_log.warn(f'Got the following mount error: {e}')
+            return False
+
+        return True
 
     def cleanup(self) -> None:
         fast_log.debug(f'Cleaning up {self.path} by un-mounting it all underlying partitions')
 
-        # Find all mount-points in the directory
-        dirs = mount_tools.list_top_level_dirs(self.path)
-        all_success = True
+        # Find all mount-points in the directory, without guestmount there is one for each partition
+        # Straight from the mount table, listing the directory would be a round trip to an appliance for each of them
+        dirs = [entry.mount_point for entry in self.get_mounts().mounts_under(self.path) if entry.is_fuse()]
+
+        with ThreadPoolExecutor(max_workers=UMOUNT_JOBS, thread_name_prefix='umount') as executor:
+            all_success = all(list(executor.map(self._umount_partition, dirs)))
 
-        for a_dir in dirs:
+        # With the libguestfs bindings, all of the partitions are under a single mount, right here
+        if all_success:
             try:
-                fast_log.debug(f'Un-mounting {a_dir}')
-                mount_tools.umount_guestfs_partition(a_dir)
+                mount_tools.umount_guestfs_partition(self.path, self.get_mounts())
             except MountException as e:
-                fast_log.warn(f'Unable to unmount {a_dir}, continuing anyway')
+                fast_log.warn(f'Unable to unmount {self.path}, continuing anyway')
                 fast_log.warn(f'Got the following mount error: {e}')
                 all_success = False
-                continue
 
         if all_success:
             shutil.rmtree(path=self.path, ignore_errors=True)
@@ -99,8 +128,23 @@ class GuestFSCleanupHandler(BaseCleanupHandler):
 
 
 class TarGzCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
+
+
+class TarZstCleanupHandler(BaseCleanupHandler):
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
+
+
+class TarXzCleanupHandler(BaseCleanupHandler):
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
+
+
+class TarBz2CleanupHandler(BaseCleanupHandler):
+    def __init__(self, path: str, mounts: Optional[mount_table.MountTable] = None):
+        super().__init__(path, mounts)
 
 
 FILETYPE_HANDLERS = {
@@ -110,6 +154,9 @@ FILETYPE_HANDLERS = {
     FileType.VMDK: GuestFSCleanupHandler,
     FileType.TARGZ: TarGzCleanupHandler,
     FileType.QCOW2: GuestFSCleanupHandler,
+    FileType.TARZST: TarZstCleanupHandler,
+    FileType.TARXZ: TarXzCleanupHandler,
+    FileType.TARBZ2: TarBz2CleanupHandler,
 }
 
 
@@ -119,24 +166,31 @@ def _cleanup_file(filepath: str, only_one: bool, tmp_dir: str) -> None:
         fast_log.debug(f'No associated directories found for {filepath}')
         return
 
+    # Every directory is un-mounted at most once, so one look at the mount table does for all of them
+    mounts = mount_tools.read_mount_table()
+
     if only_one:
         fast_log.debug(f'Found an associated directory for {filepath}')
-        cleanup_path(files[0])
+        cleanup_path(files[0], mounts)
     else:
         fast_log.debug(f'Found {len(files)} associated directories for {filepath}')
         for file in files:
             fast_log.debug(f'Cleaning up {file}')
-            cleanup_path(file)
+            cleanup_path(file, mounts)
 
 
-def cleanup_path(filepath: str) -> None:
+def cleanup_path(filepath: str, mounts: Optional[mount_table.MountTable] = None) -> None:
+    """
+    :param mounts: What is mounted where, read when it is needed if not given
+    """
+
     filetype = tmp_files.determine_tmp_dir_filetype(filepath)
 
     if filetype not in FILETYPE_HANDLERS.keys():
         raise click.BadParameter(f'Unhandled file type: {filetype}')
 
     handler_class = FILETYPE_HANDLERS[filetype]
-    handler = handler_class(filepath)
+    handler = handler_class(filepath, mounts)
     handler.cleanup()
 
 
@@ -146,3 +200,83 @@ def cleanup_file(filepath: str, tmp_dir: str) -> None:
 
 def cleanup_recursive(filepath: str, tmp_dir: str) -> None:
     _cleanup_file(filepath, only_one=False, tmp_dir=tmp_dir)
+
+
+def cleanup_ctx(u_ctx: contexts.UnpackContext) -> None:
+    # Directories are scanned where they are, there is nothing to clean up for them
+    if u_ctx.unpacked_dir_location is None or u_ctx.file_meta.filetype not in FILETYPE_HANDLERS.keys():
+        return
+
+    handler_class = FILETYPE_HANDLERS[u_ctx.file_meta.filetype]
+    handler = handler_class(u_ctx.unpacked_dir_location)
+    handler.cleanup()
+
+
+class IncrementalCleaner:
+    """
+    Cleans up each context as soon as nothing needs it anymore, instead of waiting for cleanup_recursive.
+
+    A context is needed until it has been scanned, it has been searched for nested archives, and every nested archive
+    found in it has been unpacked. Nested archives that are mounted rather than extracted keep reading from it, so
+    those have to be cleaned up before it can be.
+
+    Anything that never gets released, say because the scan stopped early, is left for cleanup_recursive.
+    """
+
+    def __init__(self, tmp_dir: str, slots: Optional[mount_slots.MountSlots] = None):
+        self.usage = tmp_files.TmpDirUsage(tmp_dir)
+        # Given back the mount slot of every context that gets un-mounted
+        self.slots = slots
+
+        self._lock = threading.Lock()
+        self._holds = {}  # type: dict[contexts.UnpackContext, int]
+
+    def _release(self, u_ctx: contexts.UnpackContext) -> None:
+        while u_ctx is not None:
+            with self._lock:
+                self._holds[u_ctx] -= 1
+                if self._holds[u_ctx] > 0:
+                    return
+                del self._holds[u_ctx]
+
+            self._cleanup(u_ctx)
+
+            # A mounted context was the last thing reading from its parent
+            u_ctx = u_ctx.parent_ctx if u_ctx.depends_on_source else None
+
+    def _cleanup(self, u_ctx: contexts.UnpackContext) -> None:
+        self.usage.sample()
+
+        fast_log.debug(f'Releasing {u_ctx}')
+        try:
+            cleanup_ctx(u_ctx)
+        except click.FileError as e:
+            fast_log.warn(f'Unable to release {u_ctx}, it will be cleaned up at the end: {e}')
+            # Still mounted, so its slot stays taken, but whoever is waiting for one shouldn't count on it
+            if self.slots is not None:
+                self.slots.release(u_ctx, failed=True)
+            return
+
+        if self.slots is not None:
+            self.slots.release(u_ctx)
+
+    def unpacked(self, u_ctx: contexts.UnpackContext) -> None:
+        with self._lock:
+            # One for the scan, one for the search for nested archives
+            self._holds[u_ctx] = 2
+
+        # Once extracted, a nested archive doesn't need its parent anymore
+        if u_ctx.parent_ctx is not None and not u_ctx.depends_on_source:
+            self._release(u_ctx.parent_ctx)
+
+    def nested_found(self, u_ctx: contexts.UnpackContext, nested_ctxs: list[contexts.UnpackContext]) -> None:
+        with self._lock:
+            self._holds[u_ctx] += len(nested_ctxs)
+
+        self._release(u_ctx)
+
+    def unpack_failed(self, u_ctx: contexts.UnpackContext) -> None:
+        self._release(u_ctx.parent_ctx)
+
+    def scanned(self, u_ctx: contexts.UnpackContext) -> None:
+        self._release(u_ctx)
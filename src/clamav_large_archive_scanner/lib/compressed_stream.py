@@ -0,0 +1,410 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Decompresses the compressed stream of a TGZ, TZST, TXZ or TBZ2 somewhere other than in the thread that reads the tar
+# out of it
+# tarfile decompresses in whichever thread reads from it, so decompressing, parsing the tar and writing the members out
+# all take turns on one core, which tops out at 100-200MB/s for gzip, and far less for xz and bzip2. BGZF streams, which
+# are made of small gzip members that each say how big they are, are inflated on several threads at once. Anything else
+# is decompressed on a thread of its own, ahead of whoever is reading it, or by a tool in a process of its own, which
+# decompresses on several threads where the format lets it
+
+import bz2
+import collections
+import gzip
+import io
+import lzma
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    # Python has no zstd of its own before 3.14, TZSTs are decompressed by one of the zstd tools without it
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+XZ = 'xz'
+BZIP2 = 'bzip2'
+COMPRESSIONS = [GZIP, ZSTD, XZ, BZIP2]
+
+# How compressed streams get decompressed, either as they are read, on threads of their own, or by the tools below
+DECOMPRESS_MODE_PYTHON = 'python'
+DECOMPRESS_MODE_THREADS = 'threads'
+DECOMPRESS_MODE_EXTERNAL = 'external'
+DECOMPRESS_MODES = [DECOMPRESS_MODE_PYTHON, DECOMPRESS_MODE_THREADS, DECOMPRESS_MODE_EXTERNAL]
+
+# Tried in this order with DECOMPRESS_MODE_EXTERNAL, anything without one of these on the PATH is decompressed on a
+# thread of its own instead
+# igzip inflates several times faster than zlib does, pigz mostly takes reading, writing and checking the CRC off of the
+# thread that inflates. pzstd decompresses the frames that it wrote on several threads, lbzip2 and pbzip2 do the same
+# with bzip2 blocks, and xz does it with the blocks of files written with -T, from version 5.4 on
+EXTERNAL_TOOLS = {
+    GZIP: ['igzip', 'pigz'],
+    ZSTD: ['pzstd', 'zstd'],
+    XZ: ['xz'],
+    BZIP2: ['lbzip2', 'pbzip2'],
+}
+# Passed along with -d -c, for the tools that only decompress on several threads when asked to
+_EXTERNAL_TOOL_ARGS = {
+    'xz': ['-T0'],
+}
+
+# The compressed stream is read this much at a time, and inflated into pieces of at most this much
+READ_SIZE = 1024 * 1024
+# How many inflated pieces can be waiting on whoever is reading them, before inflating stops to let them catch up
+QUEUE_DEPTH = 16
+# How many BGZF blocks can be inflating, or waiting to be read, for each thread
+BLOCKS_PER_THREAD = 4
+
+# zlib takes care of the gzip header and trailer, and checks the CRC and the size, with these
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_GZIP_MAGIC = b'\x1f\x8b'
+_GZIP_FLAG_EXTRA = 0x04
+# The fixed size part of a gzip header, followed by how long the extra field is
+_MEMBER_HEADER = struct.Struct('<2sBBLBBH')
+_BGZF_SUBFIELD = b'BC'
+
+_mode = DECOMPRESS_MODE_PYTHON
+
+
+def use_mode(mode: str) -> None:
+    # Picked up by every compressed tar opened from here on
+    global _mode
+    if mode not in DECOMPRESS_MODES:
+        raise ValueError(f'Unknown decompress mode {mode}')
+    _mode = mode
+
+
+def find_external_tool(compression: str = GZIP) -> Optional[str]:
+    # The first one of EXTERNAL_TOOLS for compression that is on the PATH
+    return next((x for x in EXTERNAL_TOOLS[compression] if shutil.which(x) is not None), None)
+
+
+def _read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    return data
+
+
+def _iter_inflated(f: BinaryIO, data: bytes = b'') -> Iterator[bytes]:
+    """
+    Inflates one gzip member after another, the same as gzip.GzipFile does
+    :param data: Whatever was read from f before this was called, it is inflated first
+    :return: The decompressed data, READ_SIZE at most at a time
+    """
+
+    decompressor = None
+    while True:
+        if len(data) == 0:
+            data = f.read(READ_SIZE)
+            if len(data) == 0:
+                break
+
+        if decompressor is None:
+            # Same as gzip, zeros between and after the members are padding
+            data = data.lstrip(b'\0')
+            if len(data) == 0:
+                continue
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+
+        try:
+            chunk = decompressor.decompress(data, READ_SIZE)
+        except zlib.error as e:
+            raise gzip.BadGzipFile(str(e))
+
+        if decompressor.eof:
+            data = decompressor.unused_data
+            decompressor = None
+        else:
+            data = decompressor.unconsumed_tail
+
+        if len(chunk) > 0:
+            yield chunk
+
+    if decompressor is not None:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def _read_bgzf_block(f: BinaryIO) -> tuple[Optional[bytes], bytes]:
+    """
+    :return: The next gzip member, header and all, if it says how big it is, or None and whatever was read of it, which
+        is nothing at the end of the stream
+    """
+
+    header = f.read(_MEMBER_HEADER.size)
+    if len(header) < _MEMBER_HEADER.size:
+        return None, header
+
+    magic, method, flags, _, _, _, extra_length = _MEMBER_HEADER.unpack(header)
+    if magic != _GZIP_MAGIC or method != 8 or flags & _GZIP_FLAG_EXTRA == 0:
+        return None, header
+
+    extra = _read_exactly(f, extra_length)
+    header += extra
+
+    position = 0
+    while position + 4 <= len(extra):
+        subfield, subfield_length = struct.unpack_from('<2sH', extra, position)
+        if subfield == _BGZF_SUBFIELD and subfield_length == 2:
+            # How big the whole member is, less one
+            block_size = struct.unpack_from('<H', extra, position + 4)[0] + 1
+            if block_size < len(header) + 8:
+                raise gzip.BadGzipFile(f'BGZF block is {block_size} bytes, which is too short')
+            return header + _read_exactly(f, block_size - len(header)), b''
+        position += 4 + subfield_length
+
+    return None, header
+
+
+def _iter_bgzf_inflated(f: BinaryIO, threads: int) -> Iterator[bytes]:
+    """
+    Inflates BGZF blocks on threads of their own, as many at once as there are threads, in the order they are in.
+    zlib lets go of the GIL while it inflates, so the threads do inflate at the same time
+    Anything after the last BGZF block is inflated one member after another, on the thread that reads them
+    """
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque()  # type: collections.deque[Future]
+        try:
+            while True:
+                block, already_read = _read_bgzf_block(f)
+                if block is None:
+                    break
+
+                # Each block is a whole member, so zlib checks its CRC and size as well
+                pending.append(executor.submit(zlib.decompress, block, _GZIP_WBITS))
+                if len(pending) >= threads * BLOCKS_PER_THREAD:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        except zlib.error as e:
+            raise gzip.BadGzipFile(str(e))
+        finally:
+            for future in pending:
+                future.cancel()
+
+    yield from _iter_inflated(f, already_read)
+
+
+class _END:
+    # Put on the queue once there is nothing else to put on it
+    pass
+
+
+class _PrefetchReader(io.RawIOBase):
+    """
+    Reads what chunks returns, as it is returned, on a thread of its own, QUEUE_DEPTH chunks ahead of whoever reads this
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        super().__init__()
+        self._queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, args=(chunks,), name='decompress_prefetch', daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        # Gives up as soon as the reader is closed, rather than waiting on it forever
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, chunks: Iterator[bytes]) -> None:
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except BaseException as e:
+            # Raised on whoever is reading instead
+            self._put(e)
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while len(self._chunk) == 0:
+            if self._done:
+                return 0
+
+            item = self._queue.get()
+            if item is _END:
+                self._done = True
+                return 0
+            if isinstance(item, BaseException):
+                self._done = True
+                raise item
+            self._chunk = memoryview(item)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+        super().close()
+
+
+class _ExternalReader(io.RawIOBase):
+    """
+    Reads what tool decompresses out of f, in a process of its own
+    """
+
+    def __init__(self, f: BinaryIO, tool: str):
+        super().__init__()
+        self._tool = tool
+        self._feeder = None  # type: Optional[threading.Thread]
+
+        try:
+            stdin = f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # Views of files inside of other ones have no file of their own to hand over, so they are fed through a pipe
+            stdin = subprocess.PIPE
+
+        self._process = subprocess.Popen([tool, '-d', '-c'] + _EXTERNAL_TOOL_ARGS.get(tool, []), stdin=stdin,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if stdin == subprocess.PIPE:
+            self._feeder = threading.Thread(target=self._feed, args=(f,), name='decompress_feeder', daemon=True)
+            self._feeder.start()
+
+    def _feed(self, f: BinaryIO) -> None:
+        try:
+            while True:
+                data = f.read(READ_SIZE)
+                if len(data) == 0:
+                    break
+                self._process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            # The tool is gone, or was killed since nobody is reading anymore
+            pass
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = self._process.stdout.readinto(buffer)
+        if size == 0:
+            # Anything the tool didn't like shows up in how it exits, not in what it wrote
+            if self._feeder is not None:
+                self._feeder.join()
+            stderr = self._process.stderr.read()
+            if self._process.wait() != 0:
+                raise OSError(f'{self._tool} exited with {self._process.returncode}: '
+                              f'{stderr.decode(errors="replace").strip()}')
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            if self._feeder is not None:
+                self._feeder.join()
+            self._process.stdout.close()
+            self._process.stderr.close()
+        super().close()
+
+
+def _iter_read(f: BinaryIO) -> Iterator[bytes]:
+    with f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def _open_in_process(f: BinaryIO, compression: str) -> BinaryIO:
+    # bz2, lzma and zstandard all let go of the GIL while they decompress, same as zlib
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == XZ:
+        return lzma.LZMAFile(f)
+    elif compression == BZIP2:
+        return bz2.BZ2File(f)
+    elif compression == ZSTD:
+        return zstandard.ZstdDecompressor().stream_reader(f, read_size=READ_SIZE, read_across_frames=True,
+                                                          closefd=False)
+
+    raise ValueError(f'Unknown compression {compression}')
+
+
+def open_stream(f: BinaryIO, compression: str = GZIP) -> BinaryIO:
+    """
+    :param f: The compressed stream, only ever read forwards, it has to stay open for as long as what this returns is
+    :param compression: One of COMPRESSIONS
+    :return: The decompressed stream, decompressed the way use_mode said to
+    """
+
+    tool = find_external_tool(compression) if _mode == DECOMPRESS_MODE_EXTERNAL else None
+    if tool is None and compression == ZSTD and zstandard is None:
+        tool = find_external_tool(compression)
+        if tool is None:
+            raise FileNotFoundError(f'TZSTs need the zstandard package, or one of '
+                                    f'{", ".join(EXTERNAL_TOOLS[ZSTD])} on the PATH')
+
+    if tool is not None:
+        return io.BufferedReader(_ExternalReader(f, tool), READ_SIZE)
+
+    if _mode == DECOMPRESS_MODE_PYTHON:
+        return _open_in_process(f, compression)
+
+    if compression == GZIP:
+        chunks = _iter_bgzf_inflated(f, os.cpu_count() or 1)
+    else:
+        chunks = _iter_read(_open_in_process(f, compression))
+    return io.BufferedReader(_PrefetchReader(chunks), READ_SIZE)
@@ -42,6 +42,30 @@ class UnpackContext:
         self.unpacked_dir_location = None  # type: str | None
         self.parent_ctx = parent_ctx  # type: UnpackContext | None
 
+        # Set by handlers that mount the file instead of extracting it, the file has to stay put until cleanup
+        self.depends_on_source = False  # type: bool
+
+        # Set by handlers that send files straight to clamd, instead of leaving them in unpacked_dir_location
+        # Only the files that clamd had something to say about are kept, as (clamdscan return code, clamd's reply)
+        self.streamed_results = []  # type: list[tuple[int, str]]
+
+        # Files in unpacked_dir_location that have been unpacked into contexts of their own
+        # Their contents get scanned through those contexts, so there is no need to scan the files themselves
+        self.covered_paths = set()  # type: set[str]
+
+        # Every regular file in unpacked_dir_location, as found by the walk for nested archives
+        # Lets the scanner hand clamd exactly these files, instead of having clamd walk the whole directory again
+        # None until the directory has been walked, and left that way if the walk could not get into all of it
+        self.inventory = None  # type: list[file_data.FileMetadata] | None
+
+        # The path, mode and size of every file in unpacked_dir_location, for handlers that already know them
+        # The walk for nested archives goes through these instead of the directory, and sets it back to None once done
+        self.listing = None  # type: list[tuple[str, int, int]] | None
+
+        # Nested archives that were left where they are in the file, rather than extracted to unpacked_dir_location
+        # They are never on disk for the walk for nested archives to find, so they are handed to it from here
+        self.views = []  # type: list[file_data.FileMetadata]
+
     def create_tmp_dir(self):
         self.unpacked_dir_location = tmp_files.make_temp_dir(self.file_meta, self.enclosing_tmp_dir)
 
@@ -26,10 +26,12 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import os
 import stat
 from enum import Enum
 from textwrap import dedent
+from typing import BinaryIO, Optional
 
 import humanize
 import magic
@@ -43,6 +45,10 @@ class FileType(Enum):
     VMDK = (4, 'vmdk')
     TARGZ = (5, 'tgz')  # This cannot be tar.gz, since that would conflict with tar during detection
     QCOW2 = (6, 'qcow2')
+    # Same as TARGZ, and none of these can start with tar either
+    TARZST = (7, 'tzst')
+    TARXZ = (8, 'txz')
+    TARBZ2 = (9, 'tbz2')
 
     # Directories don't need unpacked, this just fits it into the same pattern
     DIR = (97, 'dir')
@@ -55,6 +61,77 @@ class FileType(Enum):
         return self.value[1]
 
 
+# Views are read through a buffer this big, zipfile in particular reads a few bytes at a time
+VIEW_BUFFER_SIZE = 64 * 1024
+
+
+class _ViewReader(io.RawIOBase):
+    def __init__(self, view: 'FileView'):
+        super().__init__()
+        self._view = view
+        self._position = 0
+        self._fd = os.open(view.source_path, os.O_RDONLY)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._view.length
+
+        if offset < 0:
+            raise ValueError(f'Unable to seek to {offset}')
+
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        left = self._view.length - self._position
+        if left <= 0:
+            return 0
+
+        data = os.pread(self._fd, min(len(buffer), left), self._view.offset + self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class FileView:
+    """
+    A file that is stored as it is inside of another one, like a member of an uncompressed tar.
+    It is read from right where it is, with pread, instead of being copied out first.
+    """
+
+    def __init__(self, source_path: str, offset: int, length: int):
+        # The file that it is stored in
+        self.source_path = source_path
+        self.offset = offset
+        self.length = length
+
+    def sub_view(self, offset: int, length: int) -> 'FileView':
+        # A file stored inside of this one, offset is from the start of this one
+        return FileView(self.source_path, self.offset + offset, length)
+
+    def open(self) -> BinaryIO:
+        return io.BufferedReader(_ViewReader(self), buffer_size=VIEW_BUFFER_SIZE)
+
+    def __str__(self):
+        return f'{self.length} bytes at {self.offset} in {self.source_path}'
+
+
 # A data class to store metadata, plus some pretty printing
 class FileMetadata:
     def __init__(self):
@@ -63,6 +140,9 @@ class FileMetadata:
         self.size_raw = 0
         self.filetype = FileType.UNKNOWN
         self.root_meta = None
+        # Set for files that were left where they are inside of another file, path is where they would have been
+        # extracted to, and doesn't exist
+        self.view = None  # type: Optional[FileView]
 
     def get_filename(self) -> str:
         return os.path.basename(self.path)
@@ -78,6 +158,40 @@ class FileMetadata:
 DIRECTORY_DESC = 'Directory'
 UNKNOWN_DESC = 'Unknown file type'
 DNE_DESC = 'File does not exist'
+SKIPPED_DESC = 'Below size threshold, not inspected'
+
+# Signatures of the file types we know how to unpack, as (offset, magic bytes, description)
+# The descriptions are what libmagic would say, so _get_filetype works the same for sniffed and libmagic results
+TAR_DESC = 'POSIX tar archive'
+ZIP_DESC = 'Zip archive data'
+ISO_DESC = 'ISO 9660 CD-ROM filesystem data'
+VMDK_DESC = 'VMware4 disk image'
+GZIP_DESC = 'gzip compressed data'
+QCOW2_DESC = 'QEMU QCOW2 Image'
+ZSTD_DESC = 'Zstandard compressed data'
+XZ_DESC = 'XZ compressed data'
+BZIP2_DESC = 'bzip2 compressed data'
+
+HEADER_SIGNATURES = [
+    (0, b'\x1f\x8b', GZIP_DESC),
+    (0, b'KDMV', VMDK_DESC),
+    (0, b'QFI\xfb\x00\x00\x00\x02', QCOW2_DESC),
+    (0, b'QFI\xfb\x00\x00\x00\x03', QCOW2_DESC),
+    (0, b'PK\x03\x04', ZIP_DESC),
+    (257, b'ustar', TAR_DESC),
+    (0x8001, b'CD001', ISO_DESC),
+    (0, b'\x28\xb5\x2f\xfd', ZSTD_DESC),
+    (0, b'\xfd7zXZ\x00', XZ_DESC),
+] + [
+    # BZh is too short to go on by itself, it's followed by the block size, and then by the magic of the first block
+    (0, b'BZh%d1AY&SY' % level, BZIP2_DESC) for level in range(1, 10)
+]
+
+# JARs, Office documents and friends are all zip files as well, libmagic knows how to tell them apart, we don't
+AMBIGUOUS_DESCS = [ZIP_DESC]
+
+# Enough to cover every signature above (the ISO one is the furthest out) with a single read
+HEADER_READ_SIZE = max(offset + len(signature) for offset, signature, _ in HEADER_SIGNATURES)
 
 
 def _get_filetype(desc) -> FileType:
@@ -93,6 +207,12 @@ def _get_filetype(desc) -> FileType:
         return FileType.TARGZ
     elif desc.startswith('QEMU QCOW2 Image'):
         return FileType.QCOW2
+    elif desc.startswith('Zstandard compressed data'):
+        return FileType.TARZST
+    elif desc.startswith('XZ compressed data'):
+        return FileType.TARXZ
+    elif desc.startswith('bzip2 compressed data'):
+        return FileType.TARBZ2
     else:
         return FileType.UNKNOWN
 
@@ -128,3 +248,193 @@ def file_meta_from_path(path: str) -> 'FileMetadata':
         rv.desc = DNE_DESC
 
     return rv
+
+
+def _match_signatures(header: bytes) -> str:
+    """
+    :param header: The first HEADER_READ_SIZE bytes of a file, or all of it if it is shorter than that
+    :return: The description of the matching signature in HEADER_SIGNATURES, or '' if nothing matched
+    """
+
+    for offset, signature, desc in HEADER_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return desc
+
+    return ''
+
+
+def _sniff_desc(path: str) -> str:
+    """
+    Reads the start of the file once, and matches it against HEADER_SIGNATURES
+    :param path: Path to a regular file
+    :return: The description of the matching signature, or '' if nothing matched
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        header = os.pread(fd, HEADER_READ_SIZE, 0)
+    finally:
+        os.close(fd)
+
+    return _match_signatures(header)
+
+
+def _header_desc(header: bytes) -> str:
+    desc = _match_signatures(header)
+    if desc == '' or desc in AMBIGUOUS_DESCS:
+        desc = magic.from_buffer(header, mime=False)
+
+    return desc
+
+
+def filetype_from_header(header: bytes) -> FileType:
+    """
+    Same as classify_file, but for data that was never written to disk, like the members of an archive
+    :param header: The first HEADER_READ_SIZE bytes of the data, or all of it if it is shorter than that
+    :return: The filetype of the data
+    """
+
+    return _get_filetype(_header_desc(header))
+
+
+def classify_view(path: str, view: FileView, header: bytes) -> 'FileMetadata':
+    """
+    Same as classify_file, for a file that is read where it is, instead of from path
+    :param path: Where the file would have been extracted to
+    :param view: Where the file actually is
+    :param header: The first HEADER_READ_SIZE bytes of the file, or all of it if it is shorter than that
+    """
+
+    rv = FileMetadata()
+    rv.path = path
+    rv.view = view
+    rv.size_raw = view.length
+    rv.desc = _header_desc(header)
+    rv.filetype = _get_filetype(rv.desc)
+
+    return rv
+
+
+def _classify_link_target(rv: FileMetadata, target_st: os.stat_result) -> 'FileMetadata':
+    # file_meta_from_path follows links for the existence and directory checks, but never reads through them
+    if stat.S_ISDIR(target_st.st_mode):
+        rv.filetype = FileType.DIR
+        rv.desc = DIRECTORY_DESC
+    else:
+        rv.filetype = FileType.UNKNOWN
+        rv.desc = UNKNOWN_DESC
+    return rv
+
+
+def _does_not_exist(rv: FileMetadata) -> 'FileMetadata':
+    rv.filetype = FileType.DOES_NOT_EXIST
+    rv.desc = DNE_DESC
+    return rv
+
+
+def _classify_lstat(rv: FileMetadata, st_mode: int, st_size: int, min_file_size: int) -> 'FileMetadata':
+    """
+    Everything classify_file does once it knows the file is not a symlink
+    :param rv: Metadata with just the path filled in
+    :param st_mode: The mode from the lstat of rv.path
+    :param st_size: The size from the lstat of rv.path
+    """
+
+    if stat.S_ISDIR(st_mode):
+        rv.filetype = FileType.DIR
+        rv.desc = DIRECTORY_DESC
+        return rv
+
+    if not stat.S_ISREG(st_mode):
+        rv.filetype = FileType.UNKNOWN
+        rv.desc = UNKNOWN_DESC
+        return rv
+
+    rv.size_raw = st_size
+
+    if rv.size_raw < min_file_size:
+        rv.filetype = FileType.UNKNOWN
+        rv.desc = SKIPPED_DESC
+        return rv
+
+    rv.desc = _sniff_desc(rv.path)
+    if rv.desc == '' or rv.desc in AMBIGUOUS_DESCS:
+        rv.desc = magic.from_file(rv.path, mime=False)
+
+    rv.filetype = _get_filetype(rv.desc)
+
+    return rv
+
+
+def classify_file(path: str, min_file_size: int) -> 'FileMetadata':
+    """
+    A cheaper version of file_meta_from_path, meant for walking large unpacked trees.
+    Files are stat'ed first, and anything below min_file_size is never opened.
+    Anything larger is identified by its header, libmagic is only used when the header is not conclusive.
+    Symlinks, directories and special files are reported the same way as file_meta_from_path does.
+    :param path: Path to classify
+    :param min_file_size: Files smaller than this are not inspected, and come back as FileType.UNKNOWN
+    :return: The metadata of the file
+    """
+
+    rv = FileMetadata()
+    rv.path = path
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return _does_not_exist(rv)
+
+    if stat.S_ISLNK(st.st_mode):
+        try:
+            return _classify_link_target(rv, os.stat(path))
+        except OSError:
+            return _does_not_exist(rv)
+
+    return _classify_lstat(rv, st.st_mode, st.st_size, min_file_size)
+
+
+def classify_entry(entry: os.DirEntry, min_file_size: int) -> 'FileMetadata':
+    """
+    Same as classify_file, for an entry that came out of os.scandir.
+    The entry already knows whether it is a symlink, and caches its stat, so a file costs a single stat at most.
+    :param entry: Entry to classify
+    :param min_file_size: Files smaller than this are not inspected, and come back as FileType.UNKNOWN
+    :return: The metadata of the file
+    """
+
+    rv = FileMetadata()
+    rv.path = entry.path
+
+    try:
+        if entry.is_symlink():
+            return _classify_link_target(rv, entry.stat())
+
+        st = entry.stat(follow_symlinks=False)
+    except OSError:
+        return _does_not_exist(rv)
+
+    return _classify_lstat(rv, st.st_mode, st.st_size, min_file_size)
+
+
+def classify_listed(path: str, st_mode: int, st_size: int, min_file_size: int) -> 'FileMetadata':
+    """
+    Same as classify_file, for a file whose lstat is already known, like the ones in a guestfs listing.
+    Nothing is stat'ed, and files below min_file_size are never opened.
+    Symlinks are never followed, they come back as FileType.UNKNOWN
+    :param path: Path to classify
+    :param st_mode: The mode from the lstat of path
+    :param st_size: The size from the lstat of path
+    :param min_file_size: Files smaller than this are not inspected, and come back as FileType.UNKNOWN
+    :return: The metadata of the file
+    """
+
+    rv = FileMetadata()
+    rv.path = path
+
+    try:
+        return _classify_lstat(rv, st_mode, st_size, min_file_size)
+    except OSError:
+        # Got as far as opening it, so the size is already filled in
+        rv.size_raw = 0
+        return _does_not_exist(rv)
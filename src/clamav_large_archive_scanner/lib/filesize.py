@@ -30,6 +30,8 @@
 from _decimal import InvalidOperation
 from decimal import Decimal
 
+import humanize
+
 # Stops at Terabytes, because Cisco doesn't generate binaries beyond that
 FILESIZE_UNITS = {
     'B': 1,
@@ -72,3 +74,10 @@ def convert_human_to_machine_bytes(human_bytes: str):
         return Decimal(size) * FILESIZE_UNITS[unit]
     except InvalidOperation:
         raise ValueError(f'{size} is not a valid number')
+
+
+# Used to compare how fast different ways of getting at the same files are, e.g. 12 files, 1.2 GiB in 3.4s (361.4 MiB/s)
+def describe_throughput(file_count: int, byte_count: int, seconds: float) -> str:
+    rate = byte_count / seconds if seconds > 0 else 0
+    return f'{file_count} files, {humanize.naturalsize(byte_count, binary=True)} in {seconds:.1f}s ' \
+           f'({humanize.naturalsize(rate, binary=True)}/s)'
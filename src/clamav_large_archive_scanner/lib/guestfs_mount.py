@@ -0,0 +1,474 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Mounts every filesystem in a disk image under a single directory, with a single libguestfs appliance
+# guestmount can only put a filesystem where the guest already has a directory for it, so mounting them all with
+# guestmount takes one appliance per partition, plus another one for virt-filesystems to find them in the first place
+#
+# Runs as a process of its own, the same way guestmount does, so that the mount outlives whoever asked for it:
+#   python -m clamav_large_archive_scanner.lib.guestfs_mount [--format=<format>] <disk image> <mount point> [<listing file>]
+# Once the mount is up, prints {"mounted": [filesystems], "failed": {filesystem: error}, "listed": true/false},
+# or {"error": why} if it isn't. guestunmount <mount point> takes it down again, same as for guestmount
+#
+# With a listing file, every file in the image is listed with its mode and size from inside the appliance first,
+# which takes a handful of round trips per directory, instead of a stat per file through FUSE.
+# See write_listing for the format, and read_listing to read it back
+#
+# TarOut gets the files out without mounting anything on the host, by having the appliance send each filesystem as a tar
+# and AppliancePool keeps the appliances it uses booted from one image to the next, where libguestfs allows it
+
+import json
+import os
+import stat
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+try:
+    import guestfs
+except ImportError:
+    # The bindings come with the OS packages (python3-guestfs), not from pip, guestmount is used without them
+    guestfs = None
+
+# Nothing to scan in these
+IGNORED_FILESYSTEM_TYPES = ['swap', 'unknown']
+
+# How many files in a directory to stat with one lstatnslist, it has to fit in a single libguestfs message
+LSTATNS_BATCH_SIZE = 1000
+# The listing, and whatever is left over at the end of a tar_out, is read this much at a time
+LISTING_READ_SIZE = 1024 * 1024
+
+
+def is_available() -> bool:
+    return guestfs is not None
+
+
+def partition_dir_name(partition: str) -> str:
+    # Most partitions will contain the "/" character, so it needs to be replaced
+    return partition.replace('/', '++')
+
+
+def new_handle() -> 'guestfs.GuestFS':
+    return guestfs.GuestFS(python_return_dict=True)
+
+
+def _format_opts(image_format: Optional[str]) -> dict:
+    # libguestfs works the format out of whole files itself, it has to be told for a loop device over part of one
+    return {} if image_format is None else {'format': image_format}
+
+
+def open_image(image_path: str, image_format: Optional[str] = None) -> 'guestfs.GuestFS':
+    """
+    Boots an appliance with the image attached, read only
+    :param image_format: vmdk or qcow2, if libguestfs can't be left to work it out
+    """
+
+    g = new_handle()
+    g.add_drive_opts(image_path, readonly=1, **_format_opts(image_format))
+    g.launch()
+
+    return g
+
+
+def mount_filesystems(g: 'guestfs.GuestFS') -> tuple[list[str], dict[str, str]]:
+    """
+    Mounts every filesystem in the image read only, each one in a directory of its own at the root,
+    named the same way as the directories that mount_tools.mount_guestfs_partition makes
+    :param g: Handle with the image attached, and launched
+    :return: The filesystems that got mounted, and the error for each one that didn't
+    """
+
+    mounted = []  # type: list[str]
+    failed = {}  # type: dict[str, str]
+
+    for filesystem, filesystem_type in sorted(g.list_filesystems().items()):
+        if filesystem_type in IGNORED_FILESYSTEM_TYPES:
+            continue
+
+        mount_point = '/' + partition_dir_name(filesystem)
+        g.mkmountpoint(mount_point)
+        try:
+            g.mount_ro(filesystem, mount_point)
+        except RuntimeError as e:
+            g.rmmountpoint(mount_point)
+            failed[filesystem] = str(e)
+            continue
+
+        mounted.append(filesystem)
+
+    return mounted, failed
+
+
+def _group_by_dir(names: list[bytes]) -> dict[bytes, list[bytes]]:
+    names_by_dir = {}  # type: dict[bytes, list[bytes]]
+    for name in names:
+        a_dir, base_name = os.path.split(name)
+        names_by_dir.setdefault(a_dir, []).append(base_name)
+
+    return names_by_dir
+
+
+def write_listing(g: 'guestfs.GuestFS', listing_path: str) -> None:
+    """
+    Lists every file under the root, which is every mounted filesystem, directories left out.
+    find0 gets all of the names in one call, and lstatnslist gets the stats for a whole directory at a time.
+    The listing is made of NUL terminated fields, three for each file: its mode and size, in decimal,
+    then its path relative to the root
+    :param g: Handle with the filesystems mounted
+    :param listing_path: Local file to write the listing to
+    """
+
+    with tempfile.NamedTemporaryFile(prefix='clam_unpacker_find0_') as names_file:
+        g.find0('/', names_file.name)
+        names = [name for name in names_file.read().split(b'\0') if name != b'']
+
+    with open(listing_path, 'wb') as listing:
+        for a_dir, base_names in _group_by_dir(names).items():
+            for start in range(0, len(base_names), LSTATNS_BATCH_SIZE):
+                batch = base_names[start:start + LSTATNS_BATCH_SIZE]
+                stats = g.lstatnslist(os.fsdecode(b'/' + a_dir), [os.fsdecode(x) for x in batch])
+
+                for base_name, a_stat in zip(batch, stats):
+                    if stat.S_ISDIR(a_stat['st_mode']):
+                        continue
+
+                    listing.write(f'{a_stat["st_mode"]}\0{a_stat["st_size"]}\0'.encode())
+                    listing.write(os.path.join(a_dir, base_name) + b'\0')
+
+
+def _iter_fields(listing: BinaryIO) -> Iterator[bytes]:
+    leftover = b''
+    while True:
+        chunk = listing.read(LISTING_READ_SIZE)
+        if chunk == b'':
+            return
+
+        fields = (leftover + chunk).split(b'\0')
+        # The last one isn't terminated yet, it carries on in the next chunk
+        leftover = fields.pop()
+        yield from fields
+
+
+def read_listing(listing_path: str, mount_point: str) -> Iterator[tuple[str, int, int]]:
+    """
+    Reads back what write_listing wrote
+    :param listing_path: The listing
+    :param mount_point: Where the root that was listed is mounted
+    :return: The path of every file where it is mounted, along with its mode and size
+    """
+
+    with open(listing_path, 'rb') as listing:
+        fields = _iter_fields(listing)
+        for mode in fields:
+            size = next(fields)
+            path = next(fields)
+            yield os.path.join(mount_point, os.fsdecode(path)), int(mode), int(size)
+
+
+@contextmanager
+def _tar_out_stream(g: 'guestfs.GuestFS', directory: str) -> Iterator[BinaryIO]:
+    """
+    Has the appliance tar up a directory, and hands the tar over as it comes out, through a pipe
+    :param g: Handle with the filesystems mounted
+    :param directory: Directory in the appliance to tar up
+    :return: The read end of the pipe. If the tar couldn't be made, whatever was read of it is cut short,
+        and RuntimeError is raised on the way out
+    """
+
+    read_fd, write_fd = os.pipe()
+    errors = []  # type: list[RuntimeError]
+
+    def _write() -> None:
+        try:
+            # libguestfs opens the file itself, and /dev/fd/N is the write end of the pipe in this very process
+            g.tar_out(directory, f'/dev/fd/{write_fd}', numericowner=True)
+        except RuntimeError as e:
+            errors.append(e)
+        finally:
+            # Lets the reader see the end of the tar
+            os.close(write_fd)
+
+    writer = threading.Thread(target=_write, name='tar-out', daemon=True)
+    writer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as stream:
+            yield stream
+
+            # Readers stop at the end of the tar, but tar_out doesn't finish until the padding after it is read as well
+            while stream.read(LISTING_READ_SIZE) != b'':
+                pass
+    finally:
+        # With the read end closed, a tar_out that isn't done yet fails on its next write, and doesn't hang
+        writer.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+class AppliancePool:
+    """
+    Hands out appliances with an image attached, and keeps up to size of them booted once they are given back,
+    so the next image doesn't have to wait for one to boot.
+    An appliance can only be reused if the image can be swapped out while it is running, which libguestfs only does
+    with its libvirt backend. With any other backend, every image still gets an appliance of its own.
+    Either way, no more appliances than fit in memory_limit_mb are running at the same time, borrow waits for one
+    to be given back otherwise. Thread safe.
+    """
+
+    # Drive label of the borrowed image, there is only ever one per appliance
+    IMAGE_LABEL = 'image'
+
+    def __init__(self, size: int, memory_limit_mb: int = 0):
+        self.size = size
+        # 0 for no limit. A single appliance is let through even if it doesn't fit, or nothing would ever run
+        self.memory_limit_mb = memory_limit_mb
+
+        self._cond = threading.Condition()
+        # Booted appliances with nothing attached, newest last
+        self._idle = []  # type: list[guestfs.GuestFS]
+        # Memory of every appliance that is running, idle or not
+        self._running_mb = 0
+        # Until libguestfs says otherwise
+        self._hotplug = True
+
+    def _reserve(self, memsize_mb: int) -> None:
+        with self._cond:
+            while self.memory_limit_mb > 0 and self._running_mb > 0 and \
+                    self._running_mb + memsize_mb > self.memory_limit_mb:
+                if len(self._idle) > 0:
+                    # Nobody is using it, and something that is about to be used needs the memory
+                    self._shut_down(self._idle.pop(0))
+                    continue
+                self._cond.wait()
+
+            self._running_mb += memsize_mb
+
+    def _shut_down(self, g: 'guestfs.GuestFS') -> None:
+        # With _cond held
+        memsize_mb = g.get_memsize()
+        try:
+            g.shutdown()
+            g.close()
+        finally:
+            self._running_mb -= memsize_mb
+            self._cond.notify_all()
+
+    def _take_idle(self) -> Optional['guestfs.GuestFS']:
+        with self._cond:
+            if not self._hotplug or len(self._idle) == 0:
+                return None
+            return self._idle.pop()
+
+    def _attach(self, g: 'guestfs.GuestFS', image_path: str, image_format: Optional[str]) -> bool:
+        try:
+            g.add_drive_opts(image_path, readonly=1, label=self.IMAGE_LABEL, **_format_opts(image_format))
+        except RuntimeError:
+            # Not with this backend, no point in keeping any of them around
+            with self._cond:
+                self._hotplug = False
+                self._shut_down(g)
+                while len(self._idle) > 0:
+                    self._shut_down(self._idle.pop())
+            return False
+
+        return True
+
+    def borrow(self, image_path: str, image_format: Optional[str] = None) -> 'guestfs.GuestFS':
+        """
+        :param image_format: Same as for open_image
+        :return: A booted appliance with the image attached read only, give it back once done with it
+        """
+
+        g = self._take_idle()
+        if g is not None and self._attach(g, image_path, image_format):
+            return g
+
+        g = new_handle()
+        self._reserve(g.get_memsize())
+        try:
+            g.add_drive_opts(image_path, readonly=1, label=self.IMAGE_LABEL, **_format_opts(image_format))
+            g.launch()
+        except RuntimeError:
+            with self._cond:
+                self._shut_down(g)
+            raise
+
+        return g
+
+    def _detach(self, g: 'guestfs.GuestFS') -> bool:
+        if not self._hotplug:
+            return False
+
+        try:
+            g.umount_all()
+            # mount_filesystems leaves its mount points behind
+            for name in g.ls('/'):
+                g.rmmountpoint('/' + name)
+            g.remove_drive(self.IMAGE_LABEL)
+        except RuntimeError:
+            return False
+
+        return True
+
+    def give_back(self, g: 'guestfs.GuestFS') -> None:
+        detached = self._detach(g)
+        with self._cond:
+            if detached and len(self._idle) < self.size:
+                self._idle.append(g)
+                self._cond.notify_all()
+                return
+
+            self._shut_down(g)
+
+    def close(self) -> None:
+        with self._cond:
+            while len(self._idle) > 0:
+                self._shut_down(self._idle.pop())
+
+
+class TarOut:
+    """
+    Mounts every filesystem in the image inside the appliance only, and streams each one out as a tar.
+    Nothing goes through FUSE, so the files are read out in the order they are on disk, with no round trip per file
+    """
+
+    def __init__(self, image_path: str, pool: Optional[AppliancePool] = None, image_format: Optional[str] = None):
+        # If set, the appliance comes from here, and goes back once done with
+        self.pool = pool
+        if pool is None:
+            self.g = open_image(image_path, image_format)
+        else:
+            self.g = pool.borrow(image_path, image_format)
+        try:
+            # The filesystems that got mounted, and the error for each one that didn't
+            self.mounted, self.failed = mount_filesystems(self.g)
+        except RuntimeError:
+            self.close()
+            raise
+
+    def iter_streams(self) -> Iterator[tuple[str, BinaryIO]]:
+        """
+        :return: For each mounted filesystem, the name of the directory it would have been mounted on by
+            mount_filesystems, and its tar. The tar is only good until the next one is asked for
+        """
+
+        for filesystem in self.mounted:
+            dir_name = partition_dir_name(filesystem)
+            with _tar_out_stream(self.g, '/' + dir_name) as stream:
+                yield dir_name, stream
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.give_back(self.g)
+            return
+
+        self.g.shutdown()
+        self.g.close()
+
+
+def _report(ready_fd: int, report: dict) -> None:
+    with os.fdopen(ready_fd, 'w') as ready:
+        ready.write(json.dumps(report))
+
+
+def _try_write_listing(g: 'guestfs.GuestFS', listing_path: str) -> bool:
+    try:
+        write_listing(g, listing_path)
+    except (RuntimeError, UnicodeError):
+        # Whoever asked for it can still walk the mount instead
+        return False
+
+    return True
+
+
+def _serve(image_path: str, mount_point: str, listing_path: Optional[str], ready_fd: int,
+           image_format: Optional[str] = None) -> None:
+    try:
+        g = open_image(image_path, image_format)
+        mounted, failed = mount_filesystems(g)
+        listed = listing_path is not None and _try_write_listing(g, listing_path)
+        g.mount_local(mount_point, readonly=True, options='allow_other')
+    except RuntimeError as e:
+        _report(ready_fd, {'error': str(e)})
+        return
+
+    _report(ready_fd, {'mounted': mounted, 'failed': failed, 'listed': listed})
+
+    # Answers FUSE requests until the mount point is un-mounted
+    g.mount_local_run()
+    g.shutdown()
+    g.close()
+
+
+def main(argv: list[str]) -> int:
+    image_format = None
+    if len(argv) > 0 and argv[0].startswith('--format='):
+        image_format = argv[0][len('--format='):]
+        argv = argv[1:]
+
+    if len(argv) not in [2, 3]:
+        print(json.dumps({'error': 'Usage: guestfs_mount [--format=<format>] <disk image> <mount point> '
+                                   '[<listing file>]'}))
+        return 1
+
+    if not is_available():
+        print(json.dumps({'error': 'The libguestfs Python bindings are not installed'}))
+        return 1
+
+    image_path, mount_point = argv[:2]
+    listing_path = argv[2] if len(argv) == 3 else None
+    ready_read, ready_write = os.pipe()
+
+    if os.fork() == 0:
+        # Gets a session of its own, and lets go of the caller's stdout and stderr, so nobody waits on it to exit
+        os.close(ready_read)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in [0, 1, 2]:
+            os.dup2(devnull, fd)
+
+        try:
+            _serve(image_path, mount_point, listing_path, ready_write, image_format)
+        finally:
+            os._exit(0)
+
+    os.close(ready_write)
+    with os.fdopen(ready_read) as ready:
+        report = ready.read()
+
+    if report == '':
+        report = json.dumps({'error': 'The mount process exited before the mount was up'})
+
+    print(report)
+    return 1 if 'error' in json.loads(report) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
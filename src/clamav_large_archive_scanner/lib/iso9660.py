@@ -0,0 +1,416 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Reads the files out of an ISO 9660 image without mounting it
+# Everything is read with pread, directory records as well as file data, so there is no loop device, no root, and no
+# limit on how many images are read at once. Rock Ridge names are used if the image has them, Joliet names if not, and
+# the plain ISO 9660 names if it has neither
+
+import os
+import stat
+import struct
+from typing import Iterator, Optional
+
+from clamav_large_archive_scanner.lib.exceptions import IsoException
+
+SECTOR_SIZE = 2048
+
+# The volume descriptors start right after the system area
+FIRST_DESCRIPTOR_SECTOR = 16
+# Real images have a handful, anything past this is not an image worth reading
+MAX_DESCRIPTORS = 64
+
+DESCRIPTOR_PRIMARY = 1
+DESCRIPTOR_SUPPLEMENTARY = 2
+DESCRIPTOR_TERMINATOR = 255
+
+# The escape sequences that make a supplementary descriptor a Joliet one, for UCS-2 levels 1, 2 and 3
+JOLIET_ESCAPES = [b'%/@', b'%/C', b'%/E']
+
+FLAG_DIRECTORY = 0x02
+# Files over 4G are split across records, every one of them but the last has this set
+FLAG_MORE_EXTENTS = 0x80
+
+# Rock Ridge alternate name flags, for names that stand for . and ..
+NM_CURRENT = 0x02
+NM_PARENT = 0x04
+
+# Directories are read this much at a time, records never cross a sector
+DIRECTORY_READ_SIZE = 32 * SECTOR_SIZE
+
+# System use areas can continue elsewhere, which can just as well loop back on itself
+MAX_CONTINUATIONS = 16
+
+_RECORD_HEADER_LENGTH = 33
+
+
+def _le32(data: bytes, offset: int) -> int:
+    # Numbers are stored both ways round, the little endian half comes first
+    return struct.unpack_from('<I', data, offset)[0]
+
+
+def _le16(data: bytes, offset: int) -> int:
+    return struct.unpack_from('<H', data, offset)[0]
+
+
+def _strip_version(name: str) -> str:
+    # FILE.TXT;1 is FILE.TXT, and a name without an extension is written as README.
+    name = name.split(';')[0]
+    if name.endswith('.'):
+        name = name[:-1]
+    return name
+
+
+def _safe_component(name: str) -> str:
+    # Rock Ridge and Joliet names can hold anything, but each one is only ever a single path component
+    name = name.replace('/', '_').replace('\x00', '_')
+    if name in ('', '.', '..'):
+        return '_'
+    return name
+
+
+class _Record:
+    """
+    A directory record, with just the fields that are needed to find the files
+    """
+
+    def __init__(self, data: bytes):
+        if len(data) < _RECORD_HEADER_LENGTH or _RECORD_HEADER_LENGTH + data[32] > len(data):
+            raise IsoException(f'Directory record of {len(data)} bytes is too short')
+
+        self.extended_attribute_length = data[1]
+        self.extent = _le32(data, 2)
+        self.size = _le32(data, 10)
+        self.flags = data[25]
+        # Interleaved files have their data spread out in units of this many sectors
+        self.unit_size = data[26]
+
+        name_length = data[32]
+        self.raw_name = data[_RECORD_HEADER_LENGTH:_RECORD_HEADER_LENGTH + name_length]
+
+        # Names of an even length are padded out to an odd one, the system use area is what's left
+        system_use_start = _RECORD_HEADER_LENGTH + name_length + (1 - name_length % 2)
+        self.system_use = data[system_use_start:]
+
+    def is_directory(self) -> bool:
+        return self.flags & FLAG_DIRECTORY != 0
+
+    def has_more_extents(self) -> bool:
+        return self.flags & FLAG_MORE_EXTENTS != 0
+
+    def is_self_or_parent(self) -> bool:
+        # Every directory starts with its own record, then its parent's
+        return self.raw_name in (b'\x00', b'\x01')
+
+
+class _RockRidge:
+    """
+    What the Rock Ridge entries in a record's system use area have to say about it
+    """
+
+    def __init__(self):
+        self.name = None  # type: Optional[bytes]
+        self.mode = None  # type: Optional[int]
+        self.is_symlink = False
+        # A directory that was moved to keep the tree shallow, this is where it went
+        self.child_link = None  # type: Optional[int]
+        # The moved directory itself, it is found through its child link instead
+        self.is_relocated = False
+
+    def is_regular_file(self) -> bool:
+        if self.is_symlink:
+            return False
+        return self.mode is None or stat.S_ISREG(self.mode)
+
+
+class IsoFile:
+    def __init__(self, name: str, size: int, extents: list[tuple[int, int]]):
+        # Path of the file inside the image
+        self.name = name
+        self.size = size
+        # Where the data is in the image, as (offset from the start of the image, length), in order
+        self.extents = extents
+
+
+class IsoFileReader:
+    """
+    Reads a file straight out of the image, a piece at a time.
+    Readers don't share a position, so any number of them can be open at once, in any order
+    """
+
+    def __init__(self, fd: int, iso_file: IsoFile, image_offset: int = 0):
+        self._fd = fd
+        self._image_offset = image_offset
+        self._extents = iso_file.extents
+        self._extent_index = 0
+        self._extent_position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        pieces = []  # type: list[bytes]
+
+        while size != 0 and self._extent_index < len(self._extents):
+            offset, length = self._extents[self._extent_index]
+            left = length - self._extent_position
+            if left == 0:
+                self._extent_index += 1
+                self._extent_position = 0
+                continue
+
+            to_read = left if size < 0 else min(left, size)
+            data = os.pread(self._fd, to_read, self._image_offset + offset + self._extent_position)
+            if len(data) == 0:
+                raise IsoException(f'The image ends before the file does, at {offset + self._extent_position}')
+
+            pieces.append(data)
+            self._extent_position += len(data)
+            if size > 0:
+                size -= len(data)
+
+        return b''.join(pieces)
+
+
+class IsoImage:
+    """
+    An ISO 9660 image, opened for reading.
+    Files are only listed when they are asked for, and only read from when they are opened
+    """
+
+    def __init__(self, path: str, offset: int = 0):
+        """
+        :param offset: Where the image starts in the file, for images that are stored inside of another one
+        """
+
+        self.path = path
+        self.offset = offset
+        self._fd = os.open(path, os.O_RDONLY)
+
+        try:
+            self._read_volume_descriptors()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self) -> 'IsoImage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _pread(self, size: int, offset: int) -> bytes:
+        data = os.pread(self._fd, size, self.offset + offset)
+        if len(data) < size:
+            raise IsoException(f'{self.path} ends at {offset + len(data)}, expected at least {offset + size}')
+        return data
+
+    def _read_volume_descriptors(self) -> None:
+        primary = None  # type: Optional[bytes]
+        joliet = None  # type: Optional[bytes]
+
+        for index in range(MAX_DESCRIPTORS):
+            descriptor = self._pread(SECTOR_SIZE, (FIRST_DESCRIPTOR_SECTOR + index) * SECTOR_SIZE)
+            if descriptor[1:6] != b'CD001':
+                raise IsoException(f'{self.path} is not an ISO 9660 image')
+
+            if descriptor[0] == DESCRIPTOR_TERMINATOR:
+                break
+            if descriptor[0] == DESCRIPTOR_PRIMARY and primary is None:
+                primary = descriptor
+            elif descriptor[0] == DESCRIPTOR_SUPPLEMENTARY and joliet is None and descriptor[88:91] in JOLIET_ESCAPES:
+                joliet = descriptor
+
+        if primary is None:
+            raise IsoException(f'{self.path} has no primary volume descriptor')
+
+        self._use_descriptor(primary)
+        # Rock Ridge keeps the original names as they were, case, length and all, so it wins over Joliet
+        self._susp_skip = self._find_rock_ridge()
+        self._joliet = False
+
+        if self._susp_skip is None and joliet is not None:
+            self._use_descriptor(joliet)
+            self._joliet = True
+
+    def _use_descriptor(self, descriptor: bytes) -> None:
+        self._block_size = _le16(descriptor, 128)
+        if self._block_size == 0:
+            raise IsoException(f'{self.path} has a logical block size of 0')
+
+        root = _Record(descriptor[156:156 + 34])
+        self._root_extent = root.extent
+        self._root_size = root.size
+
+    def _first_record(self, extent: int) -> _Record:
+        sector = self._pread(SECTOR_SIZE, extent * self._block_size)
+        return _Record(sector[:sector[0]])
+
+    def _find_rock_ridge(self) -> Optional[int]:
+        """
+        :return: How many bytes to skip at the start of every system use area, or None if there is no Rock Ridge
+        """
+
+        # The SUSP indicator is the first entry of the root directory's own record
+        system_use = self._first_record(self._root_extent).system_use
+        if system_use[0:2] == b'SP' and len(system_use) >= 7 and system_use[4:6] == b'\xbe\xef':
+            return system_use[6]
+
+        return None
+
+    def _read_rock_ridge(self, record: _Record) -> _RockRidge:
+        rv = _RockRidge()
+        name_parts = []  # type: list[bytes]
+
+        area = record.system_use[self._susp_skip:]
+        continuations = 0
+        while len(area) > 0:
+            continuation = None  # type: Optional[tuple[int, int, int]]
+
+            position = 0
+            while position + 4 <= len(area):
+                signature = area[position:position + 2]
+                length = area[position + 2]
+                if length < 4 or position + length > len(area) or signature == b'ST':
+                    break
+
+                entry = area[position:position + length]
+                if signature == b'NM' and length >= 5:
+                    if entry[4] & (NM_CURRENT | NM_PARENT) == 0:
+                        name_parts.append(entry[5:])
+                elif signature == b'PX' and length >= 8:
+                    rv.mode = _le32(entry, 4)
+                elif signature == b'SL':
+                    rv.is_symlink = True
+                elif signature == b'CL' and length >= 8:
+                    rv.child_link = _le32(entry, 4)
+                elif signature == b'RE':
+                    rv.is_relocated = True
+                elif signature == b'CE' and length >= 28:
+                    continuation = (_le32(entry, 4), _le32(entry, 12), _le32(entry, 20))
+
+                position += length
+
+            area = b''
+            if continuation is not None and continuations < MAX_CONTINUATIONS:
+                continuations += 1
+                block, offset, length = continuation
+                area = self._pread(length, block * self._block_size + offset)
+
+        if len(name_parts) > 0:
+            rv.name = b''.join(name_parts)
+
+        return rv
+
+    def _record_name(self, record: _Record, rock_ridge: Optional[_RockRidge]) -> str:
+        if rock_ridge is not None and rock_ridge.name is not None:
+            return _safe_component(os.fsdecode(rock_ridge.name))
+
+        if self._joliet:
+            return _safe_component(_strip_version(record.raw_name.decode('utf-16-be', errors='replace')))
+
+        return _safe_component(_strip_version(os.fsdecode(record.raw_name)))
+
+    def _iter_directory(self, extent: int, size: int) -> Iterator[_Record]:
+        start = extent * self._block_size
+
+        for chunk_offset in range(0, size, DIRECTORY_READ_SIZE):
+            chunk = self._pread(min(DIRECTORY_READ_SIZE, size - chunk_offset), start + chunk_offset)
+
+            for sector_offset in range(0, len(chunk), SECTOR_SIZE):
+                sector = chunk[sector_offset:sector_offset + SECTOR_SIZE]
+
+                position = 0
+                # Whatever is left of a sector after a record length of 0 is padding
+                while position < len(sector) and sector[position] != 0:
+                    record = _Record(sector[position:position + sector[position]])
+                    position += sector[position]
+
+                    if not record.is_self_or_parent():
+                        yield record
+
+    def iter_files(self) -> Iterator[IsoFile]:
+        """
+        :return: The regular files in the image, a directory at a time. Directories, symlinks and device files, as
+            far as Rock Ridge says what they are, are skipped
+        """
+
+        # Directories are only ever read once, however many records point at them
+        seen_extents = set()  # type: set[int]
+        pending = [('', self._root_extent, self._root_size)]
+
+        while len(pending) > 0:
+            dir_name, dir_extent, dir_size = pending.pop()
+            if dir_extent in seen_extents:
+                continue
+            seen_extents.add(dir_extent)
+
+            sub_dirs = []  # type: list[tuple[str, int, int]]
+            extents = []  # type: list[tuple[int, int]]
+
+            for record in self._iter_directory(dir_extent, dir_size):
+                rock_ridge = self._read_rock_ridge(record) if self._susp_skip is not None else None
+                name = dir_name + self._record_name(record, rock_ridge)
+
+                if rock_ridge is not None and rock_ridge.is_relocated:
+                    continue
+
+                if rock_ridge is not None and rock_ridge.child_link is not None:
+                    sub_dirs.append((name + '/', rock_ridge.child_link,
+                                     self._first_record(rock_ridge.child_link).size))
+                    continue
+
+                if record.is_directory():
+                    sub_dirs.append((name + '/', record.extent, record.size))
+                    continue
+
+                if record.unit_size != 0:
+                    raise IsoException(f'{name} in {self.path} is interleaved, which is not supported')
+
+                extents.append(((record.extent + record.extended_attribute_length) * self._block_size, record.size))
+                if record.has_more_extents():
+                    continue
+
+                file_extents = extents
+                extents = []
+
+                if rock_ridge is None or rock_ridge.is_regular_file():
+                    yield IsoFile(name, sum(length for _, length in file_extents), file_extents)
+
+            # Depth first, in the order the directories are listed
+            pending.extend(reversed(sub_dirs))
+
+    def open_file(self, iso_file: IsoFile) -> IsoFileReader:
+        """
+        :param iso_file: One of the files from iter_files
+        :return: The file's data, only good for as long as the image is open
+        """
+
+        return IsoFileReader(self._fd, iso_file, self.offset)
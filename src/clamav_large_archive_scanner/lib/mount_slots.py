@@ -0,0 +1,177 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# Limits how many loop devices and libguestfs appliances are held at the same time
+# Every mounted ISO holds a loop device, and every mounted disk image a running appliance, until it is cleaned up.
+# Nested archives that would go over the limit are held back by the recursive unpacker until a slot frees up, which
+# only happens before the end of the run if something cleans up as it goes, like scan --pipeline does
+
+import threading
+import time
+from typing import Iterable, Optional
+
+import clamav_large_archive_scanner.lib.contexts as contexts
+
+LOOP_SLOT = 'loop device'
+APPLIANCE_SLOT = 'guestfs appliance'
+
+
+def _is_nested_in(u_ctx: contexts.UnpackContext, ancestor_ctx: contexts.UnpackContext) -> bool:
+    parent_ctx = u_ctx.parent_ctx
+    while parent_ctx is not None:
+        if parent_ctx is ancestor_ctx:
+            return True
+        parent_ctx = parent_ctx.parent_ctx
+
+    return False
+
+
+class MountSlots:
+    """
+    Hands out a slot to every context that gets mounted, as long as there are any left of its kind, and takes it back
+    once the context has been cleaned up. Keeps track of how long contexts had to wait for one. Thread safe.
+    """
+
+    def __init__(self, loop_limit: int = 0, appliance_limit: int = 0):
+        # 0 for no limit
+        self.limits = {LOOP_SLOT: loop_limit, APPLIANCE_SLOT: appliance_limit}
+
+        self._cond = threading.Condition()
+        self._holders = {}  # type: dict[contexts.UnpackContext, str]
+        # Contexts that could not be cleaned up, they keep their slot until the end, and nobody should wait on them
+        self._stuck = {}  # type: dict[contexts.UnpackContext, str]
+        # Bumped on every release, failed or not, so waiters can tell that something changed
+        self._releases = 0
+        # Set while something is cleaning up contexts as it goes, without it nothing is released until the end
+        self._releasing = False
+
+        # When each context that is waiting was first turned away
+        self._waiting_since = {}  # type: dict[contexts.UnpackContext, float]
+        # And what kind of slot each of them is waiting for
+        self._waiting_kinds = {}  # type: dict[contexts.UnpackContext, str]
+        self.wait_count = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # Contexts that never got a slot
+        self.given_up_count = 0
+
+    def _held(self, kind: str) -> int:
+        return sum(1 for held_kind in list(self._holders.values()) + list(self._stuck.values()) if held_kind == kind)
+
+    def _stop_waiting(self, u_ctx: contexts.UnpackContext) -> None:
+        # With _cond held
+        self._waiting_kinds.pop(u_ctx, None)
+        waiting_since = self._waiting_since.pop(u_ctx, None)
+        if waiting_since is None:
+            return
+
+        waited = time.monotonic() - waiting_since
+        self.wait_count += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def try_acquire(self, kind: str, u_ctx: contexts.UnpackContext) -> bool:
+        """
+        :return: True if u_ctx now holds a slot of kind, False if there are none left, u_ctx is then counted as
+            waiting for one until it gets one, or is given up on
+        """
+
+        with self._cond:
+            limit = self.limits[kind]
+            if limit > 0 and self._held(kind) >= limit:
+                self._waiting_since.setdefault(u_ctx, time.monotonic())
+                self._waiting_kinds[u_ctx] = kind
+                return False
+
+            self._holders[u_ctx] = kind
+            self._stop_waiting(u_ctx)
+            return True
+
+    def release(self, u_ctx: contexts.UnpackContext, failed: bool = False) -> None:
+        """
+        Fine to call for contexts that don't hold a slot
+        :param failed: Set if u_ctx could not be cleaned up, it is still mounted, so its slot stays taken, but it is no
+            longer counted on to give it back
+        """
+
+        with self._cond:
+            kind = self._holders.pop(u_ctx, None)
+            if kind is None:
+                return
+
+            if failed:
+                self._stuck[u_ctx] = kind
+
+            self._releases += 1
+            self._cond.notify_all()
+
+    def give_up(self, u_ctx: contexts.UnpackContext) -> None:
+        with self._cond:
+            self._stop_waiting(u_ctx)
+            self.given_up_count += 1
+
+    def set_releasing(self, releasing: bool) -> None:
+        with self._cond:
+            self._releasing = releasing
+            self._cond.notify_all()
+
+    def _can_release(self, waiting_ctxs: list[contexts.UnpackContext]) -> bool:
+        # With _cond held
+        # A context isn't cleaned up until everything nested in it has been unpacked, so if every holder of a kind
+        # that is being waited for has one of the waiting contexts nested in it, no slot is ever coming back
+        if not self._releasing:
+            return False
+
+        waiting_kinds = {self._waiting_kinds.get(waiting_ctx) for waiting_ctx in waiting_ctxs}
+        return any(kind in waiting_kinds and
+                   not any(_is_nested_in(waiting_ctx, holder_ctx) for waiting_ctx in waiting_ctxs)
+                   for holder_ctx, kind in self._holders.items())
+
+    def wait_for_release(self, waiting_ctxs: Iterable[contexts.UnpackContext],
+                         timeout: Optional[float] = None) -> bool:
+        """
+        Waits until a slot is released, or the timeout runs out
+        :param waiting_ctxs: Every context that is waiting on a slot, and has nothing else left to do
+        :return: False straight away if no slot will ever be released for them, True otherwise
+        """
+
+        waiting_ctxs = list(waiting_ctxs)
+        with self._cond:
+            if not self._can_release(waiting_ctxs):
+                return False
+
+            releases = self._releases
+            self._cond.wait_for(lambda: self._releases != releases or not self._releasing, timeout)
+            return True
+
+    def describe_waits(self) -> str:
+        # e.g. 3 mounts waited for a slot, 12.5s in total, 8.0s at most
+        rv = f'{self.wait_count} mounts waited for a slot, {self.wait_seconds:.1f}s in total, ' \
+             f'{self.max_wait_seconds:.1f}s at most'
+        if self.given_up_count > 0:
+            rv += f', {self.given_up_count} never got one'
+        return rv
@@ -0,0 +1,97 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# What is mounted where, as the kernel sees it
+# Reading /proc/self/mountinfo is a single read, as opposed to forking mount and picking through its output, so it is
+# read once per cleanup, and looked up by mount point from there
+
+import os
+import re
+from typing import Optional
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# Spaces, tabs, newlines and backslashes in paths are written out as octal escapes, e.g. \040 for a space
+_OCTAL_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+
+class MountEntry:
+    def __init__(self, mount_point: str, fs_type: str, source: str):
+        self.mount_point = mount_point
+        self.fs_type = fs_type
+        self.source = source
+
+    def is_fuse(self) -> bool:
+        # guestmount shows up as plain fuse, other FUSE filesystems as fuse.<name>
+        return self.fs_type == 'fuse' or self.fs_type.startswith('fuse.')
+
+
+def _unescape(field: str) -> str:
+    return _OCTAL_ESCAPE.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _parse_line(line: str) -> Optional[MountEntry]:
+    # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+    # The fields before the - have a variable number of optional fields at the end, the ones after it don't
+    fields = line.split()
+    try:
+        separator = fields.index('-', 6)
+        return MountEntry(_unescape(fields[4]), fields[separator + 1], _unescape(fields[separator + 2]))
+    except (ValueError, IndexError):
+        return None
+
+
+class MountTable:
+    """
+    The mounts at the time the table was read, by mount point.
+    Only the last mount on any mount point is kept, that's the one that can be seen, and un-mounted
+    """
+
+    def __init__(self, entries: list[MountEntry]):
+        self._by_mount_point = {entry.mount_point: entry for entry in entries}  # type: dict[str, MountEntry]
+
+    def get(self, mount_point: str) -> Optional[MountEntry]:
+        return self._by_mount_point.get(os.path.normpath(mount_point))
+
+    def is_mounted(self, mount_point: str) -> bool:
+        return self.get(mount_point) is not None
+
+    def mounts_under(self, path: str) -> list[MountEntry]:
+        """
+        :return: Everything mounted somewhere below path, not counting path itself, the deepest mount points first
+        """
+
+        prefix = os.path.join(os.path.normpath(path), '')
+        entries = [entry for mount_point, entry in self._by_mount_point.items() if mount_point.startswith(prefix)]
+        return sorted(entries, key=lambda entry: entry.mount_point.count('/'), reverse=True)
+
+
+def read_mount_table(mountinfo_path: str = MOUNTINFO_PATH) -> MountTable:
+    with open(mountinfo_path, 'r', encoding='utf-8', errors='surrogateescape') as mountinfo:
+        entries = [_parse_line(line) for line in mountinfo]
+
+    return MountTable([entry for entry in entries if entry is not None])
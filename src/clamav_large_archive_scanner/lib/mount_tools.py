@@ -27,15 +27,27 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 # This mainly exists to make UT and Mocks easier to write, but it also makes the code a bit more readable
+import json
 import os
 import subprocess
+import sys
+import tempfile
+from typing import Optional
 
+import clamav_large_archive_scanner.lib.guestfs_mount as guestfs_mount
+import clamav_large_archive_scanner.lib.mount_table as mount_table
 from clamav_large_archive_scanner.lib.exceptions import MountException
 from clamav_large_archive_scanner.lib.fast_log import trace
 
 
-def enumerate_guestfs_partitions(file_path: str) -> list[str]:
-    result = subprocess.run(['virt-filesystems', '-a', file_path], capture_output=True, text=True)
+def _format_args(image_format: Optional[str]) -> list[str]:
+    # Has to come before -a, libguestfs only works the format out of whole files
+    return [] if image_format is None else [f'--format={image_format}']
+
+
+def enumerate_guestfs_partitions(file_path: str, image_format: Optional[str] = None) -> list[str]:
+    result = subprocess.run(['virt-filesystems'] + _format_args(image_format) + ['-a', file_path],
+                            capture_output=True, text=True)
     if result.returncode != 0:
         combined_output = str(result.stdout) + '\n' + str(result.stderr)
         raise MountException(combined_output)
@@ -44,26 +56,17 @@ def enumerate_guestfs_partitions(file_path: str) -> list[str]:
     return partitions
 
 
-def _check_fuse_mounts() -> list[str]:
-    result = subprocess.run(['mount', '-t', 'fuse'], capture_output=True, text=True)
-    if result.returncode != 0:
-        trace(f'Unable to enumerate fuse mounts: {result.stderr}')
-        return []
-
-    mounts = [x for x in result.stdout.split('\n') if x != '']
-    return mounts
-
-
-def mount_guestfs_partition(archive_path: str, partition: str, parent_tmp_dir: str) -> str:
+def mount_guestfs_partition(archive_path: str, partition: str, parent_tmp_dir: str,
+                            image_format: Optional[str] = None) -> str:
     # Make a dir for the partition inside the mount_parent_dir
-    # most partitions though, will contain the "/" character, so we need to replace it
-    tmp_partition_name = partition.replace('/', '++')
+    tmp_partition_name = guestfs_mount.partition_dir_name(partition)
     partition_tmp_dir = os.path.join(parent_tmp_dir, tmp_partition_name)
     os.mkdir(partition_tmp_dir)
 
     # Actually use guestmount to mount it
     # guestmount -a /workspace/boot.vmdk -m /dev/sda1  --ro /workspace/t
-    result = subprocess.run(['guestmount', '-o', 'allow_other', '-a', archive_path, '-m', partition, '--ro', partition_tmp_dir],
+    result = subprocess.run(['guestmount', '-o', 'allow_other'] + _format_args(image_format) +
+                            ['-a', archive_path, '-m', partition, '--ro', partition_tmp_dir],
                             capture_output=True)
     if result.returncode != 0:
         # Could not mount, should remove directory
@@ -74,18 +77,129 @@ def mount_guestfs_partition(archive_path: str, partition: str, parent_tmp_dir: s
     return partition_tmp_dir
 
 
-def mount_iso(file_path: str, mount_point: str) -> None:
-    result = subprocess.run(['mount', '-r', '-o', 'loop', file_path, mount_point], capture_output=True)
+def guestfs_bindings_available() -> bool:
+    return guestfs_mount.is_available()
+
+
+def mount_guestfs_image(archive_path: str, mount_point: str, image_format: Optional[str] = None) \
+        -> tuple[list[str], dict[str, str], Optional[list[tuple[str, int, int]]]]:
+    """
+    Mounts every filesystem in the image, each one in a directory of its own in mount_point, with a single appliance.
+    The appliance lists every file in the image as well, so nobody has to walk the mount to find out what is in it.
+    Needs the libguestfs Python bindings, see guestfs_mount.py
+    :return: The filesystems that got mounted, the error for each one that didn't,
+        and the path, mode and size of every file in the mount, or None if the appliance couldn't list them
+    """
+
+    # Not in mount_point, the mount goes right on top of it
+    listing_fd, listing_path = tempfile.mkstemp(prefix='clam_unpacker_listing_', dir=os.path.dirname(mount_point))
+    os.close(listing_fd)
+
+    try:
+        result = subprocess.run([sys.executable, '-m', guestfs_mount.__name__] + _format_args(image_format) +
+                                [archive_path, mount_point, listing_path], capture_output=True, text=True)
+        try:
+            report = json.loads(result.stdout)
+        except ValueError:
+            report = {'error': str(result.stdout) + '\n' + str(result.stderr)}
+
+        if result.returncode != 0 or 'error' in report:
+            raise MountException(report.get('error', str(result.stdout) + '\n' + str(result.stderr)))
+
+        listing = None
+        if report.get('listed', False):
+            listing = list(guestfs_mount.read_listing(listing_path, mount_point))
+    finally:
+        os.remove(listing_path)
+
+    return report['mounted'], report['failed'], listing
+
+
+def open_guestfs_tar_out(archive_path: str, pool: Optional[guestfs_mount.AppliancePool] = None,
+                         image_format: Optional[str] = None) -> guestfs_mount.TarOut:
+    """
+    Boots an appliance for the image, ready to stream its filesystems out as tars, nothing is mounted on this side.
+    Needs the libguestfs Python bindings, see guestfs_mount.py
+    :param pool: If given, the appliance is borrowed from it instead
+    :param image_format: vmdk or qcow2, for images attached through attach_loop
+    """
+
+    try:
+        return guestfs_mount.TarOut(archive_path, pool, image_format)
+    except RuntimeError as e:
+        raise MountException(str(e))
+
+
+def make_guestfs_pool(size: int, memory_limit_mb: int) -> guestfs_mount.AppliancePool:
+    return guestfs_mount.AppliancePool(size, memory_limit_mb)
+
+
+def use_guestfs_cache_dir(cache_dir: str) -> None:
+    # Picked up by every appliance from here on, including the ones that guestmount and guestfs_mount.py start
+    # libguestfs builds the appliance there the first time, and reuses it for as long as it is up to date
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['LIBGUESTFS_CACHEDIR'] = cache_dir
+
+
+def mount_iso(file_path: str, mount_point: str, offset: int = 0, length: Optional[int] = None) -> None:
+    """
+    :param offset: Where the ISO starts in the file, for ISOs that are stored inside of another one
+    :param length: How long the ISO is, if it doesn't run to the end of the file
+    """
+
+    # The loop device maps just that part of the file, nothing gets copied
+    options = 'loop'
+    if offset > 0:
+        options += f',offset={offset}'
+    if length is not None:
+        options += f',sizelimit={length}'
+
+    result = subprocess.run(['mount', '-r', '-o', options, file_path, mount_point], capture_output=True)
     if result.returncode != 0:
         combined_output = str(result.stdout) + '\n' + str(result.stderr)
         raise MountException(combined_output)
 
 
-def umount_guestfs_partition(directory: str) -> None:
-    # Check to see if it still mounted
-    fuse_mounts = _check_fuse_mounts()
+def attach_loop(file_path: str, offset: int, length: int) -> str:
+    """
+    Maps part of a file onto a read only loop device, for disk images stored inside of another archive.
+    libguestfs opens the device the same way it opens a whole image, nothing gets copied
+    :return: The loop device, to hand to detach_loop once whatever is using it has opened it
+    """
+
+    result = subprocess.run(['losetup', '--find', '--show', '--read-only', '--offset', str(offset),
+                             '--sizelimit', str(length), file_path], capture_output=True, text=True)
+    if result.returncode != 0:
+        combined_output = str(result.stdout) + '\n' + str(result.stderr)
+        raise MountException(combined_output)
+
+    return result.stdout.strip()
+
+
+def detach_loop(device: str) -> None:
+    # While the device is still open, the kernel only marks it to be detached once the last user closes it,
+    # the same as for mount -o loop. So this is called right after the mount, and there is nothing left to clean up
+    result = subprocess.run(['losetup', '--detach', device], capture_output=True)
+    if result.returncode != 0:
+        combined_output = str(result.stdout) + '\n' + str(result.stderr)
+        raise MountException(combined_output)
+
 
-    if not any(directory in m for m in fuse_mounts):
+def read_mount_table() -> mount_table.MountTable:
+    return mount_table.read_mount_table()
+
+
+def umount_guestfs_partition(directory: str, mounts: Optional[mount_table.MountTable] = None) -> None:
+    """
+    :param mounts: What is mounted where, read fresh if not given
+    """
+
+    if mounts is None:
+        mounts = read_mount_table()
+
+    # Check to see if it still mounted
+    entry = mounts.get(directory)
+    if entry is None or not entry.is_fuse():
         trace(f'Partition {directory} is not mounted, skipping umount')
         return
 
@@ -96,18 +210,19 @@ def umount_guestfs_partition(directory: str) -> None:
         raise MountException(combined_output)
 
 
-def umount_iso(mount_point: str) -> None:
+def umount_iso(mount_point: str, mounts: Optional[mount_table.MountTable] = None) -> None:
+    """
+    :param mounts: What is mounted where, read fresh if not given
+    """
+
+    if mounts is None:
+        mounts = read_mount_table()
+
+    if not mounts.is_mounted(mount_point):
+        trace(f'ISO {mount_point} is not mounted, skipping umount')
+        return
+
     result = subprocess.run(['umount', mount_point], capture_output=True)
     if result.returncode != 0:
         combined_output = str(result.stdout) + '\n' + str(result.stderr)
         raise MountException(combined_output)
-
-
-def list_top_level_dirs(path: str) -> list[str]:
-    dirs = []
-    for a_dir in os.listdir(path):
-        full_path = os.path.join(path, a_dir)
-        if os.path.isdir(full_path):
-            dirs.append(full_path)
-
-    return dirs
@@ -0,0 +1,261 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Runs the unpacking and the scanning at the same time, instead of one after the other
+# Every context is handed to the scanner as soon as everything nested in it has been unpacked, so clamd doesn't sit
+# idle, and cleaned up as soon as it's no longer needed, so the tmp dir doesn't have to hold the whole tree at once
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import humanize
+
+import clamav_large_archive_scanner.lib.clamd as clamd
+import clamav_large_archive_scanner.lib.cleanup as cleaner
+import clamav_large_archive_scanner.lib.contexts as contexts
+import clamav_large_archive_scanner.lib.mount_slots as mount_slots
+import clamav_large_archive_scanner.lib.scanner as scanner
+import clamav_large_archive_scanner.lib.unpack as unpacker
+from clamav_large_archive_scanner.lib import fast_log
+
+# How many unpacked contexts can be waiting on the scanner before unpacking is paused
+DEFAULT_QUEUE_SIZE = 2
+
+# How often a blocked stage checks to see if the other side has gone away
+_POLL_INTERVAL_SECONDS = 0.5
+
+# Put on the queue by the unpack stage once there is nothing left to unpack
+_END_OF_UNPACK = None
+
+
+class _PipelineAborted(Exception):
+    # Raised inside the unpack stage once the scan stage has stopped, to unwind unpack_recursive
+    pass
+
+
+class _PipelineListener(unpacker.UnpackListener):
+    """
+    Hands contexts over to the scan stage.
+    A context is held back until every archive nested in it has been unpacked, or has failed to, so that by the time it
+    is scanned, its covered_paths says which of them don't need to be scanned again.
+    """
+
+    def __init__(self, scan_queue: queue.Queue, abort_event: threading.Event,
+                 incremental_cleaner: cleaner.IncrementalCleaner):
+        self.scan_queue = scan_queue
+        self.abort_event = abort_event
+        self.incremental_cleaner = incremental_cleaner
+
+        self._lock = threading.Lock()
+        # How many of the nested archives found in each context haven't been unpacked yet
+        self._nested_pending = {}  # type: dict[contexts.UnpackContext, int]
+
+    def put(self, item) -> None:
+        # The queue is bounded, so this is where unpacking waits on the scanner
+        while True:
+            if self.abort_event.is_set():
+                raise _PipelineAborted()
+            try:
+                self.scan_queue.put(item, timeout=_POLL_INTERVAL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def _nested_attempted(self, nested_ctx: contexts.UnpackContext) -> None:
+        parent_ctx = nested_ctx.parent_ctx
+        with self._lock:
+            self._nested_pending[parent_ctx] -= 1
+            if self._nested_pending[parent_ctx] > 0:
+                return
+            del self._nested_pending[parent_ctx]
+
+        self.put(parent_ctx)
+
+    def on_unpacked(self, u_ctx: contexts.UnpackContext) -> None:
+        self.incremental_cleaner.unpacked(u_ctx)
+        if u_ctx.parent_ctx is not None:
+            self._nested_attempted(u_ctx)
+
+    def on_nested_found(self, u_ctx: contexts.UnpackContext, nested_ctxs: list[contexts.UnpackContext]) -> None:
+        self.incremental_cleaner.nested_found(u_ctx, nested_ctxs)
+        if len(nested_ctxs) == 0:
+            self.put(u_ctx)
+            return
+
+        with self._lock:
+            self._nested_pending[u_ctx] = len(nested_ctxs)
+
+    def on_unpack_failed(self, u_ctx: contexts.UnpackContext) -> None:
+        self.incremental_cleaner.unpack_failed(u_ctx)
+        self._nested_attempted(u_ctx)
+
+
+class _UnpackStage(threading.Thread):
+    def __init__(self, unpack_fn: Callable[[unpacker.UnpackListener], list], listener: _PipelineListener):
+        super().__init__(name='unpack-stage')
+        self.unpack_fn = unpack_fn
+        self.listener = listener
+        self.error = None  # type: BaseException | None
+
+    def run(self) -> None:
+        try:
+            self.unpack_fn(self.listener)
+        except _PipelineAborted:
+            fast_log.debug('Scanning has stopped, abandoning the rest of the unpack')
+        except BaseException as e:
+            # Handed back to the scan stage, which re-raises it on the main thread
+            self.error = e
+
+        try:
+            self.listener.put(_END_OF_UNPACK)
+        except _PipelineAborted:
+            pass
+
+
+class _ScanStage:
+    """
+    Takes contexts off of the queue and scans them, on scan_jobs threads.
+    Each context is numbered as it is taken off the queue, so the results can be put back in order at the end.
+    """
+
+    def __init__(self, scan_queue: queue.Queue, abort_event: threading.Event,
+                 incremental_cleaner: cleaner.IncrementalCleaner, fail_fast: bool, all_match: bool,
+                 client: Optional[clamd.ClamdClient]):
+        self.scan_queue = scan_queue
+        self.abort_event = abort_event
+        self.incremental_cleaner = incremental_cleaner
+        self.fail_fast = fail_fast
+        self.all_match = all_match
+        self.client = client
+
+        self._take_lock = threading.Lock()
+        self._next_index = 0
+        self._lock = threading.Lock()
+        self._results = {}  # type: dict[int, List[scanner.ScanResult]]
+        # With fail_fast, only the results up to, and including, the first failure are kept
+        self._first_failure = None  # type: int | None
+
+    def _take(self) -> Optional[tuple[int, contexts.UnpackContext]]:
+        while not self.abort_event.is_set():
+            # Taking and numbering has to happen together, otherwise the order could get mixed up
+            with self._take_lock:
+                try:
+                    u_ctx = self.scan_queue.get(timeout=_POLL_INTERVAL_SECONDS)
+                except queue.Empty:
+                    continue
+
+                if u_ctx is _END_OF_UNPACK:
+                    # Leave it for the other scan threads
+                    self.scan_queue.put(_END_OF_UNPACK)
+                    return None
+
+                index = self._next_index
+                self._next_index += 1
+                return index, u_ctx
+
+        return None
+
+    def run(self) -> None:
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+
+            index, u_ctx = taken
+            ctx_results = scanner.clamdscan([u_ctx], self.fail_fast, self.all_match, self.client)
+            self.incremental_cleaner.scanned(u_ctx)
+
+            with self._lock:
+                self._results[index] = ctx_results
+
+                if self.fail_fast and any(result.clamdscan_rv != 0 for result in ctx_results):
+                    fast_log.debug('Failing fast, no more contexts will be unpacked or scanned')
+                    if self._first_failure is None or index < self._first_failure:
+                        self._first_failure = index
+                    self.abort_event.set()
+
+    def get_results(self) -> List[scanner.ScanResult]:
+        last_index = self._next_index - 1 if self._first_failure is None else self._first_failure
+        return [result for index in range(last_index + 1) for result in self._results[index]]
+
+
+def scan_pipelined(unpack_fn: Callable[[unpacker.UnpackListener], list], tmp_dir: str, fail_fast: bool,
+                   all_match: bool, queue_size: int = DEFAULT_QUEUE_SIZE,
+                   client: Optional[clamd.ClamdClient] = None, scan_jobs: int = 1,
+                   slots: Optional[mount_slots.MountSlots] = None) -> List[scanner.ScanResult]:
+    """
+    :param unpack_fn: Does the actual unpacking, telling the listener that it is given about every unpacked context.
+                      This runs on its own thread
+    :param tmp_dir: Temporary directory that unpack_fn unpacks to, the peak usage of it is reported at the end
+    :param fail_fast: If true, will stop scanning, and unpacking, after the first failure
+    :param all_match: If true, will pass in --allmatch to clam
+    :param queue_size: How many unpacked contexts can be waiting to be scanned
+    :param client: If given, talks to clamd through it, instead of running clamdscan
+    :param scan_jobs: How many contexts to have clamd scan at the same time
+    :param slots: The mount slots that unpack_fn takes, if any, given back as contexts get cleaned up
+    :return: The scan results, in the order the contexts were handed over. Empty if nothing was unpacked
+    """
+
+    scan_queue = queue.Queue(maxsize=queue_size)
+    abort_event = threading.Event()
+    incremental_cleaner = cleaner.IncrementalCleaner(tmp_dir, slots)
+    unpack_stage = _UnpackStage(unpack_fn, _PipelineListener(scan_queue, abort_event, incremental_cleaner))
+    scan_stage = _ScanStage(scan_queue, abort_event, incremental_cleaner, fail_fast, all_match, client)
+
+    if slots is not None:
+        # Archives waiting on a mount slot can count on getting one, once the ones before them are cleaned up
+        slots.set_releasing(True)
+
+    unpack_stage.start()
+    try:
+        with ThreadPoolExecutor(max_workers=scan_jobs, thread_name_prefix='scan-stage') as pool:
+            scan_futures = [pool.submit(scan_stage.run) for _ in range(scan_jobs)]
+            try:
+                for future in scan_futures:
+                    future.result()
+            finally:
+                # If one of the scan threads died, the others need to be stopped too
+                abort_event.set()
+    finally:
+        # Either everything is done, or the scan stage has stopped early, in which case the unpack stage has to as well
+        abort_event.set()
+        if slots is not None:
+            # Nothing is getting cleaned up anymore, so nothing waiting on a mount slot is ever getting one
+            slots.set_releasing(False)
+        unpack_stage.join()
+
+    incremental_cleaner.usage.sample()
+    fast_log.info(f'Peak temporary disk usage in {tmp_dir}: '
+                  f'{humanize.naturalsize(incremental_cleaner.usage.peak_bytes, binary=True)}')
+
+    if unpack_stage.error is not None:
+        raise unpack_stage.error
+
+    return scan_stage.get_results()
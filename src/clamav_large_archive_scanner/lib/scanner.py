@@ -27,12 +27,26 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 # A wrapper around calling clamdscan with a bit of validation thrown in
+# Can also talk to clamd directly, see clamd.py
 
+import os
+import shutil
 import subprocess
-from typing import List, Tuple
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Optional, Tuple
 
 from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.clamd import Abort, ClamdClient, ClamdReply
 from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+from clamav_large_archive_scanner.lib.filesize import describe_throughput
+
+_report_lock = threading.Lock()
+
+SCAN_LIST_PREFIX = 'clam_unpacker_scan_list_'
 
 
 class ScanResult:
@@ -68,18 +82,38 @@ def validate_clamdscan() -> bool:
     :return: True if clamdscan is available, False otherwise
     """
 
-    result = subprocess.run(['which', 'clamdscan'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return shutil.which('clamdscan') is not None
+
+
+def validate_clamd(client: ClamdClient) -> bool:
+    """
+    :return: True if clamd is answering on the client's socket, False otherwise
+    """
+
+    return client.ping()
+
+
+def _run_clamdscan_process(clam_args: List[str], abort: Optional[Abort]) -> Tuple[int, str]:
+    if abort is None:
+        result = subprocess.run(clam_args, capture_output=True, text=True)
+        return result.returncode, result.stdout
+
+    # Same as subprocess.run, but killed if the scan is aborted
+    with subprocess.Popen(clam_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as process:
+        with abort.watching(process.kill):
+            stdout, _ = process.communicate()
 
-    if result.returncode != 0:
-        return False
+    if abort.is_aborted():
+        return 2, 'Scan aborted'
 
-    return True
+    return process.returncode, stdout
 
 
-def _run_clamdscan(path: str, all_match: bool) -> Tuple[int, str]:
+def _run_clamdscan(path: str, all_match: bool, abort: Optional[Abort] = None) -> Tuple[int, str]:
     """
     :param path: A path to scan
     :param all_match: If true, will pass in --allmatch to clam
+    :param abort: If given, aborting it kills clamdscan
     :return: Returns the RV of clamdscan, which as per man page is this:
 
             Return Codes
@@ -94,25 +128,161 @@ def _run_clamdscan(path: str, all_match: bool) -> Tuple[int, str]:
 
     clam_args.append(path)
 
-    result = subprocess.run(clam_args, capture_output=True, text=True)
-    return result.returncode, result.stdout
+    return _run_clamdscan_process(clam_args, abort)
 
 
-def clamdscan(u_ctxs: list[UnpackContext], fail_fast: bool, all_match: bool) -> List[ScanResult]:
+def _run_clamdscan_file_list(paths: List[str], all_match: bool, abort: Optional[Abort] = None) -> Tuple[int, str]:
     """
-    :param u_ctxs: A list of UnpackContexts, containing the paths to scan
-    :param fail_fast: If true, will stop scanning after the first failure in the list of paths.
-    :param all_match: If true, will pass in --allmatch to clam, which will return all malware found
-    :return: A list of tuples containing the path and the return code of clamdscan
+    Same as _run_clamdscan, but for several paths at once, handed to clamdscan through a file list
     """
 
-    results = []
+    if len(paths) == 0:
+        return 0, ''
 
-    for a_ctx in u_ctxs:
-        fast_log.info(f'Scanning {a_ctx.nice_filename()}')
-        clamdscan_rv, clamdscan_output = _run_clamdscan(a_ctx.unpacked_dir_location, all_match)
-        results.append(ScanResult(a_ctx.nice_filename(), clamdscan_rv))
-        if clamdscan_rv != 0:
+    with tempfile.NamedTemporaryFile(mode='w', prefix=SCAN_LIST_PREFIX, suffix='.txt') as file_list:
+        file_list.write(''.join(f'{path}\n' for path in paths))
+        file_list.flush()
+
+        clam_args = ['clamdscan', '-m', '--stdout']
+        if all_match:
+            clam_args.append('--allmatch')
+
+        clam_args.append(f'--file-list={file_list.name}')
+
+        return _run_clamdscan_process(clam_args, abort)
+
+
+def _run_clamd(client: ClamdClient, paths: List[str], all_match: bool, file_list: bool,
+               abort: Optional[Abort] = None) -> Tuple[int, str]:
+    """
+    Same as _run_clamdscan, but over clamd's socket
+    :param client: Client connected to clamd
+    :param paths: The paths to scan, one after the other
+    :param all_match: If true, will use ALLMATCHSCAN instead of MULTISCAN
+    :param file_list: If true, paths are all regular files, and are pipelined down one session like clamdscan -m
+                      --file-list does. clamd doesn't take ALLMATCHSCAN in a session, so not with all_match.
+    :param abort: If given, aborting it closes the connection to clamd
+    :return: The same return codes as clamdscan, along with clamd's reply
+    """
+
+    if len(paths) == 0:
+        return 0, ''
+
+    lines = []  # type: list[str]
+    try:
+        if file_list and not all_match:
+            lines.extend(client.scan_files(paths, abort).lines)
+        else:
+            for path in paths:
+                reply = client.allmatchscan(path, abort) if all_match else client.multiscan(path, abort)
+                lines.extend(reply.lines)
+    except ClamdException as e:
+        return 2, str(e)
+
+    reply = ClamdReply(lines)
+    return reply.get_return_code(), str(reply)
+
+
+def _paths_to_scan(a_ctx: UnpackContext) -> List[str]:
+    """
+    Works out what is left to scan in a context once the files in covered_paths are left out.
+    If the context was already walked while unpacking, the files found then are used, and nothing is walked again.
+    Otherwise, directories that don't have any of those files in them are scanned whole, so the list stays short.
+    :return: The paths to scan, just unpacked_dir_location itself if there is no inventory and nothing was covered
+    """
+
+    if a_ctx.inventory is not None:
+        return [file_meta.path for file_meta in a_ctx.inventory if file_meta.path not in a_ctx.covered_paths]
+
+    root = a_ctx.unpacked_dir_location
+    if len(a_ctx.covered_paths) == 0:
+        return [root]
+
+    # Every directory between the root and a covered file has to be listed, instead of being scanned whole
+    listed_dirs = set()
+    for path in a_ctx.covered_paths:
+        parent = os.path.dirname(path)
+        while parent not in listed_dirs:
+            listed_dirs.add(parent)
+            if parent == root:
+                break
+            parent = os.path.dirname(parent)
+
+    paths = []
+    dirs_to_list = [root]
+    while len(dirs_to_list) > 0:
+        a_dir = dirs_to_list.pop()
+        for entry in sorted(os.listdir(a_dir)):
+            path = os.path.join(a_dir, entry)
+            if path in a_ctx.covered_paths:
+                continue
+            elif path in listed_dirs:
+                dirs_to_list.append(path)
+            else:
+                paths.append(path)
+
+    return paths
+
+
+def _merge_streamed_results(a_ctx: UnpackContext, clamdscan_rv: int, clamdscan_output: str) -> Tuple[int, str]:
+    """
+    Folds in whatever clamd found in the files that were streamed to it while a_ctx was being unpacked
+    :return: The worst of the return codes, a virus outranks an error, and all of the output
+    """
+
+    outputs = [clamdscan_output] if clamdscan_output != '' else []
+    return_codes = [clamdscan_rv]
+    for streamed_rv, streamed_output in a_ctx.streamed_results:
+        return_codes.append(streamed_rv)
+        outputs.append(streamed_output)
+
+    if 1 in return_codes:
+        merged_rv = 1
+    else:
+        merged_rv = max(return_codes)
+
+    return merged_rv, '\n'.join(outputs)
+
+
+def _log_throughput(a_ctx: UnpackContext, seconds: float) -> None:
+    # Only known when the files were found while unpacking, otherwise clamd is the only one that knows what it read
+    if a_ctx.inventory is None:
+        return
+
+    scanned = [file_meta for file_meta in a_ctx.inventory if file_meta.path not in a_ctx.covered_paths]
+    byte_count = sum(file_meta.size_raw for file_meta in scanned)
+    fast_log.debug(f'Scanned {a_ctx.nice_filename()}: {describe_throughput(len(scanned), byte_count, seconds)}')
+
+
+def _scan_ctx(a_ctx: UnpackContext, all_match: bool, client: Optional[ClamdClient],
+              abort: Optional[Abort] = None) -> ScanResult:
+    fast_log.info(f'Scanning {a_ctx.nice_filename()}')
+    started = time.monotonic()
+    paths = _paths_to_scan(a_ctx)
+    if len(a_ctx.covered_paths) > 0:
+        fast_log.debug(f'Leaving out {len(a_ctx.covered_paths)} archives that were unpacked on their own, '
+                       f'scanning {len(paths)} paths instead')
+
+    if client is not None:
+        clamdscan_rv, clamdscan_output = _run_clamd(client, paths, all_match, a_ctx.inventory is not None, abort)
+    elif paths == [a_ctx.unpacked_dir_location]:
+        clamdscan_rv, clamdscan_output = _run_clamdscan(a_ctx.unpacked_dir_location, all_match, abort)
+    else:
+        clamdscan_rv, clamdscan_output = _run_clamdscan_file_list(paths, all_match, abort)
+
+    if abort is not None and abort.is_aborted():
+        # Nobody is going to look at what it found, a failure before it in the list is what gets reported
+        fast_log.debug(f'Aborted the scan of {a_ctx.nice_filename()}')
+        return ScanResult(a_ctx.nice_filename(), clamdscan_rv)
+
+    _log_throughput(a_ctx, time.monotonic() - started)
+
+    if len(a_ctx.streamed_results) > 0:
+        clamdscan_rv, clamdscan_output = _merge_streamed_results(a_ctx, clamdscan_rv, clamdscan_output)
+
+    if clamdscan_rv != 0:
+        # Keep the report in one piece when several contexts are being scanned at once
+        with _report_lock:
             fast_log.info('!' * 80)
             if clamdscan_rv == 1:
                 # Virus Path
@@ -123,7 +293,77 @@ def clamdscan(u_ctxs: list[UnpackContext], fail_fast: bool, all_match: bool) ->
             fast_log.info(a_ctx.detmp_filepath(clamdscan_output))
             fast_log.info('!' * 80)
 
-            if fail_fast:
-                return results
+    return ScanResult(a_ctx.nice_filename(), clamdscan_rv)
+
+
+def _clamdscan_concurrent(u_ctxs: list[UnpackContext], fail_fast: bool, all_match: bool,
+                          client: Optional[ClamdClient], scan_jobs: int) -> List[ScanResult]:
+    results = [None] * len(u_ctxs)  # type: list[ScanResult | None]
+    # With fail_fast, only the results up to, and including, the first failure in the list are kept
+    first_failure = None  # type: int | None
+
+    to_scan = iter(enumerate(u_ctxs))
+    in_flight = {}  # type: dict[Future, int]
+    # With fail_fast, the scans after a failure are aborted, rather than waited on
+    aborts = {}  # type: dict[int, Optional[Abort]]
+
+    with ThreadPoolExecutor(max_workers=scan_jobs, thread_name_prefix='scan') as pool:
+        while True:
+            # Only hand out as much as can be scanned right now, so nothing has to be taken back after a failure
+            while first_failure is None and len(in_flight) < scan_jobs:
+                next_ctx = next(to_scan, None)
+                if next_ctx is None:
+                    break
+                index, a_ctx = next_ctx
+                aborts[index] = Abort() if fail_fast else None
+                in_flight[pool.submit(_scan_ctx, a_ctx, all_match, client, aborts[index])] = index
+
+            if len(in_flight) == 0:
+                break
+
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                results[index] = future.result()
+
+                if fail_fast and results[index].clamdscan_rv != 0:
+                    # Anything before the failure is still waited on, to get the same results as a serial scan
+                    first_failure = index if first_failure is None else min(first_failure, index)
+
+            if first_failure is not None:
+                for future, index in list(in_flight.items()):
+                    if index > first_failure:
+                        # Leaving the with still waits for it, but it won't be long once clamd or clamdscan is cut off
+                        aborts[index].abort()
+                        del in_flight[future]
+
+    if first_failure is not None:
+        return results[:first_failure + 1]
+
+    return results
+
+
+def clamdscan(u_ctxs: list[UnpackContext], fail_fast: bool, all_match: bool,
+              client: Optional[ClamdClient] = None, scan_jobs: int = 1) -> List[ScanResult]:
+    """
+    :param u_ctxs: A list of UnpackContexts, containing the paths to scan
+    :param fail_fast: If true, will stop scanning after the first failure in the list of paths.
+    :param all_match: If true, will pass in --allmatch to clam, which will return all malware found
+    :param client: If given, talks to clamd through it, instead of running clamdscan
+    :param scan_jobs: How many contexts to have clamd scan at the same time
+    :return: A list of tuples containing the path and the return code of clamdscan, in the same order as u_ctxs
+    """
+
+    if scan_jobs > 1 and len(u_ctxs) > 1:
+        return _clamdscan_concurrent(u_ctxs, fail_fast, all_match, client, scan_jobs)
+
+    results = []
+
+    for a_ctx in u_ctxs:
+        result = _scan_ctx(a_ctx, all_match, client)
+        results.append(result)
+
+        if result.clamdscan_rv != 0 and fail_fast:
+            return results
 
     return results
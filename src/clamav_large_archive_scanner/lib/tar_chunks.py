@@ -0,0 +1,160 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Packs archive members back into plain tar streams, sized so that clamd will take each one in a single INSTREAM
+
+import tarfile
+from typing import Iterator, List, Optional, Set
+
+from clamav_large_archive_scanner.lib.archive_members import ArchiveMember
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException
+
+# Every tar stream ends with two empty blocks
+END_OF_ARCHIVE = b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def _padding_length(size: int) -> int:
+    return -size % tarfile.BLOCKSIZE
+
+
+def _member_tar_header(member: ArchiveMember) -> bytes:
+    tar_info = tarfile.TarInfo(member.safe_relative_path())
+    tar_info.size = member.size
+    tar_info.mode = 0o644
+
+    # PAX, so that long names and huge members don't need anything special
+    return tar_info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+
+class StreamableMember:
+    def __init__(self, index: int, member: ArchiveMember, header: bytes, member_path: str):
+        # Position of the member in the archive, counting regular files only
+        self.index = index
+        self.member = member
+        # Whatever has already been read from the member
+        self.header = header
+        # Where the member would have been extracted to
+        self.member_path = member_path
+
+        self._tar_header = None  # type: bytes | None
+
+    def tar_header(self) -> bytes:
+        if self._tar_header is None:
+            self._tar_header = _member_tar_header(self.member)
+
+        return self._tar_header
+
+    def tar_length(self) -> int:
+        # How much room the member takes up in a tar stream, header and padding included
+        return len(self.tar_header()) + self.member.size + _padding_length(self.member.size)
+
+    def iter_tar_data(self) -> Iterator[bytes]:
+        yield self.tar_header()
+
+        data_length = 0
+        for chunk in self.member.iter_chunks(self.header):
+            data_length += len(chunk)
+            yield chunk
+
+        # Anything else would throw off where every member after this one starts
+        if data_length != self.member.size:
+            raise ArchiveException(f'{self.member.name} is {data_length} bytes long, '
+                                   f'but the archive says it is {self.member.size}')
+
+        yield b'\0' * _padding_length(self.member.size)
+
+
+def fits_in_a_chunk(a_member: StreamableMember, max_length: int) -> bool:
+    return len(END_OF_ARCHIVE) + a_member.tar_length() <= max_length
+
+
+class TarChunk:
+    """
+    One synthetic tar stream, holding as many members as fit under max_length and max_files.
+    The members are read as the stream is sent, so the chunk only finds out where it ends once it has been sent.
+    """
+
+    def __init__(self, max_length: int, max_files: int):
+        """
+        :param max_length: The most bytes that the stream can be
+        :param max_files: The most members that the stream can hold, 0 for no limit
+        """
+
+        self.max_length = max_length
+        self.max_files = max_files
+
+        self.length = len(END_OF_ARCHIVE)
+        self.members = []  # type: list[tuple[int, str]]
+
+        # The first member that didn't fit, it starts the next chunk
+        self.next_member = None  # type: StreamableMember | None
+        # Set once every member that fit has been read
+        self.complete = False
+
+    def fits(self, a_member: StreamableMember) -> bool:
+        if self.max_files > 0 and len(self.members) >= self.max_files:
+            return False
+
+        return self.length + a_member.tar_length() <= self.max_length
+
+    def iter_data(self, first_member: StreamableMember, members: Iterator[StreamableMember]) -> Iterator[bytes]:
+        """
+        :param first_member: The first member of the chunk, see fits_in_a_chunk
+        :param members: Where the rest of the members come from, they are taken for as long as they fit
+        :return: The tar stream
+        """
+
+        a_member = first_member  # type: Optional[StreamableMember]
+        while a_member is not None and self.fits(a_member):
+            self.length += a_member.tar_length()
+            self.members.append((a_member.index, a_member.member_path))
+
+            yield from a_member.iter_tar_data()
+            a_member = next(members, None)
+
+        self.next_member = a_member
+        self.complete = True
+
+        yield END_OF_ARCHIVE
+
+    def member_indexes(self) -> Set[int]:
+        return {index for index, _ in self.members}
+
+    def reply_lines(self, lines: List[str]) -> List[str]:
+        """
+        clamd calls the whole tar stream 'stream', without saying which member it was talking about.
+        This is used when that can't be worked out any other way, and names everything that was in the chunk instead.
+        """
+
+        first_path = self.members[0][1]
+        if len(self.members) == 1:
+            described = first_path
+        else:
+            described = f'One of the {len(self.members)} files starting at {first_path}'
+
+        return [described + line[len('stream'):] if line.startswith('stream:') else line for line in lines]
@@ -28,7 +28,9 @@
 
 import glob
 import os
+import shutil
 import tempfile
+import threading
 
 from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
 
@@ -62,3 +64,29 @@ def determine_tmp_dir_filetype(path: str) -> FileType:
 def find_associated_dirs(filepath: str, tmp_dir: str) -> list[str]:
     file_name = os.path.basename(filepath)
     return glob.glob(f'{tmp_dir}/{TMP_DIR_PREFIX}_*_{file_name}_*')
+
+
+class TmpDirUsage:
+    """
+    Keeps track of how much space the unpacked files are taking up on the volume holding the tmp dir.
+    Usage only grows while unpacking, so sampling right before anything is deleted, and once at the end, catches the peak.
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        self.peak_bytes = 0
+
+        self._lock = threading.Lock()
+        # Whatever was already there doesn't count
+        self._baseline_bytes = self._used_bytes()
+
+    def _used_bytes(self) -> int:
+        return shutil.disk_usage(self.tmp_dir).used
+
+    def sample(self) -> int:
+        used_bytes = max(self._used_bytes() - self._baseline_bytes, 0)
+
+        with self._lock:
+            self.peak_bytes = max(self.peak_bytes, used_bytes)
+
+        return used_bytes
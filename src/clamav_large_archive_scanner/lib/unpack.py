@@ -28,19 +28,154 @@
 
 
 import os
-import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
 
 import click
 
 from clamav_large_archive_scanner.lib import fast_log
-from clamav_large_archive_scanner.lib.exceptions import ArchiveException, MountException
+from clamav_large_archive_scanner.lib.clamd import ClamdClient, ClamdReply
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException, ClamdException, MountException
 from clamav_large_archive_scanner.lib.fast_log import trace
+from clamav_large_archive_scanner.lib.filesize import describe_throughput
 
 # These imports are here to make mocking easier in UT
 # Yes, it does make the code a bit more verbose, but it's worth it
+import clamav_large_archive_scanner.lib.archive_members as archive_members
 import clamav_large_archive_scanner.lib.file_data as file_data
+import clamav_large_archive_scanner.lib.guestfs_mount as guestfs_mount
+import clamav_large_archive_scanner.lib.mount_slots as mount_slots
 import clamav_large_archive_scanner.lib.mount_tools as mount_tools
 import clamav_large_archive_scanner.lib.contexts as contexts
+import clamav_large_archive_scanner.lib.tar_chunks as tar_chunks
+import clamav_large_archive_scanner.lib.walker as walker
+
+
+# How VMDK and QCOW2 images get unpacked, either mounted through FUSE, or read out of the appliance as tars
+GUESTFS_MODE_MOUNT = 'mount'
+GUESTFS_MODE_TAR_OUT = 'tar-out'
+GUESTFS_MODES = [GUESTFS_MODE_MOUNT, GUESTFS_MODE_TAR_OUT]
+
+# How ISOs get unpacked, either mounted on a loop device, or read in-process, straight out of the image
+ISO_MODE_MOUNT = 'mount'
+ISO_MODE_READ = 'read'
+ISO_MODES = [ISO_MODE_MOUNT, ISO_MODE_READ]
+
+# Nested archives of these types can be unpacked from right where they are in a TAR, ZIP or ISO, without being extracted
+# VMDK and QCOW2 images get handed to libguestfs as a loop device over their part of the file
+IN_PLACE_FILE_TYPES = [file_data.FileType.TAR, file_data.FileType.TARGZ, file_data.FileType.TARZST,
+                       file_data.FileType.TARXZ, file_data.FileType.TARBZ2, file_data.FileType.ZIP,
+                       file_data.FileType.ISO, file_data.FileType.VMDK, file_data.FileType.QCOW2]
+
+# What libguestfs calls the formats of the disk images, it only works them out by itself for whole files
+GUESTFS_IMAGE_FORMATS = {file_data.FileType.VMDK: 'vmdk', file_data.FileType.QCOW2: 'qcow2'}
+
+# Mount slots are released by whoever cleans up, not by the unpack workers, so the contexts waiting on one are tried
+# again this often, while there is other work going on
+SLOT_POLL_SECONDS = 0.5
+
+
+class UnpackOptions:
+    """
+    Settings that change how archives get unpacked, as opposed to which ones do
+    """
+
+    def __init__(self, stream_client: Optional[ClamdClient] = None, stream_chunks: bool = False, walk_threads: int = 1,
+                 guestfs_mode: str = GUESTFS_MODE_MOUNT, guestfs_pool: Optional[guestfs_mount.AppliancePool] = None,
+                 mount_slots: Optional[mount_slots.MountSlots] = None, iso_mode: str = ISO_MODE_MOUNT,
+                 in_place: bool = False, zip_jobs: int = 1):
+        # If set, TAR, compressed TAR and ZIP members are sent to clamd as they are read, instead of being extracted
+        self.stream_client = stream_client
+        # If set, the streamed members are packed into tar streams, instead of being sent one at a time
+        self.stream_chunks = stream_chunks
+        # How many threads walk a mounted disk image, or a directory, when looking for nested archives
+        self.walk_threads = walk_threads
+        # One of GUESTFS_MODES
+        self.guestfs_mode = guestfs_mode
+        # If set, images read out with GUESTFS_MODE_TAR_OUT borrow their appliances from here
+        self.guestfs_pool = guestfs_pool
+        # If set, nested archives only get mounted while there are loop devices and appliances to spare
+        self.mount_slots = mount_slots
+        # One of ISO_MODES
+        self.iso_mode = iso_mode
+        # If set, nested archives in TARs, ZIPs and ISOs are read where they are, instead of being extracted first
+        self.in_place = in_place
+        # How many processes a big ZIP is extracted with, each one takes a part of its central directory
+        self.zip_jobs = zip_jobs
+
+
+def _source_view(file_meta: file_data.FileMetadata) -> file_data.FileView:
+    # Where the file's data actually is
+    if file_meta.view is not None:
+        return file_meta.view
+    return file_data.FileView(file_meta.path, 0, file_meta.size_raw)
+
+
+def _leave_in_place(u_ctx: contexts.UnpackContext, member: archive_members.ArchiveMember, header: bytes,
+                    member_path: str, min_file_size: int) -> bool:
+    """
+    Nested archives that are stored in one piece get unpacked from right where they are, later on
+    :param header: The first HEADER_READ_SIZE bytes of the member
+    :param member_path: Where the member would have been extracted to
+    :return: True if the member was added to u_ctx.views, False if it has to be extracted
+    """
+
+    if member.data_offset is None or member.size < min_file_size:
+        return False
+
+    file_meta = file_data.classify_view(member_path, _source_view(u_ctx.file_meta).sub_view(member.data_offset,
+                                                                                            member.size), header)
+    if file_meta.filetype not in IN_PLACE_FILE_TYPES:
+        return False
+
+    trace(f'Leaving {member.name} where it is, at {member.data_offset}')
+    u_ctx.views.append(file_meta)
+    # The views read from the same file that this does, so it has to stay put until they are done with it
+    u_ctx.depends_on_source = True
+    return True
+
+
+def _extract_view(file_meta: file_data.FileMetadata) -> None:
+    # For when a nested archive that was left in place has to be on disk after all. A member with the same name may
+    # have been extracted to where it would have gone since, in which case it goes next to that
+    with file_meta.view.open() as f:
+        file_meta.path = archive_members.extract_member(
+            archive_members.ArchiveMember(file_meta.path, file_meta.size_raw, f), file_meta.path)
+
+
+@contextmanager
+def _guestfs_image(u_ctx: contexts.UnpackContext) -> Iterator[tuple[str, Optional[str]]]:
+    """
+    Where libguestfs should open the disk image of u_ctx from, and its format if libguestfs has to be told.
+    An image that was left in place is opened through a read only loop device over its part of the outer file, which
+    goes away by itself once libguestfs is done with it. If there is no loop device to be had, it is extracted after all
+    """
+
+    view = u_ctx.file_meta.view
+    if view is None:
+        yield u_ctx.file_meta.path, None
+        return
+
+    try:
+        device = mount_tools.attach_loop(view.source_path, view.offset, view.length)
+    except MountException as e:
+        fast_log.warn(f'Unable to attach {u_ctx.file_meta.path} to a loop device, extracting it instead')
+        fast_log.debug(f'Got the following error: {e}')
+        _extract_view(u_ctx.file_meta)
+        yield u_ctx.file_meta.path, None
+        return
+
+    trace(f'Attached {u_ctx.file_meta.path}, at {view.offset} in {view.source_path}, to {device}')
+    try:
+        yield device, GUESTFS_IMAGE_FORMATS[u_ctx.file_meta.filetype]
+    finally:
+        try:
+            mount_tools.detach_loop(device)
+        except MountException as e:
+            fast_log.warn(f'Unable to detach {device}, it stays attached to {view.source_path}')
+            fast_log.debug(f'Got the following error: {e}')
 
 
 class BaseFileUnpackHandler:
@@ -52,18 +187,54 @@ class BaseFileUnpackHandler:
         raise NotImplementedError()
 
 
-class ArchiveFileUnpackHandler(BaseFileUnpackHandler):
-    def __init__(self, u_ctx: contexts.UnpackContext, file_format: str):
+class IsoFileUnpackHandler(BaseFileUnpackHandler):
+    def __init__(self, u_ctx: contexts.UnpackContext):
+        super().__init__(u_ctx)
+
+    def unpack(self) -> contexts.UnpackContext:
+        try:
+            view = self.u_ctx.file_meta.view
+            if view is None:
+                mount_tools.mount_iso(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location)
+            else:
+                mount_tools.mount_iso(view.source_path, self.u_ctx.unpacked_dir_location, view.offset, view.length)
+        except MountException as e:
+            fast_log.debug(f'Got MountException {e} when trying to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
+            raise click.FileError(filename=self.u_ctx.file_meta.path, hint=f'Unable to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
+
+        # The loop device keeps reading from the ISO until it is un-mounted
+        self.u_ctx.depends_on_source = True
+
+        return self.u_ctx
+
+
+class MemberArchiveUnpackHandler(BaseFileUnpackHandler):
+    """
+    Extracts an archive one member at a time, through archive_members, so that nothing but the member being extracted
+    is held on to, however many of them there are.
+    This is how ISOs are read with ISO_MODE_READ, without a loop device to wait on, or to be root for, at the cost of
+    the tmp dir having to fit all of it. It is also how archives that are themselves left in place get read, and how
+    TARs get read with in_place, so the nested archives in them can be left where they are.
+    Only regular files are extracted, links and empty directories have nothing in them for clamd to scan.
+    """
+
+    def __init__(self, u_ctx: contexts.UnpackContext, min_file_size: int = 0, in_place: bool = False):
         super().__init__(u_ctx)
-        self.format = file_format
+        # Nested archives smaller than this are extracted like everything else
+        self.min_file_size = min_file_size
+        self.in_place = in_place
 
     def unpack(self) -> contexts.UnpackContext:
-        # This can sometimes fail if the archive is corrupt
+        file_meta = self.u_ctx.file_meta
         try:
-            shutil.unpack_archive(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location, format=self.format)
+            for member in archive_members.iter_members(file_meta.path, file_meta.filetype, file_meta.view):
+                member_path = os.path.join(self.u_ctx.unpacked_dir_location, member.safe_relative_path())
+                header = member.fileobj.read(file_data.HEADER_READ_SIZE)
 
-            # Try to chmod -R a+r on the new directory so that it can be scanned
-            os.system(f'chmod -R a+r {self.u_ctx.unpacked_dir_location}')
+                if self.in_place and _leave_in_place(self.u_ctx, member, header, member_path, self.min_file_size):
+                    continue
+
+                archive_members.extract_member(member, member_path, header)
         except Exception as e:
             # Delete the temp dir since the unpacker created it
             self.u_ctx.cleanup_tmp()
@@ -72,33 +243,227 @@ class ArchiveFileUnpackHandler(BaseFileUnpackHandler):
         return self.u_ctx
 
 
-class IsoFileUnpackHandler(BaseFileUnpackHandler):
+class TarFileUnpackHandler(MemberArchiveUnpackHandler):
+    """
+    shutil.unpack_archive goes through tarfile.extractall, which keeps a TarInfo around for every member it extracts.
+    Extracting one member at a time keeps memory flat no matter how many members there are.
+    """
+
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx)
 
+
+class ZipFileUnpackHandler(MemberArchiveUnpackHandler):
+    """
+    shutil.unpack_archive goes through zipfile.ZipFile, which reads the whole central directory before it extracts
+    anything. archive_members reads it a chunk at a time, as the members are extracted.
+    With more than one job, ZIPs big enough to be worth it have their central directory split up between that many
+    processes, which inflate their members at the same time.
+    """
+
+    def __init__(self, u_ctx: contexts.UnpackContext, zip_jobs: int = 1):
+        super().__init__(u_ctx)
+        self.zip_jobs = zip_jobs
+
     def unpack(self) -> contexts.UnpackContext:
+        if self.zip_jobs <= 1:
+            return super().unpack()
+
+        file_meta = self.u_ctx.file_meta
         try:
-            mount_tools.mount_iso(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location)
-        except MountException as e:
-            fast_log.debug(f'Got MountException {e} when trying to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
-            raise click.FileError(filename=self.u_ctx.file_meta.path, hint=f'Unable to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
+            start = time.monotonic()
+            extracted = archive_members.extract_zip(file_meta.path, self.u_ctx.unpacked_dir_location, self.zip_jobs,
+                                                    file_meta.view)
+            fast_log.debug(f'Extracted {file_meta.path} with up to {self.zip_jobs} jobs: '
+                           f'{describe_throughput(extracted, file_meta.size_raw, time.monotonic() - start)}')
+        except Exception as e:
+            # Delete the temp dir since the unpacker created it
+            self.u_ctx.cleanup_tmp()
+            raise ArchiveException(e)
 
         return self.u_ctx
 
 
-class TarFileUnpackHandler(ArchiveFileUnpackHandler):
+class TarGzFileUnpackHandler(TarFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
-        super().__init__(u_ctx, 'tar')
+        super().__init__(u_ctx)
+
+
+class TarZstFileUnpackHandler(TarFileUnpackHandler):
+    def __init__(self, u_ctx: contexts.UnpackContext):
+        super().__init__(u_ctx)
 
 
-class ZipFileUnpackHandler(ArchiveFileUnpackHandler):
+class TarXzFileUnpackHandler(TarFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
-        super().__init__(u_ctx, 'zip')
+        super().__init__(u_ctx)
 
 
-class TarGzFileUnpackHandler(ArchiveFileUnpackHandler):
+class TarBz2FileUnpackHandler(TarFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
-        super().__init__(u_ctx, 'gztar')
+        super().__init__(u_ctx)
+
+
+class StreamingArchiveUnpackHandler(BaseFileUnpackHandler):
+    """
+    Reads the members of a TAR, compressed TAR or ZIP, or of an ISO with ISO_MODE_READ, one at a time, and sends them to clamd
+    over INSTREAM, so they never hit the disk.
+    Members that are archives we would unpack anyway, and members that are over clamd's StreamMaxLength, are extracted
+    to the unpack dir instead, where they are picked up the same way as with MemberArchiveUnpackHandler.
+    Since INSTREAM has no allmatch option, whether every signature gets reported is up to clamd's AllMatch setting.
+    """
+
+    def __init__(self, u_ctx: contexts.UnpackContext, client: ClamdClient, min_file_size: int,
+                 in_place: bool = False):
+        super().__init__(u_ctx)
+        self.client = client
+        # Nested archives smaller than this are streamed like everything else
+        self.min_file_size = min_file_size
+        # If set, nested archives are left where they are instead of being extracted, wherever that can be done
+        self.in_place = in_place
+
+    def _should_extract(self, member: archive_members.ArchiveMember, header: bytes) -> bool:
+        if member.size > self.client.stream_max_length:
+            trace(f'{member.name} is too big to stream, extracting it')
+            return True
+
+        if member.size < self.min_file_size:
+            return False
+
+        return file_data.filetype_from_header(header) in HANDLED_FILE_TYPES
+
+    def _member_path(self, member: archive_members.ArchiveMember) -> str:
+        return os.path.join(self.u_ctx.unpacked_dir_location, member.safe_relative_path())
+
+    def _stream(self, member: archive_members.ArchiveMember, header: bytes, member_path: str) -> None:
+        try:
+            reply = self.client.instream(member.iter_chunks(header))
+        except ClamdException as e:
+            self.u_ctx.streamed_results.append((2, f'{member_path}: {e} ERROR'))
+            return
+
+        return_code = reply.get_return_code()
+        if return_code == 0:
+            return
+
+        # Point the reply at where the member would have been extracted to, so it gets reported like everything else
+        lines = [member_path + line[len('stream'):] if line.startswith('stream:') else line for line in reply.lines]
+        self.u_ctx.streamed_results.append((return_code, '\n'.join(lines)))
+
+    def _iter_members(self) -> Iterator[archive_members.ArchiveMember]:
+        file_meta = self.u_ctx.file_meta
+        return archive_members.iter_members(file_meta.path, file_meta.filetype, file_meta.view)
+
+    def _iter_streamable(self) -> Iterator[tar_chunks.StreamableMember]:
+        # Extracts whatever has to be extracted along the way, and hands back everything else
+        for index, member in enumerate(self._iter_members()):
+            member_path = self._member_path(member)
+            header = member.fileobj.read(file_data.HEADER_READ_SIZE)
+
+            if self._should_extract(member, header):
+                if not self.in_place or not _leave_in_place(self.u_ctx, member, header, member_path,
+                                                            self.min_file_size):
+                    archive_members.extract_member(member, member_path, header)
+                continue
+
+            yield tar_chunks.StreamableMember(index, member, header, member_path)
+
+    def _stream_members(self) -> None:
+        for a_member in self._iter_streamable():
+            self._stream(a_member.member, a_member.header, a_member.member_path)
+
+    def unpack(self) -> contexts.UnpackContext:
+        try:
+            self._stream_members()
+        except Exception as e:
+            # Delete the temp dir since the unpacker created it
+            self.u_ctx.cleanup_tmp()
+            raise ArchiveException(e)
+
+        return self.u_ctx
+
+
+class ChunkedStreamingArchiveUnpackHandler(StreamingArchiveUnpackHandler):
+    """
+    Same as StreamingArchiveUnpackHandler, but rather than one INSTREAM per member, the members are packed into plain
+    tar streams that are as big as clamd will take, and clamd unpacks those on its own.
+    clamd doesn't say which member of a tar stream it found something in, so the members of any chunk that it had
+    something to say about are read again afterwards, and sent one at a time to find out.
+    """
+
+    def __init__(self, u_ctx: contexts.UnpackContext, client: ClamdClient, min_file_size: int,
+                 in_place: bool = False):
+        super().__init__(u_ctx, client, min_file_size, in_place)
+
+        # clamd won't take a stream over StreamMaxLength, and won't look at more than MaxScanSize of what it unpacks
+        self.chunk_length = client.stream_max_length
+        if client.max_scan_size > 0:
+            self.chunk_length = min(self.chunk_length, client.max_scan_size)
+
+    def _send_chunk(self, first_member: tar_chunks.StreamableMember,
+                    members: Iterator[tar_chunks.StreamableMember]) -> tuple[tar_chunks.TarChunk, ClamdReply]:
+        chunk = tar_chunks.TarChunk(self.chunk_length, self.client.max_files)
+        chunk_data = chunk.iter_data(first_member, members)
+
+        try:
+            reply = self.client.instream(chunk_data)
+        except ClamdException as e:
+            reply = ClamdReply([f'stream: {e} ERROR'])
+
+        # If clamd stopped reading part way through, the rest of the chunk still needs to be read past
+        for _ in chunk_data:
+            pass
+
+        if not chunk.complete:
+            raise ArchiveException(f'Unable to read {self.u_ctx.file_meta.path}')
+
+        trace(f'Sent {len(chunk.members)} files to clamd in a chunk of {chunk.length} bytes')
+        return chunk, reply
+
+    def _pinpoint(self, flagged: list[tuple[tar_chunks.TarChunk, ClamdReply]]) -> None:
+        chunks_by_index = {}  # type: dict[int, tar_chunks.TarChunk]
+        for chunk, _ in flagged:
+            for index in chunk.member_indexes():
+                chunks_by_index[index] = chunk
+
+        pinpointed_chunk_ids = set()
+        for index, member in enumerate(self._iter_members()):
+            if index not in chunks_by_index:
+                continue
+
+            results_before = len(self.u_ctx.streamed_results)
+            self._stream(member, b'', self._member_path(member))
+            if len(self.u_ctx.streamed_results) > results_before:
+                pinpointed_chunk_ids.add(id(chunks_by_index[index]))
+
+        # Whatever clamd found might have taken more than one member to find, in which case the best we can do is to
+        # name the whole chunk
+        for chunk, reply in flagged:
+            if id(chunk) not in pinpointed_chunk_ids:
+                self.u_ctx.streamed_results.append((reply.get_return_code(), '\n'.join(chunk.reply_lines(reply.lines))))
+
+    def _stream_members(self) -> None:
+        flagged = []  # type: list[tuple[tar_chunks.TarChunk, ClamdReply]]
+
+        members = self._iter_streamable()
+        a_member = next(members, None)
+        while a_member is not None:
+            if not tar_chunks.fits_in_a_chunk(a_member, self.chunk_length):
+                # Could still be under StreamMaxLength, it is only MaxScanSize that it doesn't fit under
+                self._stream(a_member.member, a_member.header, a_member.member_path)
+                a_member = next(members, None)
+                continue
+
+            chunk, reply = self._send_chunk(a_member, members)
+            if reply.get_return_code() != 0:
+                flagged.append((chunk, reply))
+
+            a_member = chunk.next_member
+
+        if len(flagged) > 0:
+            fast_log.debug(f'clamd flagged {len(flagged)} chunks of {self.u_ctx.file_meta.path}, '
+                           f'reading them again to find out which files it was talking about')
+            self._pinpoint(flagged)
 
 
 # Handles VMDK and QCOW2
@@ -106,12 +471,36 @@ class GuestFSFileUnpackHandler(BaseFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx)
 
-    def unpack(self) -> contexts.UnpackContext:
+    def _mount_with_one_appliance(self, image_path: str, image_format: Optional[str]) -> None:
+        try:
+            partitions, failed, listing = mount_tools.mount_guestfs_image(image_path, self.u_ctx.unpacked_dir_location,
+                                                                          image_format)
+        except MountException as e:
+            fast_log.debug(f'Unable to mount {self.u_ctx.file_meta.path}, aborting unpack')
+            fast_log.debug(f'Got the following error: {e}')
+
+            raise click.FileError(filename=self.u_ctx.file_meta.path,
+                                  hint=f'Unable to mount {self.u_ctx.file_meta.path}, aborting unpack')
+
+        fast_log.debug(f'Mounted the following partitions to {self.u_ctx.unpacked_dir_location}:')
+        fast_log.debug('\n'.join(partitions))
+
+        for partition, error in failed.items():
+            fast_log.warn(f'Unable to mount the {partition} for {self.u_ctx.file_meta.path}, attempting to continue anyway')
+            fast_log.debug(f'Got the following error: {error}')
+
+        if listing is None:
+            fast_log.debug(f'Unable to list the files in {self.u_ctx.file_meta.path}, they will be found through the mount')
+
+        # Every stat through the mount is a round trip to the appliance, it already knows all of them
+        self.u_ctx.listing = listing
+
+    def _mount_each_partition(self, image_path: str, image_format: Optional[str]) -> None:
         try:
             # These VM Filesystem images can have multiple partitions
             # These need to be mounted individually
             partitions = mount_tools.enumerate_guestfs_partitions(
-                self.u_ctx.file_meta.path)  # internal partitions inside the blob
+                image_path, image_format)  # internal partitions inside the blob
 
             fast_log.debug(f'Found the following partitions:')
             fast_log.debug('\n'.join(partitions))
@@ -126,15 +515,115 @@ class GuestFSFileUnpackHandler(BaseFileUnpackHandler):
         for partition in partitions:
             try:
                 fast_log.debug(f'attempting to mount {partition}')
-                mount_tools.mount_guestfs_partition(self.u_ctx.file_meta.path, partition, self.u_ctx.unpacked_dir_location)
+                mount_tools.mount_guestfs_partition(image_path, partition, self.u_ctx.unpacked_dir_location,
+                                                    image_format)
                 fast_log.debug(f'Mounted {partition} to {self.u_ctx.unpacked_dir_location}')
             except MountException as e:
                 fast_log.warn(f'Unable to mount the {partition} for {self.u_ctx.file_meta.path}, attempting to continue anyway')
                 fast_log.debug(f'Got the following error: {e}')
 
+    def unpack(self) -> contexts.UnpackContext:
+        try:
+            with _guestfs_image(self.u_ctx) as (image_path, image_format):
+                if mount_tools.guestfs_bindings_available():
+                    # One appliance finds and mounts every partition, instead of one to find them, and one for each
+                    self._mount_with_one_appliance(image_path, image_format)
+                else:
+                    self._mount_each_partition(image_path, image_format)
+        except OSError as e:
+            raise click.FileError(filename=self.u_ctx.file_meta.path,
+                                  hint=f'Unable to extract {self.u_ctx.file_meta.path}: {e}')
+
+        # guestmount keeps reading from the disk image until it is un-mounted
+        self.u_ctx.depends_on_source = True
+
         return self.u_ctx
 
 
+def _iter_tar_out_members(u_ctx: contexts.UnpackContext,
+                          pool: Optional[guestfs_mount.AppliancePool]) -> Iterator[archive_members.ArchiveMember]:
+    """
+    The files in every filesystem of a VMDK or QCOW2, read out of a libguestfs appliance as tars, one after the other.
+    Each name starts with the directory that GuestFSFileUnpackHandler would have mounted the filesystem on.
+    How long it took is logged once everything has been read, to compare against mounting the image
+    :param pool: Where to borrow the appliance from, if anywhere
+    """
+
+    started = time.monotonic()
+    file_count = 0
+    byte_count = 0
+
+    with _guestfs_image(u_ctx) as (image_path, image_format):
+        try:
+            tar_out = mount_tools.open_guestfs_tar_out(image_path, pool, image_format)
+        except MountException as e:
+            raise ArchiveException(f'Unable to read {u_ctx.file_meta.path} out of libguestfs: {e}')
+
+        try:
+            for filesystem, error in tar_out.failed.items():
+                fast_log.warn(f'Unable to mount the {filesystem} for {u_ctx.file_meta.path}, '
+                              f'attempting to continue anyway')
+                fast_log.debug(f'Got the following error: {error}')
+
+            for dir_name, stream in tar_out.iter_streams():
+                fast_log.debug(f'Reading {dir_name} out of {u_ctx.file_meta.path}')
+                for member in archive_members.iter_tar_stream(stream, dir_name + '/'):
+                    file_count += 1
+                    byte_count += member.size
+                    yield member
+        finally:
+            tar_out.close()
+
+    fast_log.info(f'Read {u_ctx.nice_filename()} with tar-out: '
+                  f'{describe_throughput(file_count, byte_count, time.monotonic() - started)}')
+
+
+class GuestFSTarOutUnpackHandler(BaseFileUnpackHandler):
+    """
+    Handles VMDK and QCOW2 by extracting every file in them, instead of mounting them.
+    Every read through a guestfs mount is a round trip to the appliance, which adds up over a lot of small files.
+    This reads each filesystem out in one go instead, at the cost of the tmp dir having to fit all of it.
+    """
+
+    def __init__(self, u_ctx: contexts.UnpackContext, pool: Optional[guestfs_mount.AppliancePool] = None):
+        super().__init__(u_ctx)
+        self.pool = pool
+
+    def unpack(self) -> contexts.UnpackContext:
+        try:
+            for member in _iter_tar_out_members(self.u_ctx, self.pool):
+                archive_members.extract_member(member, os.path.join(self.u_ctx.unpacked_dir_location,
+                                                                    member.safe_relative_path()))
+        except Exception as e:
+            # Delete the temp dir since the unpacker created it
+            self.u_ctx.cleanup_tmp()
+            raise ArchiveException(e)
+
+        return self.u_ctx
+
+
+class StreamingGuestFSUnpackHandler(StreamingArchiveUnpackHandler):
+    # Same as GuestFSTarOutUnpackHandler, but with the files sent to clamd instead of being extracted
+    def __init__(self, u_ctx: contexts.UnpackContext, client: ClamdClient, min_file_size: int,
+                 pool: Optional[guestfs_mount.AppliancePool] = None):
+        super().__init__(u_ctx, client, min_file_size)
+        self.pool = pool
+
+    def _iter_members(self) -> Iterator[archive_members.ArchiveMember]:
+        return _iter_tar_out_members(self.u_ctx, self.pool)
+
+
+class ChunkedStreamingGuestFSUnpackHandler(ChunkedStreamingArchiveUnpackHandler):
+    # Finding out which file clamd was talking about means reading the image out of the appliance a second time
+    def __init__(self, u_ctx: contexts.UnpackContext, client: ClamdClient, min_file_size: int,
+                 pool: Optional[guestfs_mount.AppliancePool] = None):
+        super().__init__(u_ctx, client, min_file_size)
+        self.pool = pool
+
+    def _iter_members(self) -> Iterator[archive_members.ArchiveMember]:
+        return _iter_tar_out_members(self.u_ctx, self.pool)
+
+
 # Directories don't need unpacked, this just fits it into the same pattern
 class DirFileUnpackHandler:
     def __init__(self, u_ctx: contexts.UnpackContext):
@@ -153,15 +642,68 @@ FILETYPE_HANDLERS = {
     file_data.FileType.VMDK: GuestFSFileUnpackHandler,
     file_data.FileType.ZIP: ZipFileUnpackHandler,
     file_data.FileType.TARGZ: TarGzFileUnpackHandler,
+    file_data.FileType.TARZST: TarZstFileUnpackHandler,
+    file_data.FileType.TARXZ: TarXzFileUnpackHandler,
+    file_data.FileType.TARBZ2: TarBz2FileUnpackHandler,
     file_data.FileType.QCOW2: GuestFSFileUnpackHandler,
     file_data.FileType.DIR: DirFileUnpackHandler,
 }
 
 HANDLED_FILE_TYPES = FILETYPE_HANDLERS.keys()
 
+# Walking these goes through FUSE, or wherever the directory happens to live, and every readdir and stat is a round trip
+PARALLEL_WALK_FILE_TYPES = [filetype for filetype, handler_class in FILETYPE_HANDLERS.items()
+                            if handler_class in [GuestFSFileUnpackHandler, DirFileUnpackHandler]]
+
+
+def _is_tar_out(file_meta: file_data.FileMetadata, options: Optional[UnpackOptions]) -> bool:
+    # Disk images that get read out of the appliance, rather than mounted
+    return options is not None and options.guestfs_mode == GUESTFS_MODE_TAR_OUT and \
+        FILETYPE_HANDLERS[file_meta.filetype] == GuestFSFileUnpackHandler
+
+
+def _is_iso_read(file_meta: file_data.FileMetadata, options: Optional[UnpackOptions]) -> bool:
+    # ISOs that get read in-process, rather than mounted
+    return options is not None and options.iso_mode == ISO_MODE_READ and \
+        FILETYPE_HANDLERS[file_meta.filetype] == IsoFileUnpackHandler
+
+
+def _mount_slot_kind(file_meta: file_data.FileMetadata, options: Optional[UnpackOptions]) -> Optional[str]:
+    # What the context holds on to from the time it is mounted until it is cleaned up, if anything
+    handler_class = FILETYPE_HANDLERS.get(file_meta.filetype)
+    if handler_class == IsoFileUnpackHandler and not _is_iso_read(file_meta, options):
+        return mount_slots.LOOP_SLOT
+    if handler_class == GuestFSFileUnpackHandler and not _is_tar_out(file_meta, options):
+        return mount_slots.APPLIANCE_SLOT
+    return None
+
+
+def _handler_from_ctx(u_ctx: contexts.UnpackContext, options: Optional[UnpackOptions] = None,
+                      min_file_size: int = 0) -> BaseFileUnpackHandler:
+    if _is_tar_out(u_ctx.file_meta, options):
+        if options.stream_client is None:
+            return GuestFSTarOutUnpackHandler(u_ctx, options.guestfs_pool)
+        if options.stream_chunks:
+            return ChunkedStreamingGuestFSUnpackHandler(u_ctx, options.stream_client, min_file_size,
+                                                        options.guestfs_pool)
+        return StreamingGuestFSUnpackHandler(u_ctx, options.stream_client, min_file_size, options.guestfs_pool)
+
+    is_iso_read = _is_iso_read(u_ctx.file_meta, options)
+    in_place = options is not None and options.in_place
+    if options is not None and options.stream_client is not None and \
+            (u_ctx.file_meta.filetype in archive_members.STREAMABLE_FILE_TYPES or is_iso_read):
+        if options.stream_chunks:
+            return ChunkedStreamingArchiveUnpackHandler(u_ctx, options.stream_client, min_file_size, in_place)
+        return StreamingArchiveUnpackHandler(u_ctx, options.stream_client, min_file_size, in_place)
+
+    # Leaving nested archives in place needs to know which ones are worth unpacking
+    if is_iso_read or (in_place and u_ctx.file_meta.filetype in archive_members.STREAMABLE_FILE_TYPES):
+        return MemberArchiveUnpackHandler(u_ctx, min_file_size, in_place)
 
-def _handler_from_ctx(u_ctx: contexts.UnpackContext) -> BaseFileUnpackHandler:
     handler_class = FILETYPE_HANDLERS[u_ctx.file_meta.filetype]
+    if handler_class == ZipFileUnpackHandler and options is not None:
+        return ZipFileUnpackHandler(u_ctx, options.zip_jobs)
+
     return handler_class(u_ctx)
 
 
@@ -169,71 +711,339 @@ def is_handled_filetype(file_meta: file_data.FileMetadata) -> bool:
     return file_meta.filetype in HANDLED_FILE_TYPES
 
 
-def _do_unpack(u_ctx: contexts.UnpackContext) -> contexts.UnpackContext:
+def _do_unpack(u_ctx: contexts.UnpackContext, options: Optional[UnpackOptions] = None,
+               min_file_size: int = 0) -> contexts.UnpackContext:
     fast_log.debug('Doing unpack')
     if not is_handled_filetype(u_ctx.file_meta):
         raise click.BadParameter(f'Unhandled file type: {u_ctx.file_meta.filetype}')
 
-    handler = _handler_from_ctx(u_ctx)
+    handler = _handler_from_ctx(u_ctx, options, min_file_size)
     ret_ctx = handler.unpack()
 
     return ret_ctx
 
 
-def unpack(file: file_data.FileMetadata, tmp_dir: str) -> contexts.UnpackContext:
+def unpack(file: file_data.FileMetadata, tmp_dir: str, options: Optional[UnpackOptions] = None) -> contexts.UnpackContext:
     try:
-        u_ctx = contexts.UnpackContext(file, tmp_dir)
-        return _do_unpack(u_ctx)
+        u_ctx = _do_unpack(contexts.UnpackContext(file, tmp_dir), options)
+
+        # Nothing else is going to unpack the nested archives that were left in place, so they are extracted after all
+        for file_meta in u_ctx.views:
+            _extract_view(file_meta)
+
+        return u_ctx
     except ArchiveException as e:
         raise click.FileError(filename=file.path, hint=f'Unable to unpack {file.path}, got the following error: {e}')
 
 
-def unpack_recursive(parent_filemeta: file_data.FileMetadata, min_file_size: int, tmp_dir: str) -> list[contexts.UnpackContext]:
-    unpacked_ctx = list()  # type: list[contexts.UnpackContext]
+class UnpackListener:
+    """
+    Hooks for callers that want to act on contexts while unpack_recursive is still running.
+    With more than one unpack job, these are called from the worker threads, so they need to be thread safe.
+    """
 
-    parent_ctx = contexts.UnpackContext(parent_filemeta, tmp_dir)
-    parent_ctx = _do_unpack(parent_ctx)
+    def on_unpacked(self, u_ctx: contexts.UnpackContext) -> None:
+        # Called as soon as the handler for u_ctx returns, before it is searched for nested archives
+        pass
 
-    unpacked_ctx.append(parent_ctx)
+    def on_nested_found(self, u_ctx: contexts.UnpackContext, nested_ctxs: list[contexts.UnpackContext]) -> None:
+        # Called once u_ctx has been searched, before any of nested_ctxs are unpacked
+        pass
 
-    ctxs_to_inspect = [parent_ctx]  # type: list[contexts.UnpackContext]
+    def on_unpack_failed(self, u_ctx: contexts.UnpackContext) -> None:
+        # Called when a nested archive could not be unpacked, and is being skipped
+        pass
 
-    # Now walk the unpacked directory and find all relevant archives
-    # Add found archives to inspection list
-    # Go until all archives are unpacked and inspected
-    while len(ctxs_to_inspect) > 0:
-        ctx_to_inspect = ctxs_to_inspect.pop()
-        fast_log.debug(f'Analyzing {ctx_to_inspect.nice_filename()} for additional archives')
-        for root, _, files in os.walk(ctx_to_inspect.unpacked_dir_location):
-            trace(f'Looking at {root}')
-            for file in files:
-                file_path = os.path.join(root, file)
+
+def _is_inventoried(file_meta: file_data.FileMetadata) -> bool:
+    # Only regular files, clamd doesn't follow symlinks when it walks a directory, so these are left out as well
+    return file_meta.filetype not in [file_data.FileType.DIR, file_data.FileType.DOES_NOT_EXIST] \
+        and file_meta.desc != file_data.UNKNOWN_DESC
+
+
+class _RecursiveUnpacker:
+    def __init__(self, root_meta: file_data.FileMetadata, min_file_size: int, tmp_dir: str,
+                 listener: UnpackListener, options: UnpackOptions):
+        # Metadata of the top level file, used to name the temp dirs
+        self.root_meta = root_meta
+        # Archives smaller than this are left for clam to deal with
+        self.min_file_size = min_file_size
+        # Temporary directory that nested archives will be unpacked to
+        self.tmp_dir = tmp_dir
+        self.listener = listener
+        self.options = options
+
+    def _classify_unpacked(self, u_ctx: contexts.UnpackContext,
+                           onerror: Callable[[OSError], None]) -> Iterator[file_data.FileMetadata]:
+        if u_ctx.listing is not None:
+            trace(f'Going through the listing of {u_ctx.nice_filename()} instead of walking it')
+            listing = u_ctx.listing
+            # Nothing else needs it, and it can be as long as the image has files
+            u_ctx.listing = None
+            for file_path, st_mode, st_size in listing:
                 trace(f'Looking at at {file_path}')
-                file_meta = file_data.file_meta_from_path(file_path)
+                # Only files that could be archives get read through the mount
+                yield file_data.classify_listed(file_path, st_mode, st_size, self.min_file_size)
+            return
 
-                a_new_ctx = contexts.UnpackContext(file_meta, tmp_dir, parent_ctx=ctx_to_inspect)
+        # Extracted archives sit on local disk, where a single thread keeps up fine
+        walk_threads = 1
+        if u_ctx.file_meta.filetype in PARALLEL_WALK_FILE_TYPES and not _is_tar_out(u_ctx.file_meta, self.options):
+            walk_threads = self.options.walk_threads
+        for root, entries in walker.walk(u_ctx.unpacked_dir_location, onerror=onerror, threads=walk_threads):
+            trace(f'Looking at {root}')
+            for entry in entries:
+                trace(f'Looking at at {entry.path}')
+                # Whatever scandir already found out about the file is reused, instead of stat'ing it again
+                yield file_data.classify_entry(entry, self.min_file_size)
 
-                trace(f'Got meta from at {file_path}, type is {file_meta.filetype}')
+    def _take_slot(self, u_ctx: contexts.UnpackContext) -> bool:
+        # True if u_ctx can be unpacked right away, False if it has to wait for a mount slot
+        slot_kind = _mount_slot_kind(u_ctx.file_meta, self.options)
+        if self.options.mount_slots is None or slot_kind is None:
+            return True
 
-                if not is_handled_filetype(file_meta) or file_meta.size_raw < min_file_size:
-                    trace('File too small or not handled, moving on')
-                    # During recursive unpacking, we need to warn the user if we found a file that was not handled
-                    # But meets the filesize requirement
-                    if file_meta.size_raw >= min_file_size:
-                        fast_log.warn(f'Ignoring unhandled large file: {file_path}')
-                    continue
+        if self.options.mount_slots.try_acquire(slot_kind, u_ctx):
+            return True
+
+        trace(f'No {slot_kind} to spare for {u_ctx.nice_filename()}, holding it back')
+        return False
+
+    def _release_slot(self, u_ctx: contexts.UnpackContext) -> None:
+        if self.options.mount_slots is not None:
+            self.options.mount_slots.release(u_ctx)
+
+    def _leave_for_clamd(self, u_ctx: contexts.UnpackContext) -> None:
+        """
+        Called for a nested archive that is not getting unpacked, before the listener hears about it, so that it is
+        scanned as it is along with its parent
+        """
+
+        if u_ctx.file_meta.view is None:
+            return
+
+        # clamd can only scan it if it is on disk
+        try:
+            _extract_view(u_ctx.file_meta)
+        except OSError as e:
+            fast_log.warn(f'Unable to extract {u_ctx.file_meta.path} from {u_ctx.file_meta.view}: {e}')
+            return
+
+        if u_ctx.parent_ctx.inventory is not None:
+            u_ctx.parent_ctx.inventory.append(u_ctx.file_meta)
+
+    def _wait_for_slots(self, waiting_ctxs: list[contexts.UnpackContext]) -> list[contexts.UnpackContext]:
+        """
+        Called once there is nothing left to unpack but the contexts waiting on a mount slot
+        :return: The contexts to try again, empty if none of them are ever getting a slot, those are given up on
+        """
+
+        if self.options.mount_slots.wait_for_release(waiting_ctxs):
+            return waiting_ctxs
+
+        for a_ctx in waiting_ctxs:
+            fast_log.warn(f'Unable to get a mount slot for {a_ctx.file_meta.path}, leaving it to clamd as it is')
+            self.options.mount_slots.give_up(a_ctx)
+            self._leave_for_clamd(a_ctx)
+            self.listener.on_unpack_failed(a_ctx)
+
+        return []
+
+    def find_nested_archives(self, u_ctx: contexts.UnpackContext) -> list[contexts.UnpackContext]:
+        """
+        Walks the unpacked directory of a context, looking for archives that should be unpacked as well
+        :param u_ctx: An already unpacked context
+        :return: Contexts for the nested archives, in the order that they were found. None of these are unpacked yet
+        """
+
+        nested_ctxs = []  # type: list[contexts.UnpackContext]
+        inventory = []  # type: list[file_data.FileMetadata]
+        walk_errors = []  # type: list[OSError]
+
+        fast_log.debug(f'Analyzing {u_ctx.nice_filename()} for additional archives')
+        for file_meta in self._classify_unpacked(u_ctx, walk_errors.append):
+            file_path = file_meta.path
+            trace(f'Got meta from at {file_path}, type is {file_meta.filetype}')
+
+            if _is_inventoried(file_meta):
+                inventory.append(file_meta)
+
+            if not is_handled_filetype(file_meta) or file_meta.size_raw < self.min_file_size:
+                trace('File too small or not handled, moving on')
+                # During recursive unpacking, we need to warn the user if we found a file that was not handled
+                # But meets the filesize requirement
+                if file_meta.size_raw >= self.min_file_size:
+                    fast_log.warn(f'Ignoring unhandled large file: {file_path}')
+                continue
+
+            # Current is a valid unpackable archive
+            fast_log.debug(f'Found archive:')
+            fast_log.debug(str(file_meta))
+            file_meta.root_meta = self.root_meta
+
+            nested_ctxs.append(contexts.UnpackContext(file_meta, self.tmp_dir, parent_ctx=u_ctx))
+
+        # Never extracted, so the walk didn't come across these
+        for file_meta in u_ctx.views:
+            fast_log.debug(f'Found archive, left in place at {file_meta.view}:')
+            fast_log.debug(str(file_meta))
+            file_meta.root_meta = self.root_meta
+
+            nested_ctxs.append(contexts.UnpackContext(file_meta, self.tmp_dir, parent_ctx=u_ctx))
+
+        if len(walk_errors) > 0:
+            # Whatever the walk couldn't get into, clamd might, so let it walk the directory itself
+            fast_log.warn(f'Unable to look at all of {u_ctx.nice_filename()}, got the following error: '
+                          f'{walk_errors[0]}. Leaving it to clamd to find the files to scan')
+        else:
+            u_ctx.inventory = inventory
+
+        self.listener.on_nested_found(u_ctx, nested_ctxs)
+
+        return nested_ctxs
+
+    def unpack_root(self) -> contexts.UnpackContext:
+        # Unlike nested archives, failing to unpack the top level file is fatal
+        root_ctx = contexts.UnpackContext(self.root_meta, self.tmp_dir)
+        # Nothing holds a slot yet, so there is always one for it
+        self._take_slot(root_ctx)
+        root_ctx = _do_unpack(root_ctx, self.options, self.min_file_size)
+        self.listener.on_unpacked(root_ctx)
+
+        return root_ctx
+
+    def unpack_nested(self, u_ctx: contexts.UnpackContext) -> bool:
+        # A broken nested archive shouldn't stop the rest of the unpack
+        try:
+            _do_unpack(u_ctx, self.options, self.min_file_size)
+        except ArchiveException as e:
+            fast_log.warn(f'Unable to unpack {u_ctx.file_meta.path}, got the following error: {e}. Continuing anyway')
+            # Nothing got mounted
+            self._release_slot(u_ctx)
+            self._leave_for_clamd(u_ctx)
+            self.listener.on_unpack_failed(u_ctx)
+            return False
+
+        # Set before the listener hears about it, so the parent is complete by the time it is told about the last one
+        u_ctx.parent_ctx.covered_paths.add(u_ctx.file_meta.path)
+        self.listener.on_unpacked(u_ctx)
+        return True
+
+    def unpack_and_find_nested(self, u_ctx: contexts.UnpackContext) -> Optional[list[contexts.UnpackContext]]:
+        """
+        One unit of work for recursive unpacking, unpack a single archive, then look inside of it for more
+        :return: The nested archives found, or None if the archive could not be unpacked
+        """
+
+        if not self.unpack_nested(u_ctx):
+            return None
+
+        return self.find_nested_archives(u_ctx)
+
+    def unpack_serial(self, found_ctxs: list[contexts.UnpackContext]) -> list[contexts.UnpackContext]:
+        unpacked_ctxs = []  # type: list[contexts.UnpackContext]
+
+        # Depth first, so that the contents of an archive are dealt with before its siblings
+        ctxs_to_unpack = list(reversed(found_ctxs))  # type: list[contexts.UnpackContext]
+        # Found, but held back until there is a mount slot for them, oldest first
+        waiting_ctxs = []  # type: list[contexts.UnpackContext]
+
+        while len(ctxs_to_unpack) > 0 or len(waiting_ctxs) > 0:
+            if len(ctxs_to_unpack) == 0:
+                ctxs_to_unpack = list(reversed(self._wait_for_slots(waiting_ctxs)))
+                waiting_ctxs = []
+                continue
+
+            a_ctx = ctxs_to_unpack.pop()
+            if not self._take_slot(a_ctx):
+                waiting_ctxs.append(a_ctx)
+                continue
+
+            nested_ctxs = self.unpack_and_find_nested(a_ctx)
+            if nested_ctxs is None:
+                continue
+
+            unpacked_ctxs.append(a_ctx)
+            ctxs_to_unpack.extend(reversed(nested_ctxs))
+
+        return unpacked_ctxs
+
+    def unpack_parallel(self, found_ctxs: list[contexts.UnpackContext], unpack_jobs: int) -> list[contexts.UnpackContext]:
+        # Threads rather than processes, the contexts need to keep pointing at their parents for nice_filename(),
+        # and the heavy lifting is done either by zlib or by mount subprocesses, neither of which hold the GIL
+        discovered_ctxs = list(found_ctxs)  # type: list[contexts.UnpackContext]
+        unpacked_ctx_ids = set()
+        ready_ctxs = list(found_ctxs)  # type: list[contexts.UnpackContext]
+        # Found, but held back until there is a mount slot for them, oldest first
+        waiting_ctxs = []  # type: list[contexts.UnpackContext]
+
+        with ThreadPoolExecutor(max_workers=unpack_jobs, thread_name_prefix='unpack') as executor:
+            pending = {}
+
+            try:
+                while True:
+                    for a_ctx in ready_ctxs:
+                        if self._take_slot(a_ctx):
+                            pending[executor.submit(self.unpack_and_find_nested, a_ctx)] = a_ctx
+                        else:
+                            waiting_ctxs.append(a_ctx)
+
+                    if len(pending) == 0:
+                        if len(waiting_ctxs) == 0:
+                            break
+                        ready_ctxs = self._wait_for_slots(waiting_ctxs)
+                        waiting_ctxs = []
+                        continue
+
+                    timeout = SLOT_POLL_SECONDS if len(waiting_ctxs) > 0 else None
+                    done, _ = wait(pending.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+
+                    ready_ctxs = waiting_ctxs
+                    waiting_ctxs = []
+                    for future in done:
+                        a_ctx = pending.pop(future)
+                        nested_ctxs = future.result()
+                        if nested_ctxs is None:
+                            continue
+
+                        unpacked_ctx_ids.add(id(a_ctx))
+                        discovered_ctxs.extend(nested_ctxs)
+                        ready_ctxs.extend(nested_ctxs)
+            except BaseException:
+                # Anything that isn't an ArchiveException is fatal, don't start any more work
+                for future in pending.keys():
+                    future.cancel()
+                raise
+
+        # Report in the order things were found, not the order the workers happened to finish in
+        return [a_ctx for a_ctx in discovered_ctxs if id(a_ctx) in unpacked_ctx_ids]
+
+
+def unpack_recursive(parent_filemeta: file_data.FileMetadata, min_file_size: int, tmp_dir: str,
+                     unpack_jobs: int = 1, listener: UnpackListener = None,
+                     options: UnpackOptions = None) -> list[contexts.UnpackContext]:
+    """
+    :param parent_filemeta: The file to unpack
+    :param min_file_size: Nested archives smaller than this are not unpacked
+    :param tmp_dir: Temporary directory to unpack to
+    :param unpack_jobs: How many archives can be unpacked at the same time
+    :param listener: Optional hooks that are told about each context as soon as it is unpacked
+    :param options: Optional settings for how archives are unpacked
+    :return: The contexts of everything that was unpacked, starting with parent_filemeta
+    """
+
+    recursive_unpacker = _RecursiveUnpacker(parent_filemeta, min_file_size, tmp_dir, listener or UnpackListener(),
+                                            options or UnpackOptions())
 
-                # Current is a valid unpackable archive
-                fast_log.debug(f'Found archive:')
-                fast_log.debug(str(file_meta))
-                file_meta.root_meta = parent_filemeta
+    parent_ctx = recursive_unpacker.unpack_root()
+    found_ctxs = recursive_unpacker.find_nested_archives(parent_ctx)
 
-                try:
+    if unpack_jobs > 1:
+        nested_ctxs = recursive_unpacker.unpack_parallel(found_ctxs, unpack_jobs)
+    else:
+        nested_ctxs = recursive_unpacker.unpack_serial(found_ctxs)
 
-                    a_new_ctx = _do_unpack(a_new_ctx)
-                    unpacked_ctx.append(a_new_ctx)
-                    ctxs_to_inspect.append(a_new_ctx)
-                except ArchiveException as e:
-                    fast_log.warn(f'Unable to unpack {file_path}, got the following error: {e}. Continuing anyway')
+    if recursive_unpacker.options.mount_slots is not None:
+        fast_log.info(f'Mount slots: {recursive_unpacker.options.mount_slots.describe_waits()}')
 
-    return unpacked_ctx
+    return [parent_ctx] + nested_ctxs
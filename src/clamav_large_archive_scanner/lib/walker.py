@@ -0,0 +1,235 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Walks unpacked trees with os.scandir, handing out the DirEntry objects instead of just their names
+# os.walk looks at the same entries to tell files from directories, then throws them away, so anything that wants
+# to know more about a file has to stat it again by path
+
+import collections
+import os
+import threading
+from typing import Callable, Iterator, Optional
+
+# What a directory read comes back as: the entries of everything in it that isn't a directory, and its sub directories
+_DirContents = tuple[list[os.DirEntry], list[str]]
+
+# How far the threads can get ahead of whoever is walking, in directories read but not handed out yet, for each thread
+_RESULTS_PER_THREAD = 4
+
+
+def _read_dir(a_dir: str) -> _DirContents:
+    files = []  # type: list[os.DirEntry]
+    sub_dirs = []  # type: list[str]
+
+    with os.scandir(a_dir) as entries:
+        for entry in entries:
+            # Neither of these needs a stat for a real directory or file, the type comes from readdir
+            if entry.is_dir() and not entry.is_symlink():
+                sub_dirs.append(entry.path)
+            elif not entry.is_dir():
+                files.append(entry)
+
+    return files, sub_dirs
+
+
+def _prefetch_stats(files: list[os.DirEntry]) -> None:
+    # Get the stats that file_data.classify_entry is going to ask for, the entries keep them around
+    for entry in files:
+        try:
+            if entry.is_symlink():
+                entry.stat()
+            else:
+                entry.stat(follow_symlinks=False)
+        except OSError:
+            # classify_entry runs into the same error, and deals with it
+            pass
+
+
+class _ParallelWalk:
+    """
+    Reads directories on a pool of threads, while handing them out in the same order as the serial walk.
+    Every thread keeps a stack of the directories that it found, and takes the most recent one off of it, so it
+    stays deep in one part of the tree. A thread that runs out steals the oldest directory off of another thread's
+    stack, which is the one closest to the top, and likely to have the most under it.
+    The threads stop taking directories once _max_results are read or being read, and haven't been handed out, so a
+    slow walker doesn't end up with the whole tree in memory. The one that the walker is waiting on can always be taken.
+    """
+
+    def __init__(self, top: str, threads: int):
+        self._top = top
+        self._cond = threading.Condition()
+
+        self._stacks = [collections.deque() for _ in range(threads)]  # type: list[collections.deque[str]]
+        self._stacks[0].append(top)
+
+        # Directories that are on a stack, or being read
+        self._pending = 1
+        # Read directories that haven't been handed out yet, or the error that reading them ran into
+        self._results = {}  # type: dict[str, _DirContents | OSError]
+        self._max_results = _RESULTS_PER_THREAD * threads
+        self._reading = 0
+        # The next one to hand out, None while the walker is busy with the last one
+        self._wanted = None  # type: str | None
+        # Anything but an OSError is a bug, and ends the walk
+        self._failure = None  # type: BaseException | None
+        self._stopped = False
+
+        self._threads = [threading.Thread(target=self._work, args=(index,), name=f'walk_{index}', daemon=True)
+                         for index in range(threads)]
+
+    def _take(self, index: int) -> Optional[str]:
+        # Has to be called with _cond held
+        while not self._stopped and self._pending > 0:
+            if len(self._results) + self._reading >= self._max_results:
+                # Otherwise the walker could wait on a directory that no thread is ever going to read
+                for stack in self._stacks:
+                    if self._wanted in stack:
+                        stack.remove(self._wanted)
+                        return self._wanted
+
+                self._cond.wait()
+                continue
+
+            own_stack = self._stacks[index]
+            if len(own_stack) > 0:
+                return own_stack.pop()
+
+            for offset in range(1, len(self._stacks)):
+                other_stack = self._stacks[(index + offset) % len(self._stacks)]
+                if len(other_stack) > 0:
+                    return other_stack.popleft()
+
+            self._cond.wait()
+
+        return None
+
+    def _work(self, index: int) -> None:
+        while True:
+            with self._cond:
+                a_dir = self._take(index)
+                if a_dir is None:
+                    return
+                self._reading += 1
+
+            try:
+                try:
+                    result = _read_dir(a_dir)  # type: _DirContents | OSError
+                    _prefetch_stats(result[0])
+                except OSError as e:
+                    result = e
+            except BaseException as e:
+                with self._cond:
+                    self._failure = e
+                    self._stopped = True
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._reading -= 1
+                self._results[a_dir] = result
+                sub_dirs = result[1] if isinstance(result, tuple) else []
+                # Reversed, so the first sub directory is the next one off of the stack
+                self._stacks[index].extend(reversed(sub_dirs))
+                self._pending += len(sub_dirs) - 1
+                self._cond.notify_all()
+
+    def _wait_for(self, a_dir: str) -> '_DirContents | OSError':
+        with self._cond:
+            self._wanted = a_dir
+            # Threads held back by _max_results may have to go read it
+            self._cond.notify_all()
+            while a_dir not in self._results and self._failure is None:
+                self._cond.wait()
+
+            if self._failure is not None:
+                raise self._failure
+
+            self._wanted = None
+            # Makes room for the threads to go on
+            self._cond.notify_all()
+            return self._results.pop(a_dir)
+
+    def walk(self, onerror: Optional[Callable[[OSError], None]]) -> Iterator[tuple[str, list[os.DirEntry]]]:
+        for thread in self._threads:
+            thread.start()
+
+        try:
+            dirs_to_hand_out = [self._top]
+            while len(dirs_to_hand_out) > 0:
+                a_dir = dirs_to_hand_out.pop()
+                result = self._wait_for(a_dir)
+
+                if isinstance(result, OSError):
+                    if onerror is not None:
+                        onerror(result)
+                    continue
+
+                files, sub_dirs = result
+                yield a_dir, files
+
+                dirs_to_hand_out.extend(reversed(sub_dirs))
+        finally:
+            # Also stops the threads if whoever is walking gives up early
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            for thread in self._threads:
+                thread.join()
+
+
+def walk(top: str, onerror: Optional[Callable[[OSError], None]] = None,
+         threads: int = 1) -> Iterator[tuple[str, list[os.DirEntry]]]:
+    """
+    Same walk as os.walk(top, onerror=onerror): top down, depth first, without following symlinks to directories
+    :param top: Directory to walk
+    :param onerror: Called with the error for every directory that could not be read, those are skipped
+    :param threads: How many directories to read at the same time. Worth it when every read is a round trip,
+                    like on FUSE mounts. The files are stat'ed on those threads as well, and come back in the same order
+    :return: For every directory, its path and the entries of everything in it that isn't a directory
+    """
+
+    if threads > 1:
+        yield from _ParallelWalk(top, threads).walk(onerror)
+        return
+
+    dirs_to_walk = [top]
+
+    while len(dirs_to_walk) > 0:
+        a_dir = dirs_to_walk.pop()
+
+        try:
+            files, sub_dirs = _read_dir(a_dir)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        yield a_dir, files
+
+        # Reversed, so the first sub directory is the next one off of the stack
+        dirs_to_walk.extend(reversed(sub_dirs))
@@ -0,0 +1,395 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Reads the entries of a ZIP out of its central directory a chunk at a time, instead of all at once
+# zipfile.ZipFile builds a ZipInfo for every entry, and a dict of their names, before anything can be read, which for
+# ZIP64 archives with millions of entries takes GiBs. Here only the entry being read is held on to. The data is still
+# decompressed, and its CRC checked, by zipfile.ZipExtFile
+
+import os
+import struct
+import zipfile
+from typing import BinaryIO, Iterator, Optional
+
+# The end of central directory record is at the very end, unless the archive has a comment, which is at most this long
+MAX_COMMENT_LENGTH = 0xFFFF
+
+# The central directory is read this much at a time, an entry can take up to 3 * 64K past its fixed size part
+DIRECTORY_READ_SIZE = 1024 * 1024
+
+FLAG_ENCRYPTED = 0x01
+FLAG_UTF8_NAME = 0x800
+
+# Sizes and offsets that don't fit in a ZIP header are set to these, and stored in a ZIP64 extra field instead
+ZIP64_LIMIT_32 = 0xFFFFFFFF
+ZIP64_LIMIT_16 = 0xFFFF
+ZIP64_EXTRA_TAG = 0x0001
+
+_END_RECORD = struct.Struct('<4s4H2LH')
+_END_RECORD_SIGNATURE = b'PK\x05\x06'
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+_ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_END_RECORD_SIGNATURE = b'PK\x06\x06'
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+class ZipEntry:
+    def __init__(self, name: str, flag_bits: int, compress_type: int, crc: int, compress_size: int, file_size: int,
+                 header_offset: int):
+        # Path of the entry inside the archive, as the archive has it
+        self.name = name
+        self.flag_bits = flag_bits
+        self.compress_type = compress_type
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        # Where the entry's local header is, from the start of the archive
+        self.header_offset = header_offset
+
+    def is_dir(self) -> bool:
+        return self.name.endswith('/')
+
+    def is_encrypted(self) -> bool:
+        return self.flag_bits & FLAG_ENCRYPTED != 0
+
+    def is_stored(self) -> bool:
+        # The data is in the archive as it is
+        return self.compress_type == zipfile.ZIP_STORED and not self.is_encrypted()
+
+
+class ZipShard:
+    """
+    A run of entries, back to back in the central directory, that can be read on its own by another ZipArchive on the
+    same file
+    """
+
+    def __init__(self, directory_offset: int, directory_size: int, entry_count: int, data_size: int):
+        # Where the run starts, from the start of the archive, and how long it is
+        self.directory_offset = directory_offset
+        self.directory_size = directory_size
+        self.entry_count = entry_count
+        # About how much of the archive the entries in the run take up between them, headers included
+        self.data_size = data_size
+
+
+class _EntryDataReader:
+    """
+    Hands ZipExtFile the compressed data of one entry, straight out of the archive with pread.
+    Readers don't share a position, so one being left half read doesn't get in the way of the next
+    """
+
+    def __init__(self, fd: int, offset: int, length: int):
+        self._fd = fd
+        self._offset = offset
+        self._left = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._left:
+            size = self._left
+
+        data = os.pread(self._fd, size, self._offset)
+        self._offset += len(data)
+        self._left -= len(data)
+        return data
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+class _DirectoryReader:
+    # Reads the central directory front to back, DIRECTORY_READ_SIZE at a time
+
+    def __init__(self, archive: 'ZipArchive', offset: int, length: int):
+        self._archive = archive
+        self._offset = offset
+        self._end = offset + length
+        self._buffer = b''
+        self._buffer_position = 0
+
+    def at_end(self) -> bool:
+        return self._offset == self._end and self._buffer_position == len(self._buffer)
+
+    def position(self) -> int:
+        # Where the next read starts, from the start of the archive
+        return self._offset - (len(self._buffer) - self._buffer_position)
+
+    def read(self, size: int) -> bytes:
+        if len(self._buffer) - self._buffer_position < size:
+            to_read = min(max(size, DIRECTORY_READ_SIZE), self._end - self._offset)
+            self._buffer = self._buffer[self._buffer_position:] + self._archive.pread(to_read, self._offset)
+            self._buffer_position = 0
+            self._offset += to_read
+
+            if len(self._buffer) < size:
+                raise zipfile.BadZipFile(f'The central directory of {self._archive.path} ends partway into an entry')
+
+        data = self._buffer[self._buffer_position:self._buffer_position + size]
+        self._buffer_position += size
+        return data
+
+
+def _decode_name(raw_name: bytes, flag_bits: int) -> str:
+    # Same as zipfile, names are only UTF-8 if the entry says so
+    return raw_name.decode('utf-8' if flag_bits & FLAG_UTF8_NAME else 'cp437')
+
+
+def _apply_zip64_extra(extra: bytes, file_size: int, compress_size: int,
+                       header_offset: int) -> tuple[int, int, int]:
+    """
+    :return: file_size, compress_size and header_offset, with the ones that didn't fit in the header read from the
+        ZIP64 extra field, which only holds those, in that order
+    """
+
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = struct.unpack_from('<2H', extra, position)
+        position += 4
+        if tag != ZIP64_EXTRA_TAG:
+            position += length
+            continue
+
+        values = extra[position:position + length]
+        value_position = 0
+        fields = [file_size, compress_size, header_offset]
+        for index, value in enumerate(fields):
+            if value != ZIP64_LIMIT_32:
+                continue
+            if value_position + 8 > len(values):
+                raise zipfile.BadZipFile('ZIP64 extra field is too short')
+            fields[index] = struct.unpack_from('<Q', values, value_position)[0]
+            value_position += 8
+
+        return fields[0], fields[1], fields[2]
+
+    return file_size, compress_size, header_offset
+
+
+class ZipArchive:
+    """
+    A ZIP archive, opened for reading.
+    Entries are only read out of the central directory when they are asked for, and only read from when they are opened
+    """
+
+    def __init__(self, path: str, offset: int = 0, length: Optional[int] = None):
+        """
+        :param offset: Where the archive starts in the file, for archives that are stored inside of another one
+        :param length: How long the archive is, by default it runs to the end of the file
+        """
+
+        self.path = path
+        self.offset = offset
+        self._fd = os.open(path, os.O_RDONLY)
+
+        try:
+            self.length = length if length is not None else os.fstat(self._fd).st_size - offset
+            self._read_end_record()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self) -> 'ZipArchive':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def pread(self, size: int, offset: int) -> bytes:
+        data = os.pread(self._fd, size, self.offset + offset)
+        if len(data) < size:
+            raise zipfile.BadZipFile(f'{self.path} ends at {offset + len(data)}, expected at least {offset + size}')
+        return data
+
+    def _find_end_record(self) -> int:
+        # Look at the very end first, where the record is for archives without a comment
+        if self.length < _END_RECORD.size:
+            raise zipfile.BadZipFile(f'{self.path} is too short to be a ZIP')
+
+        tail_length = min(self.length, _END_RECORD.size + MAX_COMMENT_LENGTH)
+        tail = self.pread(tail_length, self.length - tail_length)
+        # The last one that has room for a whole record after it, and whose comment runs right up to the end. Comments
+        # can have anything in them, including something that looks like the start of a record. Like zipfile, archives
+        # with something after their comment are still read, from the last record there is room for
+        end = tail_length - _END_RECORD.size + len(_END_RECORD_SIGNATURE)
+        last_position = tail.rfind(_END_RECORD_SIGNATURE, 0, end)
+        if last_position < 0:
+            raise zipfile.BadZipFile(f'{self.path} has no end of central directory record')
+
+        position = last_position
+        while position >= 0:
+            comment_length = _END_RECORD.unpack_from(tail, position)[-1]
+            if position + _END_RECORD.size + comment_length == tail_length:
+                return self.length - tail_length + position
+            position = tail.rfind(_END_RECORD_SIGNATURE, 0, position + len(_END_RECORD_SIGNATURE) - 1)
+
+        return self.length - tail_length + last_position
+
+    def _read_end_record(self) -> None:
+        end_position = self._find_end_record()
+        end_record = _END_RECORD.unpack(self.pread(_END_RECORD.size, end_position))
+        directory_size, directory_offset = end_record[5], end_record[6]
+        # Where the central directory ends, which is where the archive thinks it does, unless something was put in front
+        # of it, like the stub of a self extracting archive
+        directory_end = end_position
+
+        locator_position = end_position - _ZIP64_LOCATOR.size
+        if locator_position >= 0 and self.pread(4, locator_position) == _ZIP64_LOCATOR_SIGNATURE:
+            # Same as zipfile, the ZIP64 record is taken to be right in front of its locator, wherever it says it is
+            zip64_position = locator_position - _ZIP64_END_RECORD.size
+            if zip64_position < 0:
+                raise zipfile.BadZipFile(f'{self.path} has a ZIP64 locator, but no room for a ZIP64 record')
+
+            zip64_record = _ZIP64_END_RECORD.unpack(self.pread(_ZIP64_END_RECORD.size, zip64_position))
+            if zip64_record[0] != _ZIP64_END_RECORD_SIGNATURE:
+                raise zipfile.BadZipFile(f'{self.path} has a ZIP64 locator, but no ZIP64 record')
+
+            directory_size, directory_offset = zip64_record[8], zip64_record[9]
+            directory_end = zip64_position
+
+        # Offsets in the archive are off by however much was put in front of it
+        self._concat = directory_end - directory_size - directory_offset
+        if self._concat < 0:
+            raise zipfile.BadZipFile(f'The central directory of {self.path} would start before the archive does')
+
+        self._directory_offset = directory_offset + self._concat
+        self._directory_size = directory_size
+
+    def iter_entries(self, shard: Optional[ZipShard] = None) -> Iterator[ZipEntry]:
+        """
+        :param shard: If set, only the entries in it are read, it has to be from shard_entries on the same archive
+        :return: Every entry in the central directory, in the order it has them, directories included
+        """
+
+        if shard is None:
+            return self._iter_entries_from(_DirectoryReader(self, self._directory_offset, self._directory_size))
+
+        directory_end = self._directory_offset + self._directory_size
+        if shard.directory_offset < self._directory_offset or \
+                shard.directory_offset + shard.directory_size > directory_end:
+            raise ValueError(f'Shard at {shard.directory_offset} is not in the central directory of {self.path}')
+
+        return self._iter_entries_from(_DirectoryReader(self, shard.directory_offset, shard.directory_size))
+
+    def _iter_entries_from(self, reader: _DirectoryReader) -> Iterator[ZipEntry]:
+        while not reader.at_end():
+            header = _CENTRAL_HEADER.unpack(reader.read(_CENTRAL_HEADER.size))
+            if header[0] != _CENTRAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f'Bad central directory header in {self.path}')
+
+            flag_bits, compress_type, crc = header[5], header[6], header[9]
+            compress_size, file_size = header[10], header[11]
+            name_length, extra_length, comment_length = header[12], header[13], header[14]
+            header_offset = header[18]
+
+            name = _decode_name(reader.read(name_length), flag_bits)
+            extra = reader.read(extra_length)
+            reader.read(comment_length)
+
+            file_size, compress_size, header_offset = _apply_zip64_extra(extra, file_size, compress_size,
+                                                                         header_offset)
+            yield ZipEntry(name, flag_bits, compress_type, crc, compress_size, file_size,
+                           header_offset + self._concat)
+
+    def shard_entries(self, shard_count: int) -> list[ZipShard]:
+        """
+        Splits the central directory into runs of entries with about as much data in each.
+        Everything in front of the central directory is taken to be entry data, so the runs are cut as they are read,
+        in one pass over the central directory, without holding on to the entries
+        :param shard_count: How many runs to split it into at most, there are fewer if there aren't enough entries
+        :return: The runs, in the order the central directory has them, together they have every entry in it
+        """
+
+        target_size = max(1, (self._directory_offset - self._concat) // shard_count)
+        shards = []  # type: list[ZipShard]
+        reader = _DirectoryReader(self, self._directory_offset, self._directory_size)
+        start = reader.position()
+        entry_count = 0
+        data_size = 0
+        for entry in self._iter_entries_from(reader):
+            entry_count += 1
+            # What the entry takes up in front of the central directory, give or take its local extra field
+            data_size += _LOCAL_HEADER.size + len(entry.name) + entry.compress_size
+
+            # The last run takes whatever is left
+            if len(shards) < shard_count - 1 and data_size >= target_size:
+                shards.append(ZipShard(start, reader.position() - start, entry_count, data_size))
+                start = reader.position()
+                entry_count = 0
+                data_size = 0
+
+        if entry_count > 0:
+            shards.append(ZipShard(start, reader.position() - start, entry_count, data_size))
+
+        return shards
+
+    def data_offset(self, entry: ZipEntry) -> int:
+        """
+        :return: Where the entry's data starts, from the start of the archive, which is only known from its local header
+        """
+
+        header = _LOCAL_HEADER.unpack(self.pread(_LOCAL_HEADER.size, entry.header_offset))
+        if header[0] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f'Bad local header for {entry.name} in {self.path}')
+
+        name_length, extra_length = header[10], header[11]
+        return entry.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+
+    def open_entry(self, entry: ZipEntry, data_offset: Optional[int] = None) -> BinaryIO:
+        """
+        :param entry: One of the entries from iter_entries
+        :param data_offset: What data_offset returned for it, if it was already asked for
+        :return: The entry's data, decompressed, only good for as long as the archive is open
+        """
+
+        if entry.is_encrypted():
+            # Same as zipfile without a password
+            raise RuntimeError(f'File {entry.name} is encrypted, password required for extraction')
+
+        if data_offset is None:
+            data_offset = self.data_offset(entry)
+
+        zip_info = zipfile.ZipInfo(entry.name)
+        zip_info.flag_bits = entry.flag_bits
+        zip_info.compress_type = entry.compress_type
+        zip_info.CRC = entry.crc
+        zip_info.compress_size = entry.compress_size
+        zip_info.file_size = entry.file_size
+
+        reader = _EntryDataReader(self._fd, self.offset + data_offset, entry.compress_size)
+        return zipfile.ZipExtFile(reader, 'r', zip_info)
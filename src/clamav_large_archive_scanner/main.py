@@ -26,22 +26,42 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 import sys
+from typing import Optional
 
 import click
 import humanize
 
+import clamav_large_archive_scanner.lib.clamd as clamd
 import clamav_large_archive_scanner.lib.cleanup as cleaner
+import clamav_large_archive_scanner.lib.compressed_stream as compressed_stream
 import clamav_large_archive_scanner.lib.file_data as detect
+import clamav_large_archive_scanner.lib.mount_slots as mount_slots
+import clamav_large_archive_scanner.lib.mount_tools as mount_tools
+import clamav_large_archive_scanner.lib.pipeline as pipeliner
 import clamav_large_archive_scanner.lib.unpack as unpacker
 import clamav_large_archive_scanner.lib.scanner as scanner
 import clamav_large_archive_scanner.lib.contexts as Contexts
 
 from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
 from clamav_large_archive_scanner.lib.filesize import convert_human_to_machine_bytes
 
 DEFAULT_MIN_SIZE_THRESHOLD_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
 DEFAULT_MIN_SIZE_HUMAN = humanize.naturalsize(DEFAULT_MIN_SIZE_THRESHOLD_BYTES, binary=True)
 
+# How scan talks to clamd, either by running clamdscan, or over clamd's socket
+CLAMD_CLIENT_CLAMDSCAN = 'clamdscan'
+CLAMD_CLIENT_NATIVE = 'native'
+
+# How VMDK and QCOW2 images get unpacked, either mounted, or read out of the libguestfs appliance as tars
+GUESTFS_MODE_MOUNT = unpacker.GUESTFS_MODE_MOUNT
+GUESTFS_MODE_TAR_OUT = unpacker.GUESTFS_MODE_TAR_OUT
+ISO_MODE_MOUNT = unpacker.ISO_MODE_MOUNT
+ISO_MODE_READ = unpacker.ISO_MODE_READ
+DECOMPRESS_MODE_PYTHON = compressed_stream.DECOMPRESS_MODE_PYTHON
+DECOMPRESS_MODE_THREADS = compressed_stream.DECOMPRESS_MODE_THREADS
+DECOMPRESS_MODE_EXTERNAL = compressed_stream.DECOMPRESS_MODE_EXTERNAL
+
 
 # You'll notice that several functions here are duplicated with _ in front of them
 # This is to make UT easier, as trying to test some of the filesystem interactions is a bit tricky
@@ -61,12 +81,17 @@ def cli(trace, trace_file, verbose, quiet):
 
 
 # Since this is used multiple times, logic is held here
-def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_dir: str) -> list[Contexts.UnpackContext]:
+def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_dir: str,
+            unpack_jobs: int = 1, listener: unpacker.UnpackListener = None,
+            options: unpacker.UnpackOptions = None) -> list[Contexts.UnpackContext]:
     """
     :param path: Path to unpack
     :param recursive: Whether to recursively unpack
     :param min_size: Minimum file size to unpack
     :param tmp_dir: Temporary directory to unpack to
+    :param unpack_jobs: How many nested archives to unpack at the same time
+    :param listener: Told about each context as it is unpacked, only used when recursive
+    :param options: How archives get unpacked
     :return: A list of unpacked directories
     """
 
@@ -97,17 +122,83 @@ def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_di
     unpack_ctxs = []
 
     if recursive:
-        unpack_ctxs = unpacker.unpack_recursive(file_meta, min_file_size, tmp_dir)
+        unpack_ctxs = unpacker.unpack_recursive(file_meta, min_file_size, tmp_dir, unpack_jobs=unpack_jobs,
+                                                listener=listener, options=options)
         fast_log.info('Found and unpacked the following:')
         fast_log.info('\n'.join([str(u_ctx) for u_ctx in unpack_ctxs]))
     else:
-        u_ctx = unpacker.unpack(file_meta, tmp_dir)
+        u_ctx = unpacker.unpack(file_meta, tmp_dir, options)
         fast_log.info(f'Unpacked {u_ctx}')
         unpack_ctxs.append(u_ctx)
 
     return unpack_ctxs
 
 
+def _check_guestfs_mode(guestfs_mode: str) -> None:
+    if guestfs_mode == GUESTFS_MODE_TAR_OUT and not mount_tools.guestfs_bindings_available():
+        raise click.ClickException(f'--guestfs-mode {GUESTFS_MODE_TAR_OUT} needs the libguestfs Python bindings')
+
+
+def _make_guestfs_pool(guestfs_mode: str, pool_size: int, memory_limit: Optional[str],
+                       cache_dir: Optional[str]) -> Optional['mount_tools.guestfs_mount.AppliancePool']:
+    _check_guestfs_mode(guestfs_mode)
+
+    if cache_dir is not None:
+        mount_tools.use_guestfs_cache_dir(cache_dir)
+
+    if pool_size == 0 and memory_limit is None:
+        return None
+
+    # Mounted images each get a guestmount process of their own, there is nothing to pool
+    if guestfs_mode != GUESTFS_MODE_TAR_OUT:
+        raise click.ClickException(
+            f'--guestfs-pool-size and --guestfs-memory-limit need --guestfs-mode {GUESTFS_MODE_TAR_OUT}')
+
+    memory_limit_mb = 0
+    if memory_limit is not None:
+        try:
+            memory_limit_mb = int(convert_human_to_machine_bytes(memory_limit)) // (1024 * 1024)
+        except ValueError as e:
+            raise click.BadParameter(f'Unable to parse guestfs-memory-limit: {e}')
+
+    return mount_tools.make_guestfs_pool(pool_size, memory_limit_mb)
+
+
+def _use_decompress_mode(decompress_mode: str) -> None:
+    # Better to find out now than partway through the first compressed tar
+    if decompress_mode == DECOMPRESS_MODE_EXTERNAL:
+        for compression in compressed_stream.COMPRESSIONS:
+            if compressed_stream.find_external_tool(compression) is None:
+                fast_log.warn(f'None of {", ".join(compressed_stream.EXTERNAL_TOOLS[compression])} are on the PATH, '
+                              f'{compression} is decompressed on a thread instead')
+
+    compressed_stream.use_mode(decompress_mode)
+
+
+def _make_mount_slots(max_loop_mounts: int, max_guestfs_appliances: int) -> Optional[mount_slots.MountSlots]:
+    if max_loop_mounts == 0 and max_guestfs_appliances == 0:
+        return None
+
+    return mount_slots.MountSlots(max_loop_mounts, max_guestfs_appliances)
+
+
+def _check_nothing_given_up(slots: Optional[mount_slots.MountSlots]) -> None:
+    # Without the pipeline nothing gets cleaned up before the end, so the archives over the limits never get unpacked
+    if slots is not None and slots.given_up_count > 0:
+        raise click.ClickException(f'{slots.given_up_count} nested archives were left unpacked, they would have gone '
+                                   f'over --max-loop-mounts or --max-guestfs-appliances')
+
+
+def _make_unpack_options(walk_threads: int, zip_jobs: int, guestfs_mode: str,
+                         guestfs_pool: Optional['mount_tools.guestfs_mount.AppliancePool'],
+                         slots: Optional[mount_slots.MountSlots], iso_mode: str, in_place: bool,
+                         stream_client: Optional[clamd.ClamdClient] = None,
+                         stream_chunks: bool = False) -> unpacker.UnpackOptions:
+    return unpacker.UnpackOptions(stream_client=stream_client, stream_chunks=stream_chunks, walk_threads=walk_threads,
+                                  guestfs_mode=guestfs_mode, guestfs_pool=guestfs_pool, mount_slots=slots,
+                                  iso_mode=iso_mode, in_place=in_place, zip_jobs=zip_jobs)
+
+
 @cli.command()
 @click.argument('path', type=click.Path(exists=True, resolve_path=True))
 # @click.argument('path', type=click.Path(exists=False, resolve_path=True))
@@ -118,8 +209,62 @@ def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_di
               help='Ignore file size lower limit (equivalent to --min-size=0).')
 @click.option('--tmp-dir', default='/tmp', type=click.Path(resolve_path=True),
               help='Directory to unpack files to (default: /tmp).')
-def unpack(path, recursive, min_size, ignore_size, tmp_dir):
-    _unpack(path, recursive, min_size, ignore_size, tmp_dir)
+@click.option('--unpack-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of nested archives to unpack in parallel (default: 1).')
+@click.option('--walk-threads', default=1, type=click.IntRange(min=1),
+              help='Number of threads to walk disk images and directories with, when looking for nested archives '
+                   '(default: 1).')
+@click.option('--zip-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of processes to extract each ZIP with, big ZIPs have their members split up between them '
+                   '(default: 1).')
+@click.option('--decompress-mode', default=DECOMPRESS_MODE_PYTHON,
+              type=click.Choice([DECOMPRESS_MODE_PYTHON, DECOMPRESS_MODE_THREADS, DECOMPRESS_MODE_EXTERNAL]),
+              help=f'How to decompress TGZs, TZSTs, TXZs and TBZ2s: as the tar is read, on threads of their own, which '
+                   f'inflate BGZF files on every CPU, or with igzip or pigz, pzstd or zstd, xz, and lbzip2 or pbzip2, '
+                   f'which decompress on several threads where the format allows (default: {DECOMPRESS_MODE_PYTHON}). '
+                   f'TZSTs need the zstandard package, from the zstd extra, or pzstd or zstd on the PATH.')
+@click.option('--guestfs-mode', default=GUESTFS_MODE_MOUNT,
+              type=click.Choice([GUESTFS_MODE_MOUNT, GUESTFS_MODE_TAR_OUT]),
+              help=f'How to get at the files in VMDK and QCOW2 images: mount them, or have libguestfs read each '
+                   f'filesystem out as a tar, which needs the libguestfs Python bindings '
+                   f'(default: {GUESTFS_MODE_MOUNT}).')
+@click.option('--guestfs-pool-size', default=0, type=click.IntRange(min=0),
+              help=f'With --guestfs-mode {GUESTFS_MODE_TAR_OUT}, number of booted libguestfs appliances to keep '
+                   f'around for the next image (default: 0).')
+@click.option('--guestfs-memory-limit', default=None, type=str,
+              help=f'With --guestfs-mode {GUESTFS_MODE_TAR_OUT}, the most memory the running libguestfs appliances '
+                   f'can take between them, e.g. 4G (default: no limit).')
+@click.option('--guestfs-cache-dir', default=None, type=click.Path(file_okay=False, resolve_path=True),
+              help='Directory for libguestfs to build its appliance in, and to reuse it from on later runs '
+                   '(default: the libguestfs default).')
+@click.option('--iso-mode', default=ISO_MODE_MOUNT, type=click.Choice([ISO_MODE_MOUNT, ISO_MODE_READ]),
+              help=f'How to get at the files in ISO images: mount them on a loop device, which needs root, or read '
+                   f'them straight out of the image (default: {ISO_MODE_MOUNT}).')
+@click.option('--in-place', default=False, is_flag=True,
+              help=f'Unpack the ISOs, VMDK and QCOW2 images, TARs, compressed TARs and ZIPs stored in plain TARs, '
+                   f'like OVAs, stored uncompressed in ZIPs, and in ISOs read with --iso-mode {ISO_MODE_READ}, from '
+                   f'right where they are, instead of extracting them to the tmp dir first. Disk images are read '
+                   f'through a loop device, which needs root.')
+@click.option('--max-loop-mounts', default=0, type=click.IntRange(min=0),
+              help=f'Most ISO images to mount with --iso-mode {ISO_MODE_MOUNT}, the unpack fails if there are more, '
+                   f'0 for no limit (default: 0).')
+@click.option('--max-guestfs-appliances', default=0, type=click.IntRange(min=0),
+              help=f'Most VMDK and QCOW2 images to mount with --guestfs-mode {GUESTFS_MODE_MOUNT}, each one has a '
+                   f'libguestfs appliance running, the unpack fails if there are more, 0 for no limit (default: 0).')
+def unpack(path, recursive, min_size, ignore_size, tmp_dir, unpack_jobs, walk_threads, zip_jobs, decompress_mode,
+           guestfs_mode, guestfs_pool_size, guestfs_memory_limit, guestfs_cache_dir, iso_mode, in_place,
+           max_loop_mounts, max_guestfs_appliances):
+    _use_decompress_mode(decompress_mode)
+    pool = _make_guestfs_pool(guestfs_mode, guestfs_pool_size, guestfs_memory_limit, guestfs_cache_dir)
+    slots = _make_mount_slots(max_loop_mounts, max_guestfs_appliances)
+
+    try:
+        options = _make_unpack_options(walk_threads, zip_jobs, guestfs_mode, pool, slots, iso_mode, in_place)
+        _unpack(path, recursive, min_size, ignore_size, tmp_dir, unpack_jobs, options=options)
+        _check_nothing_given_up(slots)
+    finally:
+        if pool is not None:
+            pool.close()
 
 
 def _cleanup(path, is_file, tmp_dir):
@@ -142,29 +287,95 @@ def cleanup(path, is_file, tmp_dir):
     _cleanup(path, is_file, tmp_dir)
 
 
-def _scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir) -> int:
-    if not scanner.validate_clamdscan():
-        raise click.ClickException(f'Unable to find clamdscan, please install it and try again')
+def _scan_unpacked(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, unpack_jobs, pipeline,
+                   client, scan_jobs, stream=False, stream_chunks=False, walk_threads=1,
+                   guestfs_mode=GUESTFS_MODE_MOUNT, guestfs_pool=None, slots=None,
+                   iso_mode=ISO_MODE_MOUNT, in_place=False, zip_jobs=1) -> list[scanner.ScanResult]:
+    # With stream, archive members get sent to clamd as they are read, instead of being extracted for it
+    options = _make_unpack_options(walk_threads, zip_jobs, guestfs_mode, guestfs_pool, slots, iso_mode, in_place,
+                                   stream_client=client if stream else None, stream_chunks=stream_chunks)
 
-    # all-match and ff cannot be both active
-    if all_match and fail_fast:
-        raise click.ClickException(f'Cannot specify both --allmatch and --fail-fast')
+    if pipeline:
+        # recursively unpack the file, scanning each unpacked dir as soon as it is ready
+        scan_results = pipeliner.scan_pipelined(
+            lambda listener: _unpack(path, True, min_size, ignore_size, tmp_dir, unpack_jobs, listener, options),
+            tmp_dir, fail_fast, all_match, client=client, scan_jobs=scan_jobs, slots=slots)
+    else:
+        # recursively unpack the file
+        unpacked_ctxs = _unpack(path, True, min_size, ignore_size, tmp_dir, unpack_jobs, options=options)
 
-    # recursively unpack the file
-    unpacked_ctxs = _unpack(path, True, min_size, ignore_size, tmp_dir)
+        # scan the unpacked dirs
+        scan_results = scanner.clamdscan(unpacked_ctxs, fail_fast, all_match, client,
+                                         scan_jobs=scan_jobs) if len(unpacked_ctxs) > 0 else []
 
-    # scan the unpacked dirs
-    if len(unpacked_ctxs) == 0:
+    if len(scan_results) == 0:
         # Nothing was unpacked, just run a single clamdscan on the file
         single_ctx = Contexts.UnpackContext(detect.file_meta_from_path(path), tmp_dir)
         single_ctx.unpacked_dir_location = path
-        scan_results = scanner.clamdscan([single_ctx], fail_fast, all_match)
-    else:
-        scan_results = scanner.clamdscan(unpacked_ctxs, fail_fast, all_match)
+        scan_results = scanner.clamdscan([single_ctx], fail_fast, all_match, client)
 
     # Cleanup
     cleaner.cleanup_recursive(path, tmp_dir)
 
+    return scan_results
+
+
+def _make_clamd_client(clamd_client: str, clamd_conf: str, scan_jobs: int) -> Optional[clamd.ClamdClient]:
+    if clamd_client == CLAMD_CLIENT_CLAMDSCAN:
+        if not scanner.validate_clamdscan():
+            raise click.ClickException(f'Unable to find clamdscan, please install it and try again')
+        return None
+
+    try:
+        # Every scan job needs a connection of its own
+        client = clamd.client_from_conf(clamd_conf, pool_size=max(clamd.DEFAULT_POOL_SIZE, scan_jobs))
+    except ClamdException as e:
+        raise click.ClickException(f'Unable to set up the clamd client: {e}')
+
+    if not scanner.validate_clamd(client):
+        raise click.ClickException(f'Unable to reach clamd at {client.address}, make sure it is running')
+
+    return client
+
+
+def _scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, unpack_jobs=1, pipeline=False,
+          clamd_client=CLAMD_CLIENT_CLAMDSCAN, clamd_conf=None, scan_jobs=1, stream=False, stream_chunks=False,
+          walk_threads=1, guestfs_mode=GUESTFS_MODE_MOUNT, guestfs_pool_size=0, guestfs_memory_limit=None,
+          guestfs_cache_dir=None, max_loop_mounts=0, max_guestfs_appliances=0, iso_mode=ISO_MODE_MOUNT,
+          in_place=False, zip_jobs=1, decompress_mode=DECOMPRESS_MODE_PYTHON) -> int:
+    # all-match and ff cannot be both active
+    if all_match and fail_fast:
+        raise click.ClickException(f'Cannot specify both --allmatch and --fail-fast')
+
+    # clamdscan can only scan what is on disk
+    if stream and clamd_client != CLAMD_CLIENT_NATIVE:
+        raise click.ClickException(f'--stream needs --clamd-client {CLAMD_CLIENT_NATIVE}')
+
+    if stream_chunks and not stream:
+        raise click.ClickException('--stream-chunks needs --stream')
+
+    # Only the pipeline gives mounts back before the end, without it whatever is over the limits would go unscanned
+    if (max_loop_mounts > 0 or max_guestfs_appliances > 0) and not pipeline:
+        raise click.ClickException('--max-loop-mounts and --max-guestfs-appliances need --pipeline')
+
+    _use_decompress_mode(decompress_mode)
+
+    pool = _make_guestfs_pool(guestfs_mode, guestfs_pool_size, guestfs_memory_limit, guestfs_cache_dir)
+
+    client = None
+    try:
+        client = _make_clamd_client(clamd_client, clamd_conf, scan_jobs)
+
+        scan_results = _scan_unpacked(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, unpack_jobs,
+                                      pipeline, client, scan_jobs, stream, stream_chunks, walk_threads, guestfs_mode,
+                                      pool, _make_mount_slots(max_loop_mounts, max_guestfs_appliances), iso_mode,
+                                      in_place, zip_jobs)
+    finally:
+        if client is not None:
+            client.close()
+        if pool is not None:
+            pool.close()
+
     # Log scan results
     fast_log.info('=' * 80)
     fast_log.info('Scan Results, showing path and clamdscan return code')
@@ -199,8 +410,79 @@ def _scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir) -> int:
               help='Stop scanning after the first failure.')
 @click.option('--allmatch', default=False, is_flag=True,
               help='Continue scanning if a signature match occurs.')
-def scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir):
-    rv = _scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir)
+@click.option('--unpack-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of nested archives to unpack in parallel (default: 1).')
+@click.option('--pipeline', default=False, is_flag=True,
+              help='Start scanning each unpacked archive while the rest are still being unpacked, '
+                   'and clean up each one as soon as it is no longer needed.')
+@click.option('--clamd-client', default=CLAMD_CLIENT_CLAMDSCAN,
+              type=click.Choice([CLAMD_CLIENT_CLAMDSCAN, CLAMD_CLIENT_NATIVE]),
+              help=f'Run clamdscan for every scan, or talk to clamd over its socket (default: {CLAMD_CLIENT_CLAMDSCAN}).')
+@click.option('--clamd-conf', default=None, type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+              help='clamd.conf to find the clamd socket in, only used by the native client '
+                   '(default: the first one found in the usual places).')
+@click.option('--scan-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of unpacked archives to have clamd scan at the same time (default: 1).')
+@click.option('--stream', default=False, is_flag=True,
+              help='Send the files in TAR, compressed TAR and ZIP archives, in ISO images with '
+                   f'--iso-mode {ISO_MODE_READ}, and in VMDK and QCOW2 images with '
+                   f'--guestfs-mode {GUESTFS_MODE_TAR_OUT}, straight to clamd instead of extracting them, '
+                   'only nested archives and files over clamd\'s StreamMaxLength are written to the tmp dir. '
+                   f'Needs --clamd-client {CLAMD_CLIENT_NATIVE}.')
+@click.option('--stream-chunks', default=False, is_flag=True,
+              help='With --stream, pack the files into tar streams as big as clamd will take, '
+                   'and send those instead of one file at a time.')
+@click.option('--walk-threads', default=1, type=click.IntRange(min=1),
+              help='Number of threads to walk disk images and directories with, when looking for nested archives '
+                   '(default: 1).')
+@click.option('--zip-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of processes to extract each ZIP with, big ZIPs have their members split up between them '
+                   '(default: 1).')
+@click.option('--decompress-mode', default=DECOMPRESS_MODE_PYTHON,
+              type=click.Choice([DECOMPRESS_MODE_PYTHON, DECOMPRESS_MODE_THREADS, DECOMPRESS_MODE_EXTERNAL]),
+              help=f'How to decompress TGZs, TZSTs, TXZs and TBZ2s: as the tar is read, on threads of their own, which '
+                   f'inflate BGZF files on every CPU, or with igzip or pigz, pzstd or zstd, xz, and lbzip2 or pbzip2, '
+                   f'which decompress on several threads where the format allows (default: {DECOMPRESS_MODE_PYTHON}). '
+                   f'TZSTs need the zstandard package, from the zstd extra, or pzstd or zstd on the PATH.')
+@click.option('--guestfs-mode', default=GUESTFS_MODE_MOUNT,
+              type=click.Choice([GUESTFS_MODE_MOUNT, GUESTFS_MODE_TAR_OUT]),
+              help=f'How to get at the files in VMDK and QCOW2 images: mount them, or have libguestfs read each '
+                   f'filesystem out as a tar, which needs the libguestfs Python bindings '
+                   f'(default: {GUESTFS_MODE_MOUNT}).')
+@click.option('--guestfs-pool-size', default=0, type=click.IntRange(min=0),
+              help=f'With --guestfs-mode {GUESTFS_MODE_TAR_OUT}, number of booted libguestfs appliances to keep '
+                   f'around for the next image (default: 0).')
+@click.option('--guestfs-memory-limit', default=None, type=str,
+              help=f'With --guestfs-mode {GUESTFS_MODE_TAR_OUT}, the most memory the running libguestfs appliances '
+                   f'can take between them, e.g. 4G (default: no limit).')
+@click.option('--guestfs-cache-dir', default=None, type=click.Path(file_okay=False, resolve_path=True),
+              help='Directory for libguestfs to build its appliance in, and to reuse it from on later runs '
+                   '(default: the libguestfs default).')
+@click.option('--iso-mode', default=ISO_MODE_MOUNT, type=click.Choice([ISO_MODE_MOUNT, ISO_MODE_READ]),
+              help=f'How to get at the files in ISO images: mount them on a loop device, which needs root, or read '
+                   f'them straight out of the image (default: {ISO_MODE_MOUNT}).')
+@click.option('--in-place', default=False, is_flag=True,
+              help=f'Unpack the ISOs, VMDK and QCOW2 images, TARs, compressed TARs and ZIPs stored in plain TARs, '
+                   f'like OVAs, stored uncompressed in ZIPs, and in ISOs read with --iso-mode {ISO_MODE_READ}, from '
+                   f'right where they are, instead of extracting them to the tmp dir first. Disk images are read '
+                   f'through a loop device, which needs root.')
+@click.option('--max-loop-mounts', default=0, type=click.IntRange(min=0),
+              help=f'With --pipeline, most ISO images to keep mounted with --iso-mode {ISO_MODE_MOUNT} at the same '
+                   f'time, 0 for no limit (default: 0).')
+@click.option('--max-guestfs-appliances', default=0, type=click.IntRange(min=0),
+              help=f'With --pipeline, most VMDK and QCOW2 images to keep mounted with --guestfs-mode '
+                   f'{GUESTFS_MODE_MOUNT} at the same time, each one has a libguestfs appliance running, 0 for no '
+                   f'limit (default: 0).')
+def scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir, unpack_jobs, pipeline, clamd_client, clamd_conf,
+         scan_jobs, stream, stream_chunks, walk_threads, zip_jobs, decompress_mode, guestfs_mode, guestfs_pool_size,
+         guestfs_memory_limit, guestfs_cache_dir, iso_mode, in_place, max_loop_mounts, max_guestfs_appliances):
+    rv = _scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir, unpack_jobs=unpack_jobs, pipeline=pipeline,
+               clamd_client=clamd_client, clamd_conf=clamd_conf, scan_jobs=scan_jobs, stream=stream,
+               stream_chunks=stream_chunks, walk_threads=walk_threads, guestfs_mode=guestfs_mode,
+               guestfs_pool_size=guestfs_pool_size, guestfs_memory_limit=guestfs_memory_limit,
+               guestfs_cache_dir=guestfs_cache_dir, max_loop_mounts=max_loop_mounts,
+               max_guestfs_appliances=max_guestfs_appliances, iso_mode=iso_mode, in_place=in_place,
+               zip_jobs=zip_jobs, decompress_mode=decompress_mode)
     sys.exit(rv)
 
 
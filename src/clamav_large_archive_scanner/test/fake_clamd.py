@@ -0,0 +1,272 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Just enough of clamd to test the client against, listening on a unix socket
+# Anything containing EICAR_MARKER is reported as found
+
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Optional
+
+EICAR_MARKER = b'EICAR'
+SIGNATURE_NAME = 'Eicar-Test-Signature'
+VERSION = 'ClamAV 1.0.0/27000/Mon Jan  1 00:00:00 2024'
+
+# How long SCANs of the paths in FakeClamd.slow_paths take
+SLOW_SCAN_SECONDS = 0.2
+
+_CHUNK_LENGTH = struct.Struct('!L')
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buffer = b''
+        self._reply_lock = threading.Lock()
+
+    def _fill(self) -> bool:
+        data = self.sock.recv(4096)
+        self._buffer += data
+        return data != b''
+
+    def read_command(self) -> Optional[str]:
+        while b'\0' not in self._buffer:
+            if not self._fill():
+                return None
+
+        command, _, self._buffer = self._buffer.partition(b'\0')
+        # Everything is sent as z commands
+        assert command.startswith(b'z')
+        return command[1:].decode()
+
+    def read_exact(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            if not self._fill():
+                raise EOFError()
+
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        return data
+
+    def reply(self, reply: str) -> None:
+        # SCANs in a session reply from threads of their own
+        with self._reply_lock:
+            self.sock.sendall(reply.encode() + b'\0')
+
+
+def _is_infected(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return EICAR_MARKER in f.read()
+
+
+def _scan_path(path: str) -> list[str]:
+    if not os.path.exists(path):
+        return [f'{path}: lstat() failed: No such file or directory. ERROR']
+
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+    found = [f'{a_file}: {SIGNATURE_NAME} FOUND' for a_file in files if _is_infected(a_file)]
+    if len(found) == 0:
+        return [f'{path}: OK']
+
+    return found
+
+
+class FakeClamd:
+    def __init__(self, socket_path: str, stream_max_length: int = 1024 * 1024):
+        self.socket_path = socket_path
+        self.stream_max_length = stream_max_length
+
+        # What was asked of it, for the tests to check
+        self.connections = 0
+        self.max_concurrent_commands = 0
+        self.commands = []  # type: list[str]
+        self.streamed = []  # type: list[bytes]
+
+        # Paths that take SLOW_SCAN_SECONDS to SCAN, so that their replies come back after the ones sent later
+        self.slow_paths = set()  # type: set[str]
+        # Paths that are never done being scanned, until it is stopped, and set once one of them is being scanned
+        self.stuck_paths = set()  # type: set[str]
+        self.stuck = threading.Event()
+
+        self._lock = threading.Lock()
+        self._concurrent_commands = 0
+        self._open_socks = []  # type: list[socket.socket]
+        self._stopped = False
+        self._unstuck = threading.Event()
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(socket_path)
+        self._server.listen()
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+
+    def start(self) -> 'FakeClamd':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._unstuck.set()
+        # Closing alone doesn't wake up the accept
+        self._server.shutdown(socket.SHUT_RDWR)
+        self._server.close()
+        self.drop_connections()
+        self._thread.join()
+
+    def drop_connections(self) -> None:
+        # Same as clamd hitting its IdleTimeout on every open session
+        with self._lock:
+            for sock in self._open_socks:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _accept_loop(self) -> None:
+        while not self._stopped:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+
+            with self._lock:
+                self.connections += 1
+                self._open_socks.append(sock)
+
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock: socket.socket) -> None:
+        try:
+            conn = _Connection(sock)
+            command = conn.read_command()
+            if command == 'IDSESSION':
+                self._serve_session(conn)
+            elif command is not None:
+                replies, _ = self._handle(conn, command)
+                for reply in replies:
+                    conn.reply(reply)
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self._lock:
+                self._open_socks.remove(sock)
+            sock.close()
+
+    def _reply_in_session(self, conn: _Connection, request_id: int, command: str) -> None:
+        replies, _ = self._handle(conn, command)
+        try:
+            for reply in replies:
+                conn.reply(f'{request_id}: {reply}')
+        except OSError:
+            # The client hung up without waiting for it
+            pass
+
+    def _serve_session(self, conn: _Connection) -> None:
+        request_id = 0
+        scans = []  # type: list[threading.Thread]
+        while True:
+            command = conn.read_command()
+            if command is None or command == 'END':
+                for scan in scans:
+                    scan.join()
+                return
+
+            request_id += 1
+            if command.startswith('SCAN '):
+                # Like clamd, hands them off to its threads and goes on reading, they reply as soon as they are done
+                scan = threading.Thread(target=self._reply_in_session, args=(conn, request_id, command), daemon=True)
+                scan.start()
+                scans.append(scan)
+                continue
+
+            replies, keep_open = self._handle(conn, command)
+            for reply in replies:
+                conn.reply(f'{request_id}: {reply}')
+
+            if not keep_open:
+                return
+
+    def _read_stream(self, conn: _Connection) -> Optional[bytes]:
+        data = b''
+        while True:
+            (length,) = _CHUNK_LENGTH.unpack(conn.read_exact(_CHUNK_LENGTH.size))
+            if length == 0:
+                return data
+
+            data += conn.read_exact(length)
+            if len(data) > self.stream_max_length:
+                return None
+
+    def _handle(self, conn: _Connection, command: str) -> tuple[list[str], bool]:
+        """
+        :return: The replies, and whether the connection can be used for anything else
+        """
+
+        with self._lock:
+            self.commands.append(command)
+            self._concurrent_commands += 1
+            self.max_concurrent_commands = max(self.max_concurrent_commands, self._concurrent_commands)
+
+        try:
+            return self._handle_command(conn, command)
+        finally:
+            with self._lock:
+                self._concurrent_commands -= 1
+
+    def _handle_command(self, conn: _Connection, command: str) -> tuple[list[str], bool]:
+        name, _, arg = command.partition(' ')
+        if name == 'PING':
+            return ['PONG'], True
+        elif name == 'VERSION':
+            return [VERSION], True
+        elif name in ['SCAN', 'MULTISCAN', 'CONTSCAN', 'ALLMATCHSCAN']:
+            if arg in self.slow_paths:
+                time.sleep(SLOW_SCAN_SECONDS)
+            if arg in self.stuck_paths:
+                self.stuck.set()
+                self._unstuck.wait()
+            return _scan_path(arg), True
+        elif name == 'INSTREAM':
+            data = self._read_stream(conn)
+            if data is None:
+                # clamd hangs up without reading the rest of the stream
+                return ['INSTREAM size limit exceeded. ERROR'], False
+
+            with self._lock:
+                self.streamed.append(data)
+
+            if EICAR_MARKER in data:
+                return [f'stream: {SIGNATURE_NAME} FOUND'], True
+            return ['stream: OK'], True
+        else:
+            return ['UNKNOWN COMMAND'], False
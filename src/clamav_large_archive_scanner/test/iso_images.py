@@ -0,0 +1,205 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Just enough of mkisofs to test the ISO reader against, no tools that build real images are needed
+# Files are laid out one after the other, each starting on a sector of its own
+
+import stat
+import struct
+from typing import Optional
+
+SECTOR_SIZE = 2048
+FIRST_FREE_SECTOR = 20
+
+FLAG_DIRECTORY = 0x02
+FLAG_MORE_EXTENTS = 0x80
+
+
+def _both16(value: int) -> bytes:
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value: int) -> bytes:
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _record(name: bytes, extent: int, size: int, flags: int, system_use: bytes = b'') -> bytes:
+    padding = b'\x00' if len(name) % 2 == 0 else b''
+    if (33 + len(name) + len(padding) + len(system_use)) % 2 != 0:
+        system_use += b'\x00'
+
+    length = 33 + len(name) + len(padding) + len(system_use)
+    return bytes([length, 0]) + _both32(extent) + _both32(size) + bytes(7) + bytes([flags, 0, 0]) + _both16(1) + \
+        bytes([len(name)]) + name + padding + system_use
+
+
+def _susp(signature: bytes, data: bytes) -> bytes:
+    return signature + bytes([4 + len(data), 1]) + data
+
+
+def _px(mode: int) -> bytes:
+    return _susp(b'PX', _both32(mode) + _both32(1) + _both32(0) + _both32(0))
+
+
+def _nm(name: str) -> bytes:
+    return _susp(b'NM', b'\x00' + name.encode())
+
+
+def _pack(records: list[bytes]) -> bytes:
+    # Records never cross a sector
+    sectors = [b'']
+    for record in records:
+        if len(sectors[-1]) + len(record) > SECTOR_SIZE:
+            sectors.append(b'')
+        sectors[-1] += record
+
+    return b''.join(sector.ljust(SECTOR_SIZE, b'\x00') for sector in sectors)
+
+
+def _parent(path: str) -> str:
+    return path.rsplit('/', 1)[0] + '/' if '/' in path else ''
+
+
+def _descriptor(descriptor_type: int, root_record: bytes = b'', escapes: bytes = b'') -> bytes:
+    data = bytearray(SECTOR_SIZE)
+    data[0] = descriptor_type
+    data[1:6] = b'CD001'
+    data[6] = 1
+    if descriptor_type != 255:
+        data[88:88 + len(escapes)] = escapes
+        data[128:132] = _both16(SECTOR_SIZE)
+        data[156:156 + len(root_record)] = root_record
+    return bytes(data)
+
+
+class _Builder:
+    def __init__(self, files: dict[str, bytes], symlinks: dict[str, str], rock_ridge: bool, joliet: bool,
+                 max_extent_size: int):
+        self.image = bytearray(FIRST_FREE_SECTOR * SECTOR_SIZE)
+        self.rock_ridge = rock_ridge
+        # With either extension, the ISO 9660 names are anything but the real ones, so it is clear which got used
+        self.mangle_names = rock_ridge or joliet
+
+        self.tree = {}  # type: dict
+        for path in list(files.keys()) + list(symlinks.keys()):
+            node = self.tree
+            for part in path.split('/')[:-1]:
+                node = node.setdefault(part, {})
+
+        # Where each file's data went, as (sector, length), file data is shared between the trees
+        self.extents = {}  # type: dict[str, list[tuple[int, int]]]
+        for path, data in files.items():
+            self.extents[path] = []
+            for start in range(0, max(len(data), 1), max_extent_size):
+                piece = data[start:start + max_extent_size]
+                self.extents[path].append((self.write(piece), len(piece)))
+
+        self.symlinks = symlinks
+
+    def write(self, data: bytes) -> int:
+        sector = len(self.image) // SECTOR_SIZE
+        self.image += data.ljust(max(1, -(-len(data) // SECTOR_SIZE)) * SECTOR_SIZE, b'\x00')
+        return sector
+
+    def _name(self, name: str, is_file: bool, joliet: bool) -> bytes:
+        suffix = ';1' if is_file else ''
+        if joliet:
+            return (name + suffix).encode('utf-16-be')
+        if self.mangle_names:
+            name = name.upper().replace(' ', '_')
+        if is_file and '.' not in name:
+            name += '.'
+        return (name + suffix).encode()
+
+    def _system_use(self, joliet: bool, name: str, mode: int, extra: bytes = b'') -> bytes:
+        if joliet or not self.rock_ridge:
+            return b''
+        return _nm(name) + _px(mode) + extra
+
+    def write_dir(self, node: dict, dir_path: str, joliet: bool, is_root: bool) -> tuple[int, int]:
+        records = []
+        for name, child in node.items():
+            extent, size = self.write_dir(child, dir_path + name + '/', joliet, False)
+            records.append(_record(self._name(name, False, joliet), extent, size, FLAG_DIRECTORY,
+                                   self._system_use(joliet, name, stat.S_IFDIR | 0o755)))
+
+        for path, extents in self.extents.items():
+            if _parent(path) != dir_path:
+                continue
+            name = path.rsplit('/', 1)[-1]
+            for index, (sector, length) in enumerate(extents):
+                flags = FLAG_MORE_EXTENTS if index < len(extents) - 1 else 0
+                records.append(_record(self._name(name, True, joliet), sector, length, flags,
+                                       self._system_use(joliet, name, stat.S_IFREG | 0o644)))
+
+        for path, target in self.symlinks.items():
+            if _parent(path) != dir_path:
+                continue
+            name = path.rsplit('/', 1)[-1]
+            records.append(_record(self._name(name, True, joliet), 0, 0, 0,
+                                   self._system_use(joliet, name, stat.S_IFLNK | 0o777,
+                                                    _susp(b'SL', b'\x00\x00' + bytes([len(target)]) +
+                                                          target.encode()))))
+
+        self_system_use = b''
+        if is_root and self.rock_ridge and not joliet:
+            self_system_use = _susp(b'SP', b'\xbe\xef\x00') + _px(stat.S_IFDIR | 0o755)
+
+        # The records for . and .. are the same size whatever they point at
+        size = len(_pack([_record(b'\x00', 0, 0, FLAG_DIRECTORY, self_system_use),
+                          _record(b'\x01', 0, 0, FLAG_DIRECTORY)] + records))
+        extent = self.write(bytes(size))
+
+        data = _pack([_record(b'\x00', extent, size, FLAG_DIRECTORY, self_system_use),
+                      _record(b'\x01', 0, 0, FLAG_DIRECTORY)] + records)
+        self.image[extent * SECTOR_SIZE:extent * SECTOR_SIZE + size] = data
+        return extent, size
+
+
+def make_iso(path: str, files: dict[str, bytes], symlinks: Optional[dict[str, str]] = None, rock_ridge: bool = False,
+             joliet: bool = False, max_extent_size: int = 2 ** 31) -> None:
+    """
+    :param files: Contents of every file, by path
+    :param symlinks: Symlink targets by path, only written with Rock Ridge
+    :param max_extent_size: Files bigger than this are split across records, the way files over 4G are
+    """
+
+    builder = _Builder(files, symlinks or {}, rock_ridge, joliet, max_extent_size)
+
+    root_extent, root_size = builder.write_dir(builder.tree, '', False, True)
+    descriptors = _descriptor(1, _record(b'\x00', root_extent, root_size, FLAG_DIRECTORY))
+
+    if joliet:
+        root_extent, root_size = builder.write_dir(builder.tree, '', True, True)
+        descriptors += _descriptor(2, _record(b'\x00', root_extent, root_size, FLAG_DIRECTORY), b'%/E')
+
+    descriptors += _descriptor(255)
+    builder.image[16 * SECTOR_SIZE:16 * SECTOR_SIZE + len(descriptors)] = descriptors
+
+    with open(path, 'wb') as f:
+        f.write(builder.image)
@@ -0,0 +1,465 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import concurrent.futures
+import io
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import zipfile
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+import iso_images
+from clamav_large_archive_scanner.lib.file_data import FileType
+
+EXPECTED_MEMBERS = {
+    'top_level.txt': b'some top level file',
+    'some_dir/nested.txt': b'some nested file',
+    'some_dir/empty.txt': b'',
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_tar(path: str, mode: str):
+    with tarfile.open(path, mode) as tar:
+        dir_info = tarfile.TarInfo('some_dir')
+        dir_info.type = tarfile.DIRTYPE
+        tar.addfile(dir_info)
+
+        for name, data in EXPECTED_MEMBERS.items():
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tar.addfile(tar_info, io.BytesIO(data))
+
+        link_info = tarfile.TarInfo('some_link')
+        link_info.type = tarfile.SYMTYPE
+        link_info.linkname = 'top_level.txt'
+        tar.addfile(link_info)
+
+
+def _make_tzst(path: str):
+    # tarfile can't write zstd before 3.14
+    if shutil.which('zstd') is None:
+        pytest.skip('zstd is not on the PATH')
+    _make_tar(path + '.tar', 'w')
+    subprocess.run(['zstd', '-q', '--rm', path + '.tar', '-o', path], check=True)
+
+
+def _make_zip(path: str, compression: int = zipfile.ZIP_STORED):
+    with zipfile.ZipFile(path, 'w', compression) as zip_file:
+        zip_file.writestr('some_dir/', b'')
+        for name, data in EXPECTED_MEMBERS.items():
+            zip_file.writestr(name, data)
+
+
+def _read_members(path: str, filetype: FileType) -> dict:
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    members = {}
+    for member in iter_members(path, filetype):
+        data = b''.join(member.iter_chunks())
+        assert member.size == len(data)
+        members[member.name] = data
+
+    return members
+
+
+@pytest.mark.parametrize('filetype,tar_mode', [
+    (FileType.TAR, 'w'),
+    (FileType.TARGZ, 'w:gz'),
+    (FileType.TARXZ, 'w:xz'),
+    (FileType.TARBZ2, 'w:bz2'),
+])
+def test_iter_members_tar(tmp_path, filetype, tar_mode):
+    archive_path = str(tmp_path / 'some_archive')
+    _make_tar(archive_path, tar_mode)
+
+    # Links and directories aren't anything that clamd could scan
+    assert _read_members(archive_path, filetype) == EXPECTED_MEMBERS
+
+
+def test_iter_members_tzst(tmp_path):
+    from clamav_large_archive_scanner.lib import compressed_stream
+
+    archive_path = str(tmp_path / 'some_archive')
+    _make_tzst(archive_path)
+
+    # Without the zstandard package, the zstd tool decompresses it whatever the mode
+    if compressed_stream.zstandard is None and compressed_stream.find_external_tool(compressed_stream.ZSTD) is None:
+        pytest.skip('Neither the zstandard package nor a zstd tool is around')
+    assert _read_members(archive_path, FileType.TARZST) == EXPECTED_MEMBERS
+
+
+@pytest.mark.parametrize('decompress_mode', ['threads', 'external'])
+@pytest.mark.parametrize('filetype,tar_mode', [
+    (FileType.TARGZ, 'w:gz'),
+    (FileType.TARXZ, 'w:xz'),
+    (FileType.TARBZ2, 'w:bz2'),
+    (FileType.TARZST, None),
+])
+def test_iter_members_decompress_mode(tmp_path, mocker, decompress_mode, filetype, tar_mode):
+    from clamav_large_archive_scanner.lib import compressed_stream
+
+    archive_path = str(tmp_path / 'some_archive')
+    if tar_mode is None:
+        _make_tzst(archive_path)
+    else:
+        _make_tar(archive_path, tar_mode)
+    # igzip and pigz take the same arguments as gzip does, lbzip2 and pbzip2 the same as bzip2 does
+    mocker.patch.dict(compressed_stream.EXTERNAL_TOOLS, {compressed_stream.GZIP: ['gzip'],
+                                                         compressed_stream.BZIP2: ['bzip2']})
+    compressed_stream.use_mode(decompress_mode)
+
+    try:
+        assert _read_members(archive_path, filetype) == EXPECTED_MEMBERS
+        assert _read_view_members('/not/where/it/is', filetype,
+                                  _embed(archive_path, str(tmp_path / 'outer'), 1536)) == EXPECTED_MEMBERS
+    finally:
+        compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_PYTHON)
+
+
+@pytest.mark.parametrize('filetype,tar_mode', [
+    (FileType.TAR, 'w'),
+    (FileType.TARGZ, 'w:gz'),
+])
+def test_iter_members_tar_constant_memory(tmp_path, mocker, filetype, tar_mode):
+    archive_path = str(tmp_path / 'some_archive')
+    _make_tar(archive_path, tar_mode)
+
+    real_next = tarfile.TarFile.next
+    held_members = []
+
+    def _next_side_effect(tar):
+        held_members.append(len(tar.members))
+        return real_next(tar)
+
+    mocker.patch.object(tarfile.TarFile, 'next', autospec=True, side_effect=_next_side_effect)
+
+    assert _read_members(archive_path, filetype) == EXPECTED_MEMBERS
+
+    # Every header gets read, but only the last TarInfo is ever held on to, however many members there are
+    assert len(held_members) > len(EXPECTED_MEMBERS)
+    assert max(held_members) <= 1
+
+
+def test_iter_members_zip(tmp_path):
+    archive_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(archive_path)
+
+    assert _read_members(archive_path, FileType.ZIP) == EXPECTED_MEMBERS
+
+
+def test_iter_members_iso(tmp_path):
+    archive_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(archive_path, EXPECTED_MEMBERS, rock_ridge=True)
+
+    assert _read_members(archive_path, FileType.ISO) == EXPECTED_MEMBERS
+
+
+def _embed(path: str, outer_path: str, padding: int) -> 'FileView':
+    # Stands in for a member of an uncompressed tar, with something before and after it
+    from clamav_large_archive_scanner.lib.file_data import FileView
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    with open(outer_path, 'wb') as f:
+        f.write(b'\xaa' * padding + data + b'\xbb' * padding)
+
+    return FileView(outer_path, padding, len(data))
+
+
+def _read_view_members(path: str, filetype: FileType, view: 'FileView') -> dict:
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    return {member.name: b''.join(member.iter_chunks()) for member in iter_members(path, filetype, view)}
+
+
+@pytest.mark.parametrize('filetype,tar_mode', [
+    (FileType.TAR, 'w'),
+    (FileType.TARGZ, 'w:gz'),
+])
+def test_iter_members_tar_view(tmp_path, filetype, tar_mode):
+    archive_path = str(tmp_path / 'some_archive')
+    _make_tar(archive_path, tar_mode)
+    view = _embed(archive_path, str(tmp_path / 'outer'), 1000)
+
+    # The path is only a name for it, it is never opened
+    assert _read_view_members('/does/not/exist', filetype, view) == EXPECTED_MEMBERS
+
+
+def test_iter_members_zip_view(tmp_path):
+    archive_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(archive_path)
+    view = _embed(archive_path, str(tmp_path / 'outer'), 1000)
+
+    assert _read_view_members('/does/not/exist', FileType.ZIP, view) == EXPECTED_MEMBERS
+
+
+def test_iter_members_iso_view(tmp_path):
+    archive_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(archive_path, EXPECTED_MEMBERS, rock_ridge=True)
+    view = _embed(archive_path, str(tmp_path / 'outer'), 1000)
+
+    assert _read_view_members('/does/not/exist', FileType.ISO, view) == EXPECTED_MEMBERS
+
+
+@pytest.mark.parametrize('filetype,make_archive', [
+    (FileType.TAR, lambda path: _make_tar(path, 'w')),
+    (FileType.ZIP, _make_zip),
+    (FileType.ISO, lambda path: iso_images.make_iso(path, EXPECTED_MEMBERS)),
+])
+def test_iter_members_data_offset(tmp_path, filetype, make_archive):
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    archive_path = str(tmp_path / 'some_archive')
+    make_archive(archive_path)
+
+    with open(archive_path, 'rb') as f:
+        archive_data = f.read()
+
+    members = list(iter_members(archive_path, filetype))
+    assert len(members) == len(EXPECTED_MEMBERS)
+    for member in members:
+        # Stored as is, right where it says
+        assert member.data_offset is not None
+        assert archive_data[member.data_offset:member.data_offset + member.size] == EXPECTED_MEMBERS[member.name]
+
+
+@pytest.mark.parametrize('filetype,make_archive', [
+    (FileType.TARGZ, lambda path: _make_tar(path, 'w:gz')),
+    (FileType.ZIP, lambda path: _make_zip(path, zipfile.ZIP_DEFLATED)),
+])
+def test_iter_members_no_data_offset(tmp_path, filetype, make_archive):
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    archive_path = str(tmp_path / 'some_archive')
+    make_archive(archive_path)
+
+    # Compressed
+    assert all(member.data_offset is None for member in iter_members(archive_path, filetype))
+
+
+def test_iter_tar_stream(tmp_path):
+    from clamav_large_archive_scanner.lib.archive_members import iter_tar_stream
+
+    archive_path = str(tmp_path / 'some_archive')
+    _make_tar(archive_path, 'w')
+
+    members = {}
+    with open(archive_path, 'rb') as f:
+        # Nothing but reads, the same as a pipe
+        stream = io.BufferedReader(io.FileIO(f.fileno(), closefd=False))
+        for member in iter_tar_stream(stream, 'some_prefix/'):
+            members[member.name] = b''.join(member.iter_chunks())
+
+    assert members == {f'some_prefix/{name}': data for name, data in EXPECTED_MEMBERS.items()}
+
+
+def test_iter_members_corrupt(tmp_path):
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    archive_path = tmp_path / 'corrupt.zip'
+    archive_path.write_bytes(b'PK\x03\x04 not really a zip file')
+
+    with pytest.raises(zipfile.BadZipFile):
+        list(iter_members(str(archive_path), FileType.ZIP))
+
+
+def test_iter_members_unhandled_filetype():
+    from clamav_large_archive_scanner.lib.archive_members import iter_members
+
+    with pytest.raises(ValueError):
+        iter_members('/some/path', FileType.VMDK)
+
+
+@pytest.mark.parametrize('name,expected_relative_path', [
+    ('some_dir/some_file', 'some_dir/some_file'),
+    ('./some_file', 'some_file'),
+    ('/absolute/some_file', 'absolute/some_file'),
+    ('../../some_file', 'some_file'),
+    ('some_dir/../../../some_file', 'some_file'),
+])
+def test_safe_relative_path(name, expected_relative_path):
+    from clamav_large_archive_scanner.lib.archive_members import ArchiveMember
+
+    assert ArchiveMember(name, 0, io.BytesIO()).safe_relative_path() == expected_relative_path
+
+
+def test_iter_chunks(mocker):
+    from clamav_large_archive_scanner.lib.archive_members import ArchiveMember
+
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.READ_CHUNK_SIZE', 4)
+    member = ArchiveMember('some_file', 10, io.BytesIO(b'0123456789'))
+
+    header = member.fileobj.read(2)
+    assert list(member.iter_chunks(header)) == [b'01', b'2345', b'6789']
+
+
+def test_extract_member(tmp_path):
+    from clamav_large_archive_scanner.lib.archive_members import ArchiveMember, extract_member
+
+    member = ArchiveMember('some_file', 10, io.BytesIO(b'0123456789'))
+    header = member.fileobj.read(4)
+    dest_path = str(tmp_path / 'some_dir' / 'some_file')
+
+    assert extract_member(member, dest_path, header) == dest_path
+
+    with open(dest_path, 'rb') as f:
+        assert f.read() == b'0123456789'
+
+    assert stat.S_IMODE(os.stat(dest_path).st_mode) == 0o644
+
+
+def test_extract_member_same_name(tmp_path):
+    from clamav_large_archive_scanner.lib.archive_members import ArchiveMember, extract_member
+
+    dest_path = str(tmp_path / 'some_dir' / 'some_file')
+    paths = [extract_member(ArchiveMember('some_file', 4, io.BytesIO(data)), dest_path)
+             for data in [b'1111', b'2222', b'3333']]
+
+    # Nothing is written over, every member with the same name gets a file of its own
+    assert paths == [dest_path, f'{dest_path}.1', f'{dest_path}.2']
+    for path, data in zip(paths, [b'1111', b'2222', b'3333']):
+        with open(path, 'rb') as f:
+            assert f.read() == data
+
+
+def _make_sharded_zip(path: str) -> dict:
+    # Enough members, spread across the same few directories, for every shard to be creating them at the same time
+    members = {f'dir_{index % 3}/sub_dir/file_{index}': f'some member {index}'.encode() * 100 for index in range(300)}
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('dir_0/', b'')
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+
+    return members
+
+
+def _read_extracted(dest_dir: str) -> dict:
+    extracted = {}
+    for dir_path, _, file_names in os.walk(dest_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+            with open(path, 'rb') as f:
+                extracted[os.path.relpath(path, dest_dir)] = f.read()
+
+    return extracted
+
+
+def test_extract_zip(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.archive_members import extract_zip
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    members = _make_sharded_zip(zip_path)
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.ZIP_SHARD_MIN_SIZE', 1)
+    executor_spy = mocker.spy(concurrent.futures, 'ProcessPoolExecutor')
+
+    dest_dir = str(tmp_path / 'extracted')
+    assert extract_zip(zip_path, dest_dir, 3) == len(members)
+
+    assert executor_spy.call_args[1]['max_workers'] == 3
+    assert _read_extracted(dest_dir) == members
+
+
+def test_extract_zip_duplicate_names(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.archive_members import extract_zip
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    first_data, last_data = b'first member' * 10000, b'last member' * 10000
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('some_dir/same_name', first_data)
+        for index in range(300):
+            zip_file.writestr(f'file_{index}', f'some member {index}'.encode() * 100)
+        # zipfile warns about it, but writes it all the same
+        with pytest.warns(UserWarning):
+            zip_file.writestr('some_dir/same_name', last_data)
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.ZIP_SHARD_MIN_SIZE', 1)
+
+    dest_dir = str(tmp_path / 'extracted')
+    assert extract_zip(zip_path, dest_dir, 3) == 302
+
+    # The first and the last shard each had one of them, both end up whole, neither one over the other
+    extracted = _read_extracted(dest_dir)
+    assert len(extracted) == 302
+    assert sorted([extracted['some_dir/same_name'], extracted['some_dir/same_name.1']]) == \
+           sorted([first_data, last_data])
+
+
+def test_extract_zip_view(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.archive_members import extract_zip
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    members = _make_sharded_zip(zip_path)
+    view = _embed(zip_path, str(tmp_path / 'outer'), 1536)
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.ZIP_SHARD_MIN_SIZE', 1)
+
+    dest_dir = str(tmp_path / 'extracted')
+    assert extract_zip('/not/where/it/is.zip', dest_dir, 2, view) == len(members)
+
+    assert _read_extracted(dest_dir) == members
+
+
+def test_extract_zip_small(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.archive_members import extract_zip
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    members = _make_sharded_zip(zip_path)
+    executor_mock = mocker.patch('concurrent.futures.ProcessPoolExecutor')
+
+    # Not worth starting a process for, however many jobs there could be
+    dest_dir = str(tmp_path / 'extracted')
+    assert extract_zip(zip_path, dest_dir, 3) == len(members)
+
+    executor_mock.assert_not_called()
+    assert _read_extracted(dest_dir) == members
+
+
+def test_extract_zip_corrupt(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.archive_members import extract_zip
+
+    zip_path = tmp_path / 'some_archive.zip'
+    _make_sharded_zip(str(zip_path))
+    # The last member, which is in the last shard, doesn't match its CRC anymore
+    zip_data = bytearray(zip_path.read_bytes())
+    zip_data[zip_data.rfind(b'PK\x01\x02') + 16] ^= 0xFF
+    zip_path.write_bytes(zip_data)
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.ZIP_SHARD_MIN_SIZE', 1)
+
+    with pytest.raises(zipfile.BadZipFile):
+        extract_zip(str(zip_path), str(tmp_path / 'extracted'), 3)
@@ -0,0 +1,432 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+import fake_clamd
+from clamav_large_archive_scanner.lib.clamd import Abort, ClamdAddress, ClamdClient, ClamdReply
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+
+EXPECTED_SOCKET_PATH = '/run/clamav/some_clamd.ctl'
+
+WAIT_TIMEOUT_SECONDS = 5
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def socket_dir():
+    # Kept short, unix socket paths can't be very long
+    socket_dir = tempfile.mkdtemp(prefix='clamd_')
+    yield socket_dir
+    shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope='function')
+def clamd_server(socket_dir):
+    server = fake_clamd.FakeClamd(os.path.join(socket_dir, 'clamd.ctl')).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='function')
+def client(clamd_server):
+    client = ClamdClient(ClamdAddress(socket.AF_UNIX, clamd_server.socket_path), pool_size=2)
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope='function')
+def scan_dir(tmp_path):
+    (tmp_path / 'clean_file').write_bytes(b'nothing to see here')
+    (tmp_path / 'some_dir').mkdir()
+    (tmp_path / 'some_dir' / 'infected_file').write_bytes(b'some ' + fake_clamd.EICAR_MARKER + b' data')
+    return tmp_path
+
+
+def _write_conf(tmp_path, contents: str) -> str:
+    conf_path = tmp_path / 'clamd.conf'
+    conf_path.write_text(contents)
+    return str(conf_path)
+
+
+def test_parse_clamd_conf_local_socket(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    conf_path = _write_conf(tmp_path, f'''\
+# Comments are ignored
+#LocalSocket /some/commented/out/socket
+
+TCPSocket 3310
+LocalSocket {EXPECTED_SOCKET_PATH}
+''')
+
+    address = parse_clamd_conf(conf_path)
+
+    # Same as clamdscan, the local socket wins
+    assert address.family == socket.AF_UNIX
+    assert address.address == EXPECTED_SOCKET_PATH
+    assert str(address) == EXPECTED_SOCKET_PATH
+
+
+def test_parse_clamd_conf_tcp_socket(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    conf_path = _write_conf(tmp_path, 'TCPSocket 3311\nTCPAddr 10.0.0.1\nTCPAddr 10.0.0.2\n')
+
+    address = parse_clamd_conf(conf_path)
+
+    assert address.family == socket.AF_INET
+    assert address.address == ('10.0.0.1', 3311)
+    assert str(address) == '10.0.0.1:3311'
+
+
+def test_parse_clamd_conf_tabs(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    conf_path = _write_conf(tmp_path, f'LocalSocket\t{EXPECTED_SOCKET_PATH}\n')
+
+    assert parse_clamd_conf(conf_path).address == EXPECTED_SOCKET_PATH
+
+
+def test_parse_clamd_conf_repeated_option(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    conf_path = _write_conf(tmp_path, 'TCPSocket 3310\nTCPAddr 10.0.0.1\nTCPSocket 3311\n')
+
+    # Same as clamd, the last one wins
+    assert parse_clamd_conf(conf_path).address == ('10.0.0.1', 3311)
+
+
+def test_parse_clamd_conf_tcp_socket_default_addr(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf, DEFAULT_TCP_ADDR
+
+    assert parse_clamd_conf(_write_conf(tmp_path, 'TCPSocket 3310\n')).address == (DEFAULT_TCP_ADDR, 3310)
+
+
+@pytest.mark.parametrize('contents,expected_error', [
+    ('Example\nLocalSocket /some/socket\n', 'still has the Example line in it'),
+    ('LogFile /var/log/clamd.log\n', 'Neither LocalSocket nor TCPSocket is set'),
+    ('TCPSocket not_a_port\n', 'Invalid TCPSocket'),
+])
+def test_parse_clamd_conf_invalid(tmp_path, contents, expected_error):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    with pytest.raises(ClamdException) as e:
+        parse_clamd_conf(_write_conf(tmp_path, contents))
+
+    assert expected_error in str(e.value)
+
+
+def test_parse_clamd_conf_missing(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_clamd_conf
+
+    with pytest.raises(ClamdException):
+        parse_clamd_conf(str(tmp_path / 'does_not_exist.conf'))
+
+
+@pytest.mark.parametrize('contents,expected_length', [
+    ('', 100 * 1024 * 1024),
+    ('StreamMaxLength 25M\n', 25 * 1024 * 1024),
+    ('StreamMaxLength 512K\n', 512 * 1024),
+    ('StreamMaxLength 4096\n', 4096),
+])
+def test_parse_stream_max_length(tmp_path, contents, expected_length):
+    from clamav_large_archive_scanner.lib.clamd import parse_stream_max_length
+
+    assert parse_stream_max_length(_write_conf(tmp_path, contents)) == expected_length
+
+
+def test_parse_stream_max_length_invalid(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import parse_stream_max_length
+
+    with pytest.raises(ClamdException) as e:
+        parse_stream_max_length(_write_conf(tmp_path, 'StreamMaxLength lots\n'))
+
+    assert 'Invalid StreamMaxLength' in str(e.value)
+
+
+@pytest.mark.parametrize('contents,expected_limits', [
+    ('', (400 * 1024 * 1024, 10000)),
+    ('MaxScanSize 1G\nMaxFiles 500\n', (1024 * 1024 * 1024, 500)),
+    ('MaxScanSize 0\nMaxFiles 0\n', (0, 0)),
+])
+def test_parse_archive_limits(tmp_path, contents, expected_limits):
+    from clamav_large_archive_scanner.lib.clamd import parse_archive_limits
+
+    assert parse_archive_limits(_write_conf(tmp_path, contents)) == expected_limits
+
+
+@pytest.mark.parametrize('contents,expected_error', [
+    ('MaxScanSize lots\n', 'Invalid MaxScanSize'),
+    ('MaxFiles lots\n', 'Invalid MaxFiles'),
+])
+def test_parse_archive_limits_invalid(tmp_path, contents, expected_error):
+    from clamav_large_archive_scanner.lib.clamd import parse_archive_limits
+
+    with pytest.raises(ClamdException) as e:
+        parse_archive_limits(_write_conf(tmp_path, contents))
+
+    assert expected_error in str(e.value)
+
+
+def test_find_clamd_conf(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import find_clamd_conf
+
+    conf_path = _write_conf(tmp_path, '')
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.DEFAULT_CLAMD_CONF_PATHS',
+                 [str(tmp_path / 'does_not_exist.conf'), conf_path])
+
+    assert find_clamd_conf() == conf_path
+    assert find_clamd_conf('/some/explicit/clamd.conf') == '/some/explicit/clamd.conf'
+
+
+def test_find_clamd_conf_not_found(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import find_clamd_conf
+
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.DEFAULT_CLAMD_CONF_PATHS', [str(tmp_path / 'nope.conf')])
+
+    with pytest.raises(ClamdException):
+        find_clamd_conf()
+
+
+def test_client_from_conf(tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import client_from_conf
+
+    client = client_from_conf(_write_conf(tmp_path, f'LocalSocket {EXPECTED_SOCKET_PATH}\nStreamMaxLength 10M\n'
+                                                         'MaxScanSize 20M\nMaxFiles 30\n'))
+
+    assert str(client.address) == EXPECTED_SOCKET_PATH
+    assert client.stream_max_length == 10 * 1024 * 1024
+    assert client.max_scan_size == 20 * 1024 * 1024
+    assert client.max_files == 30
+
+
+def test_clamd_reply():
+    clean = ClamdReply(['/some/path: OK'])
+    assert clean.get_return_code() == 0
+    assert clean.found == []
+    assert clean.errors == []
+
+    infected = ClamdReply(['/some/path/a: Some-Signature FOUND', '/some/path/b: Access denied. ERROR'])
+    assert infected.get_return_code() == 1
+    assert infected.found == [('/some/path/a', 'Some-Signature')]
+    assert infected.errors == ['/some/path/b: Access denied. ERROR']
+    assert str(infected) == '/some/path/a: Some-Signature FOUND\n/some/path/b: Access denied. ERROR'
+
+    assert ClamdReply(['/some/path: Access denied. ERROR']).get_return_code() == 2
+    assert ClamdReply(['UNKNOWN COMMAND']).get_return_code() == 2
+    # clamd hung up without saying anything
+    assert ClamdReply([]).get_return_code() == 2
+
+
+def test_ping(client, clamd_server):
+    assert client.ping()
+    assert clamd_server.commands == ['PING']
+
+
+def test_ping_no_clamd(socket_dir):
+    client = ClamdClient(ClamdAddress(socket.AF_UNIX, os.path.join(socket_dir, 'nobody_home.ctl')))
+
+    assert not client.ping()
+
+
+def test_version(client):
+    assert client.version() == fake_clamd.VERSION
+
+
+def test_multiscan(client, clamd_server, scan_dir):
+    reply = client.multiscan(str(scan_dir))
+
+    assert reply.get_return_code() == 1
+    assert reply.found == [(str(scan_dir / 'some_dir' / 'infected_file'), fake_clamd.SIGNATURE_NAME)]
+    assert clamd_server.commands == [f'MULTISCAN {scan_dir}']
+
+
+def test_multiscan_clean(client, scan_dir):
+    reply = client.multiscan(str(scan_dir / 'clean_file'))
+
+    assert reply.get_return_code() == 0
+    assert str(reply) == f'{scan_dir / "clean_file"}: OK'
+
+
+def test_multiscan_missing_path(client, scan_dir):
+    reply = client.multiscan(str(scan_dir / 'does_not_exist'))
+
+    assert reply.get_return_code() == 2
+
+
+def test_contscan_and_allmatchscan(client, clamd_server, scan_dir):
+    assert client.contscan(str(scan_dir)).get_return_code() == 1
+    assert client.allmatchscan(str(scan_dir)).get_return_code() == 1
+
+    assert clamd_server.commands == [f'CONTSCAN {scan_dir}', f'ALLMATCHSCAN {scan_dir}']
+
+
+def test_scan_files(client, clamd_server, scan_dir):
+    paths = [str(scan_dir / 'clean_file'), str(scan_dir / 'some_dir' / 'infected_file')]
+    # The first reply comes back last
+    clamd_server.slow_paths.add(paths[0])
+
+    reply = client.scan_files(paths)
+
+    assert reply.get_return_code() == 1
+    assert reply.lines == [f'{paths[0]}: OK', f'{paths[1]}: {fake_clamd.SIGNATURE_NAME} FOUND']
+    assert sorted(clamd_server.commands) == [f'SCAN {path}' for path in paths]
+    assert clamd_server.max_concurrent_commands == 2
+    assert clamd_server.connections == 1
+
+
+@pytest.mark.parametrize('file_list', [False, True])
+def test_scan_aborted(client, clamd_server, scan_dir, file_list):
+    path = str(scan_dir / 'clean_file')
+    clamd_server.stuck_paths.add(path)
+    abort = Abort()
+    errors = []  # type: list[ClamdException]
+
+    def _scan():
+        try:
+            client.scan_files([path], abort) if file_list else client.multiscan(path, abort)
+        except ClamdException as e:
+            errors.append(e)
+
+    scan_thread = threading.Thread(target=_scan)
+    scan_thread.start()
+    assert clamd_server.stuck.wait(WAIT_TIMEOUT_SECONDS)
+
+    # clamd is still scanning it, the client stops waiting on it anyway
+    abort.abort()
+    scan_thread.join(WAIT_TIMEOUT_SECONDS)
+    assert not scan_thread.is_alive()
+    assert len(errors) == 1
+
+    # Starting a scan after the abort doesn't wait on clamd at all
+    with pytest.raises(ClamdException):
+        client.multiscan(path, abort)
+
+    # The aborted session isn't handed out again
+    assert client.version() == fake_clamd.VERSION
+
+
+def test_scan_files_past_pipeline_depth(mocker: MockerFixture, client, clamd_server, tmp_path):
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.PIPELINE_DEPTH', 4)
+    paths = []
+    for i in range(20):
+        (tmp_path / f'file_{i}').write_bytes(b'nothing to see here')
+        paths.append(str(tmp_path / f'file_{i}'))
+
+    reply = client.scan_files(paths)
+
+    assert reply.lines == [f'{path}: OK' for path in paths]
+    assert clamd_server.max_concurrent_commands <= 4
+
+    # The session is still good for something else afterwards
+    assert client.version() == fake_clamd.VERSION
+    assert clamd_server.connections == 1
+
+
+def test_instream(client, clamd_server):
+    clean_reply = client.instream([b'nothing ', b'', b'to see here'])
+    assert clean_reply.get_return_code() == 0
+    assert str(clean_reply) == 'stream: OK'
+
+    infected_reply = client.instream(iter([b'some ', fake_clamd.EICAR_MARKER, b' data']))
+    assert infected_reply.get_return_code() == 1
+    assert infected_reply.found == [('stream', fake_clamd.SIGNATURE_NAME)]
+
+    # The chunks get put back together on the other side
+    assert clamd_server.streamed == [b'nothing to see here', b'some ' + fake_clamd.EICAR_MARKER + b' data']
+
+
+def test_instream_size_limit(client, clamd_server):
+    clamd_server.stream_max_length = 10
+
+    reply = client.instream([b'x' * 8] * 1024)
+    assert reply.get_return_code() == 2
+    assert reply.errors == ['INSTREAM size limit exceeded. ERROR']
+
+    # The connection that clamd hung up on isn't reused
+    assert client.instream([b'small']).get_return_code() == 0
+
+
+def test_session_reused(client, clamd_server):
+    for _ in range(5):
+        client.version()
+        client.instream([b'some data'])
+
+    # Everything went over a single pooled connection
+    assert clamd_server.connections == 1
+    assert clamd_server.commands == ['VERSION', 'INSTREAM'] * 5
+
+
+def test_session_dropped_by_clamd(client, clamd_server):
+    client.version()
+
+    clamd_server.drop_connections()
+
+    # The dead connection is thrown away instead of reused
+    assert client.version() == fake_clamd.VERSION
+    assert clamd_server.connections == 2
+
+
+def test_pool_size_is_respected(client, clamd_server, scan_dir):
+    threads = [threading.Thread(target=client.multiscan, args=(str(scan_dir),)) for _ in range(8)]
+    threads += [threading.Thread(target=client.instream, args=([b'some data'],)) for _ in range(8)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(clamd_server.commands) == 16
+    assert clamd_server.max_concurrent_commands <= 2
+
+
+def test_idle_session_makes_room(clamd_server, scan_dir):
+    client = ClamdClient(ClamdAddress(socket.AF_UNIX, clamd_server.socket_path), pool_size=1)
+
+    client.instream([b'some data'])
+    # The idle session is closed, rather than going over the pool size
+    client.multiscan(str(scan_dir))
+    client.instream([b'some data'])
+    client.close()
+
+    assert clamd_server.connections == 3
+    assert clamd_server.max_concurrent_commands == 1
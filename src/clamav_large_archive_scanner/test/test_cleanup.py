@@ -38,6 +38,7 @@ import clamav_large_archive_scanner.lib.cleanup
 import clamav_large_archive_scanner.lib.exceptions
 import clamav_large_archive_scanner.lib.mount_tools
 from clamav_large_archive_scanner.lib.file_data import FileType
+from clamav_large_archive_scanner.lib.mount_table import MountEntry, MountTable
 
 # Some constants
 
@@ -111,6 +112,13 @@ def test_targz_cleanup_handler(mock_shutil):
     _assert_base_cleanup_behavior(mock_shutil, handler)
 
 
+@pytest.mark.parametrize('handler_name', ['TarZstCleanupHandler', 'TarXzCleanupHandler', 'TarBz2CleanupHandler'])
+def test_compressed_tar_cleanup_handlers(mock_shutil, handler_name):
+    # Same as TGZs, nothing but the unpack dir to delete
+    handler = getattr(clamav_large_archive_scanner.lib.cleanup, handler_name)(EXPECTED_ARCHIVE_PATH)
+    _assert_base_cleanup_behavior(mock_shutil, handler)
+
+
 def test_zip_cleanup_handler(mock_shutil):
     # Zip has the same logic as base
     print()
@@ -126,7 +134,8 @@ def test_iso_cleanup_handler(mock_shutil, mock_mount_tools):
     handler = clamav_large_archive_scanner.lib.cleanup.IsoCleanupHandler(EXPECTED_ARCHIVE_PATH)
     handler.cleanup()
 
-    mock_mount_tools.umount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+    mock_mount_tools.umount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH,
+                                                        mock_mount_tools.read_mount_table.return_value)
     mock_shutil.rmtree.assert_called_once_with(path=EXPECTED_ARCHIVE_PATH, ignore_errors=True)
 
 
@@ -145,31 +154,65 @@ def test_iso_cleanup_handler_mount_error(mock_shutil, mock_mount_tools):
     mock_shutil.rmtree.assert_not_called()
 
 
-GUESTFS_PARTITIONS = ['/tmp/some_test_path/some_partition_1',
-                      '/tmp/some_test_path/some_partition_2',
-                      '/tmp/some_test_path/some_partition_3']
+GUESTFS_PARTITIONS = [f'{EXPECTED_ARCHIVE_PATH}/some_partition_1',
+                      f'{EXPECTED_ARCHIVE_PATH}/some_partition_2',
+                      f'{EXPECTED_ARCHIVE_PATH}/some_partition_3']
+
+
+def _make_guestfs_mounts() -> MountTable:
+    return MountTable([MountEntry('/', 'ext4', '/dev/sda1'),
+                       MountEntry(EXPECTED_ARCHIVE_PARENT_DIR, 'tmpfs', 'tmpfs'),
+                       MountEntry(f'{EXPECTED_ARCHIVE_PATH}_not_this_one', 'fuse', '/dev/fuse')] +
+                      [MountEntry(x, 'fuse', '/dev/fuse') for x in GUESTFS_PARTITIONS] +
+                      # Only FUSE mounts are guestmount's
+                      [MountEntry(f'{EXPECTED_ARCHIVE_PATH}/some_loop_mount', 'iso9660', '/dev/loop0')])
 
 
-def _assert_umount_has_calls(mock_umount):
-    mock_umount.assert_has_calls([call(x) for x in GUESTFS_PARTITIONS], any_order=True)
+def _assert_umount_has_calls(mock_mount_tools):
+    mounts = mock_mount_tools.read_mount_table.return_value
+    mock_mount_tools.umount_guestfs_partition.assert_has_calls([call(x, mounts) for x in GUESTFS_PARTITIONS],
+                                                               any_order=True)
 
 
 def test_guestfs_cleanup_handler(mock_shutil, mock_mount_tools):
     # For test output formatting... don't remove
     print()
 
-    mock_mount_tools.list_top_level_dirs.return_value = GUESTFS_PARTITIONS
+    mock_mount_tools.read_mount_table.return_value = _make_guestfs_mounts()
 
     handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
     handler.cleanup()
 
-    _assert_umount_has_calls(mock_mount_tools.umount_guestfs_partition)
+    # The mount table is read once for all of them
+    mock_mount_tools.read_mount_table.assert_called_once()
+    _assert_umount_has_calls(mock_mount_tools)
+    assert mock_mount_tools.umount_guestfs_partition.call_count == len(GUESTFS_PARTITIONS) + 1
+
+    # Mounted with a single appliance, the partitions are all under one mount
+    mock_mount_tools.umount_guestfs_partition.assert_called_with(EXPECTED_ARCHIVE_PATH,
+                                                                 mock_mount_tools.read_mount_table.return_value)
 
     mock_shutil.rmtree.assert_called_once_with(path=EXPECTED_ARCHIVE_PATH, ignore_errors=True)
 
 
+def test_guestfs_cleanup_handler_one_appliance_umount_error(mock_shutil, mock_mount_tools):
+    mock_mount_tools.read_mount_table.return_value = _make_guestfs_mounts()
+
+    def _umount_root_exception_thrower(dir_name: str, mounts: MountTable):
+        if dir_name == EXPECTED_ARCHIVE_PATH:
+            raise clamav_large_archive_scanner.lib.exceptions.MountException('some test error')
+
+    mock_mount_tools.umount_guestfs_partition.side_effect = _umount_root_exception_thrower
+
+    handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
+    handler.cleanup()
+
+    # Whatever is still mounted there must not be deleted
+    mock_shutil.rmtree.assert_not_called()
+
+
 # Raises an exception on the second partition
-def _umount_exception_thrower(dir_name: str):
+def _umount_exception_thrower(dir_name: str, mounts: MountTable):
     if dir_name == GUESTFS_PARTITIONS[1]:
         raise clamav_large_archive_scanner.lib.exceptions.MountException('some test error')
 
@@ -178,13 +221,15 @@ def test_guestfs_cleanup_handler_umount_error(mock_shutil, mock_mount_tools):
     # For test output formatting... don't remove
     print()
 
-    mock_mount_tools.list_top_level_dirs.return_value = GUESTFS_PARTITIONS
+    mock_mount_tools.read_mount_table.return_value = _make_guestfs_mounts()
     mock_mount_tools.umount_guestfs_partition.side_effect = _umount_exception_thrower
 
     handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
     handler.cleanup()
 
-    _assert_umount_has_calls(mock_mount_tools.umount_guestfs_partition)
+    _assert_umount_has_calls(mock_mount_tools)
+    # The partitions were mounted one by one, there is no point in trying the directory they are in
+    assert mock_mount_tools.umount_guestfs_partition.call_count == len(GUESTFS_PARTITIONS)
 
     # Even in case of errors, it should still continue
     mock_shutil.rmtree.assert_not_called()
@@ -244,6 +289,21 @@ def test_cleanup_recursive(mock_tmp_files, mock_shutil):
     mock_shutil.rmtree.assert_has_calls([call(path=x, ignore_errors=True) for x in ASSOCIATED_DIRS], any_order=True)
 
 
+def test_cleanup_recursive_mounts(mock_tmp_files, mock_shutil, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    mock_tmp_files.determine_tmp_dir_filetype.return_value = FileType.ISO
+    mock_tmp_files.find_associated_dirs.return_value = ASSOCIATED_DIRS
+
+    clamav_large_archive_scanner.lib.cleanup.cleanup_recursive(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
+
+    # One look at the mount table for the whole pass
+    mounts = mock_mount_tools.read_mount_table.return_value
+    mock_mount_tools.read_mount_table.assert_called_once()
+    mock_mount_tools.umount_iso.assert_has_calls([call(x, mounts) for x in ASSOCIATED_DIRS])
+
+
 def test_cleanup_no_files(mock_tmp_files, mock_shutil):
     # For test output formatting... don't remove
     print()
@@ -268,6 +328,234 @@ def test_filetype_handlers():
         FileType.VMDK: clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler,
         FileType.TARGZ: clamav_large_archive_scanner.lib.cleanup.TarGzCleanupHandler,
         FileType.QCOW2: clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler,
+        FileType.TARZST: clamav_large_archive_scanner.lib.cleanup.TarZstCleanupHandler,
+        FileType.TARXZ: clamav_large_archive_scanner.lib.cleanup.TarXzCleanupHandler,
+        FileType.TARBZ2: clamav_large_archive_scanner.lib.cleanup.TarBz2CleanupHandler,
     }
 
     assert clamav_large_archive_scanner.lib.cleanup.FILETYPE_HANDLERS == expected_filetype_handlers
+
+
+def _make_ctx(unpack_dir: str, filetype: FileType, parent_ctx=None, depends_on_source=False):
+    u_ctx = common.make_basic_unpack_ctx(unpack_dir, f'{unpack_dir}.some_archive_format')
+    u_ctx.file_meta.filetype = filetype
+    u_ctx.parent_ctx = parent_ctx
+    u_ctx.depends_on_source = depends_on_source
+
+    return u_ctx
+
+
+def test_cleanup_ctx(mock_shutil):
+    # For test output formatting... don't remove
+    print()
+
+    u_ctx = _make_ctx(EXPECTED_ARCHIVE_PATH, FileType.TAR)
+
+    clamav_large_archive_scanner.lib.cleanup.cleanup_ctx(u_ctx)
+
+    _assert_base_cleanup_behavior(mock_shutil)
+
+
+def test_cleanup_ctx_nothing_to_clean(mock_shutil):
+    # For test output formatting... don't remove
+    print()
+
+    # Directories are scanned in place
+    clamav_large_archive_scanner.lib.cleanup.cleanup_ctx(_make_ctx(EXPECTED_ARCHIVE_PATH, FileType.DIR))
+
+    # Never got unpacked
+    not_unpacked_ctx = _make_ctx(EXPECTED_ARCHIVE_PATH, FileType.TAR)
+    not_unpacked_ctx.unpacked_dir_location = None
+    clamav_large_archive_scanner.lib.cleanup.cleanup_ctx(not_unpacked_ctx)
+
+    mock_shutil.rmtree.assert_not_called()
+
+
+ROOT_UNPACK_DIR = '/tmp/some_root_unpack_dir'
+CHILD_UNPACK_DIR = '/tmp/some_child_unpack_dir'
+
+
+def test_incremental_cleaner_extracted_child(mock_shutil, mock_tmp_files):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.TAR)
+    child_ctx = _make_ctx(CHILD_UNPACK_DIR, FileType.TAR, parent_ctx=root_ctx)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+    mock_tmp_files.TmpDirUsage.assert_called_once_with(EXPECTED_ARCHIVE_PARENT_DIR)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [child_ctx])
+    cleaner.scanned(root_ctx)
+
+    # Still waiting on the child to be extracted
+    mock_shutil.rmtree.assert_not_called()
+
+    cleaner.unpacked(child_ctx)
+    mock_shutil.rmtree.assert_called_once_with(path=ROOT_UNPACK_DIR, ignore_errors=True)
+
+    cleaner.nested_found(child_ctx, [])
+    cleaner.scanned(child_ctx)
+    mock_shutil.rmtree.assert_called_with(path=CHILD_UNPACK_DIR, ignore_errors=True)
+    assert mock_shutil.rmtree.call_count == 2
+
+    # Usage is checked before anything gets deleted
+    assert cleaner.usage.sample.call_count == 2
+
+
+def test_incremental_cleaner_mounted_child(mock_shutil, mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.TAR)
+    child_ctx = _make_ctx(CHILD_UNPACK_DIR, FileType.ISO, parent_ctx=root_ctx, depends_on_source=True)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [child_ctx])
+    cleaner.scanned(root_ctx)
+    cleaner.unpacked(child_ctx)
+    cleaner.nested_found(child_ctx, [])
+
+    # The ISO is still mounted from a file inside the root
+    mock_shutil.rmtree.assert_not_called()
+
+    cleaner.scanned(child_ctx)
+
+    # Un-mounted first, then the root it was mounted from
+    mock_mount_tools.umount_iso.assert_called_once_with(CHILD_UNPACK_DIR,
+                                                        mock_mount_tools.read_mount_table.return_value)
+    mock_shutil.rmtree.assert_has_calls([call(path=CHILD_UNPACK_DIR, ignore_errors=True),
+                                         call(path=ROOT_UNPACK_DIR, ignore_errors=True)])
+
+
+def test_incremental_cleaner_failed_child(mock_shutil, mock_tmp_files):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.TAR)
+    child_ctx = _make_ctx(CHILD_UNPACK_DIR, FileType.TAR, parent_ctx=root_ctx)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [child_ctx])
+    cleaner.scanned(root_ctx)
+    cleaner.unpack_failed(child_ctx)
+
+    mock_shutil.rmtree.assert_called_once_with(path=ROOT_UNPACK_DIR, ignore_errors=True)
+
+
+def test_incremental_cleaner_dir_root(mock_shutil, mock_tmp_files):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.DIR)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [])
+    cleaner.scanned(root_ctx)
+
+    # Never delete the user's directory
+    mock_shutil.rmtree.assert_not_called()
+
+
+def test_incremental_cleaner_cleanup_error(mock_shutil, mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    mock_mount_tools.umount_iso.side_effect = clamav_large_archive_scanner.lib.exceptions.MountException('some test error')
+
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.ISO)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [])
+
+    # Left for cleanup_recursive, instead of stopping the scan
+    cleaner.scanned(root_ctx)
+
+    mock_mount_tools.umount_iso.assert_called_once_with(ROOT_UNPACK_DIR, mock_mount_tools.read_mount_table.return_value)
+    mock_shutil.rmtree.assert_not_called()
+
+
+def test_incremental_cleaner_releases_slots(mock_shutil, mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    slots = MagicMock()
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.ISO)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR, slots)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [])
+    slots.release.assert_not_called()
+
+    cleaner.scanned(root_ctx)
+
+    mock_mount_tools.umount_iso.assert_called_once_with(ROOT_UNPACK_DIR, mock_mount_tools.read_mount_table.return_value)
+    slots.release.assert_called_once_with(root_ctx)
+
+
+def test_incremental_cleaner_keeps_slot_on_error(mock_shutil, mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+
+    mock_mount_tools.umount_iso.side_effect = clamav_large_archive_scanner.lib.exceptions.MountException('some test error')
+
+    slots = MagicMock()
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.ISO)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR, slots)
+
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [])
+    cleaner.scanned(root_ctx)
+
+    # Still mounted, so the loop device is still taken, but nothing should wait for it
+    slots.release.assert_called_once_with(root_ctx, failed=True)
+
+
+def test_incremental_cleaner_error_while_waiting(mock_shutil, mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    from clamav_large_archive_scanner.lib.cleanup import IncrementalCleaner
+    from clamav_large_archive_scanner.lib.mount_slots import LOOP_SLOT, MountSlots
+
+    mock_mount_tools.umount_iso.side_effect = clamav_large_archive_scanner.lib.exceptions.MountException('target is busy')
+
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    root_ctx = _make_ctx(ROOT_UNPACK_DIR, FileType.ISO)
+    waiting_ctx = _make_ctx(CHILD_UNPACK_DIR, FileType.ISO)
+    assert slots.try_acquire(LOOP_SLOT, root_ctx)
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    cleaner = IncrementalCleaner(EXPECTED_ARCHIVE_PARENT_DIR, slots)
+    cleaner.unpacked(root_ctx)
+    cleaner.nested_found(root_ctx, [])
+    cleaner.scanned(root_ctx)
+
+    # The waiting context is given up on, instead of waiting forever on a slot that is never coming back
+    assert not slots.wait_for_release([waiting_ctx], timeout=5)
@@ -0,0 +1,354 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import bz2
+import gzip
+import lzma
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+
+from clamav_large_archive_scanner.lib import compressed_stream
+from clamav_large_archive_scanner.lib.file_data import FileView
+
+# Doesn't compress down to nothing, and isn't a multiple of anything
+EXPECTED_DATA = b''.join(f'line {index} of some data that gets compressed\n'.encode() for index in range(50000))
+
+# The empty block that BGZF streams end with
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(autouse=True)
+def reset_mode():
+    yield
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_PYTHON)
+
+
+@pytest.fixture
+def external_gzip(mocker: MockerFixture):
+    # igzip and pigz take the same arguments as gzip does, which is around wherever they aren't
+    if shutil.which('gzip') is None:
+        pytest.skip('gzip is not on the PATH')
+    mocker.patch.dict(compressed_stream.EXTERNAL_TOOLS, {compressed_stream.GZIP: ['gzip']})
+
+
+def _make_bgzf(data: bytes, block_size: int = 0xff00) -> bytes:
+    # Same as bgzip, a gzip member for every block_size of data, each one saying how big it is in its extra field
+    blocks = []
+    for position in range(0, len(data), block_size):
+        block = data[position:position + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(block) + compressor.flush()
+        header = struct.pack('<2sBBLBBH2sHH', b'\x1f\x8b', 8, 4, 0, 0, 255, 6, b'BC', 2, 18 + len(deflated) + 8 - 1)
+        blocks.append(header + deflated + struct.pack('<2L', zlib.crc32(block), len(block)))
+
+    return b''.join(blocks) + BGZF_EOF
+
+
+COMPRESSED = {
+    'plain': gzip.compress(EXPECTED_DATA),
+    # Members one after the other, with padding after them, the way some tools write them
+    'multi_member': gzip.compress(EXPECTED_DATA[:300000]) + gzip.compress(EXPECTED_DATA[300000:]) + b'\0' * 1000,
+    'bgzf': _make_bgzf(EXPECTED_DATA),
+    # Something appended to a BGZF stream with a tool that doesn't write BGZF
+    'bgzf_then_plain': _make_bgzf(EXPECTED_DATA[:300000]) + gzip.compress(EXPECTED_DATA[300000:]),
+}
+
+
+def _read(path: str, view: FileView = None) -> bytes:
+    with (view.open() if view is not None else open(path, 'rb')) as f, compressed_stream.open_stream(f) as stream:
+        return stream.read()
+
+
+def _write(tmp_path, compressed: bytes) -> str:
+    path = str(tmp_path / 'some_file.gz')
+    with open(path, 'wb') as f:
+        f.write(compressed)
+    return path
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('kind', COMPRESSED.keys())
+def test_open_gzip(tmp_path, external_gzip, mode, kind):
+    compressed_stream.use_mode(mode)
+    path = _write(tmp_path, COMPRESSED[kind])
+
+    assert _read(path) == EXPECTED_DATA
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+def test_open_gzip_view(tmp_path, external_gzip, mode):
+    compressed_stream.use_mode(mode)
+    outer_path = str(tmp_path / 'outer')
+    with open(outer_path, 'wb') as f:
+        f.write(b'\xaa' * 1536 + COMPRESSED['bgzf'] + b'\xbb' * 1536)
+
+    # Views have no file of their own, so the external tools are fed through a pipe
+    assert _read(outer_path, FileView(outer_path, 1536, len(COMPRESSED['bgzf']))) == EXPECTED_DATA
+
+
+def test_bgzf_inflated_on_threads(tmp_path, mocker: MockerFixture):
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_THREADS)
+    mocker.patch('os.cpu_count', return_value=4)
+    executor_mock = mocker.patch.object(compressed_stream, 'ThreadPoolExecutor', wraps=compressed_stream.ThreadPoolExecutor)
+    decompress_spy = mocker.spy(zlib, 'decompress')
+
+    assert _read(_write(tmp_path, COMPRESSED['bgzf'])) == EXPECTED_DATA
+
+    # Every block, including the empty one at the end, is inflated on its own
+    executor_mock.assert_called_once_with(max_workers=4)
+    assert decompress_spy.call_count == len(EXPECTED_DATA) // 0xff00 + 2
+
+
+def test_plain_inflated_ahead(tmp_path, mocker: MockerFixture):
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_THREADS)
+    decompress_spy = mocker.spy(zlib, 'decompress')
+    reading_threads = set()
+    original_iter_inflated = compressed_stream._iter_inflated
+
+    def _iter_inflated(*args):
+        reading_threads.add(threading.current_thread())
+        yield from original_iter_inflated(*args)
+
+    mocker.patch.object(compressed_stream, '_iter_inflated', side_effect=_iter_inflated)
+
+    assert _read(_write(tmp_path, COMPRESSED['plain'])) == EXPECTED_DATA
+
+    # Not BGZF, so it all gets inflated in one go, just not on the thread reading it
+    decompress_spy.assert_not_called()
+    assert threading.current_thread() not in reading_threads
+    assert len(reading_threads) == 1
+
+
+def _corrupt(compressed: bytes) -> bytes:
+    # Something in the middle of the deflated data, so that it still inflates, into the wrong thing
+    corrupted = bytearray(compressed)
+    corrupted[len(corrupted) // 2] ^= 0xFF
+    return bytes(corrupted)
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('kind', ['plain', 'bgzf'])
+def test_open_gzip_corrupt(tmp_path, external_gzip, mode, kind):
+    compressed_stream.use_mode(mode)
+    path = _write(tmp_path, _corrupt(COMPRESSED[kind]))
+
+    # The external tools only have how they exit to go on
+    with pytest.raises((OSError, zlib.error)):
+        _read(path)
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('kind', ['plain', 'bgzf'])
+def test_open_gzip_truncated(tmp_path, external_gzip, mode, kind):
+    compressed_stream.use_mode(mode)
+    path = _write(tmp_path, COMPRESSED[kind][:len(COMPRESSED[kind]) // 2])
+
+    with pytest.raises((EOFError, OSError)):
+        _read(path)
+
+
+def test_not_gzip(tmp_path):
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_THREADS)
+
+    with pytest.raises(gzip.BadGzipFile):
+        _read(_write(tmp_path, b'not a gzip file' * 1000))
+
+
+@pytest.mark.parametrize('mode', [compressed_stream.DECOMPRESS_MODE_THREADS, compressed_stream.DECOMPRESS_MODE_EXTERNAL])
+@pytest.mark.parametrize('kind', ['plain', 'bgzf'])
+def test_close_early(tmp_path, external_gzip, mocker: MockerFixture, mode, kind):
+    compressed_stream.use_mode(mode)
+    popen_spy = mocker.spy(subprocess, 'Popen')
+    threads_before = set(threading.enumerate())
+    path = _write(tmp_path, COMPRESSED[kind])
+
+    with open(path, 'rb') as f, compressed_stream.open_stream(f) as stream:
+        assert stream.read(100) == EXPECTED_DATA[:100]
+
+    # Nothing is left running once whoever was reading lets go of it
+    assert set(threading.enumerate()) == threads_before
+    if mode == compressed_stream.DECOMPRESS_MODE_EXTERNAL:
+        assert popen_spy.spy_return.poll() is not None
+
+
+def test_find_external_tool(mocker: MockerFixture):
+    which_mock = mocker.patch('shutil.which')
+
+    which_mock.side_effect = lambda x: f'/usr/bin/{x}' if x == 'pigz' else None
+    assert compressed_stream.find_external_tool() == 'pigz'
+
+    which_mock.side_effect = lambda x: f'/usr/bin/{x}'
+    assert compressed_stream.find_external_tool() == 'igzip'
+
+    which_mock.side_effect = lambda x: None
+    assert compressed_stream.find_external_tool() is None
+
+
+def test_find_external_tool_compression(mocker: MockerFixture):
+    mocker.patch('shutil.which', side_effect=lambda x: f'/usr/bin/{x}' if x in ['zstd', 'pbzip2', 'xz'] else None)
+
+    assert compressed_stream.find_external_tool(compressed_stream.ZSTD) == 'zstd'
+    assert compressed_stream.find_external_tool(compressed_stream.BZIP2) == 'pbzip2'
+    assert compressed_stream.find_external_tool(compressed_stream.XZ) == 'xz'
+    assert compressed_stream.find_external_tool(compressed_stream.GZIP) is None
+
+
+def test_external_tool_missing(tmp_path, mocker: MockerFixture):
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_EXTERNAL)
+    mocker.patch('shutil.which', return_value=None)
+    popen_spy = mocker.spy(subprocess, 'Popen')
+    decompress_spy = mocker.spy(zlib, 'decompress')
+
+    # Decompressed on threads instead, which inflate BGZF blocks
+    assert _read(_write(tmp_path, COMPRESSED['bgzf'])) == EXPECTED_DATA
+    popen_spy.assert_not_called()
+    assert decompress_spy.call_count > 0
+
+
+OTHER_COMPRESSED = {
+    compressed_stream.XZ: lzma.compress(EXPECTED_DATA),
+    # Streams one after the other, the way pbzip2 and lbzip2 write them
+    compressed_stream.BZIP2: bz2.compress(EXPECTED_DATA[:300000]) + bz2.compress(EXPECTED_DATA[300000:]),
+}
+
+
+@pytest.fixture
+def external_bzip2(mocker: MockerFixture):
+    # lbzip2 and pbzip2 take the same arguments as bzip2 does
+    if shutil.which('bzip2') is None or shutil.which('xz') is None:
+        pytest.skip('bzip2 or xz is not on the PATH')
+    mocker.patch.dict(compressed_stream.EXTERNAL_TOOLS, {compressed_stream.BZIP2: ['bzip2']})
+
+
+def _read_compressed(path: str, compression: str, view: FileView = None) -> bytes:
+    with (view.open() if view is not None else open(path, 'rb')) as f, \
+            compressed_stream.open_stream(f, compression) as stream:
+        return stream.read()
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('compression', OTHER_COMPRESSED.keys())
+def test_open_stream(tmp_path, external_bzip2, mode, compression):
+    compressed_stream.use_mode(mode)
+    path = _write(tmp_path, OTHER_COMPRESSED[compression])
+
+    assert _read_compressed(path, compression) == EXPECTED_DATA
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('compression', OTHER_COMPRESSED.keys())
+def test_open_stream_view(tmp_path, external_bzip2, mode, compression):
+    compressed_stream.use_mode(mode)
+    outer_path = str(tmp_path / 'outer')
+    with open(outer_path, 'wb') as f:
+        f.write(b'\xaa' * 1536 + OTHER_COMPRESSED[compression] + b'\xbb' * 1536)
+
+    view = FileView(outer_path, 1536, len(OTHER_COMPRESSED[compression]))
+    assert _read_compressed(outer_path, compression, view) == EXPECTED_DATA
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+@pytest.mark.parametrize('compression', OTHER_COMPRESSED.keys())
+def test_open_stream_corrupt(tmp_path, external_bzip2, mode, compression):
+    compressed_stream.use_mode(mode)
+    path = _write(tmp_path, _corrupt(OTHER_COMPRESSED[compression]))
+
+    # lzma.LZMAError is an Exception, not an OSError
+    with pytest.raises((OSError, EOFError, lzma.LZMAError)):
+        _read_compressed(path, compression)
+
+
+def test_open_stream_xz_multi_threaded(tmp_path, mocker: MockerFixture):
+    compressed_stream.use_mode(compressed_stream.DECOMPRESS_MODE_EXTERNAL)
+    mocker.patch('shutil.which', side_effect=lambda x: f'/usr/bin/{x}')
+    popen_mock = mocker.patch('subprocess.Popen')
+    popen_mock.return_value.stdout.readinto.return_value = 0
+    popen_mock.return_value.stderr.read.return_value = b''
+    popen_mock.return_value.wait.return_value = 0
+
+    with open(_write(tmp_path, OTHER_COMPRESSED[compressed_stream.XZ]), 'rb') as f, \
+            compressed_stream.open_stream(f, compressed_stream.XZ) as stream:
+        stream.read()
+
+    # xz only decompresses on several threads when it's told to
+    assert popen_mock.call_args[0][0] == ['xz', '-d', '-c', '-T0']
+
+
+@pytest.mark.parametrize('mode', compressed_stream.DECOMPRESS_MODES)
+def test_open_stream_zstd_no_zstandard(tmp_path, mocker: MockerFixture, mode):
+    compressed_stream.use_mode(mode)
+    mocker.patch.object(compressed_stream, 'zstandard', None)
+    mocker.patch('shutil.which', side_effect=lambda x: f'/usr/bin/{x}' if x == 'zstd' else None)
+    popen_mock = mocker.patch('subprocess.Popen')
+    popen_mock.return_value.stdout.readinto.return_value = 0
+    popen_mock.return_value.stderr.read.return_value = b''
+    popen_mock.return_value.wait.return_value = 0
+
+    with open(_write(tmp_path, b'some zstd data'), 'rb') as f, \
+            compressed_stream.open_stream(f, compressed_stream.ZSTD) as stream:
+        assert stream.read() == b''
+
+    # Whatever the mode, the zstd tool is all there is to decompress it with
+    assert popen_mock.call_args[0][0] == ['zstd', '-d', '-c']
+
+
+def test_open_stream_zstd_nothing_to_decompress_with(tmp_path, mocker: MockerFixture):
+    mocker.patch.object(compressed_stream, 'zstandard', None)
+    mocker.patch('shutil.which', return_value=None)
+
+    with pytest.raises(FileNotFoundError):
+        _read_compressed(_write(tmp_path, b'some zstd data'), compressed_stream.ZSTD)
+
+
+def test_open_stream_zstd(tmp_path):
+    if shutil.which('zstd') is None:
+        pytest.skip('zstd is not on the PATH')
+    path = _write(tmp_path, EXPECTED_DATA)
+    subprocess.run(['zstd', '-q', '-f', path, '-o', path + '.zst'], check=True)
+
+    # Through the zstandard package if it's installed, through the zstd tool if it isn't
+    assert _read_compressed(path + '.zst', compressed_stream.ZSTD) == EXPECTED_DATA
+
+
+def test_use_mode_unknown():
+    with pytest.raises(ValueError):
+        compressed_stream.use_mode('some_mode')
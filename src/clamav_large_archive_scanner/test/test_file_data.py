@@ -26,6 +26,7 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import stat
 from unittest.mock import MagicMock
 
@@ -85,6 +86,9 @@ def test_get_filetype_from_desc():
     assert _get_filetype('VMware4 disk image') == FileType.VMDK
     assert _get_filetype('gzip compressed data') == FileType.TARGZ
     assert _get_filetype('QEMU QCOW2 Image') == FileType.QCOW2
+    assert _get_filetype('Zstandard compressed data (v0.8+), Dictionary ID: None') == FileType.TARZST
+    assert _get_filetype('XZ compressed data, checksum CRC64') == FileType.TARXZ
+    assert _get_filetype('bzip2 compressed data, block size = 900k') == FileType.TARBZ2
     assert _get_filetype('Strange File Type') == FileType.UNKNOWN
 
 
@@ -202,3 +206,396 @@ def test_file_meta_from_path_does_not_exist(mock_os, mock_magic):
     assert file_meta.desc == 'File does not exist'
 
     _assert_unhandled_file_calls(mock_os, mock_magic, EXPECTED_TEST_PATH)
+
+
+EXPECTED_MIN_FILE_SIZE = 1024
+EXPECTED_LARGE_FILE_SIZE = 4096
+
+
+def _mock_lstat(mock_os, mode: int, size: int = EXPECTED_LARGE_FILE_SIZE):
+    mocked_file_stat = MagicMock()
+    mocked_file_stat.st_mode = mode
+    mocked_file_stat.st_size = size
+    mock_os.lstat.return_value = mocked_file_stat
+
+
+def _mock_header(mock_os, offset: int, signature: bytes):
+    from clamav_large_archive_scanner.lib.file_data import HEADER_READ_SIZE
+
+    header = bytearray(HEADER_READ_SIZE)
+    header[offset:offset + len(signature)] = signature
+    mock_os.pread.return_value = bytes(header)
+
+
+def _assert_sniffed_once(mock_os):
+    from clamav_large_archive_scanner.lib.file_data import HEADER_READ_SIZE
+
+    mock_os.open.assert_called_once_with(EXPECTED_TEST_PATH, mock_os.O_RDONLY)
+    mock_os.pread.assert_called_once_with(mock_os.open.return_value, HEADER_READ_SIZE, 0)
+    mock_os.close.assert_called_once_with(mock_os.open.return_value)
+
+
+def test_classify_file_sniffed_types(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    expected_signatures = [
+        (0, b'\x1f\x8b\x08', FileType.TARGZ),
+        (0, b'KDMV', FileType.VMDK),
+        (0, b'QFI\xfb\x00\x00\x00\x03', FileType.QCOW2),
+        (257, b'ustar\x0000', FileType.TAR),
+        (257, b'ustar  \x00', FileType.TAR),
+        (0x8001, b'CD001', FileType.ISO),
+        (0, b'\x28\xb5\x2f\xfd', FileType.TARZST),
+        (0, b'\xfd7zXZ\x00', FileType.TARXZ),
+        (0, b'BZh91AY&SY', FileType.TARBZ2),
+        (0, b'BZh11AY&SY', FileType.TARBZ2),
+    ]
+
+    for offset, signature, expected_filetype in expected_signatures:
+        mock_os.reset_mock()
+        _mock_lstat(mock_os, stat.S_IFREG)
+        _mock_header(mock_os, offset, signature)
+
+        file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+        assert file_meta.path == EXPECTED_TEST_PATH
+        assert file_meta.size_raw == EXPECTED_LARGE_FILE_SIZE
+        assert file_meta.filetype == expected_filetype
+
+        mock_os.lstat.assert_called_once_with(EXPECTED_TEST_PATH)
+        mock_os.stat.assert_not_called()
+        _assert_sniffed_once(mock_os)
+
+    mock_magic.from_file.assert_not_called()
+
+
+def test_classify_file_below_threshold(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    _mock_lstat(mock_os, stat.S_IFREG, size=EXPECTED_MIN_FILE_SIZE - 1)
+
+    file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.desc == 'Below size threshold, not inspected'
+    assert file_meta.size_raw == EXPECTED_MIN_FILE_SIZE - 1
+    assert file_meta.filetype == FileType.UNKNOWN
+
+    mock_os.open.assert_not_called()
+    mock_magic.from_file.assert_not_called()
+
+
+def test_classify_file_no_signature_falls_back_to_magic(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    _mock_lstat(mock_os, stat.S_IFREG)
+    _mock_header(mock_os, 0, b'')
+    mock_magic.from_file.return_value = 'Some unknown file type'
+
+    file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.desc == 'Some unknown file type'
+    assert file_meta.filetype == FileType.UNKNOWN
+
+    _assert_sniffed_once(mock_os)
+    mock_magic.from_file.assert_called_once_with(EXPECTED_TEST_PATH, mime=False)
+
+
+def test_classify_file_zip_confirmed_by_magic(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    _mock_lstat(mock_os, stat.S_IFREG)
+    _mock_header(mock_os, 0, b'PK\x03\x04')
+
+    # A large JAR is not something we unpack
+    mock_magic.from_file.return_value = 'Java archive data (JAR)'
+    assert classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE).filetype == FileType.UNKNOWN
+
+    mock_magic.from_file.return_value = 'Zip archive data, at least v2.0 to extract'
+    assert classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE).filetype == FileType.ZIP
+
+
+def test_classify_file_does_not_exist(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    mock_os.lstat.side_effect = FileNotFoundError()
+
+    file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.filetype == FileType.DOES_NOT_EXIST
+    assert file_meta.desc == 'File does not exist'
+    mock_os.open.assert_not_called()
+
+
+def test_classify_file_dir(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    _mock_lstat(mock_os, stat.S_IFDIR)
+
+    file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.filetype == FileType.DIR
+    assert file_meta.size_raw == 0
+    mock_os.open.assert_not_called()
+
+
+def test_classify_file_special_file(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    _mock_lstat(mock_os, stat.S_IFIFO)
+
+    file_meta = classify_file(EXPECTED_TEST_PATH, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.filetype == FileType.UNKNOWN
+    assert file_meta.desc == 'Unknown file type'
+    mock_os.open.assert_not_called()
+
+
+def test_classify_file_symlinks(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_file
+
+    # Symlink to a regular file is never read through
+    _mock_lstat(mock_os, stat.S_IFLNK)
+    mock_os.stat.return_value.st_mode = stat.S_IFREG
+    assert classify_file(EXPECTED_TEST_PATH, 0).filetype == FileType.UNKNOWN
+
+    # Symlink to a directory
+    mock_os.stat.return_value.st_mode = stat.S_IFDIR
+    assert classify_file(EXPECTED_TEST_PATH, 0).filetype == FileType.DIR
+
+    # Broken symlink
+    mock_os.stat.side_effect = FileNotFoundError()
+    assert classify_file(EXPECTED_TEST_PATH, 0).filetype == FileType.DOES_NOT_EXIST
+
+    mock_os.open.assert_not_called()
+    mock_magic.from_file.assert_not_called()
+
+
+def _make_dir_entry(mode: int, size: int = EXPECTED_LARGE_FILE_SIZE, is_symlink: bool = False) -> MagicMock:
+    entry = MagicMock()
+    entry.path = EXPECTED_TEST_PATH
+    entry.is_symlink.return_value = is_symlink
+    entry.stat.return_value.st_mode = mode
+    entry.stat.return_value.st_size = size
+
+    return entry
+
+
+def test_classify_entry(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+
+    entry = _make_dir_entry(stat.S_IFREG)
+    _mock_header(mock_os, 257, b'ustar\x0000')
+
+    file_meta = classify_entry(entry, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.path == EXPECTED_TEST_PATH
+    assert file_meta.size_raw == EXPECTED_LARGE_FILE_SIZE
+    assert file_meta.filetype == FileType.TAR
+
+    # The entry's own stat is used, nothing is stat'ed by path
+    entry.stat.assert_called_once_with(follow_symlinks=False)
+    mock_os.lstat.assert_not_called()
+    mock_os.stat.assert_not_called()
+    _assert_sniffed_once(mock_os)
+
+
+def test_classify_entry_below_threshold(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+
+    file_meta = classify_entry(_make_dir_entry(stat.S_IFREG, size=EXPECTED_MIN_FILE_SIZE - 1), EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.desc == 'Below size threshold, not inspected'
+    assert file_meta.size_raw == EXPECTED_MIN_FILE_SIZE - 1
+    assert file_meta.filetype == FileType.UNKNOWN
+    mock_os.open.assert_not_called()
+
+
+def test_classify_entry_special_file(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+
+    file_meta = classify_entry(_make_dir_entry(stat.S_IFIFO), EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.filetype == FileType.UNKNOWN
+    assert file_meta.desc == 'Unknown file type'
+    mock_os.open.assert_not_called()
+
+
+def test_classify_entry_does_not_exist(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+
+    # Deleted between the readdir and the stat
+    entry = _make_dir_entry(stat.S_IFREG)
+    entry.stat.side_effect = FileNotFoundError()
+
+    assert classify_entry(entry, EXPECTED_MIN_FILE_SIZE).filetype == FileType.DOES_NOT_EXIST
+
+
+def test_classify_entry_symlinks(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+
+    # Symlink to a regular file is never read through
+    entry = _make_dir_entry(stat.S_IFREG, is_symlink=True)
+    assert classify_entry(entry, 0).filetype == FileType.UNKNOWN
+    entry.stat.assert_called_once_with()
+
+    # Symlink to a directory
+    entry = _make_dir_entry(stat.S_IFDIR, is_symlink=True)
+    assert classify_entry(entry, 0).filetype == FileType.DIR
+
+    # Broken symlink
+    entry.stat.side_effect = FileNotFoundError()
+    assert classify_entry(entry, 0).filetype == FileType.DOES_NOT_EXIST
+
+    mock_os.open.assert_not_called()
+    mock_magic.from_file.assert_not_called()
+
+
+def test_classify_listed(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_listed
+
+    _mock_header(mock_os, 0, b'KDMV')
+
+    file_meta = classify_listed(EXPECTED_TEST_PATH, stat.S_IFREG, EXPECTED_LARGE_FILE_SIZE, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.path == EXPECTED_TEST_PATH
+    assert file_meta.size_raw == EXPECTED_LARGE_FILE_SIZE
+    assert file_meta.filetype == FileType.VMDK
+
+    # The mode and size came with the listing, nothing is stat'ed
+    mock_os.lstat.assert_not_called()
+    mock_os.stat.assert_not_called()
+    _assert_sniffed_once(mock_os)
+
+
+def test_classify_listed_not_opened(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_listed
+
+    # Below the threshold
+    file_meta = classify_listed(EXPECTED_TEST_PATH, stat.S_IFREG, EXPECTED_MIN_FILE_SIZE - 1, EXPECTED_MIN_FILE_SIZE)
+    assert file_meta.desc == 'Below size threshold, not inspected'
+    assert file_meta.filetype == FileType.UNKNOWN
+
+    # Symlinks are never followed
+    file_meta = classify_listed(EXPECTED_TEST_PATH, stat.S_IFLNK, EXPECTED_LARGE_FILE_SIZE, EXPECTED_MIN_FILE_SIZE)
+    assert file_meta.desc == 'Unknown file type'
+    assert file_meta.filetype == FileType.UNKNOWN
+
+    mock_os.open.assert_not_called()
+    mock_magic.from_file.assert_not_called()
+
+
+def test_classify_listed_does_not_exist(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import classify_listed
+
+    # Gone from the mount, or couldn't be read through it
+    mock_os.open.side_effect = FileNotFoundError()
+
+    file_meta = classify_listed(EXPECTED_TEST_PATH, stat.S_IFREG, EXPECTED_LARGE_FILE_SIZE, EXPECTED_MIN_FILE_SIZE)
+
+    assert file_meta.filetype == FileType.DOES_NOT_EXIST
+
+
+def _make_header(offset: int, signature: bytes) -> bytes:
+    from clamav_large_archive_scanner.lib.file_data import HEADER_READ_SIZE
+
+    header = bytearray(HEADER_READ_SIZE)
+    header[offset:offset + len(signature)] = signature
+    return bytes(header)
+
+
+def test_filetype_from_header_sniffed(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import filetype_from_header
+
+    assert filetype_from_header(_make_header(0, b'\x1f\x8b\x08')) == FileType.TARGZ
+    assert filetype_from_header(_make_header(257, b'ustar\x0000')) == FileType.TAR
+    assert filetype_from_header(_make_header(0x8001, b'CD001')) == FileType.ISO
+    assert filetype_from_header(_make_header(0, b'\xfd7zXZ\x00')) == FileType.TARXZ
+
+    mock_magic.from_buffer.assert_not_called()
+
+
+def test_filetype_from_header_bzip2_needs_block_magic(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import filetype_from_header
+    mock_magic.from_buffer.return_value = 'ASCII text'
+
+    # Plenty of text files start with BZh, only bzip2 has the magic of the first block right after the block size
+    assert filetype_from_header(_make_header(0, b'BZh91AY&SY')) == FileType.TARBZ2
+    mock_magic.from_buffer.assert_not_called()
+
+    assert filetype_from_header(_make_header(0, b'BZhello')) == FileType.UNKNOWN
+    mock_magic.from_buffer.assert_called_once()
+
+
+def test_filetype_from_header_falls_back_to_magic(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import filetype_from_header
+
+    header = b'just some text'
+    mock_magic.from_buffer.return_value = 'ASCII text'
+
+    assert filetype_from_header(header) == FileType.UNKNOWN
+    mock_magic.from_buffer.assert_called_once_with(header, mime=False)
+
+
+def test_filetype_from_header_zip_confirmed_by_magic(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import filetype_from_header
+
+    header = _make_header(0, b'PK\x03\x04')
+
+    mock_magic.from_buffer.return_value = 'Java archive data (JAR)'
+    assert filetype_from_header(header) == FileType.UNKNOWN
+
+    mock_magic.from_buffer.return_value = 'Zip archive data, at least v2.0 to extract'
+    assert filetype_from_header(header) == FileType.ZIP
+
+
+def _mock_source_file(mock_os, data: bytes):
+    mock_os.pread.side_effect = lambda fd, size, offset: data[offset:offset + size]
+
+
+def test_file_view_read(mock_os):
+    from clamav_large_archive_scanner.lib.file_data import FileView
+
+    _mock_source_file(mock_os, b'headerMEMBER DATAtrailer')
+    view = FileView(EXPECTED_TEST_PATH, 6, 11)
+
+    with view.open() as f:
+        assert f.read() == b'MEMBER DATA'
+        # Never reads past the end of the view
+        assert f.read() == b''
+
+        f.seek(7)
+        assert f.read(2) == b'DA'
+        f.seek(-4, io.SEEK_END)
+        assert f.read() == b'DATA'
+
+    mock_os.open.assert_called_once_with(EXPECTED_TEST_PATH, mock_os.O_RDONLY)
+    mock_os.close.assert_called_once_with(mock_os.open.return_value)
+
+
+def test_file_view_sub_view(mock_os):
+    from clamav_large_archive_scanner.lib.file_data import FileView
+
+    _mock_source_file(mock_os, b'outer[inner[data]]')
+    sub_view = FileView(EXPECTED_TEST_PATH, 5, 13).sub_view(7, 4)
+
+    assert sub_view.source_path == EXPECTED_TEST_PATH
+    assert sub_view.offset == 12
+    assert sub_view.length == 4
+    with sub_view.open() as f:
+        assert f.read() == b'data'
+
+
+def test_classify_view(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import FileView, classify_view
+
+    view = FileView(EXPECTED_TEST_PATH, 512, EXPECTED_LARGE_FILE_SIZE)
+    file_meta = classify_view('/tmp/would_be_extracted_to', view, _make_header(0x8001, b'CD001'))
+
+    assert file_meta.path == '/tmp/would_be_extracted_to'
+    assert file_meta.view is view
+    assert file_meta.size_raw == EXPECTED_LARGE_FILE_SIZE
+    assert file_meta.filetype == FileType.ISO
+
+    # Everything it needs was handed to it
+    mock_os.open.assert_not_called()
+    mock_magic.from_buffer.assert_not_called()
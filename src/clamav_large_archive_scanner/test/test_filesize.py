@@ -56,3 +56,12 @@ def test_convert_human_to_machine_bytes_invalid():
         convert_human_to_machine_bytes('1.5ZMb')
 
     assert str(e.value) == '1.5Z is not a valid number'
+
+
+def test_describe_throughput():
+    from clamav_large_archive_scanner.lib.filesize import describe_throughput
+
+    assert describe_throughput(12, 3 * 1024 * 1024 * 1024, 2) == '12 files, 3.0 GiB in 2.0s (1.5 GiB/s)'
+
+    # Too quick to measure
+    assert describe_throughput(0, 0, 0) == '0 files, 0 Bytes in 0.0s (0 Bytes/s)'
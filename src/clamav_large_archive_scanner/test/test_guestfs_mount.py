@@ -0,0 +1,547 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import json
+import os
+import tarfile
+import threading
+from unittest.mock import MagicMock, call
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def mock_guestfs():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture, mock_guestfs):
+    # Before logic
+    # These are re-mocked for every single test
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_mount.guestfs', mock_guestfs)
+
+    yield
+
+
+EXPECTED_IMAGE_PATH = '/tmp/some_image.vmdk'
+EXPECTED_MOUNT_POINT = '/tmp/some_mount_point'
+EXPECTED_FILESYSTEMS = {'/dev/sda1': 'ntfs', '/dev/sda2': 'swap', '/dev/sda3': 'ext4', '/dev/sdb1': 'unknown',
+                        '/dev/vg0/lv0': 'xfs'}
+
+
+def _make_handle(mock_guestfs) -> MagicMock:
+    g = mock_guestfs.GuestFS.return_value
+    g.list_filesystems.return_value = EXPECTED_FILESYSTEMS
+    return g
+
+
+def test_is_available(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.guestfs_mount import is_available
+
+    assert is_available()
+
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_mount.guestfs', None)
+    assert not is_available()
+
+
+def test_open_image(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import open_image
+
+    g = open_image(EXPECTED_IMAGE_PATH)
+
+    assert g == mock_guestfs.GuestFS.return_value
+    mock_guestfs.GuestFS.assert_called_once_with(python_return_dict=True)
+    g.add_drive_opts.assert_called_once_with(EXPECTED_IMAGE_PATH, readonly=1)
+    g.launch.assert_called_once()
+
+
+def test_open_image_format(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import open_image
+
+    g = open_image('/dev/loop7', 'qcow2')
+
+    # A loop device doesn't say what is in it
+    g.add_drive_opts.assert_called_once_with('/dev/loop7', readonly=1, format='qcow2')
+
+
+def test_mount_filesystems(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import mount_filesystems
+    g = _make_handle(mock_guestfs)
+
+    mounted, failed = mount_filesystems(g)
+
+    # Swap and anything libguestfs can't make out are left alone
+    assert mounted == ['/dev/sda1', '/dev/sda3', '/dev/vg0/lv0']
+    assert failed == {}
+    g.mkmountpoint.assert_has_calls([call('/++dev++sda1'), call('/++dev++sda3'), call('/++dev++vg0++lv0')])
+    g.mount_ro.assert_has_calls([call('/dev/sda1', '/++dev++sda1'), call('/dev/sda3', '/++dev++sda3'),
+                                 call('/dev/vg0/lv0', '/++dev++vg0++lv0')])
+    assert g.mount_ro.call_count == 3
+
+
+def test_mount_filesystems_mount_error(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import mount_filesystems
+    g = _make_handle(mock_guestfs)
+
+    def _mount_ro_side_effect(filesystem, mount_point):
+        if filesystem == '/dev/sda3':
+            raise RuntimeError('some_mount_error')
+
+    g.mount_ro.side_effect = _mount_ro_side_effect
+
+    mounted, failed = mount_filesystems(g)
+
+    # One that can't be mounted doesn't stop the rest, and doesn't leave an empty directory behind
+    assert mounted == ['/dev/sda1', '/dev/vg0/lv0']
+    assert failed == {'/dev/sda3': 'some_mount_error'}
+    g.rmmountpoint.assert_called_once_with('/++dev++sda3')
+
+
+def _read_report(ready_read: int) -> dict:
+    with os.fdopen(ready_read) as ready:
+        return json.loads(ready.read())
+
+
+def test_serve(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import _serve
+    g = _make_handle(mock_guestfs)
+    g.mount_local_run.side_effect = lambda: reports.append(_read_report(ready_read))
+
+    reports = []
+    ready_read, ready_write = os.pipe()
+    _serve(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT, None, ready_write)
+
+    # The caller hears about the mount before it starts being served, and the appliance goes away once it is unmounted
+    assert reports == [{'mounted': ['/dev/sda1', '/dev/sda3', '/dev/vg0/lv0'], 'failed': {}, 'listed': False}]
+    g.mount_local.assert_called_once_with(EXPECTED_MOUNT_POINT, readonly=True, options='allow_other')
+    g.shutdown.assert_called_once()
+    g.close.assert_called_once()
+
+
+def test_serve_launch_error(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import _serve
+    g = _make_handle(mock_guestfs)
+    g.launch.side_effect = RuntimeError('some_launch_error')
+
+    ready_read, ready_write = os.pipe()
+    _serve(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT, None, ready_write)
+
+    assert _read_report(ready_read) == {'error': 'some_launch_error'}
+    g.mount_local.assert_not_called()
+    g.mount_local_run.assert_not_called()
+
+
+# Mode and size of everything in the image, keyed by path relative to the root
+EXPECTED_FILES = {
+    '++dev++sda1': (0o40755, 4096),
+    '++dev++sda1/boot.ini': (0o100644, 211),
+    '++dev++sda1/Windows': (0o40755, 4096),
+    '++dev++sda1/Windows/big.vmdk': (0o100644, 10 * 1024 * 1024),
+    '++dev++sda1/Windows/link': (0o120777, 8),
+    '++dev++sda3': (0o40755, 4096),
+    '++dev++sda3/etc': (0o40755, 4096),
+    '++dev++sda3/etc/name with spaces\nand a newline': (0o100600, 12),
+}
+
+
+def _setup_listing(g: MagicMock) -> None:
+    def _find0_side_effect(directory, names_path):
+        assert directory == '/'
+        with open(names_path, 'wb') as names:
+            names.write(b''.join(name.encode() + b'\0' for name in EXPECTED_FILES))
+
+    def _lstatnslist_side_effect(directory, base_names):
+        return [dict(zip(['st_mode', 'st_size'], EXPECTED_FILES[os.path.join(directory, x).lstrip('/')]))
+                for x in base_names]
+
+    g.find0.side_effect = _find0_side_effect
+    g.lstatnslist.side_effect = _lstatnslist_side_effect
+
+
+def _expected_listing() -> list[tuple[str, int, int]]:
+    # Directories are left out
+    return [(os.path.join(EXPECTED_MOUNT_POINT, path), mode, size) for path, (mode, size) in EXPECTED_FILES.items()
+            if mode & 0o170000 != 0o40000]
+
+
+def test_write_and_read_listing(mock_guestfs, tmp_path):
+    from clamav_large_archive_scanner.lib.guestfs_mount import write_listing, read_listing
+    g = _make_handle(mock_guestfs)
+    _setup_listing(g)
+    listing_path = str(tmp_path / 'listing')
+
+    write_listing(g, listing_path)
+
+    assert sorted(read_listing(listing_path, EXPECTED_MOUNT_POINT)) == sorted(_expected_listing())
+    # One lstatnslist per directory, not one stat per file
+    assert g.lstatnslist.call_count == 5
+
+
+def test_write_listing_batches(mocker: MockerFixture, mock_guestfs, tmp_path):
+    from clamav_large_archive_scanner.lib.guestfs_mount import write_listing, read_listing
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_mount.LSTATNS_BATCH_SIZE', 1)
+    g = _make_handle(mock_guestfs)
+    _setup_listing(g)
+    listing_path = str(tmp_path / 'listing')
+
+    write_listing(g, listing_path)
+
+    assert sorted(read_listing(listing_path, EXPECTED_MOUNT_POINT)) == sorted(_expected_listing())
+    assert g.lstatnslist.call_count == len(EXPECTED_FILES)
+
+
+def test_read_listing_small_reads(mocker: MockerFixture, mock_guestfs, tmp_path):
+    from clamav_large_archive_scanner.lib.guestfs_mount import write_listing, read_listing
+    # Fields get split across reads
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_mount.LISTING_READ_SIZE', 3)
+    g = _make_handle(mock_guestfs)
+    _setup_listing(g)
+    listing_path = str(tmp_path / 'listing')
+
+    write_listing(g, listing_path)
+
+    assert sorted(read_listing(listing_path, EXPECTED_MOUNT_POINT)) == sorted(_expected_listing())
+
+
+def test_serve_listing(mock_guestfs, tmp_path):
+    from clamav_large_archive_scanner.lib.guestfs_mount import _serve, read_listing
+    g = _make_handle(mock_guestfs)
+    _setup_listing(g)
+    listing_path = str(tmp_path / 'listing')
+
+    ready_read, ready_write = os.pipe()
+    _serve(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT, listing_path, ready_write)
+
+    assert _read_report(ready_read)['listed']
+    assert sorted(read_listing(listing_path, EXPECTED_MOUNT_POINT)) == sorted(_expected_listing())
+    g.mount_local.assert_called_once_with(EXPECTED_MOUNT_POINT, readonly=True, options='allow_other')
+
+
+def test_serve_listing_error(mock_guestfs, tmp_path):
+    from clamav_large_archive_scanner.lib.guestfs_mount import _serve
+    g = _make_handle(mock_guestfs)
+    g.find0.side_effect = RuntimeError('some_find0_error')
+    listing_path = str(tmp_path / 'listing')
+
+    ready_read, ready_write = os.pipe()
+    _serve(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT, listing_path, ready_write)
+
+    # Still gets mounted, the caller walks it instead
+    assert _read_report(ready_read) == {'mounted': ['/dev/sda1', '/dev/sda3', '/dev/vg0/lv0'], 'failed': {},
+                                        'listed': False}
+    g.mount_local.assert_called_once_with(EXPECTED_MOUNT_POINT, readonly=True, options='allow_other')
+
+
+def _make_tar(files: dict[str, bytes]) -> bytes:
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w') as tar:
+        for name, data in files.items():
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tar.addfile(tar_info, io.BytesIO(data))
+
+    return tar_data.getvalue()
+
+
+def _setup_tar_out(g: MagicMock, tars: dict[str, bytes], error_dir: str = None) -> None:
+    def _tar_out_side_effect(directory, tar_path, numericowner):
+        assert numericowner
+        try:
+            with open(tar_path, 'wb') as f:
+                f.write(tars[directory])
+        except BrokenPipeError as e:
+            # What libguestfs has to say about it
+            raise RuntimeError(str(e))
+
+        if directory == error_dir:
+            raise RuntimeError('some_tar_out_error')
+
+    g.tar_out.side_effect = _tar_out_side_effect
+
+
+def test_tar_out(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import TarOut
+    g = _make_handle(mock_guestfs)
+    _setup_tar_out(g, {'/++dev++sda1': _make_tar({'boot.ini': b'some boot file'}),
+                       '/++dev++sda3': _make_tar({'etc/passwd': b'some passwd file'}),
+                       '/++dev++vg0++lv0': _make_tar({})})
+
+    tar_out = TarOut(EXPECTED_IMAGE_PATH)
+    files = {}
+    for dir_name, stream in tar_out.iter_streams():
+        # Read the same way as archive_members.iter_tar_stream reads it
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for tar_info in tar:
+                files[f'{dir_name}/{tar_info.name}'] = tar.extractfile(tar_info).read()
+    tar_out.close()
+
+    assert files == {'++dev++sda1/boot.ini': b'some boot file', '++dev++sda3/etc/passwd': b'some passwd file'}
+    assert tar_out.failed == {}
+    # Nothing is mounted on this side
+    g.mount_local.assert_not_called()
+    g.shutdown.assert_called_once()
+    g.close.assert_called_once()
+
+
+def test_tar_out_error(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import TarOut
+    g = _make_handle(mock_guestfs)
+    _setup_tar_out(g, {'/++dev++sda1': _make_tar({'boot.ini': b'some boot file'})}, error_dir='/++dev++sda1')
+
+    streams = TarOut(EXPECTED_IMAGE_PATH).iter_streams()
+    _, stream = next(streams)
+    stream.read()
+
+    # Whoever is reading doesn't get the next filesystem as if nothing happened
+    with pytest.raises(RuntimeError) as e:
+        next(streams)
+
+    assert str(e.value) == 'some_tar_out_error'
+
+
+def test_tar_out_reader_stops_early(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import TarOut
+    g = _make_handle(mock_guestfs)
+    # Far more than a pipe holds
+    _setup_tar_out(g, {'/++dev++sda1': _make_tar({'big.bin': b'x' * 1024 * 1024})})
+
+    streams = TarOut(EXPECTED_IMAGE_PATH).iter_streams()
+    _, stream = next(streams)
+    stream.read(512)
+
+    # Doesn't hang waiting for tar_out to finish writing
+    streams.close()
+    g.tar_out.assert_called_once()
+
+
+def test_tar_out_launch_error(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import TarOut
+    g = _make_handle(mock_guestfs)
+    g.list_filesystems.side_effect = RuntimeError('some_list_error')
+
+    with pytest.raises(RuntimeError):
+        TarOut(EXPECTED_IMAGE_PATH)
+
+    g.close.assert_called_once()
+
+
+EXPECTED_APPLIANCE_MEMSIZE = 1024
+
+
+def _make_appliances(mock_guestfs) -> list[MagicMock]:
+    # Every GuestFS() is a new appliance, in the order they were made
+    appliances = []
+
+    def _new_appliance(**kwargs):
+        g = MagicMock()
+        g.get_memsize.return_value = EXPECTED_APPLIANCE_MEMSIZE
+        g.list_filesystems.return_value = EXPECTED_FILESYSTEMS
+        g.ls.return_value = ['++dev++sda1', '++dev++sda3']
+        appliances.append(g)
+        return g
+
+    mock_guestfs.GuestFS.side_effect = _new_appliance
+    return appliances
+
+
+def test_pool_reuses_appliances(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(1)
+
+    g = pool.borrow('/tmp/image_1.vmdk')
+    g.add_drive_opts.assert_called_once_with('/tmp/image_1.vmdk', readonly=1, label='image')
+    g.launch.assert_called_once()
+    pool.give_back(g)
+
+    # Cleared out for the next image, but not shut down
+    g.umount_all.assert_called_once()
+    g.rmmountpoint.assert_has_calls([call('/++dev++sda1'), call('/++dev++sda3')])
+    g.remove_drive.assert_called_once_with('image')
+    g.shutdown.assert_not_called()
+
+    assert pool.borrow('/tmp/image_2.qcow2') == g
+    g.add_drive_opts.assert_called_with('/tmp/image_2.qcow2', readonly=1, label='image')
+    g.launch.assert_called_once()
+    assert len(appliances) == 1
+
+    pool.give_back(g)
+    pool.close()
+    g.shutdown.assert_called_once()
+    g.close.assert_called_once()
+
+
+def test_pool_no_hotplug(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(2)
+
+    pool.give_back(pool.borrow('/tmp/image_1.vmdk'))
+    appliances[0].add_drive_opts.side_effect = RuntimeError('hot-add drive: not supported by this backend')
+
+    # Swapping the image in doesn't work, so a new appliance gets booted for it
+    g = pool.borrow('/tmp/image_2.vmdk')
+    assert g == appliances[1]
+    appliances[0].shutdown.assert_called_once()
+    g.launch.assert_called_once()
+
+    # None are kept around from then on
+    pool.give_back(g)
+    g.shutdown.assert_called_once()
+    g.remove_drive.assert_not_called()
+
+
+def test_pool_size_zero(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(0)
+
+    pool.give_back(pool.borrow('/tmp/image_1.vmdk'))
+    pool.borrow('/tmp/image_2.vmdk')
+
+    assert len(appliances) == 2
+    appliances[0].shutdown.assert_called_once()
+
+
+def test_pool_memory_limit(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(2, memory_limit_mb=2 * EXPECTED_APPLIANCE_MEMSIZE)
+
+    first = pool.borrow('/tmp/image_1.vmdk')
+    pool.borrow('/tmp/image_2.vmdk')
+
+    borrowed = []
+    waiter = threading.Thread(target=lambda: borrowed.append(pool.borrow('/tmp/image_3.vmdk')))
+    waiter.start()
+    waiter.join(0.2)
+
+    # A third one doesn't fit until one is given back
+    assert waiter.is_alive()
+    assert borrowed == []
+
+    first.remove_drive.side_effect = RuntimeError('some_remove_error')
+    pool.give_back(first)
+    waiter.join(5)
+
+    assert not waiter.is_alive()
+    assert borrowed == [appliances[2]]
+    first.shutdown.assert_called_once()
+
+
+def test_pool_memory_limit_shuts_down_idle(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(2, memory_limit_mb=EXPECTED_APPLIANCE_MEMSIZE)
+
+    first = pool.borrow('/tmp/image_1.vmdk')
+    pool.give_back(first)
+    # Not swapped into the idle one, which then has to make room for a new one
+    first.add_drive_opts.side_effect = RuntimeError('some_add_drive_error')
+
+    assert pool.borrow('/tmp/image_2.vmdk') == appliances[1]
+    first.shutdown.assert_called_once()
+
+
+def test_pool_launch_error(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(1, memory_limit_mb=EXPECTED_APPLIANCE_MEMSIZE)
+
+    launch_errors = [RuntimeError('some_launch_error')]
+    original_side_effect = mock_guestfs.GuestFS.side_effect
+
+    def _failing_appliance(**kwargs):
+        g = original_side_effect(**kwargs)
+        if len(launch_errors) > 0:
+            g.launch.side_effect = launch_errors.pop()
+        return g
+
+    mock_guestfs.GuestFS.side_effect = _failing_appliance
+
+    with pytest.raises(RuntimeError):
+        pool.borrow('/tmp/image_1.vmdk')
+
+    appliances[0].close.assert_called_once()
+
+    # The memory it would have taken is free again, so this doesn't wait
+    assert pool.borrow('/tmp/image_2.vmdk') == appliances[1]
+
+
+def test_tar_out_pool(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import TarOut
+    mock_pool = MagicMock()
+    g = mock_pool.borrow.return_value
+    g.list_filesystems.return_value = EXPECTED_FILESYSTEMS
+
+    tar_out = TarOut(EXPECTED_IMAGE_PATH, mock_pool)
+    tar_out.close()
+
+    mock_pool.borrow.assert_called_once_with(EXPECTED_IMAGE_PATH, None)
+    mock_pool.give_back.assert_called_once_with(g)
+    mock_guestfs.GuestFS.assert_not_called()
+    g.shutdown.assert_not_called()
+
+
+def test_main_not_available(mocker: MockerFixture, capsys):
+    from clamav_large_archive_scanner.lib.guestfs_mount import main
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_mount.guestfs', None)
+
+    assert main([EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT]) == 1
+    assert 'error' in json.loads(capsys.readouterr().out)
+
+
+def test_pool_format(mock_guestfs):
+    from clamav_large_archive_scanner.lib.guestfs_mount import AppliancePool
+    appliances = _make_appliances(mock_guestfs)
+    pool = AppliancePool(1)
+
+    pool.give_back(pool.borrow('/dev/loop7', 'vmdk'))
+    appliances[0].add_drive_opts.assert_called_once_with('/dev/loop7', readonly=1, label='image', format='vmdk')
+
+    # Swapped in the same way
+    pool.borrow('/dev/loop8', 'qcow2')
+    appliances[0].add_drive_opts.assert_called_with('/dev/loop8', readonly=1, label='image', format='qcow2')
+
+
+def test_main_usage(capsys):
+    from clamav_large_archive_scanner.lib.guestfs_mount import main
+
+    assert main([EXPECTED_IMAGE_PATH]) == 1
+    assert 'error' in json.loads(capsys.readouterr().out)
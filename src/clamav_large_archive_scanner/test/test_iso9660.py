@@ -0,0 +1,210 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+import iso_images
+from clamav_large_archive_scanner.lib.exceptions import IsoException
+
+EXPECTED_FILES = {
+    'top_level.txt': b'some top level file',
+    'README': b'some file without an extension',
+    'some_dir/nested.txt': b'some nested file',
+    'some_dir/deeper_dir/deepest.txt': b'some deeply nested file',
+    'some_dir/empty.txt': b'',
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _read_files(path: str) -> dict:
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    files = {}
+    with IsoImage(path) as image:
+        for iso_file in image.iter_files():
+            data = image.open_file(iso_file).read()
+            assert iso_file.size == len(data)
+            files[iso_file.name] = data
+
+    return files
+
+
+def test_iter_files(tmp_path):
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, EXPECTED_FILES)
+
+    # Versions and the dot of names without an extension are dropped
+    assert _read_files(iso_path) == EXPECTED_FILES
+
+
+def test_iter_files_rock_ridge(tmp_path):
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, EXPECTED_FILES, symlinks={'some_dir/some_link': 'nested.txt'}, rock_ridge=True)
+
+    # The names are the Rock Ridge ones, not the upper-cased ISO 9660 ones, and the symlink is skipped
+    assert _read_files(iso_path) == EXPECTED_FILES
+
+
+def test_iter_files_joliet(tmp_path):
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, {'Some Long Name With Spaces.txt': b'some data'}, joliet=True)
+
+    assert _read_files(iso_path) == {'Some Long Name With Spaces.txt': b'some data'}
+
+
+def test_iter_files_rock_ridge_over_joliet(tmp_path):
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, EXPECTED_FILES, symlinks={'some_link': 'README'}, rock_ridge=True, joliet=True)
+
+    # Joliet has no idea what a symlink is, only Rock Ridge can tell
+    assert _read_files(iso_path) == EXPECTED_FILES
+
+
+def test_iter_files_multi_extent(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    data = bytes(range(256)) * 40
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, {'big_file.bin': data, 'after.txt': b'some file after'}, max_extent_size=3000)
+
+    with IsoImage(iso_path) as image:
+        iso_files = list(image.iter_files())
+        assert [x.name for x in iso_files] == ['big_file.bin', 'after.txt']
+
+        # Each extent starts on a sector of its own, so they are not back to back in the image
+        big_file = iso_files[0]
+        assert [length for _, length in big_file.extents] == [3000, 3000, 3000, 1240]
+        assert big_file.size == len(data)
+
+        reader = image.open_file(big_file)
+        pieces = []
+        while True:
+            piece = reader.read(1024)
+            if piece == b'':
+                break
+            pieces.append(piece)
+
+        assert b''.join(pieces) == data
+
+
+def test_image_offset(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, EXPECTED_FILES, rock_ridge=True)
+    with open(iso_path, 'rb') as f:
+        iso_data = f.read()
+
+    # The image is stored inside of another file, like a member of a tar
+    outer_path = str(tmp_path / 'outer')
+    with open(outer_path, 'wb') as f:
+        f.write(b'\xaa' * 1536 + iso_data)
+
+    files = {}
+    with IsoImage(outer_path, offset=1536) as image:
+        for iso_file in image.iter_files():
+            files[iso_file.name] = image.open_file(iso_file).read()
+
+    assert files == EXPECTED_FILES
+
+
+def test_open_file_any_order(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    iso_path = str(tmp_path / 'some_image.iso')
+    iso_images.make_iso(iso_path, EXPECTED_FILES)
+
+    with IsoImage(iso_path) as image:
+        iso_files = {x.name: x for x in image.iter_files()}
+
+        # Readers each keep their own place
+        first = image.open_file(iso_files['top_level.txt'])
+        second = image.open_file(iso_files['some_dir/nested.txt'])
+        assert first.read(5) == b'some '
+        assert second.read(5) == b'some '
+        assert second.read() == b'nested file'
+        assert first.read() == b'top level file'
+
+
+def test_not_an_iso(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    not_iso_path = tmp_path / 'not_an_image.iso'
+    not_iso_path.write_bytes(b'\x00' * 20 * 2048)
+
+    with pytest.raises(IsoException):
+        IsoImage(str(not_iso_path))
+
+
+def test_truncated(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    iso_path = tmp_path / 'some_image.iso'
+    iso_images.make_iso(str(iso_path), {'some_file.bin': b'x' * 10000})
+
+    # The directories are written after the file data
+    truncated_path = tmp_path / 'truncated.iso'
+    truncated_path.write_bytes(iso_path.read_bytes()[:(iso_images.FIRST_FREE_SECTOR + 1) * iso_images.SECTOR_SIZE])
+    with pytest.raises(IsoException):
+        IsoImage(str(truncated_path))
+
+    with IsoImage(str(iso_path)) as image:
+        iso_file = next(image.iter_files())
+        os.truncate(iso_path, iso_images.FIRST_FREE_SECTOR * iso_images.SECTOR_SIZE + 100)
+
+        reader = image.open_file(iso_file)
+        assert reader.read(100) == b'x' * 100
+        with pytest.raises(IsoException):
+            reader.read()
+
+
+def test_rock_ridge_continuation(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage, _Record
+
+    iso_path = tmp_path / 'some_image.iso'
+    iso_images.make_iso(str(iso_path), EXPECTED_FILES, rock_ridge=True)
+
+    # The rest of the name is in a continuation area, at the end of the image
+    data = iso_path.read_bytes()
+    continuation = iso_images._susp(b'NM', b'\x00second_half.txt')
+    iso_path.write_bytes(data + continuation)
+
+    system_use = iso_images._susp(b'NM', b'\x01first_half_') + \
+        iso_images._susp(b'CE', iso_images._both32(len(data) // iso_images.SECTOR_SIZE) + iso_images._both32(0) +
+                         iso_images._both32(len(continuation)))
+    record = _Record(iso_images._record(b'FIRST_HA.TXT;1', 0, 0, 0, system_use))
+
+    with IsoImage(str(iso_path)) as image:
+        assert image._read_rock_ridge(record).name == b'first_half_second_half.txt'
@@ -34,6 +34,8 @@ import pytest
 from pytest_mock import MockerFixture
 
 import common
+import clamav_large_archive_scanner.lib.mount_slots as mount_slots
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
 from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
 from clamav_large_archive_scanner.lib.scanner import ScanResult
 
@@ -43,6 +45,7 @@ EXPECTED_MIN_SIZE_BYTES = 100 * 1024 * 1024
 EXPECTED_TMP_DIR = '/tmp'
 EXPECTED_UNPACKED_DIRS = ['/tmp/some_dir_1', '/tmp/some_dir_2', '/tmp/some_dir_3']
 EXPECTED_UNPACKED_DIR = '/tmp/some_dir_4'
+EXPECTED_CLAMD_POOL_SIZE = 4
 
 GOOD_SCAN_RESULT = ScanResult(EXPECTED_PATH, 0)
 VIRUS_SCAN_RESULT = ScanResult(EXPECTED_PATH, 1)
@@ -74,6 +77,26 @@ def mock_scanner():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_pipeliner():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_clamd():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_mount_tools():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_compressed_stream():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function')
 def testcase_file_meta() -> FileMetadata:
     file_meta = FileMetadata()
@@ -84,13 +107,21 @@ def testcase_file_meta() -> FileMetadata:
 
 
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_cleaner, mock_detect, mock_unpacker, mock_scanner):
+def setup_and_teardown(mocker: MockerFixture, mock_cleaner, mock_detect, mock_unpacker, mock_scanner, mock_pipeliner,
+                       mock_clamd, mock_mount_tools, mock_compressed_stream):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.main.cleaner', mock_cleaner)
     mocker.patch('clamav_large_archive_scanner.main.detect', mock_detect)
     mocker.patch('clamav_large_archive_scanner.main.unpacker', mock_unpacker)
     mocker.patch('clamav_large_archive_scanner.main.scanner', mock_scanner)
+    mocker.patch('clamav_large_archive_scanner.main.pipeliner', mock_pipeliner)
+    mocker.patch('clamav_large_archive_scanner.main.clamd', mock_clamd)
+    mocker.patch('clamav_large_archive_scanner.main.mount_tools', mock_mount_tools)
+    mocker.patch('clamav_large_archive_scanner.main.compressed_stream', mock_compressed_stream)
+
+    # Used as a number, so it can't be a mock
+    mock_clamd.DEFAULT_POOL_SIZE = EXPECTED_CLAMD_POOL_SIZE
 
     yield
     # After logic
@@ -121,13 +152,14 @@ def _set_clamdscan_rv(mock_scanner, results: List[ScanResult]):
 
 
 def _assert_unpack_logic(mock_detect, mock_unpacker, expected_path, expected_recursive, expected_min_size_bytes,
-                         expected_tmp_dir, expected_file_meta):
+                         expected_tmp_dir, expected_file_meta, expected_unpack_jobs=1, expected_options=None):
     mock_detect.file_meta_from_path.assert_called_once_with(expected_path)
     if expected_recursive:
         mock_unpacker.unpack_recursive.assert_called_once_with(expected_file_meta, expected_min_size_bytes,
-                                                               expected_tmp_dir)
+                                                               expected_tmp_dir, unpack_jobs=expected_unpack_jobs,
+                                                               listener=None, options=expected_options)
     else:
-        mock_unpacker.unpack.assert_called_once_with(expected_file_meta, expected_tmp_dir)
+        mock_unpacker.unpack.assert_called_once_with(expected_file_meta, expected_tmp_dir, expected_options)
 
 
 def _assert_no_unpack(mock_detect: MagicMock, mock_unpacker: MagicMock):
@@ -164,9 +196,9 @@ def test_scan_happy_path(mock_scanner, mock_cleaner, mock_unpacker, mock_detect,
     assert scan_rv == 0
 
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
-                         testcase_file_meta)
+                         testcase_file_meta, expected_options=mock_unpacker.UnpackOptions.return_value)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False, None, scan_jobs=1)
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
@@ -181,9 +213,9 @@ def test_scan_happy_path_all_match(mock_scanner, mock_cleaner, mock_unpacker, mo
     assert scan_rv == 0
 
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
-                         testcase_file_meta)
+                         testcase_file_meta, expected_options=mock_unpacker.UnpackOptions.return_value)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, True)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, True, None, scan_jobs=1)
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
@@ -198,9 +230,9 @@ def test_scan_virus_fail_fast(mock_scanner, mock_cleaner, mock_unpacker, mock_de
     assert scan_rv == 1
 
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
-                         testcase_file_meta)
+                         testcase_file_meta, expected_options=mock_unpacker.UnpackOptions.return_value)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, True, False)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, True, False, None, scan_jobs=1)
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
@@ -224,20 +256,499 @@ def test_scan_rv_iterations(mock_scanner, mock_cleaner, mock_unpacker, mock_dete
     assert scan_rv == 2
 
 
-def test_scan_error_all_match_and_ff(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+def test_scan_error_all_match_and_ff(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_mount_tools,
+                                     testcase_file_meta):
     from clamav_large_archive_scanner.main import _scan
     _set_clamdscan_present(mock_scanner, True)
+    mock_mount_tools.guestfs_bindings_available.return_value = True
 
     with pytest.raises(click.ClickException) as e:
-        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, True, True, EXPECTED_TMP_DIR)
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, True, True, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'tar-out', 2)
 
     assert e.value.message == 'Cannot specify both --allmatch and --fail-fast'
 
+    # Checked before anything is set up
+    mock_scanner.validate_clamdscan.assert_not_called()
+    mock_mount_tools.make_guestfs_pool.assert_not_called()
     _assert_no_unpack(mock_detect, mock_unpacker)
     _assert_no_scan(mock_scanner)
     _assert_no_cleanup(mock_cleaner)
 
 
+EXPECTED_LISTENER = 'some_listener'
+
+
+def _scan_pipelined_side_effect(unpack_fn, tmp_dir, fail_fast, all_match, client=None, scan_jobs=1, slots=None):
+    # The unpack function is called from the pipeline, with a listener that the pipeline provides
+    unpack_fn(EXPECTED_LISTENER)
+    return [GOOD_SCAN_RESULT, VIRUS_SCAN_RESULT]
+
+
+def test_scan_pipelined(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 4, True)
+    assert scan_rv == 1
+
+    mock_unpacker.unpack_recursive.assert_called_once_with(testcase_file_meta, EXPECTED_MIN_SIZE_BYTES,
+                                                           EXPECTED_TMP_DIR, unpack_jobs=4,
+                                                           listener=EXPECTED_LISTENER,
+                                                           options=mock_unpacker.UnpackOptions.return_value)
+    mock_pipeliner.scan_pipelined.assert_called_once()
+    assert mock_pipeliner.scan_pipelined.call_args[0][1:] == (EXPECTED_TMP_DIR, False, False)
+
+    # The pipeline does the scanning
+    mock_scanner.clamdscan.assert_not_called()
+    mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
+
+
+def test_scan_pipelined_no_unpack(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner,
+                                  testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_detect_file_meta_from_path(mock_detect, testcase_file_meta)
+    mock_pipeliner.scan_pipelined.return_value = []
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, True)
+
+    # Nothing made it through the pipeline, so the file is scanned as is
+    scanner_call_ctxs = mock_scanner.clamdscan.call_args[0][0]
+    assert len(scanner_call_ctxs) == 1
+    assert scanner_call_ctxs[0].unpacked_dir_location == EXPECTED_PATH
+
+
+EXPECTED_CLAMD_CONF = '/etc/some_clamd.conf'
+
+
+def test_scan_native_client(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    client = mock_clamd.client_from_conf.return_value
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native',
+                    EXPECTED_CLAMD_CONF)
+    assert scan_rv == 0
+
+    mock_clamd.client_from_conf.assert_called_once_with(EXPECTED_CLAMD_CONF, pool_size=EXPECTED_CLAMD_POOL_SIZE)
+    mock_scanner.validate_clamd.assert_called_once_with(client)
+    mock_scanner.validate_clamdscan.assert_not_called()
+
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False, client, scan_jobs=1)
+    client.close.assert_called_once()
+
+
+def test_scan_native_client_pipelined(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner,
+                                      mock_clamd, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, True, 'native')
+
+    mock_clamd.client_from_conf.assert_called_once_with(None, pool_size=EXPECTED_CLAMD_POOL_SIZE)
+    assert mock_pipeliner.scan_pipelined.call_args[1] == {'client': mock_clamd.client_from_conf.return_value,
+                                                          'scan_jobs': 1, 'slots': None}
+
+
+def test_scan_jobs(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    client = mock_clamd.client_from_conf.return_value
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native', None, 8)
+
+    # Enough connections for every scan job
+    mock_clamd.client_from_conf.assert_called_once_with(None, pool_size=8)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False, client, scan_jobs=8)
+
+
+def test_scan_jobs_pipelined(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner,
+                             testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, True, 'clamdscan', None, 3)
+
+    assert mock_pipeliner.scan_pipelined.call_args[1] == {'client': None, 'scan_jobs': 3, 'slots': None}
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_stream(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, mock_clamd,
+                     testcase_file_meta, pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+    client = mock_clamd.client_from_conf.return_value
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'native', None, 1, True)
+
+    # The same client does the streaming and the scanning
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=client, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=1)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_walk_threads(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta,
+                           pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'clamdscan', None, 1,
+          False, False, 8)
+
+    # Nothing gets streamed without --stream
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=8,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=1)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_guestfs_tar_out(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, mock_mount_tools,
+                              testcase_file_meta, pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'clamdscan', None, 1,
+          False, False, 1, 'tar-out')
+
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='tar-out', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=1)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+def test_scan_guestfs_tar_out_needs_bindings(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_mount_tools):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    mock_mount_tools.guestfs_bindings_available.return_value = False
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'tar-out')
+
+    assert e.value.message == '--guestfs-mode tar-out needs the libguestfs Python bindings'
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_scanner.clamdscan.assert_not_called()
+
+
+def test_scan_guestfs_pool(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, mock_mount_tools,
+                           testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    pool = mock_mount_tools.make_guestfs_pool.return_value
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+          False, False, 1, 'tar-out', 2, '4G', '/some/cache')
+
+    mock_mount_tools.use_guestfs_cache_dir.assert_called_once_with('/some/cache')
+    mock_mount_tools.make_guestfs_pool.assert_called_once_with(2, 4096)
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='tar-out', guestfs_pool=pool,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=1)
+    pool.close.assert_called_once()
+
+
+def test_scan_guestfs_pool_closed_on_error(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_mount_tools,
+                                           testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    mock_unpacker.unpack_recursive.side_effect = Exception('boom')
+
+    with pytest.raises(Exception):
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'tar-out', 2)
+
+    mock_mount_tools.make_guestfs_pool.return_value.close.assert_called_once()
+
+
+@pytest.mark.parametrize('pool_size, memory_limit', [(2, None), (0, '4G')])
+def test_scan_guestfs_pool_needs_tar_out(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_mount_tools,
+                                         pool_size, memory_limit):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'mount', pool_size, memory_limit)
+
+    assert e.value.message == '--guestfs-pool-size and --guestfs-memory-limit need --guestfs-mode tar-out'
+
+    mock_mount_tools.make_guestfs_pool.assert_not_called()
+    _assert_no_unpack(mock_detect, mock_unpacker)
+
+
+def test_scan_mount_slots(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, True, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 4, 2)
+
+    slots = mock_unpacker.UnpackOptions.call_args[1]['mount_slots']
+    assert slots.limits == {mount_slots.LOOP_SLOT: 4, mount_slots.APPLIANCE_SLOT: 2}
+    # The pipeline is what gives them back
+    assert mock_pipeliner.scan_pipelined.call_args[1]['slots'] is slots
+
+
+@pytest.mark.parametrize('max_loop_mounts, max_guestfs_appliances', [(4, 0), (0, 2)])
+def test_scan_mount_slots_need_pipeline(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, max_loop_mounts,
+                                        max_guestfs_appliances):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'mount', 0, None, None, max_loop_mounts, max_guestfs_appliances)
+
+    assert e.value.message == '--max-loop-mounts and --max-guestfs-appliances need --pipeline'
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_scanner.clamdscan.assert_not_called()
+
+
+def test_check_nothing_given_up():
+    from clamav_large_archive_scanner.main import _check_nothing_given_up
+    slots = mount_slots.MountSlots(loop_limit=1)
+
+    _check_nothing_given_up(None)
+    _check_nothing_given_up(slots)
+
+    slots.give_up(common.make_basic_unpack_ctx('/tmp', 'some_file_path_1'))
+
+    with pytest.raises(click.ClickException) as e:
+        _check_nothing_given_up(slots)
+
+    assert e.value.message == '1 nested archives were left unpacked, they would have gone over --max-loop-mounts or ' \
+                              '--max-guestfs-appliances'
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_iso_read(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta,
+                       pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 0, 0, 'read')
+
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='read', in_place=False,
+                                                        zip_jobs=1)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_in_place(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta,
+                       pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 0, 0, 'mount', True)
+
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=True,
+                                                        zip_jobs=1)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_scan_zip_jobs(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_pipeliner, testcase_file_meta,
+                       pipeline):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_pipeliner.scan_pipelined.side_effect = _scan_pipelined_side_effect
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, pipeline, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 0, 0, 'mount', False, 4)
+
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=4)
+    assert mock_unpacker.unpack_recursive.call_args[1]['options'] == mock_unpacker.UnpackOptions.return_value
+
+
+@pytest.mark.parametrize('decompress_mode', ['python', 'threads', 'external'])
+def test_scan_decompress_mode(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_compressed_stream,
+                              testcase_file_meta, decompress_mode):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_compressed_stream.find_external_tool.return_value = 'pigz'
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 0, 0, 'mount', False, 1, decompress_mode)
+
+    # Picked up by archive_members whenever it opens a compressed tar, it doesn't need any unpack options
+    mock_compressed_stream.use_mode.assert_called_once_with(decompress_mode)
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=None, stream_chunks=False, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None, mount_slots=None,
+                                                        iso_mode='mount', in_place=False, zip_jobs=1)
+
+
+def test_scan_decompress_mode_missing_external_tool(mocker: MockerFixture, mock_scanner, mock_cleaner, mock_unpacker,
+                                                    mock_detect, mock_compressed_stream, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+    mock_compressed_stream.COMPRESSIONS = ['gzip', 'zstd']
+    mock_compressed_stream.EXTERNAL_TOOLS = {'gzip': ['igzip', 'pigz'], 'zstd': ['pzstd', 'zstd']}
+    mock_compressed_stream.find_external_tool.side_effect = lambda x: 'pigz' if x == 'gzip' else None
+    mock_fast_log = mocker.patch('clamav_large_archive_scanner.main.fast_log')
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+          False, False, 1, 'mount', 0, None, None, 0, 0, 'mount', False, 1, 'external')
+
+    # Whatever has no tool is still decompressed, just not by a tool
+    mock_fast_log.warn.assert_any_call('None of pzstd, zstd are on the PATH, zstd is decompressed on a thread instead')
+    assert not any('pigz' in str(x) for x in mock_fast_log.warn.call_args_list)
+    mock_compressed_stream.use_mode.assert_called_once_with('external')
+
+
+def test_scan_guestfs_memory_limit_invalid(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_mount_tools):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+
+    with pytest.raises(click.BadParameter):
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              False, False, 1, 'tar-out', 0, 'lots')
+
+    mock_mount_tools.make_guestfs_pool.assert_not_called()
+
+
+def test_scan_stream_needs_native_client(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'clamdscan', None, 1,
+              True)
+
+    assert e.value.message == '--stream needs --clamd-client native'
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_scanner.clamdscan.assert_not_called()
+
+
+def test_scan_stream_chunks(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native', None, 1, True,
+          True)
+
+    mock_unpacker.UnpackOptions.assert_called_once_with(stream_client=mock_clamd.client_from_conf.return_value,
+                                                        stream_chunks=True, walk_threads=1,
+                                                        guestfs_mode='mount', guestfs_pool=None,
+                                                        mount_slots=None, iso_mode='mount', in_place=False,
+                                                        zip_jobs=1)
+
+
+def test_scan_stream_chunks_needs_stream(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd):
+    from clamav_large_archive_scanner.main import _scan
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native', None, 1,
+              False, True)
+
+    assert e.value.message == '--stream-chunks needs --stream'
+
+    mock_clamd.client_from_conf.assert_not_called()
+    _assert_no_unpack(mock_detect, mock_unpacker)
+
+
+def test_scan_native_client_unreachable(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = False
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native')
+
+    assert e.value.message.startswith('Unable to reach clamd at')
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_scanner.clamdscan.assert_not_called()
+
+
+def test_scan_native_client_bad_conf(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd):
+    from clamav_large_archive_scanner.main import _scan
+    mock_clamd.client_from_conf.side_effect = ClamdException('some_conf_error')
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native')
+
+    assert e.value.message == 'Unable to set up the clamd client: some_conf_error'
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_scanner.validate_clamd.assert_not_called()
+
+
+def test_scan_native_client_closed_on_error(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_clamd,
+                                            testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    mock_unpacker.unpack_recursive.side_effect = Exception('boom')
+
+    with pytest.raises(Exception):
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 1, False, 'native')
+
+    mock_clamd.client_from_conf.return_value.close.assert_called_once()
+
+
 def test_deepscan_no_unpack(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
     from clamav_large_archive_scanner.main import _scan
     _set_clamdscan_present(mock_scanner, True)
@@ -268,3 +779,13 @@ def test_unpack_non_recursive(mock_unpacker, mock_detect, testcase_file_meta):
 
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, False, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
                          testcase_file_meta)
+
+
+def test_unpack_recursive_jobs(mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _unpack
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+
+    _unpack(EXPECTED_PATH, True, EXPECTED_MIN_SIZE, False, EXPECTED_TMP_DIR, 8)
+
+    _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
+                         testcase_file_meta, expected_unpack_jobs=8)
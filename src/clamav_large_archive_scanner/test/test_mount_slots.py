@@ -0,0 +1,194 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import threading
+import time
+
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.mount_slots import MountSlots, LOOP_SLOT, APPLIANCE_SLOT
+
+WAIT_TIMEOUT_SECONDS = 5
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_ctx(name: str, parent_ctx: UnpackContext = None) -> UnpackContext:
+    return UnpackContext(common.make_file_meta(f'/some/path/{name}'), '/tmp', parent_ctx=parent_ctx)
+
+
+def test_try_acquire_limits():
+    slots = MountSlots(loop_limit=1, appliance_limit=2)
+    ctxs = [_make_ctx(f'file_{i}') for i in range(4)]
+
+    assert slots.try_acquire(LOOP_SLOT, ctxs[0])
+    assert not slots.try_acquire(LOOP_SLOT, ctxs[1])
+
+    # Each kind has a limit of its own
+    assert slots.try_acquire(APPLIANCE_SLOT, ctxs[2])
+    assert slots.try_acquire(APPLIANCE_SLOT, ctxs[3])
+    assert not slots.try_acquire(APPLIANCE_SLOT, ctxs[1])
+
+    slots.release(ctxs[0])
+    assert slots.try_acquire(LOOP_SLOT, ctxs[1])
+
+
+def test_try_acquire_no_limit():
+    slots = MountSlots()
+
+    assert all(slots.try_acquire(LOOP_SLOT, _make_ctx(f'file_{i}')) for i in range(100))
+
+
+def test_release_not_holding():
+    slots = MountSlots(loop_limit=1)
+
+    # Contexts that never got a slot, like the ones that aren't mounted, can be released all the same
+    slots.release(_make_ctx('file'))
+
+    assert slots.try_acquire(LOOP_SLOT, _make_ctx('other_file'))
+
+
+def test_wait_stats(mocker: MockerFixture):
+    mock_time = mocker.patch('clamav_large_archive_scanner.lib.mount_slots.time')
+    slots = MountSlots(loop_limit=1)
+    holder_ctx = _make_ctx('holder')
+    waiting_ctx = _make_ctx('waiting')
+    given_up_ctx = _make_ctx('given_up')
+
+    mock_time.monotonic.return_value = 10.0
+    slots.try_acquire(LOOP_SLOT, holder_ctx)
+    slots.try_acquire(LOOP_SLOT, waiting_ctx)
+    slots.try_acquire(LOOP_SLOT, given_up_ctx)
+
+    # Only the first time it is turned away counts
+    mock_time.monotonic.return_value = 11.0
+    slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    slots.release(holder_ctx)
+    mock_time.monotonic.return_value = 13.5
+    assert slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    mock_time.monotonic.return_value = 14.0
+    slots.give_up(given_up_ctx)
+
+    assert slots.wait_count == 2
+    assert slots.wait_seconds == pytest.approx(7.5)
+    assert slots.max_wait_seconds == pytest.approx(4.0)
+    assert slots.given_up_count == 1
+    assert slots.describe_waits() == '2 mounts waited for a slot, 7.5s in total, 4.0s at most, 1 never got one'
+
+
+def test_wait_for_release_not_releasing():
+    slots = MountSlots(loop_limit=1)
+    slots.try_acquire(LOOP_SLOT, _make_ctx('holder'))
+    waiting_ctx = _make_ctx('waiting')
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    # Nothing is going to clean it up before the end
+    assert not slots.wait_for_release([waiting_ctx])
+
+
+def test_wait_for_release_holder_is_parent():
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    holder_ctx = _make_ctx('holder')
+    slots.try_acquire(LOOP_SLOT, holder_ctx)
+
+    # The holder can't be cleaned up until what is nested in it has been unpacked
+    nested_ctx = _make_ctx('nested', parent_ctx=_make_ctx('middle', parent_ctx=holder_ctx))
+    assert not slots.try_acquire(LOOP_SLOT, nested_ctx)
+    assert not slots.wait_for_release([nested_ctx])
+
+
+def test_wait_for_release():
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    holder_ctx = _make_ctx('holder')
+    slots.try_acquire(LOOP_SLOT, holder_ctx)
+
+    waiting_ctx = _make_ctx('waiting')
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    releaser = threading.Timer(0.1, slots.release, [holder_ctx])
+    releaser.start()
+
+    start = time.monotonic()
+    assert slots.wait_for_release([waiting_ctx], WAIT_TIMEOUT_SECONDS)
+    assert time.monotonic() - start < WAIT_TIMEOUT_SECONDS
+    releaser.join()
+
+    assert slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+
+def test_wait_for_release_stops_releasing():
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    slots.try_acquire(LOOP_SLOT, _make_ctx('holder'))
+    waiting_ctx = _make_ctx('waiting')
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    stopper = threading.Timer(0.1, slots.set_releasing, [False])
+    stopper.start()
+
+    # Woken up, and told not to bother the next time
+    assert slots.wait_for_release([waiting_ctx], WAIT_TIMEOUT_SECONDS)
+    stopper.join()
+    assert not slots.wait_for_release([waiting_ctx])
+
+
+def test_wait_for_release_other_kind():
+    slots = MountSlots(loop_limit=1, appliance_limit=1)
+    slots.set_releasing(True)
+    loop_holder_ctx = _make_ctx('loop_holder')
+    slots.try_acquire(LOOP_SLOT, loop_holder_ctx)
+    slots.try_acquire(APPLIANCE_SLOT, _make_ctx('appliance_holder'))
+    nested_ctx = _make_ctx('nested', parent_ctx=loop_holder_ctx)
+    assert not slots.try_acquire(LOOP_SLOT, nested_ctx)
+
+    # The appliance could come back, but that is no use to something waiting for a loop device
+    assert not slots.wait_for_release([nested_ctx])
+
+
+def test_release_failed():
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    holder_ctx = _make_ctx('holder')
+    slots.try_acquire(LOOP_SLOT, holder_ctx)
+    waiting_ctx = _make_ctx('waiting')
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+
+    slots.release(holder_ctx, failed=True)
+
+    # Still mounted, so the slot is still taken, and nothing is going to give it back
+    assert not slots.try_acquire(LOOP_SLOT, waiting_ctx)
+    assert not slots.wait_for_release([waiting_ctx])
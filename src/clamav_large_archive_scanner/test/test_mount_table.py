@@ -0,0 +1,91 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.mount_table import MountEntry, MountTable, read_mount_table
+
+MOUNTINFO = '''\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw,errors=remount-ro
+25 22 0:21 / /tmp rw,nosuid,nodev shared:5 - tmpfs tmpfs rw
+60 25 7:0 / /tmp/clam_unpacker_iso_some\\040file.iso_abc rw,relatime - iso9660 /dev/loop0 ro,nojoliet
+61 25 0:50 / /tmp/clam_unpacker_vmdk_disk.vmdk_def rw,nosuid,nodev,relatime shared:30 master:2 - fuse /dev/fuse rw
+62 61 0:51 / /tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda1 rw - fuse.sshfs host:/ rw
+63 62 0:52 / /tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda1/deeper rw - fuse /dev/fuse rw
+not a mountinfo line
+'''
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def mounts(tmp_path) -> MountTable:
+    mountinfo_path = tmp_path / 'mountinfo'
+    mountinfo_path.write_text(MOUNTINFO)
+    return read_mount_table(str(mountinfo_path))
+
+
+def test_read_mount_table(mounts):
+    entry = mounts.get('/tmp/clam_unpacker_vmdk_disk.vmdk_def')
+    assert (entry.fs_type, entry.source) == ('fuse', '/dev/fuse')
+    assert entry.is_fuse()
+
+    # Optional fields don't get in the way
+    assert mounts.get('/tmp').fs_type == 'tmpfs'
+    assert not mounts.get('/tmp').is_fuse()
+    assert mounts.get('/tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda1').is_fuse()
+
+
+def test_read_mount_table_escapes(mounts):
+    assert mounts.is_mounted('/tmp/clam_unpacker_iso_some file.iso_abc')
+    assert mounts.get('/tmp/clam_unpacker_iso_some file.iso_abc').fs_type == 'iso9660'
+
+
+def test_is_mounted(mounts):
+    assert mounts.is_mounted('/tmp/')
+    assert not mounts.is_mounted('/tmp/clam_unpacker_vmdk_disk.vmdk')
+    assert not mounts.is_mounted('/tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda2')
+
+
+def test_mounts_under(mounts):
+    under = mounts.mounts_under('/tmp/clam_unpacker_vmdk_disk.vmdk_def')
+
+    # Deepest first, so they can be un-mounted in that order
+    assert [x.mount_point for x in under] == ['/tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda1/deeper',
+                                              '/tmp/clam_unpacker_vmdk_disk.vmdk_def/++dev++sda1']
+    assert mounts.mounts_under('/tmp/clam_unpacker_iso_some file.iso_abc') == []
+
+
+def test_over_mounted():
+    mounts = MountTable([MountEntry('/mnt', 'ext4', '/dev/sdb1'), MountEntry('/mnt', 'fuse', '/dev/fuse')])
+
+    # Only the one on top can be seen
+    assert mounts.get('/mnt').fs_type == 'fuse'
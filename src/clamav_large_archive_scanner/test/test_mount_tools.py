@@ -26,6 +26,8 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import json
+import sys
 from unittest.mock import MagicMock
 
 # noinspection PyPackageRequirements
@@ -34,6 +36,7 @@ from pytest_mock import MockerFixture
 
 import common
 from clamav_large_archive_scanner.lib.exceptions import MountException
+from clamav_large_archive_scanner.lib.mount_table import MountEntry, MountTable
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -51,12 +54,18 @@ def mock_subprocess():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_tempfile():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_os, mock_subprocess):
+def setup_and_teardown(mocker: MockerFixture, mock_os, mock_subprocess, mock_tempfile):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.mount_tools.os', mock_os)
     mocker.patch('clamav_large_archive_scanner.lib.mount_tools.subprocess', mock_subprocess)
+    mocker.patch('clamav_large_archive_scanner.lib.mount_tools.tempfile', mock_tempfile)
 
     yield
     # After logic
@@ -70,7 +79,6 @@ GUESTFS_PARTITIONS = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
 GUESTFS_PARTITIONS_STR = '\n'.join(GUESTFS_PARTITIONS)
 EXPECTED_GUESTFS_MOUNT_POINTS = ['++dev++sda1', '++dev++sda2', '++dev++sda3']
 EXPECTED_FUSE_MOUNTS = ['/tmp/some_parent/++dev++sda1', '/tmp/some_parent/++dev++sda2', '/tmp/some_parent/++dev++sda3']
-EXPECTED_FUSE_MOUNTS_STR = '\n'.join(EXPECTED_FUSE_MOUNTS)
 EXPECTED_PARENT_TMP_DIR = '/tmp/some_parent_tmp_dir'
 EXPECTED_ARCHIVE_PATH = '/tmp/some_archive_path.some_archive_format'
 
@@ -97,6 +105,16 @@ def test_enumerate_guestfs_parts(mock_subprocess):
                                                 text=True)
 
 
+def test_enumerate_guestfs_parts_format(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import enumerate_guestfs_partitions
+    mock_subprocess.run.return_value = _make_subprocess_result(GUESTFS_PARTITIONS_STR, '', 0)
+
+    assert enumerate_guestfs_partitions('/dev/loop7', 'vmdk') == GUESTFS_PARTITIONS
+
+    mock_subprocess.run.assert_called_once_with(['virt-filesystems', '--format=vmdk', '-a', '/dev/loop7'],
+                                                capture_output=True, text=True)
+
+
 def test_enumerate_guestfs_parts_error(mock_subprocess):
     mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
@@ -142,6 +160,19 @@ def test_mount_guestfs_partition(mock_subprocess, mock_os):
         capture_output=True)
 
 
+def test_mount_guestfs_partition_format(mock_subprocess, mock_os):
+    from clamav_large_archive_scanner.lib.mount_tools import mount_guestfs_partition
+    _setup_mount_guestfs_partition(mock_os)
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+
+    mount_guestfs_partition('/dev/loop7', GUESTFS_PARTITIONS[0], EXPECTED_PARENT_TMP_DIR, 'qcow2')
+
+    mock_subprocess.run.assert_called_once_with(
+        ['guestmount', '-o', 'allow_other', '--format=qcow2', '-a', '/dev/loop7', '-m', GUESTFS_PARTITIONS[0], '--ro',
+         EXPECTED_MOUNT_POINT],
+        capture_output=True)
+
+
 def test_mount_guestfs_partition_error(mock_subprocess, mock_os):
     _setup_mount_guestfs_partition(mock_os)
 
@@ -159,6 +190,110 @@ def test_mount_guestfs_partition_error(mock_subprocess, mock_os):
     mock_os.rmdir.assert_called_once_with(EXPECTED_MOUNT_POINT)
 
 
+def _call_mount_guestfs_image():
+    from clamav_large_archive_scanner.lib.mount_tools import mount_guestfs_image
+    return mount_guestfs_image(EXPECTED_ARCHIVE_PATH, EXPECTED_PARENT_TMP_DIR)
+
+
+EXPECTED_LISTING_PATH = '/tmp/clam_unpacker_listing_some_suffix'
+EXPECTED_LISTING = [(EXPECTED_PARENT_TMP_DIR + '/++dev++sda1/some_file', 0o100644, 1234)]
+
+
+@pytest.fixture(scope='function')
+def mock_read_listing(mocker: MockerFixture, mock_os, mock_tempfile):
+    mock_tempfile.mkstemp.return_value = (123, EXPECTED_LISTING_PATH)
+    mock_os.path.dirname.return_value = '/tmp'
+    return mocker.patch('clamav_large_archive_scanner.lib.mount_tools.guestfs_mount.read_listing',
+                        return_value=iter(EXPECTED_LISTING))
+
+
+def test_mount_guestfs_image(mock_subprocess, mock_os, mock_tempfile, mock_read_listing):
+    mock_subprocess.run.return_value = _make_subprocess_result(
+        json.dumps({'mounted': GUESTFS_PARTITIONS[:2], 'failed': {GUESTFS_PARTITIONS[2]: 'some_mount_error'},
+                    'listed': True}), '', 0)
+
+    assert _call_mount_guestfs_image() == (GUESTFS_PARTITIONS[:2], {GUESTFS_PARTITIONS[2]: 'some_mount_error'},
+                                           EXPECTED_LISTING)
+
+    # The listing can't go in the mount point, it gets mounted over
+    mock_tempfile.mkstemp.assert_called_once_with(prefix='clam_unpacker_listing_', dir='/tmp')
+    mock_os.path.dirname.assert_called_once_with(EXPECTED_PARENT_TMP_DIR)
+    mock_subprocess.run.assert_called_once_with(
+        [sys.executable, '-m', 'clamav_large_archive_scanner.lib.guestfs_mount', EXPECTED_ARCHIVE_PATH,
+         EXPECTED_PARENT_TMP_DIR, EXPECTED_LISTING_PATH], capture_output=True, text=True)
+    mock_read_listing.assert_called_once_with(EXPECTED_LISTING_PATH, EXPECTED_PARENT_TMP_DIR)
+    mock_os.remove.assert_called_once_with(EXPECTED_LISTING_PATH)
+
+
+def test_mount_guestfs_image_format(mock_subprocess, mock_os, mock_read_listing):
+    from clamav_large_archive_scanner.lib.mount_tools import mount_guestfs_image
+    mock_subprocess.run.return_value = _make_subprocess_result(
+        json.dumps({'mounted': GUESTFS_PARTITIONS, 'failed': {}, 'listed': False}), '', 0)
+
+    mount_guestfs_image('/dev/loop7', EXPECTED_PARENT_TMP_DIR, 'vmdk')
+
+    mock_subprocess.run.assert_called_once_with(
+        [sys.executable, '-m', 'clamav_large_archive_scanner.lib.guestfs_mount', '--format=vmdk', '/dev/loop7',
+         EXPECTED_PARENT_TMP_DIR, EXPECTED_LISTING_PATH], capture_output=True, text=True)
+
+
+def test_mount_guestfs_image_not_listed(mock_subprocess, mock_os, mock_read_listing):
+    mock_subprocess.run.return_value = _make_subprocess_result(
+        json.dumps({'mounted': GUESTFS_PARTITIONS, 'failed': {}, 'listed': False}), '', 0)
+
+    assert _call_mount_guestfs_image() == (GUESTFS_PARTITIONS, {}, None)
+
+    mock_read_listing.assert_not_called()
+    mock_os.remove.assert_called_once_with(EXPECTED_LISTING_PATH)
+
+
+def test_mount_guestfs_image_error(mock_subprocess, mock_os, mock_read_listing):
+    mock_subprocess.run.return_value = _make_subprocess_result(json.dumps({'error': 'some_launch_error'}), '', 1)
+
+    with pytest.raises(MountException) as e:
+        _call_mount_guestfs_image()
+
+    assert str(e.value) == 'some_launch_error'
+    mock_os.remove.assert_called_once_with(EXPECTED_LISTING_PATH)
+
+
+def test_mount_guestfs_image_crashed(mock_subprocess, mock_read_listing):
+    mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
+
+    with pytest.raises(MountException) as e:
+        _call_mount_guestfs_image()
+
+    assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
+
+
+def test_open_guestfs_tar_out(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.mount_tools import open_guestfs_tar_out
+    mock_tar_out = mocker.patch('clamav_large_archive_scanner.lib.mount_tools.guestfs_mount.TarOut')
+
+    assert open_guestfs_tar_out(EXPECTED_ARCHIVE_PATH) == mock_tar_out.return_value
+    mock_tar_out.assert_called_once_with(EXPECTED_ARCHIVE_PATH, None, None)
+
+    mock_pool = MagicMock()
+    open_guestfs_tar_out(EXPECTED_ARCHIVE_PATH, mock_pool, 'vmdk')
+    mock_tar_out.assert_called_with(EXPECTED_ARCHIVE_PATH, mock_pool, 'vmdk')
+
+    mock_tar_out.side_effect = RuntimeError('some_launch_error')
+    with pytest.raises(MountException) as e:
+        open_guestfs_tar_out(EXPECTED_ARCHIVE_PATH)
+
+    assert str(e.value) == 'some_launch_error'
+
+
+def test_use_guestfs_cache_dir(mock_os):
+    from clamav_large_archive_scanner.lib.mount_tools import use_guestfs_cache_dir
+    mock_os.environ = {}
+
+    use_guestfs_cache_dir('/some/cache_dir')
+
+    mock_os.makedirs.assert_called_once_with('/some/cache_dir', exist_ok=True)
+    assert mock_os.environ == {'LIBGUESTFS_CACHEDIR': '/some/cache_dir'}
+
+
 def _mount_iso():
     from clamav_large_archive_scanner.lib.mount_tools import mount_iso
     mount_iso(EXPECTED_ARCHIVE_PATH, EXPECTED_PARENT_TMP_DIR)
@@ -173,6 +308,16 @@ def test_mount_iso(mock_subprocess):
                                                  EXPECTED_PARENT_TMP_DIR], capture_output=True)
 
 
+def test_mount_iso_view(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import mount_iso
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+
+    mount_iso(EXPECTED_ARCHIVE_PATH, EXPECTED_PARENT_TMP_DIR, offset=1536, length=4096)
+
+    mock_subprocess.run.assert_called_once_with(['mount', '-r', '-o', 'loop,offset=1536,sizelimit=4096',
+                                                 EXPECTED_ARCHIVE_PATH, EXPECTED_PARENT_TMP_DIR], capture_output=True)
+
+
 def test_mount_iso_error(mock_subprocess):
     mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
@@ -182,82 +327,106 @@ def test_mount_iso_error(mock_subprocess):
     assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
 
 
-class GuestfsUmountRunSideEffect:
-    def __init__(self, return_good_fuse_mounts: bool, umount_should_succeed: bool):
-        self.return_good_fuse_mounts = return_good_fuse_mounts
-        self.umount_should_succeed = umount_should_succeed
+def test_attach_loop(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import attach_loop
+    mock_subprocess.run.return_value = _make_subprocess_result('/dev/loop7\n', '', 0)
 
-    def __call__(self, *args, **kwargs):
-        if args[0] == ['mount', '-t', 'fuse']:
-            if self.return_good_fuse_mounts:
-                return _make_subprocess_result(EXPECTED_FUSE_MOUNTS_STR, '', 0)
-            else:
-                return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
-        elif args[0][0] == 'guestunmount':
-            if self.umount_should_succeed:
-                return _make_subprocess_result('', '', 0)
-            else:
-                return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
+    assert attach_loop(EXPECTED_ARCHIVE_PATH, 1536, 4096) == '/dev/loop7'
 
-        return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
+    mock_subprocess.run.assert_called_once_with(['losetup', '--find', '--show', '--read-only', '--offset', '1536',
+                                                 '--sizelimit', '4096', EXPECTED_ARCHIVE_PATH],
+                                                capture_output=True, text=True)
 
 
-def _mock_guestfs_umount_run_actions(mock_subprocess, return_good_fuse_mounts: bool, umount_should_succeed: bool):
-    mock_subprocess.run.side_effect = GuestfsUmountRunSideEffect(return_good_fuse_mounts, umount_should_succeed)
+def test_attach_loop_error(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import attach_loop
+    mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
+    with pytest.raises(MountException) as e:
+        attach_loop(EXPECTED_ARCHIVE_PATH, 1536, 4096)
 
-def _assert_check_fuse_mounts_called(mock_subprocess):
-    mock_subprocess.run.assert_any_call(['mount', '-t', 'fuse'], capture_output=True, text=True)
+    assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
 
 
-def _assert_guestunmount_called(mock_subprocess, mount_point):
-    mock_subprocess.run.assert_any_call(['guestunmount', '--no-retry', mount_point], capture_output=True)
+def test_detach_loop(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import detach_loop
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
 
+    detach_loop('/dev/loop7')
 
-def _assert_guestumount_not_called(mock_subprocess):
-    for call in mock_subprocess.run.mock_calls:
-        assert 'guestunmount' not in call.args[0]
+    mock_subprocess.run.assert_called_once_with(['losetup', '--detach', '/dev/loop7'], capture_output=True)
 
 
-def _call_umount_guestfs_partition(directory):
-    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
-    umount_guestfs_partition(directory)
+def _make_mounts(mount_points: list[str], fs_type: str = 'fuse') -> MountTable:
+    return MountTable([MountEntry('/', 'ext4', '/dev/sda1')] +
+                      [MountEntry(x, fs_type, '/dev/fuse') for x in mount_points])
+
+
+def _mock_guestunmount(mock_subprocess, umount_should_succeed: bool):
+    if umount_should_succeed:
+        mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+    else:
+        mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
+
+
+def _assert_guestunmount_called(mock_subprocess, mount_point):
+    mock_subprocess.run.assert_called_once_with(['guestunmount', '--no-retry', mount_point], capture_output=True)
 
 
 def test_umount_guestfs_partition(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, True)
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
+    _mock_guestunmount(mock_subprocess, True)
 
-    _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
+    umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0], _make_mounts(EXPECTED_FUSE_MOUNTS))
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
+    _assert_guestunmount_called(mock_subprocess, EXPECTED_FUSE_MOUNTS[0])
+
+
+def test_umount_guestfs_partition_reads_mount_table(mocker: MockerFixture, mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
+    mock_mount_table = mocker.patch('clamav_large_archive_scanner.lib.mount_tools.mount_table')
+    mock_mount_table.read_mount_table.return_value = _make_mounts(EXPECTED_FUSE_MOUNTS)
+    _mock_guestunmount(mock_subprocess, True)
+
+    umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
+
+    mock_mount_table.read_mount_table.assert_called_once()
     _assert_guestunmount_called(mock_subprocess, EXPECTED_FUSE_MOUNTS[0])
 
 
 def test_umount_guestfs_partition_no_fuse_mount(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, False, True)
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
 
-    _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
+    umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0], _make_mounts([]))
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
-    _assert_guestumount_not_called(mock_subprocess)
+    mock_subprocess.run.assert_not_called()
+
+
+def test_umount_guestfs_partition_not_fuse(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
+
+    umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0], _make_mounts(EXPECTED_FUSE_MOUNTS, 'ext4'))
+
+    mock_subprocess.run.assert_not_called()
 
 
 def test_umount_guestfs_partition_wrong_fuse_mount(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, True)
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
 
-    _call_umount_guestfs_partition('/tmp/some_other_mount')
+    # Mount points that merely start with, or are inside of, the directory don't count
+    umount_guestfs_partition('/tmp/some_parent/++dev++sda', _make_mounts(EXPECTED_FUSE_MOUNTS))
+    umount_guestfs_partition('/tmp/some_parent', _make_mounts(EXPECTED_FUSE_MOUNTS))
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
-    _assert_guestumount_not_called(mock_subprocess)
+    mock_subprocess.run.assert_not_called()
 
 
 def test_umount_guestfs_partition_umount_error(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, False)
+    from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
+    _mock_guestunmount(mock_subprocess, False)
 
     with pytest.raises(MountException) as e:
-        _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
+        umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0], _make_mounts(EXPECTED_FUSE_MOUNTS))
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
     _assert_guestunmount_called(mock_subprocess, EXPECTED_FUSE_MOUNTS[0])
 
     assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
@@ -267,17 +436,25 @@ def test_umount_iso(mock_subprocess):
     from clamav_large_archive_scanner.lib.mount_tools import umount_iso
     mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
 
-    umount_iso(EXPECTED_ARCHIVE_PATH)
+    umount_iso(EXPECTED_ARCHIVE_PATH, _make_mounts([EXPECTED_ARCHIVE_PATH], 'iso9660'))
 
     mock_subprocess.run.assert_called_once_with(['umount', EXPECTED_ARCHIVE_PATH], capture_output=True)
 
 
+def test_umount_iso_not_mounted(mock_subprocess):
+    from clamav_large_archive_scanner.lib.mount_tools import umount_iso
+
+    umount_iso(EXPECTED_ARCHIVE_PATH, _make_mounts([]))
+
+    mock_subprocess.run.assert_not_called()
+
+
 def test_umount_iso_failed(mock_subprocess):
     from clamav_large_archive_scanner.lib.mount_tools import umount_iso
     mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
     with pytest.raises(MountException) as e:
-        umount_iso(EXPECTED_ARCHIVE_PATH)
+        umount_iso(EXPECTED_ARCHIVE_PATH, _make_mounts([EXPECTED_ARCHIVE_PATH], 'iso9660'))
 
     mock_subprocess.run.assert_called_once_with(['umount', EXPECTED_ARCHIVE_PATH], capture_output=True)
 
@@ -0,0 +1,342 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import time
+from unittest.mock import MagicMock, call
+
+import click
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.scanner import ScanResult
+
+# How long a test will wait on the other stage before deciding that something is stuck
+WAIT_TIMEOUT_SECONDS = 5
+
+EXPECTED_CTXS = [
+    common.make_basic_unpack_ctx('some_unpack_path_1', 'some_file_path_1'),
+    common.make_basic_unpack_ctx('some_unpack_path_2', 'some_file_path_2'),
+    common.make_basic_unpack_ctx('some_unpack_path_3', 'some_file_path_3'),
+]
+
+EXPECTED_TMP_DIR = 'some_tmp_dir'
+
+PATH_SCAN_VALUES = {
+    'some_unpack_path_1': 0,
+    'some_unpack_path_2': 1,
+    'some_unpack_path_3': 2,
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def mock_scanner():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_cleaner():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture, mock_scanner, mock_cleaner):
+    # Before logic
+    # These are re-mocked for every single test
+    mocker.patch('clamav_large_archive_scanner.lib.pipeline.scanner', mock_scanner)
+    mocker.patch('clamav_large_archive_scanner.lib.pipeline.cleaner', mock_cleaner)
+    mock_cleaner.IncrementalCleaner.return_value.usage.peak_bytes = 0
+
+    yield
+    # After logic
+    # print('--AFTER--')
+    pass
+
+
+def _clamdscan_side_effect(*args, **kwargs):
+    u_ctx = args[0][0]
+    return [ScanResult(u_ctx.nice_filename(), PATH_SCAN_VALUES[u_ctx.unpacked_dir_location])]
+
+
+class FakeUnpack:
+    # Stands in for unpack_recursive, reporting each context to the listener that the pipeline provides
+    # None of the contexts have anything nested in them
+    def __init__(self, ctxs: list, error: BaseException = None):
+        self.ctxs = ctxs
+        self.error = error
+        self.reported = []
+
+    def __call__(self, listener):
+        for u_ctx in self.ctxs:
+            listener.on_unpacked(u_ctx)
+            listener.on_nested_found(u_ctx, [])
+            self.reported.append(u_ctx)
+
+        if self.error:
+            raise self.error
+
+        return self.ctxs
+
+
+def test_scan_pipelined(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+
+    results = scan_pipelined(FakeUnpack(EXPECTED_CTXS), EXPECTED_TMP_DIR, False, True)
+
+    assert results == [ScanResult('some_file_path_1', 0), ScanResult('some_file_path_2', 1),
+                       ScanResult('some_file_path_3', 2)]
+
+    # Each context is scanned on its own, as soon as it shows up
+    for u_ctx in EXPECTED_CTXS:
+        mock_scanner.clamdscan.assert_any_call([u_ctx], False, True, None)
+    assert mock_scanner.clamdscan.call_count == len(EXPECTED_CTXS)
+
+
+def _make_nested_ctxs() -> tuple:
+    parent_ctx = common.make_basic_unpack_ctx('some_unpack_path_1', 'some_file_path_1')
+    nested_ctxs = [
+        UnpackContext(common.make_file_meta('some_unpack_path_1/nested_1'), EXPECTED_TMP_DIR, parent_ctx=parent_ctx),
+        UnpackContext(common.make_file_meta('some_unpack_path_1/nested_2'), EXPECTED_TMP_DIR, parent_ctx=parent_ctx),
+    ]
+    nested_ctxs[0].unpacked_dir_location = 'some_unpack_path_2'
+    nested_ctxs[1].unpacked_dir_location = 'some_unpack_path_3'
+
+    return parent_ctx, nested_ctxs
+
+
+def test_scan_pipelined_waits_on_nested(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+
+    parent_ctx, nested_ctxs = _make_nested_ctxs()
+    scanned_during_unpack = []
+
+    def _unpack_with_nested(listener):
+        listener.on_unpacked(parent_ctx)
+        listener.on_nested_found(parent_ctx, nested_ctxs)
+
+        listener.on_unpacked(nested_ctxs[0])
+        listener.on_nested_found(nested_ctxs[0], [])
+        # Give the scan stage a chance to get to whatever it has been handed so far
+        time.sleep(0.5)
+        scanned_during_unpack.extend(call[0][0][0] for call in mock_scanner.clamdscan.call_args_list)
+
+        listener.on_unpacked(nested_ctxs[1])
+        listener.on_nested_found(nested_ctxs[1], [])
+
+    results = scan_pipelined(_unpack_with_nested, EXPECTED_TMP_DIR, False, False)
+
+    # The parent isn't scanned until it is known what got unpacked out of it
+    assert scanned_during_unpack == [nested_ctxs[0]]
+    assert len(results) == 3
+    assert mock_scanner.clamdscan.call_args_list[1][0][0] == [parent_ctx]
+
+
+def test_scan_pipelined_cleans_up_incrementally(mock_scanner, mock_cleaner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+    incremental_cleaner = mock_cleaner.IncrementalCleaner.return_value
+
+    parent_ctx, nested_ctxs = _make_nested_ctxs()
+
+    def _unpack_with_nested(listener):
+        listener.on_unpacked(parent_ctx)
+        listener.on_nested_found(parent_ctx, nested_ctxs)
+        listener.on_unpacked(nested_ctxs[0])
+        listener.on_nested_found(nested_ctxs[0], [])
+        listener.on_unpack_failed(nested_ctxs[1])
+
+    scan_pipelined(_unpack_with_nested, EXPECTED_TMP_DIR, False, False)
+
+    mock_cleaner.IncrementalCleaner.assert_called_once_with(EXPECTED_TMP_DIR, None)
+    incremental_cleaner.unpacked.assert_any_call(parent_ctx)
+    incremental_cleaner.unpacked.assert_any_call(nested_ctxs[0])
+    incremental_cleaner.nested_found.assert_any_call(parent_ctx, nested_ctxs)
+    incremental_cleaner.unpack_failed.assert_called_once_with(nested_ctxs[1])
+
+    # Everything that was scanned is handed back, so it can be cleaned up
+    incremental_cleaner.scanned.assert_any_call(parent_ctx)
+    incremental_cleaner.scanned.assert_any_call(nested_ctxs[0])
+    assert incremental_cleaner.scanned.call_count == 2
+
+    incremental_cleaner.usage.sample.assert_called()
+
+
+def test_scan_pipelined_mount_slots(mock_scanner, mock_cleaner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+
+    slots = MagicMock()
+    releasing_during_unpack = []
+
+    def _unpack(listener):
+        releasing_during_unpack.extend(slots.set_releasing.call_args_list)
+        return FakeUnpack(EXPECTED_CTXS)(listener)
+
+    scan_pipelined(_unpack, EXPECTED_TMP_DIR, False, False, slots=slots)
+
+    mock_cleaner.IncrementalCleaner.assert_called_once_with(EXPECTED_TMP_DIR, slots)
+    # Anything waiting on a slot can count on one while the pipeline runs, and not after
+    assert releasing_during_unpack == [call(True)]
+    assert slots.set_releasing.call_args_list == [call(True), call(False)]
+
+
+def test_scan_pipelined_nothing_unpacked(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+
+    assert scan_pipelined(FakeUnpack([]), EXPECTED_TMP_DIR, False, False) == []
+    mock_scanner.clamdscan.assert_not_called()
+
+
+def test_scan_pipelined_scans_while_unpacking(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+
+    first_ctx_scanned = threading.Event()
+
+    def _clamdscan_signal_side_effect(*args, **kwargs):
+        if args[0][0] is EXPECTED_CTXS[0]:
+            first_ctx_scanned.set()
+        return _clamdscan_side_effect(*args, **kwargs)
+
+    def _slow_unpack(listener):
+        listener.on_unpacked(EXPECTED_CTXS[0])
+        listener.on_nested_found(EXPECTED_CTXS[0], [])
+        # The rest of the unpack can't finish until the first context has been scanned
+        assert first_ctx_scanned.wait(WAIT_TIMEOUT_SECONDS)
+        listener.on_unpacked(EXPECTED_CTXS[1])
+        listener.on_nested_found(EXPECTED_CTXS[1], [])
+
+    mock_scanner.clamdscan.side_effect = _clamdscan_signal_side_effect
+
+    results = scan_pipelined(_slow_unpack, EXPECTED_TMP_DIR, False, False)
+
+    assert len(results) == 2
+
+
+def test_scan_pipelined_queue_is_bounded(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+
+    scanner_release = threading.Event()
+
+    def _clamdscan_blocked_side_effect(*args, **kwargs):
+        scanner_release.wait(WAIT_TIMEOUT_SECONDS)
+        return _clamdscan_side_effect(*args, **kwargs)
+
+    mock_scanner.clamdscan.side_effect = _clamdscan_blocked_side_effect
+    fake_unpack = FakeUnpack(EXPECTED_CTXS)
+
+    pipeline_thread = threading.Thread(target=scan_pipelined, args=(fake_unpack, EXPECTED_TMP_DIR, False, False, 1))
+    pipeline_thread.start()
+
+    # One context is being scanned, one is waiting in the queue, the last one can't be handed over yet
+    time.sleep(0.5)
+    assert len(fake_unpack.reported) == 2
+
+    scanner_release.set()
+    pipeline_thread.join(WAIT_TIMEOUT_SECONDS)
+    assert len(fake_unpack.reported) == 3
+
+
+def test_scan_pipelined_fail_fast(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+
+    # Keep handing over contexts, to make sure that the unpack is told to stop
+    fake_unpack = FakeUnpack(EXPECTED_CTXS * 10)
+
+    results = scan_pipelined(fake_unpack, EXPECTED_TMP_DIR, True, False, 1)
+
+    assert results == [ScanResult('some_file_path_1', 0), ScanResult('some_file_path_2', 1)]
+    assert mock_scanner.clamdscan.call_count == 2
+    assert len(fake_unpack.reported) < len(fake_unpack.ctxs)
+
+
+def test_scan_pipelined_unpack_error(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+    mock_scanner.clamdscan.side_effect = _clamdscan_side_effect
+
+    with pytest.raises(click.FileError) as e:
+        scan_pipelined(FakeUnpack(EXPECTED_CTXS[:1], click.FileError('some_file', 'some_unpack_error')),
+                       EXPECTED_TMP_DIR, False, False)
+
+    assert str(e.value) == 'some_unpack_error'
+
+
+def test_scan_pipelined_scan_jobs(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+
+    # Every context has to be scanning at the same time for any of them to finish
+    all_started = threading.Barrier(len(EXPECTED_CTXS), timeout=WAIT_TIMEOUT_SECONDS)
+
+    def _concurrent_side_effect(*args, **kwargs):
+        all_started.wait()
+        return _clamdscan_side_effect(*args, **kwargs)
+
+    mock_scanner.clamdscan.side_effect = _concurrent_side_effect
+
+    results = scan_pipelined(FakeUnpack(EXPECTED_CTXS), EXPECTED_TMP_DIR, False, False,
+                             scan_jobs=len(EXPECTED_CTXS))
+
+    # Still in the order they were unpacked
+    assert results == [ScanResult('some_file_path_1', 0), ScanResult('some_file_path_2', 1),
+                       ScanResult('some_file_path_3', 2)]
+
+
+def test_scan_pipelined_scan_jobs_fail_fast(mock_scanner):
+    from clamav_large_archive_scanner.lib.pipeline import scan_pipelined
+
+    second_ctx_scanned = threading.Event()
+
+    def _out_of_order_side_effect(*args, **kwargs):
+        u_ctx = args[0][0]
+        if u_ctx is EXPECTED_CTXS[0]:
+            # Still scanning when the failure shows up
+            assert second_ctx_scanned.wait(WAIT_TIMEOUT_SECONDS)
+
+        results = _clamdscan_side_effect(*args, **kwargs)
+        if u_ctx is EXPECTED_CTXS[1]:
+            second_ctx_scanned.set()
+        return results
+
+    mock_scanner.clamdscan.side_effect = _out_of_order_side_effect
+    fake_unpack = FakeUnpack(EXPECTED_CTXS * 10)
+
+    results = scan_pipelined(fake_unpack, EXPECTED_TMP_DIR, True, False, 1, scan_jobs=2)
+
+    # Same as a serial scan, the first context is waited on, and nothing after the failure is kept
+    assert results == [ScanResult('some_file_path_1', 0), ScanResult('some_file_path_2', 1)]
+    assert len(fake_unpack.reported) < len(fake_unpack.ctxs)
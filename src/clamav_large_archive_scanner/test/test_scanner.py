@@ -27,6 +27,9 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import subprocess
+import threading
+import time
+from typing import Optional
 from unittest.mock import MagicMock
 
 # noinspection PyPackageRequirements
@@ -34,7 +37,9 @@ import pytest
 from pytest_mock import MockerFixture
 
 import common
+from clamav_large_archive_scanner.lib.clamd import Abort, ClamdReply
 from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
 from clamav_large_archive_scanner.lib.scanner import ScanResult
 
 
@@ -48,11 +53,17 @@ def mock_subprocess():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_shutil():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_subprocess):
+def setup_and_teardown(mocker: MockerFixture, mock_subprocess, mock_shutil):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.scanner.subprocess', mock_subprocess)
+    mocker.patch('clamav_large_archive_scanner.lib.scanner.shutil', mock_shutil)
 
     # Make devnull correct
     mock_subprocess.DEVNULL = subprocess.DEVNULL
@@ -71,9 +82,10 @@ def _make_subprocess_result(stdout: str, stderr: str, returncode: int):
     return result
 
 
-def _assert_which_clamdscan_called(mock_subprocess):
-    mock_subprocess.run.assert_called_once_with(['which', 'clamdscan'], stdout=subprocess.DEVNULL,
-                                                stderr=subprocess.DEVNULL)
+def _assert_which_clamdscan_called(mock_shutil, mock_subprocess):
+    mock_shutil.which.assert_called_once_with('clamdscan')
+    # Looking it up shouldn't need a process of its own
+    mock_subprocess.run.assert_not_called()
 
 
 def _assert_run_clamdscan_called(mock_subprocess, u_ctx: UnpackContext, all_match: bool):
@@ -85,20 +97,31 @@ def _assert_run_clamdscan_called(mock_subprocess, u_ctx: UnpackContext, all_matc
     mock_subprocess.run.assert_any_call(expected_args, capture_output=True, text=True)
 
 
-def test_validate_clamd_present(mock_subprocess):
+def test_validate_clamd_present(mock_subprocess, mock_shutil):
     from clamav_large_archive_scanner.lib.scanner import validate_clamdscan
-    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+    mock_shutil.which.return_value = '/usr/bin/clamdscan'
 
     assert validate_clamdscan()
-    _assert_which_clamdscan_called(mock_subprocess)
+    _assert_which_clamdscan_called(mock_shutil, mock_subprocess)
 
 
-def test_validate_clamd_not_present(mock_subprocess):
+def test_validate_clamd_not_present(mock_subprocess, mock_shutil):
     from clamav_large_archive_scanner.lib.scanner import validate_clamdscan
-    mock_subprocess.run.return_value = _make_subprocess_result('', '', 1)
+    mock_shutil.which.return_value = None
 
     assert not validate_clamdscan()
-    _assert_which_clamdscan_called(mock_subprocess)
+    _assert_which_clamdscan_called(mock_shutil, mock_subprocess)
+
+
+def test_validate_native_clamd():
+    from clamav_large_archive_scanner.lib.scanner import validate_clamd
+    client = MagicMock()
+
+    client.ping.return_value = True
+    assert validate_clamd(client)
+
+    client.ping.return_value = False
+    assert not validate_clamd(client)
 
 
 EXPECTED_CTXS = [
@@ -181,6 +204,359 @@ def test_clamdsan_virus_and_errors(mock_subprocess):
     assert results == EXPECTED_SCAN_RESULTS
 
 
+def _clamd_reply_side_effect(path: str, abort: Optional[Abort] = None) -> ClamdReply:
+    if PATH_SCAN_VALUES[path] == 0:
+        return ClamdReply([f'{path}: OK'])
+    elif PATH_SCAN_VALUES[path] == 1:
+        return ClamdReply([f'{path}/some_file: Eicar-Test-Signature FOUND'])
+    else:
+        return ClamdReply([f'{path}/some_file: Access denied. ERROR'])
+
+
+def test_clamdscan_native_client(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    client = MagicMock()
+    client.multiscan.side_effect = _clamd_reply_side_effect
+
+    results = clamdscan(EXPECTED_CTXS, False, False, client)
+
+    assert results == EXPECTED_SCAN_RESULTS
+    for ctx in EXPECTED_CTXS:
+        client.multiscan.assert_any_call(ctx.unpacked_dir_location, None)
+    client.allmatchscan.assert_not_called()
+    mock_subprocess.run.assert_not_called()
+
+
+def test_clamdscan_native_client_all_match():
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    client = MagicMock()
+    client.allmatchscan.side_effect = _clamd_reply_side_effect
+
+    assert clamdscan(EXPECTED_CTXS, False, True, client) == EXPECTED_SCAN_RESULTS
+    client.multiscan.assert_not_called()
+
+
+def test_clamdscan_native_client_fail_fast():
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    client = MagicMock()
+    client.multiscan.side_effect = _clamd_reply_side_effect
+
+    assert clamdscan(EXPECTED_CTXS, True, False, client) == EXPECTED_SCAN_RESULTS[:2]
+    assert client.multiscan.call_count == 2
+
+
+def test_clamdscan_native_client_connection_error():
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    client = MagicMock()
+    client.multiscan.side_effect = ClamdException('some_connection_error')
+
+    # Same as clamdscan not being able to reach clamd
+    results = clamdscan(EXPECTED_CTXS[:1], False, False, client)
+    assert results == [ScanResult('some_file_path_1', 2)]
+
+
+@pytest.mark.parametrize('scan_rv,streamed_rvs,expected_rv', [
+    (0, [1], 1),
+    (0, [2], 2),
+    (2, [1], 1),
+    (1, [2], 1),
+    (0, [2, 1], 1),
+])
+def test_clamdscan_streamed_results(scan_rv, streamed_rvs, expected_rv):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    client = MagicMock()
+    client.multiscan.side_effect = _clamd_reply_side_effect
+
+    # A copy, so that the shared contexts don't pick up the streamed results
+    template_ctx = EXPECTED_CTXS[scan_rv]
+    u_ctx = common.make_basic_unpack_ctx(template_ctx.unpacked_dir_location, template_ctx.file_meta.path)
+    u_ctx.streamed_results = [(rv, f'{u_ctx.unpacked_dir_location}/streamed_{rv}: something') for rv in streamed_rvs]
+
+    assert clamdscan([u_ctx], False, False, client) == [ScanResult(u_ctx.file_meta.path, expected_rv)]
+
+
+def test_clamdscan_streamed_results_reported(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_fast_log = mocker.patch('clamav_large_archive_scanner.lib.scanner.fast_log')
+    client = MagicMock()
+    client.multiscan.return_value = ClamdReply(['some_unpack_path_1: OK'])
+
+    u_ctx = common.make_basic_unpack_ctx('some_unpack_path_1', 'some_file_path_1')
+    u_ctx.streamed_results = [(1, 'some_unpack_path_1/some_member: Eicar-Test-Signature FOUND')]
+
+    clamdscan([u_ctx], False, False, client)
+
+    # The tmp dir is swapped out for the archive name, same as for files clamd read off of the disk
+    mock_fast_log.info.assert_any_call('some_file_path_1: OK\nsome_file_path_1/some_member: Eicar-Test-Signature FOUND')
+
+
+def _make_covered_ctx(tmp_path) -> UnpackContext:
+    # unpack_dir
+    #     |- covered.tar (unpacked on its own)
+    #     |- some_file
+    #     |- clean_dir/...
+    #     |- nested_dir
+    #         |- covered.zip (unpacked on its own)
+    #         |- other_file
+    unpack_dir = tmp_path / 'unpack_dir'
+    (unpack_dir / 'clean_dir' / 'deeper').mkdir(parents=True)
+    (unpack_dir / 'nested_dir').mkdir()
+    for path in ['covered.tar', 'some_file', 'clean_dir/deeper/deep_file', 'nested_dir/covered.zip',
+                 'nested_dir/other_file']:
+        (unpack_dir / path).write_text('some data')
+
+    u_ctx = common.make_basic_unpack_ctx(str(unpack_dir), 'some_file_path_1')
+    u_ctx.covered_paths = {str(unpack_dir / 'covered.tar'), str(unpack_dir / 'nested_dir' / 'covered.zip')}
+
+    return u_ctx
+
+
+def _expected_covered_scan_paths(u_ctx: UnpackContext) -> set:
+    # Directories without anything covered in them are scanned whole
+    return {f'{u_ctx.unpacked_dir_location}/{path}' for path in ['some_file', 'clean_dir', 'nested_dir/other_file']}
+
+
+def test_clamdscan_covered_paths(mock_subprocess, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    u_ctx = _make_covered_ctx(tmp_path)
+
+    file_lists = []
+
+    def _read_file_list(args, **kwargs):
+        file_list_arg = args[-1]
+        assert file_list_arg.startswith('--file-list=')
+        with open(file_list_arg[len('--file-list='):]) as f:
+            file_lists.append(f.read().splitlines())
+        return _make_subprocess_result('', '', 0)
+
+    mock_subprocess.run.side_effect = _read_file_list
+
+    assert clamdscan([u_ctx], False, True) == [ScanResult('some_file_path_1', 0)]
+
+    mock_subprocess.run.assert_called_once()
+    assert mock_subprocess.run.call_args[0][0][:4] == ['clamdscan', '-m', '--stdout', '--allmatch']
+    assert len(file_lists) == 1
+    assert set(file_lists[0]) == _expected_covered_scan_paths(u_ctx)
+    assert len(file_lists[0]) == 3
+
+
+def test_clamdscan_covered_paths_native(tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    u_ctx = _make_covered_ctx(tmp_path)
+
+    client = MagicMock()
+    client.multiscan.side_effect = lambda path, abort: ClamdReply(
+        [f'{path}: Eicar-Test-Signature FOUND' if path.endswith('other_file') else f'{path}: OK'])
+
+    assert clamdscan([u_ctx], False, False, client) == [ScanResult('some_file_path_1', 1)]
+
+    assert {call[0][0] for call in client.multiscan.call_args_list} == _expected_covered_scan_paths(u_ctx)
+    assert client.multiscan.call_count == 3
+
+
+def test_clamdscan_everything_covered(mock_subprocess, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    (tmp_path / 'covered.tar').write_text('some data')
+    u_ctx = common.make_basic_unpack_ctx(str(tmp_path), 'some_file_path_1')
+    u_ctx.covered_paths = {str(tmp_path / 'covered.tar')}
+
+    # Nothing left for clam to look at
+    assert clamdscan([u_ctx], False, False) == [ScanResult('some_file_path_1', 0)]
+    mock_subprocess.run.assert_not_called()
+
+
+def _make_inventoried_ctx(tmp_path) -> UnpackContext:
+    u_ctx = _make_covered_ctx(tmp_path)
+    # Same files as on disk, minus the one in clean_dir, to tell whether the directory was walked again
+    u_ctx.inventory = [common.make_file_meta(f'{u_ctx.unpacked_dir_location}/{path}') for path in
+                       ['covered.tar', 'some_file', 'nested_dir/covered.zip', 'nested_dir/other_file']]
+
+    return u_ctx
+
+
+def _expected_inventoried_scan_paths(u_ctx: UnpackContext) -> list:
+    return [f'{u_ctx.unpacked_dir_location}/{path}' for path in ['some_file', 'nested_dir/other_file']]
+
+
+def test_clamdscan_inventory(mock_subprocess, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    u_ctx = _make_inventoried_ctx(tmp_path)
+
+    file_lists = []
+
+    def _read_file_list(args, **kwargs):
+        with open(args[-1][len('--file-list='):]) as f:
+            file_lists.append(f.read().splitlines())
+        return _make_subprocess_result('', '', 0)
+
+    mock_subprocess.run.side_effect = _read_file_list
+
+    assert clamdscan([u_ctx], False, False) == [ScanResult('some_file_path_1', 0)]
+
+    # Exactly what was found while unpacking, without what was unpacked on its own
+    assert file_lists == [_expected_inventoried_scan_paths(u_ctx)]
+
+
+def test_clamdscan_inventory_native(tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    u_ctx = _make_inventoried_ctx(tmp_path)
+
+    client = MagicMock()
+    client.scan_files.side_effect = lambda paths, abort: ClamdReply([f'{path}: OK' for path in paths])
+
+    assert clamdscan([u_ctx], False, False, client) == [ScanResult('some_file_path_1', 0)]
+
+    # All of it down one session, instead of a connection for every file
+    client.scan_files.assert_called_once_with(_expected_inventoried_scan_paths(u_ctx), None)
+    client.multiscan.assert_not_called()
+
+
+def test_clamdscan_inventory_native_all_match(tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    u_ctx = _make_inventoried_ctx(tmp_path)
+
+    client = MagicMock()
+    client.allmatchscan.side_effect = lambda path, abort: ClamdReply([f'{path}: OK'])
+
+    assert clamdscan([u_ctx], False, True, client) == [ScanResult('some_file_path_1', 0)]
+
+    # clamd won't take ALLMATCHSCAN in a session
+    assert [call[0][0] for call in client.allmatchscan.call_args_list] == _expected_inventoried_scan_paths(u_ctx)
+    client.scan_files.assert_not_called()
+
+
+def test_clamdscan_empty_inventory(mock_subprocess, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    u_ctx = common.make_basic_unpack_ctx(str(tmp_path), 'some_file_path_1')
+    u_ctx.inventory = []
+
+    assert clamdscan([u_ctx], False, False) == [ScanResult('some_file_path_1', 0)]
+    mock_subprocess.run.assert_not_called()
+
+
+# How long a test will wait on the other scans before deciding that something is stuck
+WAIT_TIMEOUT_SECONDS = 5
+
+
+def test_clamdscan_scan_jobs(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    # Every scan has to be running at the same time for any of them to finish
+    all_started = threading.Barrier(len(EXPECTED_CTXS), timeout=WAIT_TIMEOUT_SECONDS)
+
+    def _concurrent_side_effect(*args, **kwargs):
+        all_started.wait()
+        return _clamdscan_side_effect(*args, **kwargs)
+
+    mock_subprocess.run.side_effect = _concurrent_side_effect
+
+    # Comes back in the same order as it went in
+    assert clamdscan(EXPECTED_CTXS, False, False, scan_jobs=len(EXPECTED_CTXS)) == EXPECTED_SCAN_RESULTS
+
+
+def _make_clamdscan_process(returncode: int, runs_until: threading.Event) -> MagicMock:
+    # Stands in for a clamdscan that keeps running until runs_until is set, which killing it does
+    process = MagicMock()
+    process.__enter__.return_value = process
+    process.returncode = returncode
+
+    def _communicate():
+        assert runs_until.wait(WAIT_TIMEOUT_SECONDS)
+        return '', ''
+
+    process.communicate.side_effect = _communicate
+    process.kill.side_effect = runs_until.set
+    return process
+
+
+def test_clamdscan_scan_jobs_fail_fast(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    second_scan_started = threading.Event()
+    processes = {
+        # Fails once the second one is running
+        'some_unpack_path_1': _make_clamdscan_process(1, second_scan_started),
+        # Never finishes on its own
+        'some_unpack_path_2': _make_clamdscan_process(0, threading.Event()),
+    }
+
+    def _popen_side_effect(args, **kwargs):
+        if args[-1] == 'some_unpack_path_2':
+            second_scan_started.set()
+        return processes[args[-1]]
+
+    mock_subprocess.Popen.side_effect = _popen_side_effect
+
+    started = time.monotonic()
+    results = clamdscan(EXPECTED_CTXS, True, False, scan_jobs=2)
+
+    # Same as a serial scan, nothing after the first failure
+    assert results == [ScanResult('some_file_path_1', 1)]
+
+    # The second one was killed, rather than waited on, and the third one never started
+    processes['some_unpack_path_2'].kill.assert_called_once_with()
+    assert time.monotonic() - started < WAIT_TIMEOUT_SECONDS
+    processes['some_unpack_path_1'].kill.assert_not_called()
+    assert mock_subprocess.Popen.call_count == 2
+    mock_subprocess.run.assert_not_called()
+
+
+def test_clamdscan_scan_jobs_fail_fast_native(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    second_scan_started = threading.Event()
+    second_scan_aborted = threading.Event()
+
+    def _multiscan_side_effect(path: str, abort: Abort) -> ClamdReply:
+        if path == 'some_unpack_path_1':
+            assert second_scan_started.wait(WAIT_TIMEOUT_SECONDS)
+            return _clamd_reply_side_effect('some_unpack_path_2')
+
+        # Same as the client, which shuts the connection down on abort, while clamd is still scanning
+        second_scan_started.set()
+        with abort.watching(second_scan_aborted.set):
+            assert second_scan_aborted.wait(WAIT_TIMEOUT_SECONDS)
+        raise ClamdException('Scan aborted')
+
+    client = MagicMock()
+    client.multiscan.side_effect = _multiscan_side_effect
+
+    assert clamdscan(EXPECTED_CTXS, True, False, client, scan_jobs=2) == [ScanResult('some_file_path_1', 1)]
+    assert second_scan_aborted.is_set()
+    assert client.multiscan.call_count == 2
+
+
+def test_clamdscan_scan_jobs_fail_fast_out_of_order(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    second_scan_done = threading.Event()
+    processes = {
+        # Finishes after the failure that comes after it
+        'some_unpack_path_1': _make_clamdscan_process(0, second_scan_done),
+        'some_unpack_path_2': _make_clamdscan_process(1, threading.Event()),
+    }
+
+    def _second_communicate():
+        second_scan_done.set()
+        return '', ''
+
+    processes['some_unpack_path_2'].communicate.side_effect = _second_communicate
+    mock_subprocess.Popen.side_effect = lambda args, **kwargs: processes[args[-1]]
+
+    # Everything before the failure is still waited on
+    assert clamdscan(EXPECTED_CTXS, True, False, scan_jobs=2) == EXPECTED_SCAN_RESULTS[:2]
+    processes['some_unpack_path_1'].kill.assert_not_called()
+
+
+def test_clamdscan_scan_jobs_single_ctx(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_subprocess.run.side_effect = _clamdscan_side_effect
+
+    assert clamdscan(EXPECTED_CTXS[:1], False, False, scan_jobs=4) == EXPECTED_SCAN_RESULTS[:1]
+
+
 def test_scan_result_is_virus():
     assert ScanResult('some_file', 1).is_virus_found()
     assert not ScanResult('some_file', 0).is_virus_found()
@@ -0,0 +1,142 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import tarfile
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.archive_members import ArchiveMember
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException
+from clamav_large_archive_scanner.lib.tar_chunks import StreamableMember, TarChunk, END_OF_ARCHIVE, fits_in_a_chunk
+
+EXPECTED_UNPACK_DIR = '/tmp/some_unpack_dir'
+EXPECTED_HEADER_LENGTH = 4
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_streamable(index: int, name: str, data: bytes) -> StreamableMember:
+    member = ArchiveMember(name, len(data), io.BytesIO(data))
+    header = member.fileobj.read(EXPECTED_HEADER_LENGTH)
+
+    return StreamableMember(index, member, header, f'{EXPECTED_UNPACK_DIR}/{name}')
+
+
+def _read_tar(data: bytes) -> dict:
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+        return {tar_info.name: tar.extractfile(tar_info).read() for tar_info in tar}
+
+
+def test_chunk_is_a_tar():
+    members = [
+        _make_streamable(0, 'some_file', b'some data'),
+        _make_streamable(1, 'some_dir/' + 'x' * 200, b'a member with a name too long for a plain ustar header'),
+        _make_streamable(2, 'empty', b''),
+    ]
+
+    chunk = TarChunk(1024 * 1024, 0)
+    data = b''.join(chunk.iter_data(members[0], iter(members[1:])))
+
+    assert _read_tar(data) == {
+        'some_file': b'some data',
+        'some_dir/' + 'x' * 200: b'a member with a name too long for a plain ustar header',
+        'empty': b'',
+    }
+
+    assert chunk.complete
+    assert chunk.next_member is None
+    assert chunk.length == len(data)
+    assert chunk.member_indexes() == {0, 1, 2}
+
+
+def test_chunk_max_length():
+    members = [_make_streamable(index, f'file_{index}', b'x' * 1000) for index in range(5)]
+
+    # Header, data and padding come to 2048 for each of these
+    max_length = len(END_OF_ARCHIVE) + 2 * members[0].tar_length()
+    assert fits_in_a_chunk(members[0], max_length)
+
+    remaining = iter(members[1:])
+    chunk = TarChunk(max_length, 0)
+    data = b''.join(chunk.iter_data(members[0], remaining))
+
+    assert len(data) <= max_length
+    assert list(_read_tar(data).keys()) == ['file_0', 'file_1']
+    # The member that didn't fit is kept for the next chunk, and nothing past it has been read
+    assert chunk.next_member is members[2]
+    assert next(remaining) is members[3]
+
+
+def test_chunk_max_files():
+    members = [_make_streamable(index, f'file_{index}', b'x') for index in range(5)]
+
+    chunk = TarChunk(1024 * 1024, 3)
+    data = b''.join(chunk.iter_data(members[0], iter(members[1:])))
+
+    assert list(_read_tar(data).keys()) == ['file_0', 'file_1', 'file_2']
+    assert chunk.next_member is members[3]
+
+
+def test_too_big_for_a_chunk():
+    a_member = _make_streamable(0, 'some_file', b'x' * 1000)
+
+    assert not fits_in_a_chunk(a_member, a_member.tar_length())
+    assert fits_in_a_chunk(a_member, a_member.tar_length() + len(END_OF_ARCHIVE))
+
+
+def test_chunk_member_shorter_than_expected():
+    member = ArchiveMember('some_file', 100, io.BytesIO(b'not 100 bytes'))
+    a_member = StreamableMember(0, member, b'', f'{EXPECTED_UNPACK_DIR}/some_file')
+
+    chunk = TarChunk(1024 * 1024, 0)
+    with pytest.raises(ArchiveException):
+        b''.join(chunk.iter_data(a_member, iter([])))
+
+    assert not chunk.complete
+
+
+def test_chunk_reply_lines():
+    members = [_make_streamable(index, f'file_{index}', b'x') for index in range(3)]
+
+    single_chunk = TarChunk(1024 * 1024, 1)
+    b''.join(single_chunk.iter_data(members[0], iter(members[1:])))
+    assert single_chunk.reply_lines(['stream: Eicar-Test-Signature FOUND']) == [
+        f'{EXPECTED_UNPACK_DIR}/file_0: Eicar-Test-Signature FOUND']
+
+    chunk = TarChunk(1024 * 1024, 0)
+    b''.join(chunk.iter_data(members[1], iter(members[2:])))
+    assert chunk.reply_lines(['stream: Eicar-Test-Signature FOUND', 'UNKNOWN COMMAND']) == [
+        f'One of the 2 files starting at {EXPECTED_UNPACK_DIR}/file_1: Eicar-Test-Signature FOUND',
+        'UNKNOWN COMMAND',
+    ]
@@ -72,13 +72,19 @@ def mock_os():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_shutil():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_glob, mock_tempfile, mock_os):
+def setup_and_teardown(mocker: MockerFixture, mock_glob, mock_tempfile, mock_os, mock_shutil):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.glob', mock_glob)
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.tempfile', mock_tempfile)
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.os', mock_os)
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files.shutil', mock_shutil)
 
     # Make os.path the real one
     mock_os.path = os.path
@@ -127,7 +133,8 @@ def test_make_tmp_dir_with_parent(mock_tempfile, mock_os):
     mock_os.chmod.assert_called_once_with(EXPECTED_MKDTEMP_RV, 0o755)
 
 
-HANDLED_FILE_TYPES = [FileType.TAR, FileType.TARGZ, FileType.ZIP, FileType.ISO, FileType.VMDK, FileType.QCOW2]
+HANDLED_FILE_TYPES = [FileType.TAR, FileType.TARGZ, FileType.ZIP, FileType.ISO, FileType.VMDK, FileType.QCOW2,
+                      FileType.TARZST, FileType.TARXZ, FileType.TARBZ2]
 
 
 def test_detect_filetype():
@@ -149,3 +156,37 @@ def test_find_associated_dirs(mock_glob):
     assert find_associated_dirs(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR) == expected_glob_return
 
     mock_glob.glob.assert_called_once_with(f'{EXPECTED_TMP_DIR}/{EXPECTED_TMP_FILE_PREFIX}_*_{EXPECTED_ARCHIVE_NAME}_*')
+
+
+def _disk_usage(used: int) -> MagicMock:
+    usage = MagicMock()
+    usage.used = used
+    return usage
+
+
+def test_tmp_dir_usage(mock_shutil):
+    from clamav_large_archive_scanner.lib.tmp_files import TmpDirUsage
+
+    mock_shutil.disk_usage.side_effect = [_disk_usage(x) for x in [1000, 1500, 3000, 2000]]
+
+    usage = TmpDirUsage(EXPECTED_TMP_DIR)
+    mock_shutil.disk_usage.assert_called_once_with(EXPECTED_TMP_DIR)
+    assert usage.peak_bytes == 0
+
+    # Only what was added since it was created counts
+    assert usage.sample() == 500
+    assert usage.sample() == 2000
+    assert usage.sample() == 1000
+    assert usage.peak_bytes == 2000
+
+
+def test_tmp_dir_usage_shrinks_below_baseline(mock_shutil):
+    from clamav_large_archive_scanner.lib.tmp_files import TmpDirUsage
+
+    # Something else freed up space on the volume
+    mock_shutil.disk_usage.side_effect = [_disk_usage(x) for x in [1000, 500]]
+
+    usage = TmpDirUsage(EXPECTED_TMP_DIR)
+
+    assert usage.sample() == 0
+    assert usage.peak_bytes == 0
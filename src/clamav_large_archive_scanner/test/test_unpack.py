@@ -26,7 +26,12 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import contextlib
+import io
 import os
+import tarfile
+import threading
+import zipfile
 from unittest.mock import MagicMock, call
 
 import click
@@ -36,21 +41,21 @@ from pytest_mock import MockerFixture
 
 import common
 
-from clamav_large_archive_scanner.lib.exceptions import ArchiveException, MountException
-from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
+from clamav_large_archive_scanner.lib.archive_members import ArchiveMember
+from clamav_large_archive_scanner.lib.clamd import ClamdReply
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException, ClamdException, IsoException, MountException
+from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType, FileView, UNKNOWN_DESC
 
 EXPECTED_TMP_DIR_PARENT = '/tmp/some_tmp_dir_for_files_parent'
 EXPECTED_TMP_DIR = f'{EXPECTED_TMP_DIR_PARENT}/some_tmp_dir_for_files'
 EXPECTED_ARCHIVE_PATH = '/tmp/some_archive_path.tar'
+EXPECTED_OUTER_ARCHIVE_PATH = '/tmp/some_outer_archive.ova'
 
-EXPECTED_TAR_FILE_FORMAT = 'tar'
-EXPECTED_ZIP_FILE_FORMAT = 'zip'
-EXPECTED_TGZ_FILE_FORMAT = 'gztar'
 
 EXPECTED_GUESTFS_PARTITIONS = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
 
-EXPECTED_HANDLED_FILE_TYPES = [FileType.TAR, FileType.ISO, FileType.VMDK, FileType.ZIP, FileType.TARGZ, FileType.QCOW2,
-                               FileType.DIR]
+EXPECTED_HANDLED_FILE_TYPES = [FileType.TAR, FileType.ISO, FileType.VMDK, FileType.ZIP, FileType.TARGZ, FileType.TARZST,
+                               FileType.TARXZ, FileType.TARBZ2, FileType.QCOW2, FileType.DIR]
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -58,11 +63,6 @@ def init_logging():
     common.init_logging()
 
 
-@pytest.fixture(scope='function')
-def mock_shutil():
-    return MagicMock()
-
-
 @pytest.fixture(scope='function')
 def mock_mount_tools():
     return MagicMock()
@@ -83,15 +83,27 @@ def mock_os():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_archive_members():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_walker():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_mount_tools, mock_os, mock_file_data, mock_shutil, mock_contexts):
+def setup_and_teardown(mocker: MockerFixture, mock_mount_tools, mock_os, mock_file_data, mock_contexts,
+                       mock_archive_members, mock_walker):
     # Before logic
     # These are re-mocked for every single test
-    mocker.patch('clamav_large_archive_scanner.lib.unpack.shutil', mock_shutil)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.mount_tools', mock_mount_tools)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.os', mock_os)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.file_data', mock_file_data)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.contexts', mock_contexts)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.archive_members', mock_archive_members)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.walker', mock_walker)
 
     yield
 
@@ -112,6 +124,7 @@ def _make_mock_u_ctx() -> MagicMock:
     expected_ctx = MagicMock()
     expected_ctx.file_meta = expected_meta
     expected_ctx.unpacked_dir_location = EXPECTED_TMP_DIR
+    expected_ctx.depends_on_source = False
 
     return expected_ctx
 
@@ -133,40 +146,313 @@ def test_base_file_unpacker():
         unpacker.unpack()
 
 
-def test_archive_file_unpacker(mock_shutil, mock_os):
-    from clamav_large_archive_scanner.lib.unpack import ArchiveFileUnpackHandler
+EXPECTED_MIN_FILE_SIZE = 1024
+EXPECTED_STREAM_MAX_LENGTH = 4096
+EXPECTED_HEADER_READ_SIZE = 4
+
+
+def _make_member(name: str, data: bytes) -> ArchiveMember:
+    return ArchiveMember(name, len(data), io.BytesIO(data))
+
+
+def _make_stream_client() -> MagicMock:
+    client = MagicMock()
+    client.stream_max_length = EXPECTED_STREAM_MAX_LENGTH
+    client.instream.side_effect = lambda chunks: ClamdReply(['stream: OK'])
+
+    return client
+
+
+def _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, members: list):
+    mock_os.path.join = os.path.join
+    mock_file_data.HEADER_READ_SIZE = EXPECTED_HEADER_READ_SIZE
+    mock_archive_members.STREAMABLE_FILE_TYPES = [FileType.TAR, FileType.TARGZ, FileType.ZIP]
+    mock_archive_members.iter_members.return_value = iter(members)
+
+
+def test_streaming_archive_unpacker(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingArchiveUnpackHandler
+
+    small_member = _make_member('small.txt', b'some small file')
+    large_member = _make_member('dir/large.bin', b'x' * EXPECTED_MIN_FILE_SIZE)
+    nested_member = _make_member('dir/nested.tar', b'TAR!' + b'x' * EXPECTED_MIN_FILE_SIZE)
+    oversized_member = _make_member('oversized.txt', b'x' * (EXPECTED_STREAM_MAX_LENGTH + 1))
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members,
+                           [small_member, large_member, nested_member, oversized_member])
+    mock_file_data.filetype_from_header.side_effect = lambda header: FileType.TAR if header == b'TAR!' else FileType.UNKNOWN
+
+    client = _make_stream_client()
+    streamed_data = []
+    client.instream.side_effect = lambda chunks: streamed_data.append(b''.join(chunks)) or ClamdReply(['stream: OK'])
 
     mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.streamed_results = []
 
-    unpacker = ArchiveFileUnpackHandler(mock_u_ctx, EXPECTED_TAR_FILE_FORMAT)
+    unpacker = StreamingArchiveUnpackHandler(mock_u_ctx, client, EXPECTED_MIN_FILE_SIZE)
     _assert_base_file_handler_init_behavior(mock_u_ctx)
 
-    unpack_ctx = unpacker.unpack()
+    assert unpacker.unpack() == mock_u_ctx
 
-    assert unpack_ctx == mock_u_ctx
-    mock_shutil.unpack_archive.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR,
-                                                       format=EXPECTED_TAR_FILE_FORMAT)
+    mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, FileType.TAR, None)
+
+    # The header that was read to classify the member is sent along with the rest of it
+    assert streamed_data == [b'some small file', b'x' * EXPECTED_MIN_FILE_SIZE]
+    assert mock_u_ctx.streamed_results == []
+
+    # Only nested archives worth unpacking, and what clamd won't take over INSTREAM, end up on disk
+    mock_archive_members.extract_member.assert_has_calls([
+        call(nested_member, f'{EXPECTED_TMP_DIR}/dir/nested.tar', b'TAR!'),
+        call(oversized_member, f'{EXPECTED_TMP_DIR}/oversized.txt', b'xxxx'),
+    ])
+    assert mock_archive_members.extract_member.call_count == 2
+
+    assert not mock_u_ctx.depends_on_source
+
+
+def test_streaming_archive_unpacker_small_nested_archive(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingArchiveUnpackHandler
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [_make_member('nested.tar', b'TAR!')])
+    mock_file_data.filetype_from_header.return_value = FileType.TAR
+    client = _make_stream_client()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.streamed_results = []
+
+    StreamingArchiveUnpackHandler(mock_u_ctx, client, EXPECTED_MIN_FILE_SIZE).unpack()
+
+    # Below the size threshold, clam gets to deal with it as is
+    client.instream.assert_called_once()
+    mock_archive_members.extract_member.assert_not_called()
 
-    mock_os.system.assert_called_once_with(f'chmod -R a+r {EXPECTED_TMP_DIR}')
+
+def _classify_view_side_effect(path: str, view: FileView, header: bytes) -> FileMetadata:
+    file_meta = FileMetadata()
+    file_meta.path = path
+    file_meta.view = view
+    file_meta.size_raw = view.length
+    file_meta.filetype = {b'ISO!': FileType.ISO, b'TAR!': FileType.TAR, b'KDMV': FileType.VMDK}.get(header,
+                                                                                                  FileType.UNKNOWN)
+    return file_meta
 
 
-def test_archive_file_unpacker_unpack_failed(mock_shutil):
-    from clamav_large_archive_scanner.lib.unpack import ArchiveFileUnpackHandler
+def test_streaming_archive_unpacker_in_place(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingArchiveUnpackHandler
+
+    nested_member = ArchiveMember('nested.tar', EXPECTED_MIN_FILE_SIZE, io.BytesIO(b'TAR!' + b'x' * 1020), 1536)
+    compressed_member = _make_member('compressed.tar', b'TAR!' + b'x' * EXPECTED_MIN_FILE_SIZE)
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [nested_member, compressed_member])
+    mock_file_data.filetype_from_header.return_value = FileType.TAR
+    mock_file_data.FileView = FileView
+    mock_file_data.classify_view.side_effect = _classify_view_side_effect
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.size_raw = 10 * EXPECTED_MIN_FILE_SIZE
+    mock_u_ctx.streamed_results = []
+    mock_u_ctx.views = []
+
+    StreamingArchiveUnpackHandler(mock_u_ctx, _make_stream_client(), EXPECTED_MIN_FILE_SIZE, in_place=True).unpack()
+
+    # Read where it is, later on, so the tar has to stay around until then
+    assert [(x.path, x.view.source_path, x.view.offset, x.view.length) for x in mock_u_ctx.views] == [
+        (f'{EXPECTED_TMP_DIR}/nested.tar', EXPECTED_ARCHIVE_PATH, 1536, EXPECTED_MIN_FILE_SIZE)]
+    assert mock_u_ctx.depends_on_source
+
+    # Only what isn't stored as it is gets extracted
+    mock_archive_members.extract_member.assert_called_once_with(compressed_member, f'{EXPECTED_TMP_DIR}/compressed.tar',
+                                                                b'TAR!')
+
+
+def test_streaming_archive_unpacker_results(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingArchiveUnpackHandler
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [
+        _make_member('clean.txt', b'clean'),
+        _make_member('../../eicar.txt', b'eicar'),
+        _make_member('unreadable.txt', b'unreadable'),
+        _make_member('connection_lost.txt', b'connection_lost'),
+    ])
+    mock_file_data.filetype_from_header.return_value = FileType.UNKNOWN
+
+    def _instream_side_effect(chunks):
+        data = b''.join(chunks)
+        if data == b'eicar':
+            return ClamdReply(['stream: Eicar-Test-Signature FOUND'])
+        elif data == b'unreadable':
+            return ClamdReply(['stream: Some error. ERROR'])
+        elif data == b'connection_lost':
+            raise ClamdException('some_connection_error')
+        return ClamdReply(['stream: OK'])
+
+    client = _make_stream_client()
+    client.instream.side_effect = _instream_side_effect
 
     mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.streamed_results = []
 
-    mock_shutil.unpack_archive.side_effect = Exception('some_archive_exception')
+    StreamingArchiveUnpackHandler(mock_u_ctx, client, EXPECTED_MIN_FILE_SIZE).unpack()
 
-    unpacker = ArchiveFileUnpackHandler(mock_u_ctx, EXPECTED_TAR_FILE_FORMAT)
+    # Reported as if they had been extracted, names that would climb out of the unpack dir are kept inside of it
+    assert mock_u_ctx.streamed_results == [
+        (1, f'{EXPECTED_TMP_DIR}/eicar.txt: Eicar-Test-Signature FOUND'),
+        (2, f'{EXPECTED_TMP_DIR}/unreadable.txt: Some error. ERROR'),
+        (2, f'{EXPECTED_TMP_DIR}/connection_lost.txt: some_connection_error ERROR'),
+    ]
+
+
+def test_streaming_archive_unpacker_unpack_failed(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingArchiveUnpackHandler
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    mock_archive_members.iter_members.side_effect = Exception('some_archive_exception')
+
+    mock_u_ctx = _make_mock_u_ctx()
+    unpacker = StreamingArchiveUnpackHandler(mock_u_ctx, _make_stream_client(), EXPECTED_MIN_FILE_SIZE)
 
     with pytest.raises(ArchiveException):
         unpacker.unpack()
 
-    mock_shutil.unpack_archive.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR,
-                                                       format=EXPECTED_TAR_FILE_FORMAT)
     mock_u_ctx.cleanup_tmp.assert_called_once()
 
 
+EXPECTED_CHUNK_MEMBERS = {
+    'first.txt': b'first file',
+    'some_dir/second.txt': b'second file, with EICAR in it',
+    'third.txt': b'third file',
+}
+
+
+def _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, members: dict):
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    mock_file_data.filetype_from_header.return_value = FileType.UNKNOWN
+
+    # Read from the start every time it is asked for
+    mock_archive_members.iter_members.side_effect = lambda path, filetype, view: iter(
+        [_make_member(name, data) for name, data in members.items()])
+
+
+def _make_chunk_client(stream_max_length: int = 1024 * 1024, max_scan_size: int = 0, max_files: int = 0):
+    client = MagicMock()
+    client.stream_max_length = stream_max_length
+    client.max_scan_size = max_scan_size
+    client.max_files = max_files
+
+    client.streamed = []
+
+    def _instream_side_effect(chunks):
+        data = b''.join(chunks)
+        client.streamed.append(data)
+        if b'EICAR' in data:
+            return ClamdReply(['stream: Eicar-Test-Signature FOUND'])
+        return ClamdReply(['stream: OK'])
+
+    client.instream.side_effect = _instream_side_effect
+
+    return client
+
+
+def _read_tar(data: bytes) -> dict:
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+        return {tar_info.name: tar.extractfile(tar_info).read() for tar_info in tar}
+
+
+def _make_chunk_handler(client: MagicMock):
+    from clamav_large_archive_scanner.lib.unpack import ChunkedStreamingArchiveUnpackHandler
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.streamed_results = []
+
+    return ChunkedStreamingArchiveUnpackHandler(mock_u_ctx, client, EXPECTED_MIN_FILE_SIZE)
+
+
+def test_chunked_streaming_unpacker(mock_os, mock_file_data, mock_archive_members):
+    clean_members = {name: data.replace(b'EICAR', b'clean') for name, data in EXPECTED_CHUNK_MEMBERS.items()}
+    _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, clean_members)
+    client = _make_chunk_client()
+
+    handler = _make_chunk_handler(client)
+    handler.unpack()
+
+    # Everything fits in a single chunk, that clamd unpacks on its own
+    assert len(client.streamed) == 1
+    assert _read_tar(client.streamed[0]) == clean_members
+    assert handler.u_ctx.streamed_results == []
+    mock_archive_members.iter_members.assert_called_once()
+
+
+def test_chunked_streaming_unpacker_limits(mock_os, mock_file_data, mock_archive_members):
+    _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, {
+        'big.bin': b'x' * 4096,
+        'small_1.txt': b'x',
+        'small_2.txt': b'x',
+        'small_3.txt': b'x',
+    })
+    # Big enough for two of the small files, but not for the big one
+    client = _make_chunk_client(stream_max_length=8192, max_scan_size=4096, max_files=2)
+
+    _make_chunk_handler(client).unpack()
+
+    # The one that doesn't fit in a chunk still fits in a stream of its own
+    assert client.streamed[0] == b'x' * 4096
+    assert [list(_read_tar(data).keys()) for data in client.streamed[1:]] == [['small_1.txt', 'small_2.txt'],
+                                                                             ['small_3.txt']]
+    assert all(len(data) <= 4096 for data in client.streamed[1:])
+
+
+def test_chunked_streaming_unpacker_found(mock_os, mock_file_data, mock_archive_members):
+    _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, EXPECTED_CHUNK_MEMBERS)
+    client = _make_chunk_client()
+
+    handler = _make_chunk_handler(client)
+    handler.unpack()
+
+    # The chunk, then each of its members on their own, to find out which one it was
+    assert client.instream.call_count == 1 + len(EXPECTED_CHUNK_MEMBERS)
+    assert client.streamed[1:] == list(EXPECTED_CHUNK_MEMBERS.values())
+    assert handler.u_ctx.streamed_results == [(1, f'{EXPECTED_TMP_DIR}/some_dir/second.txt: Eicar-Test-Signature FOUND')]
+
+
+def test_chunked_streaming_unpacker_not_pinpointed(mock_os, mock_file_data, mock_archive_members):
+    _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, {'first.txt': b'EI', 'second.txt': b'CAR'})
+    client = _make_chunk_client()
+
+    # Only found when both halves are sent together, so the whole chunk gets the blame
+    def _instream_side_effect(chunks):
+        data = b''.join(chunks)
+        if b'EI' in data and b'CAR' in data:
+            return ClamdReply(['stream: Split-Signature FOUND'])
+        return ClamdReply(['stream: OK'])
+
+    client.instream.side_effect = _instream_side_effect
+
+    handler = _make_chunk_handler(client)
+    handler.unpack()
+
+    assert handler.u_ctx.streamed_results == [
+        (1, f'One of the 2 files starting at {EXPECTED_TMP_DIR}/first.txt: Split-Signature FOUND')]
+
+
+def test_chunked_streaming_unpacker_connection_error(mock_os, mock_file_data, mock_archive_members):
+    _setup_chunk_mocks(mock_os, mock_file_data, mock_archive_members, {'first.txt': b'first', 'second.txt': b'second'})
+    client = _make_chunk_client()
+
+    def _instream_side_effect(chunks):
+        # Gives up part way through the chunk
+        next(iter(chunks))
+        raise ClamdException('some_connection_error')
+
+    client.instream.side_effect = _instream_side_effect
+
+    handler = _make_chunk_handler(client)
+    handler.unpack()
+
+    # Every member is tried again on its own, and fails again
+    assert handler.u_ctx.streamed_results == [
+        (2, f'{EXPECTED_TMP_DIR}/first.txt: some_connection_error ERROR'),
+        (2, f'{EXPECTED_TMP_DIR}/second.txt: some_connection_error ERROR'),
+    ]
+
+
 def test_iso_unpacker(mock_mount_tools):
     from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
 
@@ -180,6 +466,22 @@ def test_iso_unpacker(mock_mount_tools):
     assert unpack_ctx == mock_u_ctx
     mock_mount_tools.mount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR)
 
+    # The mount reads from the ISO, so it has to stay around
+    assert unpack_ctx.depends_on_source
+
+
+def test_iso_unpacker_view(mock_mount_tools):
+    from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.view = FileView(EXPECTED_OUTER_ARCHIVE_PATH, 1536, 2048000)
+
+    IsoFileUnpackHandler(mock_u_ctx).unpack()
+
+    # Mounted from right where it is
+    mock_mount_tools.mount_iso.assert_called_once_with(EXPECTED_OUTER_ARCHIVE_PATH, EXPECTED_TMP_DIR, 1536, 2048000)
+    assert mock_u_ctx.depends_on_source
+
 
 def test_iso_unpacker_mount_error(mock_mount_tools):
     from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
@@ -198,42 +500,204 @@ def test_iso_unpacker_mount_error(mock_mount_tools):
     assert str(e.value) == f'Unable to mount {EXPECTED_ARCHIVE_PATH} to {EXPECTED_TMP_DIR}'
 
 
-def _archive_unpacker_children_test_and_assert(handler_class, expected_file_format):
+def test_member_unpacker_iso(mock_mount_tools, mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import MemberArchiveUnpackHandler
+
+    members = [_make_member('boot/isolinux.bin', b'some boot file'), _make_member('README', b'some readme')]
+    mock_os.path.join = os.path.join
+    mock_file_data.HEADER_READ_SIZE = EXPECTED_HEADER_READ_SIZE
+    mock_archive_members.iter_members.return_value = iter(members)
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.ISO
+    mock_u_ctx.depends_on_source = False
+
+    unpacker = MemberArchiveUnpackHandler(mock_u_ctx)
+    _assert_base_file_handler_init_behavior(mock_u_ctx)
+
+    assert unpacker.unpack() == mock_u_ctx
+
+    mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, FileType.ISO, None)
+    mock_archive_members.extract_member.assert_has_calls([
+        call(members[0], f'{EXPECTED_TMP_DIR}/boot/isolinux.bin', b'some'),
+        call(members[1], f'{EXPECTED_TMP_DIR}/README', b'some'),
+    ])
+
+    # Nothing is mounted, and nothing reads from the ISO once this is done
+    mock_mount_tools.mount_iso.assert_not_called()
+    assert not mock_u_ctx.depends_on_source
+
+
+def test_member_unpacker_in_place(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import MemberArchiveUnpackHandler
+
+    large_data = b'x' * EXPECTED_MIN_FILE_SIZE
+    members = [
+        ArchiveMember('README', 11, io.BytesIO(b'some readme'), 512),
+        ArchiveMember('nested.iso', EXPECTED_MIN_FILE_SIZE + 4, io.BytesIO(b'ISO!' + large_data), 1024),
+        ArchiveMember('small.tar', 4, io.BytesIO(b'TAR!'), 4096),
+        ArchiveMember('disk.vmdk', EXPECTED_MIN_FILE_SIZE + 4, io.BytesIO(b'KDMV' + large_data), 8192),
+        ArchiveMember('compressed.tar', EXPECTED_MIN_FILE_SIZE + 4, io.BytesIO(b'TAR!' + large_data)),
+    ]
+    mock_os.path.join = os.path.join
+    mock_file_data.HEADER_READ_SIZE = EXPECTED_HEADER_READ_SIZE
+    mock_file_data.classify_view.side_effect = _classify_view_side_effect
+    mock_archive_members.iter_members.return_value = iter(members)
+
+    # The tar is itself inside of an OVA
+    mock_u_ctx = _make_mock_u_ctx()
+    source_view = FileView(EXPECTED_OUTER_ARCHIVE_PATH, 2560, 100 * EXPECTED_MIN_FILE_SIZE)
+    mock_u_ctx.file_meta.view = source_view
+    mock_u_ctx.views = []
+
+    MemberArchiveUnpackHandler(mock_u_ctx, EXPECTED_MIN_FILE_SIZE, in_place=True).unpack()
+
+    mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, FileType.TAR, source_view)
+    assert [(x.path, x.view.source_path, x.view.offset, x.view.length) for x in mock_u_ctx.views] == [
+        (f'{EXPECTED_TMP_DIR}/nested.iso', EXPECTED_OUTER_ARCHIVE_PATH, 2560 + 1024, EXPECTED_MIN_FILE_SIZE + 4),
+        (f'{EXPECTED_TMP_DIR}/disk.vmdk', EXPECTED_OUTER_ARCHIVE_PATH, 2560 + 8192, EXPECTED_MIN_FILE_SIZE + 4)]
+    assert mock_u_ctx.depends_on_source
+
+    # Not an archive, too small to bother with, and compressed
+    mock_archive_members.extract_member.assert_has_calls([
+        call(members[0], f'{EXPECTED_TMP_DIR}/README', b'some'),
+        call(members[2], f'{EXPECTED_TMP_DIR}/small.tar', b'TAR!'),
+        call(members[4], f'{EXPECTED_TMP_DIR}/compressed.tar', b'TAR!'),
+    ])
+    assert mock_archive_members.extract_member.call_count == 3
+
+
+def test_member_unpacker_error(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import MemberArchiveUnpackHandler
+
+    mock_archive_members.iter_members.side_effect = IsoException('some_iso_error')
+    mock_u_ctx = _make_mock_u_ctx()
+
+    # Same as any other broken archive, rather than a failed mount
+    with pytest.raises(ArchiveException):
+        MemberArchiveUnpackHandler(mock_u_ctx).unpack()
+
+    mock_u_ctx.cleanup_tmp.assert_called_once()
+
+
+@pytest.mark.parametrize('filetype', [FileType.TAR, FileType.TARGZ, FileType.TARZST, FileType.TARXZ, FileType.TARBZ2,
+                                      FileType.ZIP])
+def test_member_file_unpackers(mock_os, mock_file_data, mock_archive_members, filetype):
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx
+
+    members = [_make_member('some_dir/some_file', b'some file'), _make_member('some_other_file', b'some other file')]
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, members)
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = filetype
+
+    unpacker = _handler_from_ctx(mock_u_ctx)
+    _assert_base_file_handler_init_behavior(mock_u_ctx)
+
+    assert unpacker.unpack() == mock_u_ctx
+
+    # One member at a time, instead of through tarfile.extractall or zipfile.ZipFile
+    mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, filetype, None)
+    mock_archive_members.extract_member.assert_has_calls([
+        call(members[0], f'{EXPECTED_TMP_DIR}/some_dir/some_file', b'some'),
+        call(members[1], f'{EXPECTED_TMP_DIR}/some_other_file', b'some'),
+    ])
+    # The members are written out readable to begin with
+    mock_os.system.assert_not_called()
+
+    assert not mock_u_ctx.depends_on_source
+
+
+def test_zip_unpacker_jobs(mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, UnpackOptions, ZipFileUnpackHandler
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    mock_archive_members.extract_zip.return_value = 2
     mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.ZIP
 
-    unpacker = handler_class(mock_u_ctx)
+    unpacker = _handler_from_ctx(mock_u_ctx, UnpackOptions(zip_jobs=4))
+    assert isinstance(unpacker, ZipFileUnpackHandler)
     _assert_base_file_handler_init_behavior(mock_u_ctx)
 
-    assert unpacker.format == expected_file_format
+    assert unpacker.unpack() == mock_u_ctx
 
+    # The members are split up between the jobs by archive_members, instead of being read here
+    mock_archive_members.extract_zip.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR, 4, None)
+    mock_archive_members.iter_members.assert_not_called()
+    assert not mock_u_ctx.depends_on_source
 
-def test_tar_unpacker():
-    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+    # Leaving nested archives in place needs the members one at a time
+    unpacker = _handler_from_ctx(mock_u_ctx, UnpackOptions(zip_jobs=4, in_place=True))
+    assert not isinstance(unpacker, ZipFileUnpackHandler)
 
-    _archive_unpacker_children_test_and_assert(TarFileUnpackHandler, EXPECTED_TAR_FILE_FORMAT)
+    mock_u_ctx.file_meta.filetype = FileType.TAR
+    assert not isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(zip_jobs=4)), ZipFileUnpackHandler)
 
 
-def test_zip_unpacker():
+def test_zip_unpacker_jobs_exception(mock_os, mock_file_data, mock_archive_members):
     from clamav_large_archive_scanner.lib.unpack import ZipFileUnpackHandler
 
-    _archive_unpacker_children_test_and_assert(ZipFileUnpackHandler, EXPECTED_ZIP_FILE_FORMAT)
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    mock_archive_members.extract_zip.side_effect = zipfile.BadZipFile('Bad zip file')
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.ZIP
+
+    with pytest.raises(ArchiveException):
+        ZipFileUnpackHandler(mock_u_ctx, 4).unpack()
+
+    mock_u_ctx.cleanup_tmp.assert_called_once()
 
 
-def test_targz_unpacker():
-    from clamav_large_archive_scanner.lib.unpack import TarGzFileUnpackHandler
+def test_zip_unpacker_jobs_duplicate_names(tmp_path, mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib import archive_members, file_data
+    from clamav_large_archive_scanner.lib.unpack import ZipFileUnpackHandler
 
-    _archive_unpacker_children_test_and_assert(TarGzFileUnpackHandler, EXPECTED_TGZ_FILE_FORMAT)
+    # Extracted for real this time, with and without jobs, so the two trees can be compared
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.os', os)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.file_data', file_data)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.archive_members', archive_members)
+    mocker.patch('clamav_large_archive_scanner.lib.archive_members.ZIP_SHARD_MIN_SIZE', 1)
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for index in range(3):
+            zip_file.writestr(f'some_file_{index}', f'some member {index}'.encode() * 100)
+            # zipfile warns about it, but writes it all the same
+            with pytest.warns(UserWarning) if index else contextlib.nullcontext():
+                zip_file.writestr('some_dir/same_name', f'same name {index}'.encode() * 100)
+
+    trees = []
+    for zip_jobs in [1, 2]:
+        mock_u_ctx = _make_mock_u_ctx()
+        mock_u_ctx.file_meta.path = zip_path
+        mock_u_ctx.file_meta.filetype = FileType.ZIP
+        mock_u_ctx.file_meta.view = None
+        mock_u_ctx.unpacked_dir_location = str(tmp_path / f'extracted_{zip_jobs}')
+
+        ZipFileUnpackHandler(mock_u_ctx, zip_jobs).unpack()
+
+        tree = {}
+        for dir_path, _, file_names in os.walk(mock_u_ctx.unpacked_dir_location):
+            for file_name in file_names:
+                with open(os.path.join(dir_path, file_name), 'rb') as f:
+                    tree[os.path.relpath(f.name, mock_u_ctx.unpacked_dir_location)] = f.read()
+        trees.append(tree)
+
+    # Which one of the same named members gets which name depends on which process got to it first
+    assert trees[0].keys() == trees[1].keys() == {'some_file_0', 'some_file_1', 'some_file_2', 'some_dir/same_name',
+                                                  'some_dir/same_name.1', 'some_dir/same_name.2'}
+    assert sorted(trees[0].values()) == sorted(trees[1].values())
 
 
 def _mock_enumerate_guestfs_partitions(mock_mount_tools, return_value):
+    mock_mount_tools.guestfs_bindings_available.return_value = False
     mock_mount_tools.enumerate_guestfs_partitions.return_value = return_value
 
 
 def _assert_guestfs_unpack_calls(mock_mount_tools, expected_tmp_dir, expected_partitions):
-    mock_mount_tools.enumerate_guestfs_partitions.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+    mock_mount_tools.enumerate_guestfs_partitions.assert_called_once_with(EXPECTED_ARCHIVE_PATH, None)
 
     mock_mount_tools.mount_guestfs_partition.has_calls(
-        [call(EXPECTED_ARCHIVE_PATH, x, expected_tmp_dir) for x in expected_partitions], any_order=True)
+        [call(EXPECTED_ARCHIVE_PATH, x, expected_tmp_dir, None) for x in expected_partitions], any_order=True)
 
 
 def test_guestfs_unpacker(mock_mount_tools):
@@ -254,6 +718,8 @@ def test_guestfs_unpacker(mock_mount_tools):
 
     _assert_guestfs_unpack_calls(mock_mount_tools, EXPECTED_TMP_DIR, EXPECTED_GUESTFS_PARTITIONS)
 
+    assert unpack_ctx.depends_on_source
+
 
 def test_guestfs_unpacker_enumerate_error(mock_mount_tools):
     from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
@@ -262,6 +728,7 @@ def test_guestfs_unpacker_enumerate_error(mock_mount_tools):
     print()
 
     mock_u_ctx = _make_mock_u_ctx()
+    mock_mount_tools.guestfs_bindings_available.return_value = False
     mock_mount_tools.enumerate_guestfs_partitions.side_effect = MountException('some_mount_exception')
 
     unpacker = GuestFSFileUnpackHandler(mock_u_ctx)
@@ -272,7 +739,7 @@ def test_guestfs_unpacker_enumerate_error(mock_mount_tools):
 
     assert str(e.value) == f'Unable to list partitions for {EXPECTED_ARCHIVE_PATH}, aborting unpack'
 
-    mock_mount_tools.enumerate_guestfs_partitions.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+    mock_mount_tools.enumerate_guestfs_partitions.assert_called_once_with(EXPECTED_ARCHIVE_PATH, None)
     mock_mount_tools.mount_guestfs_partition.assert_not_called()
 
 
@@ -295,6 +762,117 @@ def test_guestfs_unpacker_mount_error(mock_mount_tools):
     _assert_guestfs_unpack_calls(mock_mount_tools, EXPECTED_TMP_DIR, EXPECTED_GUESTFS_PARTITIONS)
 
 
+EXPECTED_GUESTFS_LISTING = [(f'{EXPECTED_TMP_DIR}/++dev++sda1/some_file', 0o100644, 1234)]
+
+
+def test_guestfs_unpacker_one_appliance(mock_mount_tools):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.depends_on_source = False
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    mock_mount_tools.mount_guestfs_image.return_value = (EXPECTED_GUESTFS_PARTITIONS[:2],
+                                                         {EXPECTED_GUESTFS_PARTITIONS[2]: 'some_mount_error'},
+                                                         EXPECTED_GUESTFS_LISTING)
+
+    unpack_ctx = GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    # Everything is found and mounted in one go, a partition that can't be mounted doesn't stop the rest
+    mock_mount_tools.mount_guestfs_image.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR, None)
+    mock_mount_tools.enumerate_guestfs_partitions.assert_not_called()
+    mock_mount_tools.mount_guestfs_partition.assert_not_called()
+
+    assert unpack_ctx.depends_on_source
+    # The walk for nested archives goes through this, instead of through the mount
+    assert unpack_ctx.listing == EXPECTED_GUESTFS_LISTING
+
+
+def test_guestfs_unpacker_one_appliance_error(mock_mount_tools):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    mock_mount_tools.mount_guestfs_image.side_effect = MountException('some_mount_exception')
+
+    with pytest.raises(click.FileError) as e:
+        GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert str(e.value) == f'Unable to mount {EXPECTED_ARCHIVE_PATH}, aborting unpack'
+    assert not mock_u_ctx.depends_on_source
+
+
+def _make_in_place_image_ctx(filetype: FileType) -> MagicMock:
+    # A disk image that was left where it is in an OVA
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = filetype
+    mock_u_ctx.file_meta.path = f'{EXPECTED_TMP_DIR_PARENT}/disk.{filetype.value[1]}'
+    mock_u_ctx.file_meta.view = FileView(EXPECTED_OUTER_ARCHIVE_PATH, 10752, 4096)
+    return mock_u_ctx
+
+
+def test_guestfs_unpacker_in_place(mocker: MockerFixture, mock_mount_tools, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    mock_view_open = mocker.patch.object(FileView, 'open')
+    mock_u_ctx = _make_in_place_image_ctx(FileType.VMDK)
+    mock_mount_tools.attach_loop.return_value = '/dev/loop7'
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    mock_mount_tools.mount_guestfs_image.return_value = (EXPECTED_GUESTFS_PARTITIONS, {}, EXPECTED_GUESTFS_LISTING)
+
+    GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    # libguestfs reads it through a loop device over its part of the OVA, which goes once the mount lets go of it
+    mock_mount_tools.attach_loop.assert_called_once_with(EXPECTED_OUTER_ARCHIVE_PATH, 10752, 4096)
+    assert mock_mount_tools.method_calls[-2:] == [
+        call.mount_guestfs_image('/dev/loop7', EXPECTED_TMP_DIR, 'vmdk'),
+        call.detach_loop('/dev/loop7'),
+    ]
+    assert mock_u_ctx.depends_on_source
+
+    # Never written to the tmp dir
+    mock_view_open.assert_not_called()
+    mock_archive_members.extract_member.assert_not_called()
+
+
+def test_guestfs_unpacker_in_place_each_partition(mock_mount_tools):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    mock_u_ctx = _make_in_place_image_ctx(FileType.QCOW2)
+    mock_mount_tools.attach_loop.return_value = '/dev/loop7'
+    _mock_enumerate_guestfs_partitions(mock_mount_tools, EXPECTED_GUESTFS_PARTITIONS[:1])
+
+    GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert mock_mount_tools.method_calls[-3:] == [
+        call.enumerate_guestfs_partitions('/dev/loop7', 'qcow2'),
+        call.mount_guestfs_partition('/dev/loop7', EXPECTED_GUESTFS_PARTITIONS[0], EXPECTED_TMP_DIR, 'qcow2'),
+        call.detach_loop('/dev/loop7'),
+    ]
+
+
+def test_guestfs_unpacker_in_place_no_loop_device(mocker: MockerFixture, mock_mount_tools, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    mock_view_open = mocker.patch.object(FileView, 'open')
+    mock_u_ctx = _make_in_place_image_ctx(FileType.VMDK)
+    mock_mount_tools.attach_loop.side_effect = MountException('some_losetup_error')
+    mock_mount_tools.guestfs_bindings_available.return_value = True
+    mock_mount_tools.mount_guestfs_image.return_value = (EXPECTED_GUESTFS_PARTITIONS, {}, None)
+    mock_archive_members.extract_member.return_value = f'{EXPECTED_TMP_DIR_PARENT}/disk.vmdk.1'
+    image_path = mock_u_ctx.file_meta.path
+
+    GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    # Without root, for one, it gets extracted after all, next to a member with the same name that is already there
+    mock_archive_members.extract_member.assert_called_once_with(mock_archive_members.ArchiveMember.return_value,
+                                                                image_path)
+    assert mock_u_ctx.file_meta.path == f'{EXPECTED_TMP_DIR_PARENT}/disk.vmdk.1'
+    mock_mount_tools.mount_guestfs_image.assert_called_once_with(f'{EXPECTED_TMP_DIR_PARENT}/disk.vmdk.1',
+                                                                 EXPECTED_TMP_DIR, None)
+    mock_mount_tools.detach_loop.assert_not_called()
+    mock_view_open.assert_called_once_with()
+
+
 def test_dir_unpacker():
     from clamav_large_archive_scanner.lib.unpack import DirFileUnpackHandler
 
@@ -310,6 +888,225 @@ def test_dir_unpacker():
     mock_u_ctx.create_tmp_dir.assert_not_called()
 
 
+def _make_tar_out(mock_mount_tools, streams: list, failed: dict = None) -> MagicMock:
+    tar_out = mock_mount_tools.open_guestfs_tar_out.return_value
+    tar_out.failed = failed if failed is not None else {}
+    tar_out.iter_streams.return_value = iter(streams)
+    return tar_out
+
+
+def _setup_tar_out_mocks(mock_os, mock_archive_members, members_by_dir: dict):
+    mock_os.path.join = os.path.join
+    mock_archive_members.iter_tar_stream.side_effect = lambda stream, name_prefix: iter(members_by_dir[name_prefix])
+
+
+def test_guestfs_tar_out_unpacker(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSTarOutUnpackHandler
+
+    sda1_member = _make_member('++dev++sda1/boot.ini', b'some boot file')
+    sda3_member = _make_member('++dev++sda3/etc/passwd', b'some passwd file')
+    tar_out = _make_tar_out(mock_mount_tools, [('++dev++sda1', 'sda1_stream'), ('++dev++sda3', 'sda3_stream')],
+                            {'/dev/sda2': 'some_mount_error'})
+    _setup_tar_out_mocks(mock_os, mock_archive_members,
+                         {'++dev++sda1/': [sda1_member], '++dev++sda3/': [sda3_member]})
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.depends_on_source = False
+
+    unpacker = GuestFSTarOutUnpackHandler(mock_u_ctx)
+    _assert_base_file_handler_init_behavior(mock_u_ctx)
+
+    assert unpacker.unpack() == mock_u_ctx
+
+    # Every file ends up where it would have been if the image had been mounted
+    mock_mount_tools.open_guestfs_tar_out.assert_called_once_with(EXPECTED_ARCHIVE_PATH, None, None)
+    mock_archive_members.iter_tar_stream.assert_has_calls([call('sda1_stream', '++dev++sda1/'),
+                                                           call('sda3_stream', '++dev++sda3/')])
+    mock_archive_members.extract_member.assert_has_calls([
+        call(sda1_member, f'{EXPECTED_TMP_DIR}/++dev++sda1/boot.ini'),
+        call(sda3_member, f'{EXPECTED_TMP_DIR}/++dev++sda3/etc/passwd'),
+    ])
+    tar_out.close.assert_called_once()
+
+    # Nothing is mounted, so nothing reads from the image once this is done
+    mock_mount_tools.mount_guestfs_image.assert_not_called()
+    assert not mock_u_ctx.depends_on_source
+
+
+def test_guestfs_tar_out_unpacker_in_place(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSTarOutUnpackHandler
+
+    tar_out = _make_tar_out(mock_mount_tools, [('++dev++sda1', 'sda1_stream')])
+    _setup_tar_out_mocks(mock_os, mock_archive_members, {'++dev++sda1/': []})
+    mock_u_ctx = _make_in_place_image_ctx(FileType.QCOW2)
+    mock_mount_tools.attach_loop.return_value = '/dev/loop7'
+
+    GuestFSTarOutUnpackHandler(mock_u_ctx).unpack()
+
+    mock_mount_tools.attach_loop.assert_called_once_with(EXPECTED_OUTER_ARCHIVE_PATH, 10752, 4096)
+    mock_mount_tools.open_guestfs_tar_out.assert_called_once_with('/dev/loop7', None, 'qcow2')
+    tar_out.close.assert_called_once()
+    mock_mount_tools.detach_loop.assert_called_once_with('/dev/loop7')
+    mock_archive_members.extract_member.assert_not_called()
+
+
+def test_guestfs_tar_out_unpacker_error(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSTarOutUnpackHandler
+
+    tar_out = _make_tar_out(mock_mount_tools, [('++dev++sda1', 'sda1_stream')])
+    _setup_tar_out_mocks(mock_os, mock_archive_members, {'++dev++sda1/': []})
+    mock_archive_members.iter_tar_stream.side_effect = RuntimeError('some_tar_out_error')
+    mock_u_ctx = _make_mock_u_ctx()
+
+    with pytest.raises(ArchiveException):
+        GuestFSTarOutUnpackHandler(mock_u_ctx).unpack()
+
+    tar_out.close.assert_called_once()
+    mock_u_ctx.cleanup_tmp.assert_called_once()
+
+
+def test_guestfs_tar_out_unpacker_launch_error(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSTarOutUnpackHandler
+
+    mock_mount_tools.open_guestfs_tar_out.side_effect = MountException('some_launch_error')
+    mock_u_ctx = _make_mock_u_ctx()
+
+    with pytest.raises(ArchiveException):
+        GuestFSTarOutUnpackHandler(mock_u_ctx).unpack()
+
+    mock_u_ctx.cleanup_tmp.assert_called_once()
+
+
+def test_streaming_guestfs_unpacker(mock_mount_tools, mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import StreamingGuestFSUnpackHandler
+
+    member = _make_member('++dev++sda1/boot.ini', b'some boot file')
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    _make_tar_out(mock_mount_tools, [('++dev++sda1', 'sda1_stream')])
+    _setup_tar_out_mocks(mock_os, mock_archive_members, {'++dev++sda1/': [member]})
+    mock_file_data.filetype_from_header.return_value = FileType.UNKNOWN
+
+    client = _make_stream_client()
+    streamed_data = []
+    client.instream.side_effect = lambda chunks: streamed_data.append(b''.join(chunks)) or ClamdReply(['stream: OK'])
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.streamed_results = []
+
+    StreamingGuestFSUnpackHandler(mock_u_ctx, client, EXPECTED_MIN_FILE_SIZE).unpack()
+
+    # Straight from the appliance to clamd
+    assert streamed_data == [b'some boot file']
+    mock_archive_members.iter_members.assert_not_called()
+    mock_archive_members.extract_member.assert_not_called()
+
+
+def test_guestfs_tar_out_pool(mock_mount_tools, mock_os, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, UnpackOptions, GUESTFS_MODE_TAR_OUT
+
+    _make_tar_out(mock_mount_tools, [])
+    mock_pool = MagicMock()
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.VMDK
+
+    for stream_client, stream_chunks in [(None, False), (_make_chunk_client(), False), (_make_chunk_client(), True)]:
+        mock_mount_tools.reset_mock()
+        mock_u_ctx.streamed_results = []
+        options = UnpackOptions(stream_client=stream_client, stream_chunks=stream_chunks,
+                                guestfs_mode=GUESTFS_MODE_TAR_OUT, guestfs_pool=mock_pool)
+
+        _handler_from_ctx(mock_u_ctx, options).unpack()
+
+        # However the files end up getting to clamd, the appliance comes from the pool
+        mock_mount_tools.open_guestfs_tar_out.assert_called_once_with(EXPECTED_ARCHIVE_PATH, mock_pool, None)
+
+
+@pytest.mark.parametrize('filetype', [FileType.VMDK, FileType.QCOW2])
+def test_handler_guestfs_mode(filetype):
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, UnpackOptions, GUESTFS_MODE_TAR_OUT, \
+        GuestFSFileUnpackHandler, GuestFSTarOutUnpackHandler, StreamingGuestFSUnpackHandler, \
+        ChunkedStreamingGuestFSUnpackHandler
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = filetype
+
+    assert isinstance(_handler_from_ctx(mock_u_ctx), GuestFSFileUnpackHandler)
+    assert isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(stream_client=_make_stream_client())),
+                      GuestFSFileUnpackHandler)
+
+    tar_out_options = UnpackOptions(guestfs_mode=GUESTFS_MODE_TAR_OUT)
+    assert isinstance(_handler_from_ctx(mock_u_ctx, tar_out_options), GuestFSTarOutUnpackHandler)
+
+    tar_out_options.stream_client = _make_chunk_client()
+    assert isinstance(_handler_from_ctx(mock_u_ctx, tar_out_options), StreamingGuestFSUnpackHandler)
+
+    tar_out_options.stream_chunks = True
+    assert isinstance(_handler_from_ctx(mock_u_ctx, tar_out_options), ChunkedStreamingGuestFSUnpackHandler)
+
+    # Only disk images are read out as tars
+    mock_u_ctx.file_meta.filetype = FileType.ISO
+    assert not isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(guestfs_mode=GUESTFS_MODE_TAR_OUT)),
+                          GuestFSTarOutUnpackHandler)
+
+
+def test_handler_iso_mode():
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, _mount_slot_kind, UnpackOptions, \
+        ISO_MODE_READ, IsoFileUnpackHandler, MemberArchiveUnpackHandler, StreamingArchiveUnpackHandler, \
+        ChunkedStreamingArchiveUnpackHandler
+    from clamav_large_archive_scanner.lib.mount_slots import LOOP_SLOT
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.ISO
+
+    assert isinstance(_handler_from_ctx(mock_u_ctx), IsoFileUnpackHandler)
+    assert isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(stream_client=_make_stream_client())),
+                      IsoFileUnpackHandler)
+    assert _mount_slot_kind(mock_u_ctx.file_meta, UnpackOptions()) == LOOP_SLOT
+
+    read_options = UnpackOptions(iso_mode=ISO_MODE_READ)
+    assert isinstance(_handler_from_ctx(mock_u_ctx, read_options), MemberArchiveUnpackHandler)
+    # No loop device, nothing to wait for
+    assert _mount_slot_kind(mock_u_ctx.file_meta, read_options) is None
+
+    read_options.stream_client = _make_chunk_client()
+    assert isinstance(_handler_from_ctx(mock_u_ctx, read_options), StreamingArchiveUnpackHandler)
+
+    read_options.stream_chunks = True
+    assert isinstance(_handler_from_ctx(mock_u_ctx, read_options), ChunkedStreamingArchiveUnpackHandler)
+
+    # Only ISOs are read like this
+    mock_u_ctx.file_meta.filetype = FileType.VMDK
+    assert not isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(iso_mode=ISO_MODE_READ)),
+                          MemberArchiveUnpackHandler)
+
+
+def test_handler_in_place(mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, UnpackOptions, ZipFileUnpackHandler, \
+        MemberArchiveUnpackHandler, IsoFileUnpackHandler, StreamingArchiveUnpackHandler
+
+    mock_archive_members.STREAMABLE_FILE_TYPES = [FileType.TAR, FileType.TARGZ, FileType.ZIP]
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.filetype = FileType.ZIP
+    handler = _handler_from_ctx(mock_u_ctx, UnpackOptions())
+    assert isinstance(handler, ZipFileUnpackHandler)
+    assert not handler.in_place
+
+    handler = _handler_from_ctx(mock_u_ctx, UnpackOptions(in_place=True), EXPECTED_MIN_FILE_SIZE)
+    assert isinstance(handler, MemberArchiveUnpackHandler)
+    assert handler.in_place
+    assert handler.min_file_size == EXPECTED_MIN_FILE_SIZE
+
+    handler = _handler_from_ctx(mock_u_ctx, UnpackOptions(stream_client=_make_stream_client(), in_place=True))
+    assert isinstance(handler, StreamingArchiveUnpackHandler)
+    assert handler.in_place
+
+    # Whatever was left in place is read from where it is, with or without in_place
+    mock_u_ctx.file_meta.view = FileView(EXPECTED_OUTER_ARCHIVE_PATH, 1536, 4096)
+    assert isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions()), MemberArchiveUnpackHandler)
+    assert isinstance(_handler_from_ctx(mock_u_ctx), MemberArchiveUnpackHandler)
+
+    mock_u_ctx.file_meta.filetype = FileType.ISO
+    assert isinstance(_handler_from_ctx(mock_u_ctx, UnpackOptions(in_place=True)), IsoFileUnpackHandler)
+
+
 def test_is_handled_filetype():
     from clamav_large_archive_scanner.lib.unpack import is_handled_filetype
 
@@ -322,7 +1119,7 @@ def test_is_handled_filetype():
     assert not is_handled_filetype(meta)
 
 
-def test_unpack(mock_shutil, mock_contexts):
+def test_unpack(mock_contexts, mock_archive_members):
     from clamav_large_archive_scanner.lib.unpack import unpack
 
     expected_file_meta = _make_file_meta()
@@ -331,12 +1128,62 @@ def test_unpack(mock_shutil, mock_contexts):
 
     unpack_ctx = unpack(expected_file_meta, EXPECTED_TMP_DIR_PARENT)
 
-    mock_shutil.unpack_archive.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR,
-                                                       format=EXPECTED_TAR_FILE_FORMAT)
+    mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, FileType.TAR, None)
 
     _assert_base_file_handler_init_behavior(unpack_ctx)
 
 
+def test_unpack_in_place(mocker: MockerFixture, mock_contexts, mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import unpack, UnpackOptions
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [
+        ArchiveMember('nested.tar', EXPECTED_MIN_FILE_SIZE, io.BytesIO(b'TAR!' + b'x' * 1020), 1536)])
+    mock_file_data.classify_view.side_effect = _classify_view_side_effect
+    mock_file_data.FileView = FileView
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.size_raw = 10 * EXPECTED_MIN_FILE_SIZE
+    mock_u_ctx.views = []
+    mock_contexts.UnpackContext.return_value = mock_u_ctx
+
+    mock_view_open = mocker.patch.object(FileView, 'open')
+
+    unpack(mock_u_ctx.file_meta, EXPECTED_TMP_DIR_PARENT, UnpackOptions(in_place=True))
+
+    # Nothing else is going to unpack it, so it ends up on disk after all
+    assert len(mock_u_ctx.views) == 1
+    extract_calls = mock_archive_members.extract_member.call_args_list
+    assert len(extract_calls) == 1
+    assert extract_calls[0][0][1] == f'{EXPECTED_TMP_DIR}/nested.tar'
+    mock_archive_members.ArchiveMember.assert_called_once_with(f'{EXPECTED_TMP_DIR}/nested.tar',
+                                                               EXPECTED_MIN_FILE_SIZE,
+                                                               mock_view_open.return_value.__enter__.return_value)
+
+
+def test_unpack_streaming(mock_contexts, mock_os, mock_file_data, mock_archive_members):
+    from clamav_large_archive_scanner.lib.unpack import _do_unpack, UnpackOptions
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    options = UnpackOptions(stream_client=_make_stream_client())
+
+    for filetype in [FileType.TAR, FileType.TARGZ, FileType.ZIP]:
+        mock_archive_members.reset_mock()
+        mock_u_ctx = _make_mock_u_ctx()
+        mock_u_ctx.file_meta.filetype = filetype
+
+        _do_unpack(mock_u_ctx, options, EXPECTED_MIN_FILE_SIZE)
+
+        mock_archive_members.iter_members.assert_called_once_with(EXPECTED_ARCHIVE_PATH, filetype, None)
+        mock_archive_members.extract_member.assert_not_called()
+
+    from clamav_large_archive_scanner.lib.unpack import _handler_from_ctx, ChunkedStreamingArchiveUnpackHandler, \
+        StreamingArchiveUnpackHandler
+    chunk_options = UnpackOptions(stream_client=_make_chunk_client(), stream_chunks=True)
+    assert isinstance(_handler_from_ctx(_make_mock_u_ctx(), chunk_options), ChunkedStreamingArchiveUnpackHandler)
+
+    # Without a client to stream to, archives are extracted as usual
+    assert not isinstance(_handler_from_ctx(_make_mock_u_ctx(), UnpackOptions()), StreamingArchiveUnpackHandler)
+
+
 def test_unpack_unhandled_filetype(mock_contexts):
     from clamav_large_archive_scanner.lib.unpack import unpack
 
@@ -352,7 +1199,7 @@ def test_unpack_unhandled_filetype(mock_contexts):
     assert str(e.value) == f'Unhandled file type: {FileType.DOES_NOT_EXIST}'
 
 
-def test_unpack_archive_exception(mock_shutil, mock_contexts):
+def test_unpack_archive_exception(mock_contexts, mock_archive_members):
     from clamav_large_archive_scanner.lib.unpack import unpack
 
     expected_archive_exception_str = 'some_archive_exception'
@@ -361,7 +1208,7 @@ def test_unpack_archive_exception(mock_shutil, mock_contexts):
     mock_u_ctx = _make_mock_u_ctx()
     mock_contexts.UnpackContext.return_value = mock_u_ctx
 
-    mock_shutil.unpack_archive.side_effect = Exception(expected_archive_exception_str)
+    mock_archive_members.iter_members.side_effect = Exception(expected_archive_exception_str)
 
     with pytest.raises(click.FileError) as e:
         unpack(expected_file_meta, EXPECTED_TMP_DIR_PARENT)
@@ -405,21 +1252,29 @@ def _parent_archive_metadata() -> FileMetadata:
     return file_meta
 
 
-def _recursive_unpack_os_walk_side_effect(*args, **kwargs):
+def _make_dir_entry(path: str) -> MagicMock:
+    entry = MagicMock()
+    entry.path = path
+
+    return entry
+
+
+def _recursive_unpack_walk_side_effect(*args, **kwargs):
     target_dir = args[0]
 
     if target_dir == PARENT_ARCHIVE_UNPACK_DIR:
         return [
-            (PARENT_ARCHIVE_UNPACK_DIR, [], [VALID_ARCHIVE_1, 'invalid_file_1']),
-            (PARENT_ARCHIVE_SUBDIR_1, [], [VALID_ARCHIVE_2])
+            (PARENT_ARCHIVE_UNPACK_DIR, [_make_dir_entry(VALID_ARCHIVE_1),
+                                         _make_dir_entry(f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1')]),
+            (PARENT_ARCHIVE_SUBDIR_1, [_make_dir_entry(VALID_ARCHIVE_2)])
         ]
 
     # Not a directory that we are mocking (likely valid_archive_1_dir or valid_archive_2_dir)
     return []
 
 
-def _recursive_unpack_file_meta_from_path_side_effect(*args, **kwargs):
-    file_path = args[0]
+def _recursive_unpack_classify_entry_side_effect(*args, **kwargs):
+    file_path = args[0].path
 
     if file_path == VALID_ARCHIVE_1:
         file_meta = FileMetadata()
@@ -445,6 +1300,11 @@ def _recursive_unpack_unpack_context_ctor_side_effect(*args, **kwargs):
     u_ctx = MagicMock()
 
     u_ctx.file_meta = file_meta
+    u_ctx.parent_ctx = kwargs.get('parent_ctx', None)
+    u_ctx.covered_paths = set()
+    u_ctx.inventory = None
+    u_ctx.listing = None
+    u_ctx.views = []
 
     if file_meta.path == PARENT_ARCHIVE:
         u_ctx.unpacked_dir_location = PARENT_ARCHIVE_UNPACK_DIR
@@ -456,20 +1316,21 @@ def _recursive_unpack_unpack_context_ctor_side_effect(*args, **kwargs):
     return u_ctx
 
 
-def test_unpack_recursive(mock_shutil, mock_contexts, mock_os, mock_file_data):
+def _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data):
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+
+    # mock_tmp_files.make_temp_dir.side_effect = _recursive_unpack_make_temp_dir_side_effect
+    mock_walker.walk.side_effect = _recursive_unpack_walk_side_effect
+    mock_file_data.classify_entry.side_effect = _recursive_unpack_classify_entry_side_effect
+
+
+def test_unpack_recursive(mock_contexts, mock_walker, mock_file_data):
     from clamav_large_archive_scanner.lib.unpack import unpack_recursive
 
     # For test output formatting... don't remove
     print()
 
-    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
-
-    # mock_tmp_files.make_temp_dir.side_effect = _recursive_unpack_make_temp_dir_side_effect
-    mock_os.walk.side_effect = _recursive_unpack_os_walk_side_effect
-    mock_file_data.file_meta_from_path.side_effect = _recursive_unpack_file_meta_from_path_side_effect
-
-    # Use real join
-    mock_os.path.join = os.path.join
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
 
     parent_archive_meta = _parent_archive_metadata()
 
@@ -480,3 +1341,322 @@ def test_unpack_recursive(mock_shutil, mock_contexts, mock_os, mock_file_data):
     assert unpack_dirs == EXPECTED_RECURSIVE_UNPACK_DIRS
     # There are no call assertions here, since the only way that these two match is if all the
     # mocks got called correctly
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_jobs(mock_contexts, mock_walker, mock_file_data, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, unpack_jobs=unpack_jobs)
+
+    # Results come back in the order they were found, regardless of how many workers there are
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR,
+                                                              VALID_ARCHIVE_2_UNPACK_DIR]
+
+    # Both nested archives live directly in the parent, so that's who nice_filename() has to go through
+    parent_ctx = unpack_ctxs[0]
+    assert parent_ctx.parent_ctx is None
+    assert unpack_ctxs[1].parent_ctx is parent_ctx
+    assert unpack_ctxs[2].parent_ctx is parent_ctx
+
+    for u_ctx in unpack_ctxs[1:]:
+        assert u_ctx.file_meta.root_meta.path == PARENT_ARCHIVE
+
+    # Both of them are scanned through their own contexts, the parent can leave them out
+    assert parent_ctx.covered_paths == {VALID_ARCHIVE_1, VALID_ARCHIVE_2}
+
+    # Everything the walk came across is remembered, so the scanner doesn't have to walk it again
+    assert [x.path for x in parent_ctx.inventory] == [VALID_ARCHIVE_1, f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1',
+                                                      VALID_ARCHIVE_2]
+    assert unpack_ctxs[1].inventory == []
+
+
+def _recursive_unpack_walk_error_side_effect(*args, **kwargs):
+    kwargs['onerror'](PermissionError('some_permission_error'))
+    return _recursive_unpack_walk_side_effect(*args, **kwargs)
+
+
+def test_unpack_recursive_walk_error(mock_contexts, mock_walker, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_walker.walk.side_effect = _recursive_unpack_walk_error_side_effect
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT)
+
+    # Whatever could be seen still gets unpacked, but the scanner has to walk the directories itself
+    assert len(unpack_ctxs) == 3
+    for u_ctx in unpack_ctxs:
+        assert u_ctx.inventory is None
+
+
+def test_unpack_recursive_inventory_regular_files_only(mock_contexts, mock_walker, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_file_data.FileType = FileType
+    mock_file_data.UNKNOWN_DESC = UNKNOWN_DESC
+
+    def _classify_links_side_effect(*args, **kwargs):
+        file_meta = _recursive_unpack_classify_entry_side_effect(*args, **kwargs)
+        if file_meta.path.endswith('invalid_file_1'):
+            # What a symlink or a special file comes back as
+            file_meta.desc = UNKNOWN_DESC
+        return file_meta
+
+    mock_file_data.classify_entry.side_effect = _classify_links_side_effect
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT)
+
+    assert [x.path for x in unpack_ctxs[0].inventory] == [VALID_ARCHIVE_1, VALID_ARCHIVE_2]
+
+
+@pytest.mark.parametrize('filetype,expected_threads', [(FileType.TAR, 1), (FileType.TARGZ, 1), (FileType.ZIP, 1),
+                                                       (FileType.ISO, 1), (FileType.VMDK, 4), (FileType.QCOW2, 4),
+                                                       (FileType.DIR, 4)])
+def test_unpack_recursive_walk_threads(mock_contexts, mock_walker, mock_file_data, mock_mount_tools,
+                                       filetype, expected_threads):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_mount_tools.mount_guestfs_image.return_value = ([], {}, None)
+    mock_walker.walk.side_effect = None
+    mock_walker.walk.return_value = []
+    parent_archive_meta = _parent_archive_metadata()
+    parent_archive_meta.filetype = filetype
+
+    unpack_recursive(parent_archive_meta, 0, EXPECTED_TMP_DIR_PARENT, options=UnpackOptions(walk_threads=4))
+
+    # Only what gets mounted, or is already there, is walked on several threads
+    assert mock_walker.walk.call_args[1]['threads'] == expected_threads
+
+
+@pytest.mark.parametrize('filetype', [FileType.VMDK, FileType.QCOW2])
+def test_unpack_recursive_walk_threads_tar_out(mock_contexts, mock_walker, mock_file_data,
+                                               mock_mount_tools, mock_archive_members, filetype):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions, GUESTFS_MODE_TAR_OUT
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    _make_tar_out(mock_mount_tools, [])
+    mock_walker.walk.side_effect = None
+    mock_walker.walk.return_value = []
+    parent_archive_meta = _parent_archive_metadata()
+    parent_archive_meta.filetype = filetype
+
+    unpack_recursive(parent_archive_meta, 0, EXPECTED_TMP_DIR_PARENT,
+                     options=UnpackOptions(walk_threads=4, guestfs_mode=GUESTFS_MODE_TAR_OUT))
+
+    # Read out of the image onto local disk, instead of mounted
+    mock_mount_tools.mount_guestfs_image.assert_not_called()
+    assert mock_walker.walk.call_args[1]['threads'] == 1
+
+
+def test_unpack_recursive_listing(mock_contexts, mock_walker, mock_file_data, mock_mount_tools):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_mount_tools.mount_guestfs_image.return_value = (['/dev/sda1'], {}, [
+        (VALID_ARCHIVE_1, 0o100644, 1234),
+        (f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1', 0o100644, 12),
+    ])
+    mock_file_data.classify_listed.side_effect = \
+        lambda path, st_mode, st_size, min_file_size: _recursive_unpack_classify_entry_side_effect(_make_dir_entry(path))
+    parent_archive_meta = _parent_archive_metadata()
+    parent_archive_meta.filetype = FileType.VMDK
+
+    unpack_ctxs = unpack_recursive(parent_archive_meta, 0, EXPECTED_TMP_DIR_PARENT)
+
+    # The image isn't walked, what the appliance listed is used instead. The nested tar is walked as usual
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR]
+    mock_file_data.classify_listed.assert_has_calls([
+        call(VALID_ARCHIVE_1, 0o100644, 1234, 0),
+        call(f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1', 0o100644, 12, 0),
+    ])
+    mock_walker.walk.assert_called_once()
+    assert mock_walker.walk.call_args[0][0] == VALID_ARCHIVE_1_UNPACK_DIR
+
+    assert [x.path for x in unpack_ctxs[0].inventory] == [VALID_ARCHIVE_1, f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1']
+    # Not kept around once it has been gone through
+    assert unpack_ctxs[0].listing is None
+
+
+def _recursive_unpack_classify_isos_side_effect(*args, **kwargs):
+    file_meta = _recursive_unpack_classify_entry_side_effect(*args, **kwargs)
+    if file_meta.filetype == FileType.TAR:
+        file_meta.filetype = FileType.ISO
+    return file_meta
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_mount_slots_given_up(mock_contexts, mock_walker, mock_file_data,
+                                               mock_mount_tools, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions
+    from clamav_large_archive_scanner.lib.mount_slots import MountSlots
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_file_data.classify_entry.side_effect = _recursive_unpack_classify_isos_side_effect
+    mock_listener = MagicMock()
+    slots = MountSlots(loop_limit=1)
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, unpack_jobs=unpack_jobs,
+                                   listener=mock_listener, options=UnpackOptions(mount_slots=slots))
+
+    # Nothing cleans up the first ISO before the end, so there is never a loop device for the second one
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR]
+    mock_mount_tools.mount_iso.assert_called_once_with(VALID_ARCHIVE_1, VALID_ARCHIVE_1_UNPACK_DIR)
+    assert mock_listener.on_unpack_failed.call_args[0][0].file_meta.path == VALID_ARCHIVE_2
+    assert slots.given_up_count == 1
+
+    # Left for clamd to scan as it is
+    assert unpack_ctxs[0].covered_paths == {VALID_ARCHIVE_1}
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_mount_slots_waits(mock_contexts, mock_walker, mock_file_data,
+                                            mock_mount_tools, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions
+    from clamav_large_archive_scanner.lib.mount_slots import MountSlots
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_file_data.classify_entry.side_effect = _recursive_unpack_classify_isos_side_effect
+    slots = MountSlots(loop_limit=1)
+    slots.set_releasing(True)
+    mounted = []
+
+    def _mount_iso_side_effect(file_path, mount_point):
+        # Whoever cleans up gets to the first ISO a little later, and gives its loop device back
+        mounted.append(file_path)
+        if file_path == VALID_ARCHIVE_1:
+            first_ctx = next(x for x in slots._holders.keys() if x.file_meta.path == VALID_ARCHIVE_1)
+            threading.Timer(0.2, slots.release, [first_ctx]).start()
+
+    mock_mount_tools.mount_iso.side_effect = _mount_iso_side_effect
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, unpack_jobs=unpack_jobs,
+                                   options=UnpackOptions(mount_slots=slots))
+
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR,
+                                                              VALID_ARCHIVE_2_UNPACK_DIR]
+    assert mounted == [VALID_ARCHIVE_1, VALID_ARCHIVE_2]
+    assert slots.wait_count == 1
+    assert slots.given_up_count == 0
+
+
+def _recursive_unpack_broken_archive_side_effect(*args, **kwargs):
+    if args[0] == VALID_ARCHIVE_1:
+        raise tarfile.ReadError('some_archive_exception')
+    return iter([])
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_broken_nested_archive(mock_contexts, mock_walker, mock_file_data,
+                                                mock_archive_members, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_archive_members.iter_members.side_effect = _recursive_unpack_broken_archive_side_effect
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, unpack_jobs=unpack_jobs)
+
+    # A broken nested archive is skipped, everything else still gets unpacked
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_2_UNPACK_DIR]
+
+    # The broken one still has to be scanned as is
+    assert unpack_ctxs[0].covered_paths == {VALID_ARCHIVE_2}
+
+
+def _setup_in_place_mocks(mock_os, mock_file_data, mock_archive_members, mock_walker, broken_paths: list):
+    def _iter_members_side_effect(path, filetype, view):
+        if path in broken_paths:
+            raise tarfile.ReadError('some_tar_error')
+        if path == PARENT_ARCHIVE:
+            return iter([ArchiveMember('valid_archive_1.tar', EXPECTED_MIN_FILE_SIZE,
+                                       io.BytesIO(b'TAR!' + b'x' * (EXPECTED_MIN_FILE_SIZE - 4)), 1536)])
+        return iter([])
+
+    _setup_streaming_mocks(mock_os, mock_file_data, mock_archive_members, [])
+    mock_archive_members.iter_members.side_effect = _iter_members_side_effect
+    mock_file_data.classify_view.side_effect = _classify_view_side_effect
+    mock_file_data.FileView = FileView
+    # Only the views are nested archives, nothing on disk is
+    mock_walker.walk.side_effect = None
+    mock_walker.walk.return_value = []
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_in_place(mock_contexts, mock_walker, mock_file_data, mock_os,
+                                   mock_archive_members, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    _setup_in_place_mocks(mock_os, mock_file_data, mock_archive_members, mock_walker, [])
+    parent_archive_meta = _parent_archive_metadata()
+    parent_archive_meta.size_raw = 10 * EXPECTED_MIN_FILE_SIZE
+
+    unpack_ctxs = unpack_recursive(parent_archive_meta, EXPECTED_MIN_FILE_SIZE, EXPECTED_TMP_DIR_PARENT,
+                                   unpack_jobs=unpack_jobs, options=UnpackOptions(in_place=True))
+
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR]
+
+    # Read from right where it is in the parent, which has to stay put until it is done
+    nested_view = unpack_ctxs[1].file_meta.view
+    assert (nested_view.source_path, nested_view.offset) == (PARENT_ARCHIVE, 1536)
+    assert unpack_ctxs[1].parent_ctx == unpack_ctxs[0]
+    assert unpack_ctxs[0].depends_on_source
+    mock_archive_members.iter_members.assert_has_calls([call(PARENT_ARCHIVE, FileType.TAR, None),
+                                                        call(VALID_ARCHIVE_1, FileType.TAR, nested_view)])
+    mock_archive_members.extract_member.assert_not_called()
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_in_place_broken(mocker: MockerFixture, mock_contexts, mock_walker,
+                                          mock_file_data, mock_os, mock_archive_members, unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, UnpackOptions
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    _setup_in_place_mocks(mock_os, mock_file_data, mock_archive_members, mock_walker, [VALID_ARCHIVE_1])
+    mock_view_open = mocker.patch.object(FileView, 'open')
+    mock_archive_members.extract_member.return_value = VALID_ARCHIVE_1
+    mock_listener = MagicMock()
+    parent_archive_meta = _parent_archive_metadata()
+    parent_archive_meta.size_raw = 10 * EXPECTED_MIN_FILE_SIZE
+
+    def _unpack_context_ctor_side_effect(*args, **kwargs):
+        u_ctx = _recursive_unpack_unpack_context_ctor_side_effect(*args, **kwargs)
+        u_ctx.inventory = []
+        return u_ctx
+
+    mock_contexts.UnpackContext.side_effect = _unpack_context_ctor_side_effect
+
+    unpack_ctxs = unpack_recursive(parent_archive_meta, EXPECTED_MIN_FILE_SIZE, EXPECTED_TMP_DIR_PARENT,
+                                   unpack_jobs=unpack_jobs, listener=mock_listener,
+                                   options=UnpackOptions(in_place=True))
+
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR]
+    assert mock_listener.on_unpack_failed.call_args[0][0].file_meta.path == VALID_ARCHIVE_1
+
+    # clamd still has to scan it as it is, so it gets extracted, and scanned along with its parent
+    mock_view_open.assert_called_once_with()
+    mock_archive_members.ArchiveMember.assert_called_once_with(VALID_ARCHIVE_1, EXPECTED_MIN_FILE_SIZE,
+                                                               mock_view_open.return_value.__enter__.return_value)
+    assert mock_archive_members.extract_member.call_args[0][1] == VALID_ARCHIVE_1
+    assert [x.path for x in unpack_ctxs[0].inventory] == [VALID_ARCHIVE_1]
+
+
+@pytest.mark.parametrize('unpack_jobs', [1, 4])
+def test_unpack_recursive_listener(mock_contexts, mock_walker, mock_file_data, mock_archive_members,
+                                   unpack_jobs):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    _setup_recursive_unpack_mocks(mock_contexts, mock_walker, mock_file_data)
+    mock_archive_members.iter_members.side_effect = _recursive_unpack_broken_archive_side_effect
+    mock_listener = MagicMock()
+
+    unpack_ctxs = unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, unpack_jobs=unpack_jobs,
+                                   listener=mock_listener)
+
+    # Everything that was unpacked gets reported, archives that could not be unpacked don't
+    mock_listener.on_unpacked.assert_has_calls([call(x) for x in unpack_ctxs], any_order=True)
+    assert mock_listener.on_unpacked.call_count == len(unpack_ctxs)
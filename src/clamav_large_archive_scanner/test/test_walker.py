@@ -0,0 +1,223 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.file_data import FileType
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_tree(tmp_path):
+    # tmp_path
+    #     |- top_file
+    #     |- a_dir
+    #         |- a_file
+    #         |- deeper
+    #             |- deep_file
+    #     |- b_dir
+    #         |- b_file
+    #     |- dir_link -> a_dir
+    #     |- file_link -> top_file
+    #     |- broken_link -> nowhere
+    #     |- a_fifo
+    (tmp_path / 'a_dir' / 'deeper').mkdir(parents=True)
+    (tmp_path / 'b_dir').mkdir()
+    for path in ['top_file', 'a_dir/a_file', 'a_dir/deeper/deep_file', 'b_dir/b_file']:
+        (tmp_path / path).write_text('some data')
+
+    (tmp_path / 'dir_link').symlink_to(tmp_path / 'a_dir')
+    (tmp_path / 'file_link').symlink_to(tmp_path / 'top_file')
+    (tmp_path / 'broken_link').symlink_to(tmp_path / 'nowhere')
+    os.mkfifo(tmp_path / 'a_fifo')
+
+
+def _os_walk_files(top: str) -> list:
+    return [(root, sorted(os.path.join(root, file) for file in files)) for root, _, files in os.walk(top)]
+
+
+def _walker_files(top: str) -> list:
+    from clamav_large_archive_scanner.lib.walker import walk
+
+    return [(root, sorted(entry.path for entry in entries)) for root, entries in walk(top)]
+
+
+def test_walk_same_as_os_walk(tmp_path):
+    _make_tree(tmp_path)
+
+    walked = _walker_files(str(tmp_path))
+
+    # Same directories, in the same order, with the same files in them, and nothing through dir_link
+    assert walked == _os_walk_files(str(tmp_path))
+    assert sorted(root for root, _ in walked) == [str(tmp_path / path) for path in ['', 'a_dir', 'a_dir/deeper',
+                                                                                  'b_dir']]
+    assert walked[0][1] == sorted(str(tmp_path / path) for path in ['top_file', 'file_link', 'broken_link', 'a_fifo'])
+
+
+def test_walk_entries_classify_like_paths(tmp_path):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry, classify_file
+    from clamav_large_archive_scanner.lib.walker import walk
+
+    _make_tree(tmp_path)
+
+    for _, entries in walk(str(tmp_path)):
+        for entry in entries:
+            from_entry = classify_entry(entry, 0)
+            from_path = classify_file(entry.path, 0)
+
+            assert (from_entry.filetype, from_entry.desc, from_entry.size_raw) == \
+                   (from_path.filetype, from_path.desc, from_path.size_raw)
+
+    walked = {entry.name: classify_entry(entry, 0) for entry in next(iter(walk(str(tmp_path))))[1]}
+    assert walked['file_link'].filetype == FileType.UNKNOWN
+    assert walked['broken_link'].filetype == FileType.DOES_NOT_EXIST
+    assert walked['a_fifo'].filetype == FileType.UNKNOWN
+
+
+def test_walk_unreadable_dir(tmp_path):
+    from clamav_large_archive_scanner.lib.walker import walk
+
+    errors = []
+
+    # Same as a directory that went away, or can't be read, after its parent was
+    assert list(walk(str(tmp_path / 'nowhere'), onerror=errors.append)) == []
+    assert len(errors) == 1
+    assert isinstance(errors[0], FileNotFoundError)
+
+    # Without onerror, the error is dropped, same as os.walk
+    assert list(walk(str(tmp_path / 'nowhere'))) == []
+
+
+def _make_wide_tree(tmp_path):
+    # Enough directories, at different depths, for the threads to have to steal from each other
+    for index in range(50):
+        a_dir = tmp_path / f'dir_{index}' / 'sub' / f'deeper_{index % 3}'
+        a_dir.mkdir(parents=True)
+        for file_index in range(index % 5):
+            (a_dir / f'file_{file_index}').write_text('some data')
+        (tmp_path / f'dir_{index}' / 'top_file').write_text('some data')
+
+
+@pytest.mark.parametrize('threads', [2, 8])
+def test_walk_threads_same_as_serial(tmp_path, threads):
+    from clamav_large_archive_scanner.lib.walker import walk
+    _make_tree(tmp_path)
+    _make_wide_tree(tmp_path)
+
+    serial = [(root, [entry.path for entry in entries]) for root, entries in walk(str(tmp_path))]
+    walked = [(root, [entry.path for entry in entries]) for root, entries in walk(str(tmp_path), threads=threads)]
+
+    # Same directories, and files, in the same order
+    assert walked == serial
+
+
+def test_walk_threads_prefetches_stats(tmp_path):
+    from clamav_large_archive_scanner.lib.file_data import classify_entry
+    from clamav_large_archive_scanner.lib.walker import walk
+    _make_tree(tmp_path)
+
+    top_files = {entry.name: entry for entry in next(iter(walk(str(tmp_path), threads=2)))[1]}
+
+    # The stats are already in the entries, so they are there even once the files are gone
+    for path in ['top_file', 'file_link']:
+        os.remove(tmp_path / path)
+
+    # Big enough for the file not to be opened
+    assert classify_entry(top_files['top_file'], 1024).size_raw == len('some data')
+    assert classify_entry(top_files['file_link'], 0).filetype == FileType.UNKNOWN
+
+
+def test_walk_threads_unreadable_dir(tmp_path):
+    from clamav_large_archive_scanner.lib.walker import walk
+    _make_tree(tmp_path)
+
+    errors = []
+    walked = []
+    for root, entries in walk(str(tmp_path), onerror=errors.append, threads=4):
+        walked.append(root)
+        if root == str(tmp_path):
+            # Gone before the walk gets to it
+            os.rename(tmp_path / 'b_dir', tmp_path / 'moved_dir')
+
+    # Whether b_dir had already been read is up to the threads, either way the walk gets through the rest of the tree
+    assert str(tmp_path / 'a_dir' / 'deeper') in walked
+    assert len(errors) + walked.count(str(tmp_path / 'b_dir')) == 1
+
+    errors = []
+    assert list(walk(str(tmp_path / 'nowhere'), onerror=errors.append, threads=4)) == []
+    assert len(errors) == 1
+
+
+def test_walk_threads_results_bounded(tmp_path):
+    import time
+    from clamav_large_archive_scanner.lib.walker import walk, _ParallelWalk, _RESULTS_PER_THREAD
+    _make_wide_tree(tmp_path)
+
+    parallel_walk = _ParallelWalk(str(tmp_path), 2)
+    walked = []
+    most_results = 0
+    for root, entries in parallel_walk.walk(None):
+        walked.append((root, [entry.path for entry in entries]))
+        # A slow walker, which the threads would otherwise get far ahead of
+        time.sleep(0.002)
+        most_results = max(most_results, len(parallel_walk._results))
+
+    # Plus the one that the walker was waiting on
+    assert most_results <= 2 * _RESULTS_PER_THREAD + 1
+    assert walked == [(root, [entry.path for entry in entries]) for root, entries in walk(str(tmp_path))]
+
+
+def test_walk_threads_stopped_early(tmp_path):
+    import threading
+    from clamav_large_archive_scanner.lib.walker import walk
+    _make_wide_tree(tmp_path)
+
+    walk_iter = walk(str(tmp_path), threads=4)
+    next(walk_iter)
+    walk_iter.close()
+
+    # Giving up on the walk takes the threads down with it
+    assert [thread for thread in threading.enumerate() if thread.name.startswith('walk_')] == []
+
+
+def test_walk_threads_failure(tmp_path, mocker):
+    from clamav_large_archive_scanner.lib.walker import walk
+    _make_wide_tree(tmp_path)
+
+    # Anything but an OSError is a bug, and has to come out of the walk instead of getting lost on a thread
+    mocker.patch('clamav_large_archive_scanner.lib.walker._prefetch_stats', side_effect=ValueError('some_bug'))
+
+    with pytest.raises(ValueError, match='some_bug'):
+        list(walk(str(tmp_path), threads=4))
@@ -0,0 +1,325 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+import zipfile
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+
+EXPECTED_FILES = {
+    'top_level.txt': (b'some top level file' * 100, zipfile.ZIP_DEFLATED),
+    'stored.bin': (b'some stored file', zipfile.ZIP_STORED),
+    'some_dir/bzip2.txt': (b'some bzip2 file' * 100, zipfile.ZIP_BZIP2),
+    'some_dir/lzma.txt': (b'some lzma file' * 100, zipfile.ZIP_LZMA),
+    'some_dir/ünïcödé.txt': (b'some file with a utf-8 name', zipfile.ZIP_DEFLATED),
+    'some_dir/empty.txt': (b'', zipfile.ZIP_STORED),
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_zip(path: str, comment: bytes = b''):
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        zip_file.comment = comment
+        zip_file.writestr('some_dir/', b'')
+        for name, (data, compression) in EXPECTED_FILES.items():
+            zip_file.writestr(name, data, compress_type=compression)
+
+
+def _read_files(path: str, offset: int = 0, length: int = None) -> dict:
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    files = {}
+    with ZipArchive(path, offset, length) as archive:
+        for entry in archive.iter_entries():
+            if entry.is_dir():
+                continue
+            with archive.open_entry(entry) as f:
+                data = f.read()
+            assert entry.file_size == len(data)
+            files[entry.name] = data
+
+    return files
+
+
+def _expected_data() -> dict:
+    return {name: data for name, (data, _) in EXPECTED_FILES.items()}
+
+
+def test_iter_entries(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path)
+
+    assert _read_files(zip_path) == _expected_data()
+
+    # Directories are listed too, in the order the central directory has them
+    with ZipArchive(zip_path) as archive:
+        entries = list(archive.iter_entries())
+    assert [x.name for x in entries] == ['some_dir/'] + list(EXPECTED_FILES.keys())
+    assert [x.is_dir() for x in entries] == [True] + [False] * len(EXPECTED_FILES)
+    assert [x.is_stored() for x in entries[1:]] == [x[1] == zipfile.ZIP_STORED for x in EXPECTED_FILES.values()]
+
+
+def test_comment_and_stub(tmp_path):
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path, comment=b'PK\x05\x06 some comment that looks like the start of an end record')
+
+    with open(zip_path, 'rb') as f:
+        zip_data = f.read()
+
+    # Self extracting archives have their stub in front, none of the offsets in the archive take it into account
+    stub_path = str(tmp_path / 'some_archive.exe')
+    with open(stub_path, 'wb') as f:
+        f.write(b'MZ some stub' * 1000 + zip_data)
+
+    assert _read_files(zip_path) == _expected_data()
+    assert _read_files(stub_path) == _expected_data()
+
+
+def test_archive_offset(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path)
+    with open(zip_path, 'rb') as f:
+        zip_data = f.read()
+
+    # The archive is stored inside of another file, like a member of a tar, with something else after it
+    outer_path = str(tmp_path / 'outer')
+    with open(outer_path, 'wb') as f:
+        f.write(b'\xaa' * 1536 + zip_data + b'\xbb' * 1536)
+
+    assert _read_files(outer_path, 1536, len(zip_data)) == _expected_data()
+
+    # Where the stored entries are is from the start of the archive
+    with ZipArchive(outer_path, 1536, len(zip_data)) as archive:
+        entry = next(x for x in archive.iter_entries() if x.name == 'stored.bin')
+        data_offset = archive.data_offset(entry)
+    assert zip_data[data_offset:data_offset + entry.file_size] == b'some stored file'
+
+
+def test_zip64(tmp_path, mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    # Not worth writing out GiBs for, so zipfile is made to think that everything is too big for a plain ZIP
+    mocker.patch('zipfile.ZIP64_LIMIT', 8)
+    mocker.patch('zipfile.ZIP_FILECOUNT_LIMIT', 2)
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path)
+    mocker.stopall()
+
+    with open(zip_path, 'rb') as f:
+        zip_data = f.read()
+    assert b'PK\x06\x06' in zip_data
+    assert b'PK\x06\x07' in zip_data
+
+    assert _read_files(zip_path) == _expected_data()
+
+    # The offsets and sizes in the headers themselves are all 0xFFFFFFFF
+    with ZipArchive(zip_path) as archive:
+        entry = list(archive.iter_entries())[-2]
+    assert entry.header_offset > 0xFF
+    assert entry.file_size == len(EXPECTED_FILES['some_dir/ünïcödé.txt'][0])
+
+
+def test_zip64_extra():
+    from clamav_large_archive_scanner.lib.zip_directory import _apply_zip64_extra
+
+    extra = struct.pack('<2H2Q', 0x5455, 16, 1, 2) + struct.pack('<2H2Q', 0x0001, 16, 5 * 2 ** 32, 6 * 2 ** 32)
+
+    # Only what didn't fit is in there, in order
+    assert _apply_zip64_extra(extra, 0xFFFFFFFF, 1234, 0xFFFFFFFF) == (5 * 2 ** 32, 1234, 6 * 2 ** 32)
+    assert _apply_zip64_extra(extra, 12, 34, 56) == (12, 34, 56)
+
+    with pytest.raises(zipfile.BadZipFile):
+        _apply_zip64_extra(extra, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF)
+
+
+def test_directory_read_in_chunks(tmp_path, mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for index in range(1000):
+            zip_file.writestr(f'some_dir/file_{index}', f'file {index}')
+
+    # Entries end up split across chunks, with whatever is left over of the last one carried into the next
+    mocker.patch('clamav_large_archive_scanner.lib.zip_directory.DIRECTORY_READ_SIZE', 100)
+    pread_spy = mocker.spy(ZipArchive, 'pread')
+
+    with ZipArchive(zip_path) as archive:
+        pread_spy.reset_mock()
+        names = []
+        for entry in archive.iter_entries():
+            with archive.open_entry(entry) as f:
+                assert f.read() == f'file {entry.name.split("_")[-1]}'.encode()
+            names.append(entry.name)
+
+    assert names == [f'some_dir/file_{index}' for index in range(1000)]
+    # Nothing but the chunk being parsed, and the local headers, is ever read out of the archive
+    assert max(x.args[1] for x in pread_spy.call_args_list) <= 100
+
+
+def test_not_a_zip(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    not_a_zip = tmp_path / 'not_a_zip'
+    not_a_zip.write_bytes(b'PK\x03\x04 not really a zip file' * 100)
+    with pytest.raises(zipfile.BadZipFile):
+        ZipArchive(str(not_a_zip))
+
+    too_short = tmp_path / 'too_short'
+    too_short.write_bytes(b'PK')
+    with pytest.raises(zipfile.BadZipFile):
+        ZipArchive(str(too_short))
+
+
+def test_truncated_directory(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = tmp_path / 'some_archive.zip'
+    _make_zip(str(zip_path))
+    zip_data = zip_path.read_bytes()
+
+    # The end record says the central directory is longer than what is in front of it
+    end_position = zip_data.rfind(b'PK\x05\x06')
+    directory_size, directory_offset = struct.unpack_from('<2L', zip_data, end_position + 12)
+    zip_path.write_bytes(zip_data[:end_position + 12] + struct.pack('<2L', directory_size + 100, directory_offset - 100)
+                         + zip_data[end_position + 20:])
+
+    with pytest.raises(zipfile.BadZipFile):
+        with ZipArchive(str(zip_path)) as archive:
+            list(archive.iter_entries())
+
+
+def test_bad_crc(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = tmp_path / 'some_archive.zip'
+    _make_zip(str(zip_path))
+    zip_path.write_bytes(zip_path.read_bytes().replace(b'some stored file', b'some STORED file'))
+
+    with ZipArchive(str(zip_path)) as archive:
+        entry = next(x for x in archive.iter_entries() if x.name == 'stored.bin')
+        with pytest.raises(zipfile.BadZipFile):
+            archive.open_entry(entry).read()
+
+
+def test_encrypted(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive, FLAG_ENCRYPTED
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path)
+
+    with ZipArchive(zip_path) as archive:
+        entry = next(x for x in archive.iter_entries() if x.name == 'stored.bin')
+        entry.flag_bits |= FLAG_ENCRYPTED
+
+        # Same as zipfile without a password, and never where it is, since what is there isn't what is in it
+        assert not entry.is_stored()
+        with pytest.raises(RuntimeError):
+            archive.open_entry(entry)
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3, 7])
+def test_shard_entries(tmp_path, shard_count):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+        # A few big entries in front, so that balancing on entry counts would get it wrong
+        for index in range(3):
+            zip_file.writestr(f'big_{index}', b'\0' * 100000)
+        for index in range(300):
+            zip_file.writestr(f'small_{index}', b'\0' * 1000)
+
+    with ZipArchive(zip_path) as archive:
+        all_names = [x.name for x in archive.iter_entries()]
+        shards = archive.shard_entries(shard_count)
+        shard_names = [[x.name for x in archive.iter_entries(shard)] for shard in shards]
+
+    # Every entry is in exactly one shard, in order
+    assert len(shards) == shard_count
+    assert sum(shard_names, []) == all_names
+    assert [x.entry_count for x in shards] == [len(x) for x in shard_names]
+
+    # The shards are back to back
+    for previous, shard in zip(shards, shards[1:]):
+        assert shard.directory_offset == previous.directory_offset + previous.directory_size
+
+    # And about as big as each other, with the big entries all on their own
+    total_size = sum(x.data_size for x in shards)
+    assert all(abs(x.data_size - total_size / shard_count) < 110000 for x in shards)
+    if shard_count == 7:
+        assert shard_names[:3] == [['big_0'], ['big_1'], ['big_2']]
+
+
+def test_shard_entries_few_entries(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path, comment=b'some comment')
+
+    # There is never a shard with nothing in it
+    with ZipArchive(zip_path) as archive:
+        shards = archive.shard_entries(100)
+    assert len(shards) == len(EXPECTED_FILES) + 1
+    assert all(x.entry_count == 1 for x in shards)
+
+    # And the shards can be read from another ZipArchive, like the ones the extract processes have
+    files = {}
+    for shard in shards:
+        with ZipArchive(zip_path) as archive:
+            for entry in archive.iter_entries(shard):
+                if not entry.is_dir():
+                    with archive.open_entry(entry) as f:
+                        files[entry.name] = f.read()
+    assert files == _expected_data()
+
+
+def test_shard_outside_directory(tmp_path):
+    from clamav_large_archive_scanner.lib.zip_directory import ZipArchive, ZipShard
+
+    zip_path = str(tmp_path / 'some_archive.zip')
+    _make_zip(zip_path)
+
+    with ZipArchive(zip_path) as archive:
+        shard = archive.shard_entries(1)[0]
+        with pytest.raises(ValueError):
+            archive.iter_entries(ZipShard(0, shard.directory_size, 1, 1))
+        with pytest.raises(ValueError):
+            archive.iter_entries(ZipShard(shard.directory_offset, shard.directory_size + 1, 1, 1))